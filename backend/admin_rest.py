@@ -2,14 +2,32 @@
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from typing import Optional, List, Union
+import os
 import secrets
+import shutil
+import tempfile
+import zipfile
 
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, UploadFile
 from sqlalchemy.orm import Session
 from sqlalchemy import func, or_, inspect
 from uuid import UUID
 from database import get_db
 from auth import get_current_user  # ВАЖНО: НЕ security
+from services import presence_tracker
+import http_cache
+import ws_outbox
+import tracking_ingest
+import track_positions
+import track_fanout
+import email_outbox
+import geo_cache
+import geo_providers
+import place_index
+import listing_search
+import places_import
+import scheduler_worker
+import auto_match_queue
 from models import (
     User as UserModel,
     UserRole,
@@ -170,6 +188,16 @@ def admin_stats(
         "transports_total": transports_total,
         "matches_7d": matches_7d,
         "tracking_active": tracking_active,
+        "http_cache": http_cache.stats(),
+        "ws_outbox": ws_outbox.stats(),
+        "tracking_ingest": tracking_ingest.stats(),
+        "track_positions": track_positions.stats(),
+        "track_fanout": track_fanout.stats(),
+        "email_outbox": email_outbox.stats(db),
+        "scheduler": scheduler_worker.stats(db),
+        "geo_providers": geo_providers.stats(),
+        "place_index": place_index.stats(),
+        "geo_cache": geo_cache.stats(),
         "generated_at": now.isoformat(),
     }
 
@@ -185,11 +213,31 @@ def admin_online_users(
         db.query(UserSession, UserModel)
         .join(UserModel, UserModel.id == UserSession.user_id)
         .filter(UserSession.last_seen_at >= cutoff)
-        .order_by(UserSession.last_seen_at.desc())
         .all()
     )
+    # Сессии из БД + ещё не сброшенная активность из буфера presence_tracker
+    seen = {
+        user.id: (user, session.last_seen_at, session.last_path)
+        for session, user in rows
+    }
+    buffered = {
+        uid: p for uid, p in presence_tracker.pending_snapshot().items()
+        if p["last_seen_at"] >= cutoff
+    }
+    missing = [uid for uid in buffered if uid not in seen]
+    extra_users = {
+        u.id: u for u in db.query(UserModel).filter(UserModel.id.in_(missing)).all()
+    } if missing else {}
+    for uid, p in buffered.items():
+        user = seen[uid][0] if uid in seen else extra_users.get(uid)
+        if user is None:
+            continue
+        if uid not in seen or (seen[uid][1] or datetime.min) < p["last_seen_at"]:
+            seen[uid] = (user, p["last_seen_at"], p["last_path"])
+
     users = []
-    for session, user in rows:
+    for user, last_seen_at, last_path in sorted(
+            seen.values(), key=lambda item: item[1] or datetime.min, reverse=True):
         role_val = getattr(user.role, "value", user.role)
         name = getattr(user, "name", None) or getattr(
             user, "contact_person", None) or getattr(user, "organization", None)
@@ -199,8 +247,8 @@ def admin_online_users(
             "name": name or user.email,
             "role": role_val,
             "phone": getattr(user, "phone", None),
-            "last_seen_at": session.last_seen_at.isoformat() if session.last_seen_at else None,
-            "last_path": session.last_path,
+            "last_seen_at": last_seen_at.isoformat() if last_seen_at else None,
+            "last_path": last_path,
         })
 
     return {
@@ -215,6 +263,12 @@ def admin_visit_stats(
     db: Session = Depends(get_db),
     _: UserModel = Depends(admin_required),
 ):
+    # Визиты определяются при сбросе буфера присутствия — сбрасываем перед подсчётом
+    try:
+        presence_tracker.flush()
+    except Exception as e:
+        print("[admin] presence flush failed:", e)
+
     now = datetime.utcnow()
     days = 30
     start_date = (now - timedelta(days=days - 1)).date()
@@ -248,6 +302,18 @@ def admin_visit_stats(
         "to": now.date().isoformat(),
         "days": stats,
     }
+
+
+@router.get("/stats/auto-match")
+def admin_auto_match_stats(
+    window_minutes: int = Query(60, ge=1, le=24 * 60),
+    db: Session = Depends(get_db),
+    _: UserModel = Depends(admin_required),
+):
+    """Глубина очереди авто-подбора и латентность задач (см. auto_match_queue)."""
+    out = auto_match_queue.metrics(db, window_minutes=window_minutes)
+    out["generated_at"] = datetime.utcnow().isoformat()
+    return out
 # ----- USERS LIST
 
 
@@ -457,13 +523,10 @@ def admin_orders(
     _: UserModel = Depends(admin_required),
 ):
     query = db.query(Order)
-    if q:
-        from sqlalchemy import or_
-        fields = ["title", "description",
-                  "from_city", "to_city", "contact_name"]
-        query = query.filter(or_(*[
-            getattr(Order, f).ilike(f"%{q}%") for f in fields if hasattr(Order, f)
-        ])) if any(hasattr(Order, f) for f in fields) else query
+    # Админка ищет и по title (в search_text его нет: q в /orders title не ищет)
+    cond = listing_search.any_filter("order", q, Order.title)
+    if cond is not None:
+        query = query.filter(cond)
     if is_active is not None and hasattr(Order, "is_active"):
         query = query.filter(Order.is_active == is_active)
     if status and hasattr(Order, "status"):
@@ -544,13 +607,9 @@ def admin_transports(
     _: UserModel = Depends(admin_required),
 ):
     query = db.query(Transport)
-    if q:
-        from sqlalchemy import or_
-        fields = ["title", "description",
-                  "from_city", "to_city", "driver_name"]
-        query = query.filter(or_(*[
-            getattr(Transport, f).ilike(f"%{q}%") for f in fields if hasattr(Transport, f)
-        ])) if any(hasattr(Transport, f) for f in fields) else query
+    cond = listing_search.any_filter("transport", q)
+    if cond is not None:
+        query = query.filter(cond)
     if is_active is not None and hasattr(Transport, "is_active"):
         query = query.filter(Transport.is_active == is_active)
     if status and hasattr(Transport, "status"):
@@ -677,6 +736,77 @@ def admin_tracking_revoke(session_id: str, db: Session = Depends(get_db), admin:
         db.rollback()
     return {"ok": True}
 
+# ===== ГАЗЕТТИР (PLACES) =====
+
+
+def _spool_upload(upload: UploadFile) -> str:
+    suffix = os.path.splitext(upload.filename or "")[1] or ".txt"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        shutil.copyfileobj(upload.file, tmp, 1 << 20)
+    return tmp.name
+
+
+@router.post("/places/import")
+def admin_places_import(
+    file: UploadFile = File(...),
+    format: str = Form("geonames"),
+    alternate_names: Optional[UploadFile] = File(None),
+    countries: Optional[str] = Form(None),
+    min_population: int = Form(0),
+    db: Session = Depends(get_db),
+    admin: UserModel = Depends(admin_required),
+):
+    """
+    Массовый импорт мест из дампа GeoNames/OSM (см. places_import).
+    Для дампов целых стран/регионов удобнее CLI: python places_import.py ...
+    """
+    if format not in ("geonames", "osm"):
+        raise HTTPException(400, "error.places.badFormat")
+    country_list = [c.strip().upper() for c in (countries or "").split(",") if c.strip()]
+    paths = []
+    try:
+        paths.append(_spool_upload(file))
+        if format == "geonames":
+            alt_path = None
+            if alternate_names is not None:
+                alt_path = _spool_upload(alternate_names)
+                paths.append(alt_path)
+            records = places_import.read_geonames(
+                paths[0], alt_path, country_list, min_population)
+        else:
+            records = places_import.read_osm(
+                paths[0], country_list[0] if country_list else None)
+        try:
+            res = places_import.import_records(records, db.get_bind())
+        except RuntimeError as e:
+            raise HTTPException(400, str(e))
+        except (ValueError, IndexError, OSError, zipfile.BadZipFile) as e:
+            print("[PLACES_IMPORT] bad file:", e)
+            raise HTTPException(400, "error.places.badFile")
+    finally:
+        for p in paths:
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+    # Индекс автокомплита этого воркера — сразу, остальные подтянут по updated_at
+    place_index.refresh(db)
+    try:
+        from models import AdminAction
+        db.add(AdminAction(
+            admin_user_id=admin.id,
+            action="PLACES_IMPORT",
+            target_type="places",
+            target_id=0,
+            payload_after=str({"format": format, "file": file.filename, **res}),
+        ))
+        db.commit()
+    except Exception:
+        db.rollback()
+    return res
+
+
 # ===== АУДИТ =====
 
 
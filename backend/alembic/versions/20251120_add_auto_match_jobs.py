@@ -0,0 +1,51 @@
+"""add auto_match_jobs queue table"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251120_add_auto_match_jobs"
+down_revision = "20251107_add_review_received_notification_type"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        sa.text(
+            """
+            CREATE TABLE IF NOT EXISTS auto_match_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                kind VARCHAR(16) NOT NULL,
+                entity_id VARCHAR(64) NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_after TIMESTAMP NOT NULL DEFAULT now(),
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                started_at TIMESTAMP NULL,
+                finished_at TIMESTAMP NULL,
+                locked_by VARCHAR(128) NULL,
+                last_error TEXT NULL
+            )
+            """
+        )
+    )
+    # Не больше одной ожидающей задачи на сущность (коалесинг повторных enqueue)
+    op.execute(
+        sa.text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_auto_match_jobs_pending "
+            "ON auto_match_jobs (kind, entity_id) WHERE status = 'pending'"
+        )
+    )
+    op.execute(
+        sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_auto_match_jobs_status_run_after "
+            "ON auto_match_jobs (status, run_after)"
+        )
+    )
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_auto_match_jobs_status_run_after"))
+    op.execute(sa.text("DROP INDEX IF EXISTS uq_auto_match_jobs_pending"))
+    op.execute(sa.text("DROP TABLE IF EXISTS auto_match_jobs"))
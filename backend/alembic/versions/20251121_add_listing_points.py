@@ -0,0 +1,125 @@
+"""listing_points: normalized pickup/delivery coordinates with earthdistance GiST index"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251121_add_listing_points"
+down_revision = "20251120_add_auto_match_jobs"
+branch_labels = None
+depends_on = None
+
+
+# Число в JSON-поле lat/lng (строка или number)
+_NUM_RE = r"^\s*-?[0-9]+(\.[0-9]+)?([eE][-+]?[0-9]+)?\s*$"
+
+
+def _valid(lat, lng):
+    return (
+        f"{lat} BETWEEN -90 AND 90 AND {lng} BETWEEN -180 AND 180 "
+        f"AND NOT ({lat} = 0 AND {lng} = 0)"
+    )
+
+
+def _json_points(owner_col, table, src, kind):
+    # Точки из jsonb-массива объектов {lat, lng}; idx — позиция в исходном массиве
+    return f"""
+        INSERT INTO listing_points ({owner_col}, kind, idx, lat, lng)
+        SELECT owner_id, '{kind}', idx, lat, lng FROM (
+            SELECT t.id AS owner_id,
+                   (e.ord - 1)::int AS idx,
+                   (e.val->>'lat')::double precision AS lat,
+                   (e.val->>'lng')::double precision AS lng
+              FROM {table} AS t
+             CROSS JOIN LATERAL jsonb_array_elements(
+                   CASE WHEN jsonb_typeof(t.{src}) = 'array' THEN t.{src} ELSE '[]'::jsonb END
+             ) WITH ORDINALITY AS e(val, ord)
+             WHERE jsonb_typeof(e.val) = 'object'
+               AND (e.val->>'lat') ~ '{_NUM_RE}'
+               AND (e.val->>'lng') ~ '{_NUM_RE}'
+        ) AS p
+        WHERE {_valid('lat', 'lng')}
+    """
+
+
+def upgrade():
+    op.execute(sa.text("CREATE EXTENSION IF NOT EXISTS cube"))
+    op.execute(sa.text("CREATE EXTENSION IF NOT EXISTS earthdistance"))
+
+    op.execute(
+        sa.text(
+            """
+            CREATE TABLE IF NOT EXISTS listing_points (
+                id BIGSERIAL PRIMARY KEY,
+                order_id INTEGER NULL REFERENCES orders(id) ON DELETE CASCADE,
+                transport_id UUID NULL REFERENCES transports(id) ON DELETE CASCADE,
+                kind VARCHAR(8) NOT NULL,
+                idx INTEGER NOT NULL DEFAULT 0,
+                lat DOUBLE PRECISION NOT NULL,
+                lng DOUBLE PRECISION NOT NULL,
+                CONSTRAINT ck_listing_points_owner
+                    CHECK ((order_id IS NULL) <> (transport_id IS NULL))
+            )
+            """
+        )
+    )
+    op.execute(sa.text(
+        "CREATE INDEX IF NOT EXISTS ix_listing_points_order_id ON listing_points (order_id)"))
+    op.execute(sa.text(
+        "CREATE INDEX IF NOT EXISTS ix_listing_points_transport_id ON listing_points (transport_id)"))
+
+    # --- Бэкфилл из существующих JSONB-полей ---
+    op.execute(sa.text("DELETE FROM listing_points"))
+    op.execute(sa.text(_json_points(
+        "order_id", "orders", "from_locations_coords", "from")))
+    op.execute(sa.text(_json_points(
+        "order_id", "orders", "to_locations_coords", "to")))
+
+    # Транспорт «откуда»: числовые колонки, иначе объект from_location_coords
+    op.execute(
+        sa.text(
+            f"""
+            INSERT INTO listing_points (transport_id, kind, idx, lat, lng)
+            SELECT id, 'from', 0, lat, lng FROM (
+                SELECT t.id,
+                       COALESCE(
+                           t.from_location_lat,
+                           CASE WHEN jsonb_typeof(t.from_location_coords) = 'object'
+                                 AND (t.from_location_coords->>'lat') ~ '{_NUM_RE}'
+                                THEN (t.from_location_coords->>'lat')::double precision
+                                WHEN jsonb_typeof(t.from_location_coords) = 'array'
+                                 AND (t.from_location_coords->0->>'lat') ~ '{_NUM_RE}'
+                                THEN (t.from_location_coords->0->>'lat')::double precision END
+                       ) AS lat,
+                       COALESCE(
+                           t.from_location_lng,
+                           CASE WHEN jsonb_typeof(t.from_location_coords) = 'object'
+                                 AND (t.from_location_coords->>'lng') ~ '{_NUM_RE}'
+                                THEN (t.from_location_coords->>'lng')::double precision
+                                WHEN jsonb_typeof(t.from_location_coords) = 'array'
+                                 AND (t.from_location_coords->0->>'lng') ~ '{_NUM_RE}'
+                                THEN (t.from_location_coords->0->>'lng')::double precision END
+                       ) AS lng
+                  FROM transports AS t
+            ) AS p
+            WHERE lat IS NOT NULL AND lng IS NOT NULL AND {_valid('lat', 'lng')}
+            """
+        )
+    )
+    op.execute(sa.text(_json_points(
+        "transport_id", "transports", "to_locations", "to")))
+
+    # Радиусный поиск: earth_box(...) @> ll_to_earth(lat, lng)
+    op.execute(
+        sa.text(
+            "CREATE INDEX IF NOT EXISTS ix_listing_points_earth "
+            "ON listing_points USING gist (ll_to_earth(lat, lng))"
+        )
+    )
+    op.execute(sa.text("ANALYZE listing_points"))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_listing_points_earth"))
+    op.execute(sa.text("DROP TABLE IF EXISTS listing_points"))
+    # Расширения cube/earthdistance не удаляем — ими могут пользоваться другие объекты
@@ -0,0 +1,87 @@
+"""typed DATE shadow columns for orders.load_date and transports.ready_date_*"""
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251122_add_typed_listing_dates"
+down_revision = "20251121_add_listing_points"
+branch_labels = None
+depends_on = None
+
+
+# Те же форматы, что models.parse_listing_date (модели в миграции не импортируем)
+_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d.%m.%Y")
+_BATCH = 1000
+
+
+def _parse(value):
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in _FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _backfill(bind, table, pairs):
+    """pairs: [(строковая колонка, DATE-колонка)]. Парсим в Python пачками по id."""
+    src_cols = ", ".join(src for src, _ in pairs)
+    set_clause = ", ".join(f"{dst} = :{dst}" for _, dst in pairs)
+    update = sa.text(f"UPDATE {table} SET {set_clause} WHERE id = :id")
+    last_id = None
+    while True:
+        if last_id is None:
+            rows = bind.execute(sa.text(
+                f"SELECT id, {src_cols} FROM {table} ORDER BY id LIMIT {_BATCH}"
+            )).fetchall()
+        else:
+            rows = bind.execute(sa.text(
+                f"SELECT id, {src_cols} FROM {table} WHERE id > :last "
+                f"ORDER BY id LIMIT {_BATCH}"
+            ), {"last": last_id}).fetchall()
+        if not rows:
+            break
+        params = []
+        for row in rows:
+            item = {"id": row[0]}
+            for i, (_, dst) in enumerate(pairs, start=1):
+                item[dst] = _parse(row[i])
+            params.append(item)
+        bind.execute(update, params)
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    op.add_column("orders", sa.Column("load_date_d", sa.Date(), nullable=True))
+    op.add_column("transports", sa.Column(
+        "ready_date_from_d", sa.Date(), nullable=True))
+    op.add_column("transports", sa.Column(
+        "ready_date_to_d", sa.Date(), nullable=True))
+
+    bind = op.get_bind()
+    _backfill(bind, "orders", [("load_date", "load_date_d")])
+    _backfill(bind, "transports", [
+        ("ready_date_from", "ready_date_from_d"),
+        ("ready_date_to", "ready_date_to_d"),
+    ])
+
+    op.create_index("ix_orders_load_date_d", "orders", ["load_date_d"])
+    op.create_index("ix_transports_ready_date_from_d",
+                    "transports", ["ready_date_from_d"])
+    op.create_index("ix_transports_ready_date_to_d",
+                    "transports", ["ready_date_to_d"])
+
+
+def downgrade():
+    op.drop_index("ix_transports_ready_date_to_d", table_name="transports")
+    op.drop_index("ix_transports_ready_date_from_d", table_name="transports")
+    op.drop_index("ix_orders_load_date_d", table_name="orders")
+    op.drop_column("transports", "ready_date_to_d")
+    op.drop_column("transports", "ready_date_from_d")
+    op.drop_column("orders", "load_date_d")
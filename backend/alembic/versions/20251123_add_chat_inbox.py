@@ -0,0 +1,93 @@
+"""chat_inbox: per-participant chat summaries for /my-chats"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251123_add_chat_inbox"
+down_revision = "20251122_add_typed_listing_dates"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE TABLE IF NOT EXISTS chat_inbox (
+            user_id           integer   NOT NULL,
+            chat_id           integer   NOT NULL REFERENCES chat(id) ON DELETE CASCADE,
+            last_message_id   integer,
+            last_message_at   timestamp,
+            last_message_type varchar(16),
+            last_preview      text,
+            unread_count      integer   NOT NULL DEFAULT 0,
+            activity_at       timestamp,
+            updated_at        timestamp,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """))
+    op.execute(sa.text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_inbox_chat_id ON chat_inbox (chat_id)"))
+    # Лента /my-chats: WHERE user_id = ? ORDER BY activity_at DESC, chat_id DESC
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_chat_inbox_user_activity
+            ON chat_inbox (user_id, activity_at DESC, chat_id DESC)
+         WHERE activity_at IS NOT NULL
+    """))
+
+    # Пересчёт сводки чата: последнее сообщение и непрочитанные
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_chat_message_chat_sent
+            ON chat_message (chat_id, sent_at DESC, id DESC)
+    """))
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_chat_message_chat_unread
+            ON chat_message (chat_id, sender_id)
+         WHERE is_read = false
+    """))
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_chat_participant_chat_user
+            ON chat_participant (chat_id, user_id)
+    """))
+
+    # Бэкфилл: тот же запрос, что chat_inbox.refresh(), по всем чатам
+    op.execute(sa.text("""
+        INSERT INTO chat_inbox (user_id, chat_id, last_message_id, last_message_at,
+                                last_message_type, last_preview, unread_count,
+                                activity_at, updated_at)
+        SELECT DISTINCT ON (p.user_id, p.chat_id)
+               p.user_id, p.chat_id,
+               lm.id, lm.sent_at, lm.message_type,
+               left(coalesce(lm.content, ''), 500),
+               coalesce(ur.n, 0),
+               CASE WHEN lm.id IS NOT NULL THEN lm.sent_at
+                    WHEN c.is_group THEN c.created_at
+               END,
+               now() AT TIME ZONE 'utc'
+          FROM chat_participant AS p
+          JOIN chat AS c ON c.id = p.chat_id
+          LEFT JOIN LATERAL (
+               SELECT m.id, m.sent_at, m.message_type, m.content
+                 FROM chat_message AS m
+                WHERE m.chat_id = p.chat_id
+                  AND (p.cleared_at IS NULL OR m.sent_at >= p.cleared_at)
+                ORDER BY m.sent_at DESC, m.id DESC
+                LIMIT 1
+          ) AS lm ON true
+          LEFT JOIN LATERAL (
+               SELECT count(*) AS n
+                 FROM chat_message AS m
+                WHERE m.chat_id = p.chat_id
+                  AND m.sender_id <> p.user_id
+                  AND m.is_read = false
+                  AND (p.cleared_at IS NULL OR m.sent_at >= p.cleared_at)
+          ) AS ur ON true
+         ORDER BY p.user_id, p.chat_id, p.id
+        ON CONFLICT (user_id, chat_id) DO NOTHING
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_chat_participant_chat_user"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_chat_message_chat_unread"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_chat_message_chat_sent"))
+    op.execute(sa.text("DROP TABLE IF EXISTS chat_inbox"))
@@ -0,0 +1,47 @@
+"""unread_counters: maintained unread counts for chats and auto-match notifications"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251124_add_unread_counters"
+down_revision = "20251123_add_chat_inbox"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE TABLE IF NOT EXISTS unread_counters (
+            user_id    integer     NOT NULL,
+            kind       varchar(16) NOT NULL,
+            key        varchar(64) NOT NULL DEFAULT '',
+            count      integer     NOT NULL DEFAULT 0,
+            updated_at timestamp,
+            PRIMARY KEY (user_id, kind, key)
+        )
+    """))
+    # reconcile(): выборка непрочитанных AUTO_MATCH по (user_id, related_id)
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_notifications_unread_auto_match
+            ON notifications (user_id, related_id)
+         WHERE type = 'AUTO_MATCH' AND read = false
+    """))
+
+    op.execute(sa.text("""
+        INSERT INTO unread_counters (user_id, kind, key, count, updated_at)
+        SELECT user_id, 'chats', '', sum(unread_count), now() AT TIME ZONE 'utc'
+          FROM chat_inbox
+         GROUP BY user_id
+        UNION ALL
+        SELECT user_id, 'match', related_id, count(*), now() AT TIME ZONE 'utc'
+          FROM notifications
+         WHERE type = 'AUTO_MATCH' AND read = false AND related_id IS NOT NULL
+         GROUP BY user_id, related_id
+        ON CONFLICT (user_id, kind, key) DO NOTHING
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_notifications_unread_auto_match"))
+    op.execute(sa.text("DROP TABLE IF EXISTS unread_counters"))
@@ -0,0 +1,135 @@
+"""tracking_points: monthly RANGE partitions on ts"""
+
+import os
+from datetime import date, datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251125_partition_tracking_points"
+down_revision = "20251124_add_unread_counters"
+branch_labels = None
+depends_on = None
+
+# Те же имена, что tracking_partitions.partition_name (модули в миграции не импортируем)
+_MONTHS_AHEAD = 2
+# Секции создаём не раньше этого горизонта: min(ts) может прийти от
+# устройства со сбитыми часами (1970), а цикл по месяцам от него создал бы
+# сотни пустых секций. Более старые точки уходят в tracking_points_default.
+# Горизонт — TRACK_RETENTION_DAYS, а если он 0 (хранить всё) —
+# TRACK_PARTITIONS_BACKFILL_MONTHS месяцев назад.
+_RETENTION_DAYS = int(os.getenv("TRACK_RETENTION_DAYS", "0") or "0")
+_BACKFILL_MONTHS = int(os.getenv("TRACK_PARTITIONS_BACKFILL_MONTHS", "24") or "24")
+_COLUMNS = "id, session_id, ts, lat, lng, speed, heading, accuracy, battery, source, meta"
+
+
+def _month(d):
+    return date(d.year, d.month, 1)
+
+
+def _next_month(d):
+    return date(d.year + (d.month // 12), d.month % 12 + 1, 1)
+
+
+def _prev_month(d):
+    return date(d.year - (d.month == 1), (d.month - 2) % 12 + 1, 1)
+
+
+def _earliest_month(now):
+    if _RETENTION_DAYS > 0:
+        return _month(now - timedelta(days=_RETENTION_DAYS))
+    month = _month(now)
+    for _ in range(max(0, _BACKFILL_MONTHS)):
+        month = _prev_month(month)
+    return month
+
+
+def _partition_name(d):
+    return f"tracking_points_p{d.year:04d}_{d.month:02d}"
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    op.execute(sa.text("ALTER TABLE tracking_points RENAME TO tracking_points_legacy"))
+    op.execute(sa.text(
+        "ALTER TABLE tracking_points_legacy RENAME CONSTRAINT tracking_points_pkey TO tracking_points_legacy_pkey"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_tracking_points_session_id"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_tracking_points_ts"))
+    op.execute(sa.text("ALTER SEQUENCE tracking_points_id_seq OWNED BY NONE"))
+
+    op.execute(sa.text("""
+        CREATE TABLE tracking_points (
+            id         integer   NOT NULL DEFAULT nextval('tracking_points_id_seq'),
+            session_id uuid      NOT NULL REFERENCES tracking_sessions(id) ON DELETE CASCADE,
+            ts         timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            lat        double precision NOT NULL,
+            lng        double precision NOT NULL,
+            speed      double precision,
+            heading    double precision,
+            accuracy   double precision,
+            battery    double precision,
+            source     varchar,
+            meta       jsonb,
+            PRIMARY KEY (id, ts)
+        ) PARTITION BY RANGE (ts)
+    """))
+    op.execute(sa.text(
+        "CREATE INDEX ix_tracking_points_session_ts ON tracking_points (session_id, ts)"))
+
+    oldest = bind.execute(sa.text("SELECT min(ts) FROM tracking_points_legacy")).scalar()
+    now = datetime.utcnow().date()
+    start = max(_month(oldest), _earliest_month(now)) if oldest else _month(now)
+    stop = _month(now)
+    for _ in range(_MONTHS_AHEAD):
+        stop = _next_month(stop)
+    month = start
+    while month <= stop:
+        op.execute(sa.text(f"""
+            CREATE TABLE IF NOT EXISTS {_partition_name(month)}
+                PARTITION OF tracking_points
+                FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')
+        """))
+        month = _next_month(month)
+    # Точки с явно неверным временем (часы устройства) не должны ломать вставку
+    op.execute(sa.text(
+        "CREATE TABLE IF NOT EXISTS tracking_points_default PARTITION OF tracking_points DEFAULT"))
+
+    op.execute(sa.text(f"""
+        INSERT INTO tracking_points ({_COLUMNS})
+        SELECT id, session_id, COALESCE(ts, now() AT TIME ZONE 'utc'), lat, lng,
+               speed, heading, accuracy, battery, source, meta
+          FROM tracking_points_legacy
+    """))
+    op.execute(sa.text("DROP TABLE tracking_points_legacy"))
+    op.execute(sa.text("ALTER SEQUENCE tracking_points_id_seq OWNED BY tracking_points.id"))
+
+
+def downgrade():
+    op.execute(sa.text("ALTER TABLE tracking_points RENAME TO tracking_points_partitioned"))
+    op.execute(sa.text("ALTER SEQUENCE tracking_points_id_seq OWNED BY NONE"))
+    op.execute(sa.text("""
+        CREATE TABLE tracking_points (
+            id         integer   NOT NULL DEFAULT nextval('tracking_points_id_seq') PRIMARY KEY,
+            session_id uuid      NOT NULL REFERENCES tracking_sessions(id) ON DELETE CASCADE,
+            ts         timestamp,
+            lat        double precision NOT NULL,
+            lng        double precision NOT NULL,
+            speed      double precision,
+            heading    double precision,
+            accuracy   double precision,
+            battery    double precision,
+            source     varchar,
+            meta       jsonb
+        )
+    """))
+    op.execute(sa.text(f"""
+        INSERT INTO tracking_points ({_COLUMNS})
+        SELECT {_COLUMNS} FROM tracking_points_partitioned
+    """))
+    op.execute(sa.text("DROP TABLE tracking_points_partitioned CASCADE"))
+    op.execute(sa.text("ALTER SEQUENCE tracking_points_id_seq OWNED BY tracking_points.id"))
+    op.execute(sa.text(
+        "CREATE INDEX ix_tracking_points_session_id ON tracking_points (session_id)"))
+    op.execute(sa.text("CREATE INDEX ix_tracking_points_ts ON tracking_points (ts)"))
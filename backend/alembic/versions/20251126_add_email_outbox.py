@@ -0,0 +1,47 @@
+"""email_outbox: transactional outbox for notification emails"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251126_add_email_outbox"
+down_revision = "20251125_partition_tracking_points"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id              bigserial   PRIMARY KEY,
+            kind            varchar(32) NOT NULL DEFAULT 'raw',
+            user_id         integer     REFERENCES users(id) ON DELETE CASCADE,
+            to_email        varchar,
+            subject         varchar,
+            html_body       text,
+            payload         jsonb,
+            status          varchar(16) NOT NULL DEFAULT 'pending',
+            attempts        integer     NOT NULL DEFAULT 0,
+            next_attempt_at timestamp   NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            locked_until    timestamp,
+            last_error      text,
+            created_at      timestamp   NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+            sent_at         timestamp
+        )
+    """))
+    # Выборка диспетчера: только неотправленные, по времени следующей попытки
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_email_outbox_due
+            ON email_outbox (next_attempt_at, id)
+         WHERE status IN ('pending', 'sending')
+    """))
+    # Очистка отправленных
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_email_outbox_sent_at
+            ON email_outbox (sent_at)
+         WHERE status = 'sent'
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP TABLE IF EXISTS email_outbox"))
@@ -0,0 +1,54 @@
+"""indexes for set-based listing expiry and per-day dedup of overdue notifications"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251127_listing_expiry_indexes"
+down_revision = "20251126_add_email_outbox"
+branch_labels = None
+depends_on = None
+
+# Типы, которые шлёт listing_expiry: <_KINDS префикс>_OVERDUE_<REMIND_DAYS> и _AUTO_DISABLED
+_TYPES = (
+    "'ORDER_OVERDUE_1', 'ORDER_OVERDUE_4', 'ORDER_OVERDUE_7', 'ORDER_AUTO_DISABLED', "
+    "'TRANSPORT_OVERDUE_1', 'TRANSPORT_OVERDUE_4', 'TRANSPORT_OVERDUE_7', 'TRANSPORT_AUTO_DISABLED'"
+)
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_orders_active_load_date_d
+            ON orders (load_date_d)
+         WHERE is_active = true
+    """))
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_transports_active_ready_end_d
+            ON transports ((COALESCE(ready_date_to_d, ready_date_from_d)))
+         WHERE is_active = true
+    """))
+
+    # Дубли за один день (старые проверки без блокировок) мешают уникальному
+    # индексу: удаляем только то, что он не пропустит. Строки с related_id NULL
+    # индекс не сравнивает (NULL различны) — их не трогаем.
+    op.execute(sa.text(f"""
+        DELETE FROM notifications AS n
+         USING notifications AS keep
+         WHERE n.type IN ({_TYPES})
+           AND keep.type = n.type
+           AND keep.user_id = n.user_id
+           AND keep.related_id = n.related_id
+           AND CAST(keep.created_at AS date) = CAST(n.created_at AS date)
+           AND keep.id < n.id
+    """))
+    op.execute(sa.text(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_notifications_listing_expiry_day
+            ON notifications (user_id, type, related_id, (CAST(created_at AS date)))
+         WHERE type IN ({_TYPES})
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS uq_notifications_listing_expiry_day"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_transports_active_ready_end_d"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_orders_active_load_date_d"))
@@ -0,0 +1,32 @@
+"""scheduler_job_stats: per-job run duration, failures and overlaps"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251128_add_scheduler_job_stats"
+down_revision = "20251127_listing_expiry_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE TABLE IF NOT EXISTS scheduler_job_stats (
+            job_id            varchar(128) PRIMARY KEY,
+            runs              integer   NOT NULL DEFAULT 0,
+            failures          integer   NOT NULL DEFAULT 0,
+            overlaps          integer   NOT NULL DEFAULT 0,
+            last_started_at   timestamp,
+            last_finished_at  timestamp,
+            last_duration_ms  integer,
+            max_duration_ms   integer,
+            total_duration_ms bigint    NOT NULL DEFAULT 0,
+            last_error        text,
+            instance          varchar(128)
+        )
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP TABLE IF EXISTS scheduler_job_stats"))
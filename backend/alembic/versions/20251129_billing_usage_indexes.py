@@ -0,0 +1,30 @@
+"""indexes for grouped billing usage snapshot (active transports per owner, employees per manager)"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251129_billing_usage_indexes"
+down_revision = "20251128_add_scheduler_job_stats"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # billing_tasks._usage_cte: LEFT JOIN transports ON owner_id AND is_active
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_transports_active_owner
+            ON transports (owner_id)
+         WHERE is_active = true
+    """))
+    # Сотрудники аккаунта (members)
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_users_manager_id
+            ON users (manager_id)
+         WHERE manager_id IS NOT NULL
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_users_manager_id"))
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_transports_active_owner"))
@@ -0,0 +1,31 @@
+"""places: population, place_type and updated_at for the in-memory prefix index"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251130_places_rank_columns"
+down_revision = "20251129_billing_usage_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("ALTER TABLE places ADD COLUMN IF NOT EXISTS population bigint"))
+    op.execute(sa.text("ALTER TABLE places ADD COLUMN IF NOT EXISTS place_type varchar(32)"))
+    op.execute(sa.text("""
+        ALTER TABLE places
+            ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL
+            DEFAULT (now() AT TIME ZONE 'utc')
+    """))
+    # place_index.refresh: изменения после прошлой загрузки
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_places_updated_at ON places (updated_at)
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP INDEX IF EXISTS ix_places_updated_at"))
+    op.execute(sa.text("ALTER TABLE places DROP COLUMN IF EXISTS updated_at"))
+    op.execute(sa.text("ALTER TABLE places DROP COLUMN IF EXISTS place_type"))
+    op.execute(sa.text("ALTER TABLE places DROP COLUMN IF EXISTS population"))
@@ -0,0 +1,31 @@
+"""geocode_cache: shared L2 cache of external geocoder responses"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251201_add_geocode_cache"
+down_revision = "20251130_places_rank_columns"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.text("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            key         varchar(512) PRIMARY KEY,
+            items       jsonb        NOT NULL,
+            fetched_at  timestamp    NOT NULL,
+            fresh_until timestamp    NOT NULL,
+            stale_until timestamp    NOT NULL
+        )
+    """))
+    # Очистка: order_reminders.purge_geocode_cache
+    op.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_geocode_cache_stale_until
+            ON geocode_cache (stale_until)
+    """))
+
+
+def downgrade():
+    op.execute(sa.text("DROP TABLE IF EXISTS geocode_cache"))
@@ -0,0 +1,69 @@
+"""orders/transports: search shadow columns with pg_trgm GIN indexes"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251202_listing_search_trgm"
+down_revision = "20251201_add_geocode_cache"
+branch_labels = None
+depends_on = None
+
+_COLUMNS = ("search_text", "search_from", "search_to")
+
+
+def _names(col):
+    # То же, что models.listing_location_names + join_search_values
+    return f"""
+        (SELECT string_agg(n, E'\\n')
+           FROM (SELECT btrim(CASE jsonb_typeof(e)
+                                  WHEN 'string' THEN e #>> '{{}}'
+                                  WHEN 'object' THEN COALESCE(
+                                      NULLIF(e->>'location', ''), NULLIF(e->>'name', ''),
+                                      e->>'address')
+                              END) AS n
+                   FROM jsonb_array_elements(
+                       CASE WHEN jsonb_typeof({col}) = 'array' THEN {col} ELSE '[]'::jsonb END
+                   ) AS e) AS s
+          WHERE n <> '')
+    """
+
+
+def _text(*cols):
+    parts = ", ".join(f"NULLIF(btrim({c}), '')" for c in cols)
+    return f"NULLIF(concat_ws(E'\\n', {parts}), '')"
+
+
+def upgrade():
+    op.execute(sa.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for table in ("orders", "transports"):
+        for col in _COLUMNS:
+            op.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} text"))
+
+    op.execute(sa.text(f"""
+        UPDATE orders
+           SET search_text = {_text("description", "truck_type", "comment")},
+               search_from = {_names("from_locations")},
+               search_to = {_names("to_locations")}
+    """))
+    op.execute(sa.text(f"""
+        UPDATE transports
+           SET search_text = {_text("truck_type", "transport_kind", "contact_name", "comment", "email")},
+               search_from = NULLIF(btrim(from_location), ''),
+               search_to = {_names("to_locations")}
+    """))
+
+    # gin_trgm_ops обслуживает ILIKE '%...%' и word_similarity
+    for table in ("orders", "transports"):
+        for col in _COLUMNS:
+            op.execute(sa.text(f"""
+                CREATE INDEX IF NOT EXISTS ix_{table}_{col}_trgm
+                    ON {table} USING gin ({col} gin_trgm_ops)
+            """))
+
+
+def downgrade():
+    for table in ("orders", "transports"):
+        for col in _COLUMNS:
+            op.execute(sa.text(f"DROP INDEX IF EXISTS ix_{table}_{col}_trgm"))
+            op.execute(sa.text(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {col}"))
@@ -0,0 +1,54 @@
+"""orders/transports: auto-match key columns (truck code, dates, geohash cells)"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251203_listing_match_keys"
+down_revision = "20251202_listing_search_trgm"
+branch_labels = None
+depends_on = None
+
+_COLUMNS = (
+    ("match_code", "varchar(32)"),
+    ("match_permanent", "boolean NOT NULL DEFAULT false"),
+    ("match_date_from", "date"),
+    ("match_date_to", "date"),
+    ("match_cells", "text[] NOT NULL DEFAULT '{}'"),
+    ("match_cover", "text[] NOT NULL DEFAULT '{}'"),
+    ("match_cities", "text[] NOT NULL DEFAULT '{}'"),
+    ("match_keys_at", "timestamp"),
+)
+_GIN = ("match_cells", "match_cover", "match_cities")
+
+
+def upgrade():
+    for table in ("orders", "transports"):
+        for col, ddl in _COLUMNS:
+            op.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} {ddl}"))
+
+        op.execute(sa.text(f"""
+            CREATE INDEX IF NOT EXISTS ix_{table}_match_code_date
+                ON {table} (match_code, match_date_from) WHERE is_active
+        """))
+        for col in _GIN:
+            op.execute(sa.text(f"""
+                CREATE INDEX IF NOT EXISTS ix_{table}_{col}
+                    ON {table} USING gin ({col})
+            """))
+        # Строки без ключей (match_keys_at IS NULL) дозаполняет
+        # match_index.backfill из планировщика: geohash в SQL не считаем
+        op.execute(sa.text(f"""
+            CREATE INDEX IF NOT EXISTS ix_{table}_match_keys_pending
+                ON {table} (id) WHERE match_keys_at IS NULL
+        """))
+
+
+def downgrade():
+    for table in ("orders", "transports"):
+        op.execute(sa.text(f"DROP INDEX IF EXISTS ix_{table}_match_keys_pending"))
+        for col in _GIN:
+            op.execute(sa.text(f"DROP INDEX IF EXISTS ix_{table}_{col}"))
+        op.execute(sa.text(f"DROP INDEX IF EXISTS ix_{table}_match_code_date"))
+        for col, _ in _COLUMNS:
+            op.execute(sa.text(f"ALTER TABLE {table} DROP COLUMN IF EXISTS {col}"))
@@ -0,0 +1,335 @@
+"""
+Очередь задач авто-подбора в Postgres (таблица auto_match_jobs).
+
+API-воркеры только кладут задачу (enqueue), а выполняет её долгоживущий
+пул auto_match_worker.py: задачи разбираются через FOR UPDATE SKIP LOCKED,
+поэтому несколько процессов/потоков пула не мешают друг другу.
+
+- коалесинг: на сущность хранится не больше одной pending-задачи
+  (частичный уникальный индекс uq_auto_match_jobs_pending);
+- пока по сущности идёт running-задача, следующая не берётся в работу;
+- ретраи с экспоненциальной задержкой, после AUTO_MATCH_JOB_MAX_ATTEMPTS — failed;
+- зависшие running (упал воркер) возвращаются в очередь по таймауту.
+"""
+from __future__ import annotations
+
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+# Задача не нужна: по той же сущности уже ждёт более свежая
+JOB_COALESCED = "coalesced"
+
+AUTO_MATCH_JOB_MAX_ATTEMPTS = int(
+    os.getenv("AUTO_MATCH_JOB_MAX_ATTEMPTS", "5") or "5")
+AUTO_MATCH_JOB_RETRY_BASE_SEC = float(
+    os.getenv("AUTO_MATCH_JOB_RETRY_BASE_SEC", "10") or "10")
+AUTO_MATCH_JOB_RETRY_MAX_SEC = float(
+    os.getenv("AUTO_MATCH_JOB_RETRY_MAX_SEC", "900") or "900")
+# Сколько может висеть running-задача, прежде чем её заберут заново
+AUTO_MATCH_JOB_TIMEOUT_SEC = int(
+    os.getenv("AUTO_MATCH_JOB_TIMEOUT_SEC", "600") or "600")
+# Сколько часов хранить завершённые задачи (для метрик латентности)
+AUTO_MATCH_JOB_RETENTION_HOURS = int(
+    os.getenv("AUTO_MATCH_JOB_RETENTION_HOURS", "72") or "72")
+
+JOB_KINDS = ("order", "transport")
+
+
+class Job:
+    __slots__ = ("id", "kind", "entity_id", "attempts", "created_at")
+
+    def __init__(self, id, kind, entity_id, attempts=0, created_at=None):
+        self.id = id
+        self.kind = kind
+        self.entity_id = entity_id
+        self.attempts = attempts
+        self.created_at = created_at
+
+    @classmethod
+    def from_row(cls, row) -> "Job":
+        return cls(row.id, row.kind, row.entity_id, row.attempts, row.created_at)
+
+
+def enqueue(db: Session, kind: str, entity_id, *, delay_sec: float = 0.0) -> bool:
+    """
+    Ставит задачу в очередь и коммитит. False — задача по сущности уже ждёт
+    (дубликат схлопнут).
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError(f"unknown auto-match job kind: {kind!r}")
+    now = datetime.utcnow()
+    res = db.execute(
+        text("""
+            INSERT INTO auto_match_jobs (kind, entity_id, status, attempts, run_after, created_at)
+            VALUES (:kind, :entity_id, :pending, 0, :run_after, :now)
+            ON CONFLICT (kind, entity_id) WHERE status = 'pending' DO NOTHING
+        """),
+        {
+            "kind": kind,
+            "entity_id": str(entity_id),
+            "pending": JOB_PENDING,
+            "run_after": now + timedelta(seconds=max(0.0, delay_sec)),
+            "now": now,
+        },
+    )
+    db.commit()
+    return bool(res.rowcount)
+
+
+def claim(db: Session, worker_id: str) -> Optional[Job]:
+    """Забирает одну готовую задачу (или None) и помечает её running."""
+    now = datetime.utcnow()
+    row = db.execute(
+        text("""
+            UPDATE auto_match_jobs AS j
+               SET status = :running,
+                   started_at = :now,
+                   attempts = j.attempts + 1,
+                   locked_by = :worker_id
+             WHERE j.id = (
+                   SELECT p.id
+                     FROM auto_match_jobs AS p
+                    WHERE p.status = :pending
+                      AND p.run_after <= :now
+                      AND NOT EXISTS (
+                          SELECT 1 FROM auto_match_jobs AS r
+                           WHERE r.kind = p.kind
+                             AND r.entity_id = p.entity_id
+                             AND r.status = :running
+                      )
+                    ORDER BY p.run_after, p.id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+             )
+            RETURNING j.id, j.kind, j.entity_id, j.attempts, j.created_at
+        """),
+        {"running": JOB_RUNNING, "pending": JOB_PENDING,
+            "now": now, "worker_id": worker_id},
+    ).first()
+    db.commit()
+    return Job.from_row(row) if row else None
+
+
+def complete(db: Session, job: Job) -> None:
+    db.execute(
+        text("""
+            UPDATE auto_match_jobs
+               SET status = :done, finished_at = :now, last_error = NULL
+             WHERE id = :id
+        """),
+        {"done": JOB_DONE, "now": datetime.utcnow(), "id": job.id},
+    )
+    db.commit()
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(AUTO_MATCH_JOB_RETRY_MAX_SEC,
+               AUTO_MATCH_JOB_RETRY_BASE_SEC * (2 ** max(0, attempts - 1)))
+
+
+def fail(db: Session, job: Job, error: str) -> None:
+    """Ошибка выполнения: повтор с backoff или окончательный failed."""
+    now = datetime.utcnow()
+    error = (error or "")[:2000]
+    if job.attempts >= AUTO_MATCH_JOB_MAX_ATTEMPTS:
+        db.execute(
+            text("""
+                UPDATE auto_match_jobs
+                   SET status = :failed, finished_at = :now, last_error = :error
+                 WHERE id = :id
+            """),
+            {"failed": JOB_FAILED, "now": now, "error": error, "id": job.id},
+        )
+        db.commit()
+        return
+
+    try:
+        res = db.execute(
+            text("""
+                UPDATE auto_match_jobs AS j
+                   SET status = :pending, run_after = :run_after,
+                       locked_by = NULL, last_error = :error
+                 WHERE j.id = :id
+                   AND NOT EXISTS (
+                       SELECT 1 FROM auto_match_jobs AS p
+                        WHERE p.kind = j.kind AND p.entity_id = j.entity_id
+                          AND p.status = :pending
+                   )
+            """),
+            {
+                "pending": JOB_PENDING,
+                "run_after": now + timedelta(seconds=_retry_delay(job.attempts)),
+                "error": error,
+                "id": job.id,
+            },
+        )
+        requeued = bool(res.rowcount)
+    except IntegrityError:
+        # enqueue параллельно вставил pending-задачу (NOT EXISTS её ещё не
+        # видел) — uq_auto_match_jobs_pending не даёт второй
+        db.rollback()
+        requeued = False
+    if not requeued:
+        # По сущности уже ждёт свежая задача — она и выполнит подбор
+        db.execute(
+            text("""
+                UPDATE auto_match_jobs
+                   SET status = :coalesced, finished_at = :now, last_error = :error
+                 WHERE id = :id
+            """),
+            {"coalesced": JOB_COALESCED, "now": now,
+                "error": error, "id": job.id},
+        )
+    db.commit()
+
+
+def requeue_stale(db: Session) -> int:
+    """Возвращает в очередь running-задачи, чей воркер пропал."""
+    now = datetime.utcnow()
+    params = {
+        "pending": JOB_PENDING,
+        "running": JOB_RUNNING,
+        "coalesced": JOB_COALESCED,
+        "cutoff": now - timedelta(seconds=AUTO_MATCH_JOB_TIMEOUT_SEC),
+        "now": now,
+    }
+    # Где уже есть свежая pending-задача — просто закрываем зависшую
+    db.execute(
+        text("""
+            UPDATE auto_match_jobs AS j
+               SET status = :coalesced, finished_at = :now
+             WHERE j.status = :running AND j.started_at < :cutoff
+               AND EXISTS (
+                   SELECT 1 FROM auto_match_jobs AS p
+                    WHERE p.kind = j.kind AND p.entity_id = j.entity_id
+                      AND p.status = :pending
+               )
+        """),
+        params,
+    )
+    db.commit()
+    try:
+        res = db.execute(
+            text("""
+                UPDATE auto_match_jobs
+                   SET status = :pending, run_after = :now, locked_by = NULL
+                 WHERE status = :running AND started_at < :cutoff
+            """),
+            params,
+        )
+        db.commit()
+    except IntegrityError:
+        # Между двумя UPDATE enqueue добавил pending по одной из сущностей:
+        # следующий проход закроет её зависшую задачу первым запросом
+        db.rollback()
+        return 0
+    return res.rowcount or 0
+
+
+def purge_finished(db: Session) -> int:
+    if AUTO_MATCH_JOB_RETENTION_HOURS <= 0:
+        return 0
+    res = db.execute(
+        text("""
+            DELETE FROM auto_match_jobs
+             WHERE status IN (:done, :coalesced, :failed)
+               AND finished_at < :cutoff
+        """),
+        {
+            "done": JOB_DONE,
+            "coalesced": JOB_COALESCED,
+            "failed": JOB_FAILED,
+            "cutoff": datetime.utcnow() - timedelta(hours=AUTO_MATCH_JOB_RETENTION_HOURS),
+        },
+    )
+    db.commit()
+    return res.rowcount or 0
+
+
+def run_job(db: Session, job: Job) -> None:
+    """Выполняет подбор по сущности задачи. Исчезнувшая сущность — не ошибка."""
+    from models import Order, Transport
+    from notifications import (
+        find_and_notify_auto_match_for_order,
+        find_and_notify_auto_match_for_transport,
+    )
+
+    if job.kind == "order":
+        order = db.query(Order).get(int(job.entity_id))
+        if not order:
+            print(f"[AUTO_MATCH_WORKER] order {job.entity_id} not found")
+            return
+        find_and_notify_auto_match_for_order(order, db, raise_errors=True)
+    elif job.kind == "transport":
+        transport = db.query(Transport).get(uuid.UUID(job.entity_id))
+        if not transport:
+            print(f"[AUTO_MATCH_WORKER] transport {job.entity_id} not found")
+            return
+        find_and_notify_auto_match_for_transport(transport, db, raise_errors=True)
+    else:
+        raise ValueError(f"unknown auto-match job kind: {job.kind!r}")
+
+
+def metrics(db: Session, *, window_minutes: int = 60) -> dict:
+    """Глубина очереди и латентность задач за последнее окно."""
+    now = datetime.utcnow()
+    counts = {
+        status: int(cnt)
+        for status, cnt in db.execute(
+            text("SELECT status, count(*) FROM auto_match_jobs GROUP BY status")
+        ).all()
+    }
+    oldest_pending = db.execute(
+        text("""
+            SELECT min(created_at) FROM auto_match_jobs
+             WHERE status = :pending AND run_after <= :now
+        """),
+        {"pending": JOB_PENDING, "now": now},
+    ).scalar()
+
+    lat = db.execute(
+        text("""
+            SELECT count(*) AS n,
+                   percentile_cont(0.5)  WITHIN GROUP (ORDER BY extract(epoch FROM started_at - created_at))  AS wait_p50,
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY extract(epoch FROM started_at - created_at))  AS wait_p95,
+                   percentile_cont(0.5)  WITHIN GROUP (ORDER BY extract(epoch FROM finished_at - started_at)) AS run_p50,
+                   percentile_cont(0.95) WITHIN GROUP (ORDER BY extract(epoch FROM finished_at - started_at)) AS run_p95,
+                   max(extract(epoch FROM finished_at - created_at)) AS total_max
+              FROM auto_match_jobs
+             WHERE status = :done AND finished_at >= :since
+        """),
+        {"done": JOB_DONE, "since": now - timedelta(minutes=window_minutes)},
+    ).first()
+
+    def _sec(v):
+        return round(float(v), 3) if v is not None else None
+
+    return {
+        "queue": {
+            "pending": counts.get(JOB_PENDING, 0),
+            "running": counts.get(JOB_RUNNING, 0),
+            "failed": counts.get(JOB_FAILED, 0),
+            "done": counts.get(JOB_DONE, 0),
+            "coalesced": counts.get(JOB_COALESCED, 0),
+            "oldest_pending_age_sec": _sec((now - oldest_pending).total_seconds()) if oldest_pending else None,
+        },
+        "latency": {
+            "window_minutes": window_minutes,
+            "completed": int(lat.n or 0) if lat else 0,
+            "wait_p50_sec": _sec(lat.wait_p50) if lat else None,
+            "wait_p95_sec": _sec(lat.wait_p95) if lat else None,
+            "run_p50_sec": _sec(lat.run_p50) if lat else None,
+            "run_p95_sec": _sec(lat.run_p95) if lat else None,
+            "total_max_sec": _sec(lat.total_max) if lat else None,
+        },
+    }
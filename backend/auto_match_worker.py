@@ -1,48 +1,134 @@
 # auto_match_worker.py
+"""
+Долгоживущий пул воркеров авто-подбора.
+
+Запуск (отдельный systemd-сервис, см. server-config/systemd/transinfo-auto-match.service):
+    python auto_match_worker.py --workers 4
+
+Воркеры разбирают задачи из auto_match_queue (таблица auto_match_jobs).
+Один процесс держит один пул соединений на все задачи,
+вместо отдельного python-процесса (и импорта main.py) на каждую заявку.
+
+Старый режим разового запуска сохранён:
+    python auto_match_worker.py --kind order --id 123
+"""
 import argparse
 import os
-import sys
+import signal
+import socket
+import threading
+import time
 
+import auto_match_queue
 from database import SessionLocal
-from models import Order as OrderModel, Transport as TransportModel
-from notifications import (
-    find_and_notify_auto_match_for_order,
-    find_and_notify_auto_match_for_transport,
-)
-from main import dbg_mem  # чтобы писать в тот же mem.log
 
+AUTO_MATCH_WORKERS = int(os.getenv("AUTO_MATCH_WORKERS", "2") or "2")
+AUTO_MATCH_POLL_SEC = float(os.getenv("AUTO_MATCH_POLL_SEC", "1.0") or "1.0")
+# Как часто возвращать зависшие задачи и чистить завершённые
+AUTO_MATCH_MAINTENANCE_SEC = int(
+    os.getenv("AUTO_MATCH_MAINTENANCE_SEC", "60") or "60")
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--kind", choices=["order", "transport"], required=True)
-    parser.add_argument("--id", required=True)
-    args = parser.parse_args()
 
+def _worker_loop(worker_id: str, stop: threading.Event) -> None:
+    print(f"[AUTO_MATCH_WORKER] {worker_id} started")
+    while not stop.is_set():
+        db = SessionLocal()
+        try:
+            job = auto_match_queue.claim(db, worker_id)
+            if job is None:
+                stop.wait(AUTO_MATCH_POLL_SEC)
+                continue
+            started = time.time()
+            try:
+                auto_match_queue.run_job(db, job)
+                auto_match_queue.complete(db, job)
+                print(
+                    f"[AUTO_MATCH_WORKER] {worker_id} job={job.id} "
+                    f"{job.kind}:{job.entity_id} done in {time.time() - started:.2f}s"
+                )
+            except Exception as e:
+                db.rollback()
+                print(
+                    f"[AUTO_MATCH_WORKER] {worker_id} job={job.id} "
+                    f"{job.kind}:{job.entity_id} attempt={job.attempts} failed: {e}"
+                )
+                auto_match_queue.fail(db, job, repr(e))
+        except Exception as e:
+            # Ошибки самой очереди (БД недоступна и т.п.) — ждём и пробуем снова
+            print(f"[AUTO_MATCH_WORKER] {worker_id} queue error: {e}")
+            try:
+                db.rollback()
+            except Exception:
+                pass
+            stop.wait(max(AUTO_MATCH_POLL_SEC, 5.0))
+        finally:
+            db.close()
+    print(f"[AUTO_MATCH_WORKER] {worker_id} stopped")
+
+
+def _maintenance_loop(stop: threading.Event) -> None:
+    while not stop.wait(AUTO_MATCH_MAINTENANCE_SEC):
+        db = SessionLocal()
+        try:
+            requeued = auto_match_queue.requeue_stale(db)
+            purged = auto_match_queue.purge_finished(db)
+            if requeued or purged:
+                print(
+                    f"[AUTO_MATCH_WORKER] maintenance: requeued={requeued} purged={purged}")
+        except Exception as e:
+            print("[AUTO_MATCH_WORKER] maintenance failed:", e)
+            db.rollback()
+        finally:
+            db.close()
+
+
+def run_pool(workers: int) -> None:
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        print(f"[AUTO_MATCH_WORKER] signal {signum}, stopping")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=_worker_loop, args=(
+            f"{prefix}:{i}", stop), daemon=True)
+        for i in range(max(1, workers))
+    ]
+    threads.append(threading.Thread(
+        target=_maintenance_loop, args=(stop,), daemon=True))
+    for t in threads:
+        t.start()
+    while not stop.is_set():
+        stop.wait(1.0)
+    for t in threads:
+        t.join(timeout=30)
+
+
+def run_once(kind: str, entity_id: str) -> None:
     db = SessionLocal()
     try:
-        if args.kind == "order":
-            order_id = int(args.id)
-            order = db.query(OrderModel).get(order_id)
-            if not order:
-                print(f"[AUTO_MATCH_WORKER] order {order_id} not found")
-                return
-            dbg_mem(f"worker(order {order_id}): before auto_match")
-            find_and_notify_auto_match_for_order(order, db)
-            dbg_mem(f"worker(order {order_id}): after auto_match")
-
-        elif args.kind == "transport":
-            transport_id = args.id
-            transport = db.query(TransportModel).get(transport_id)
-            if not transport:
-                print(f"[AUTO_MATCH_WORKER] transport {transport_id} not found")
-                return
-            dbg_mem(f"worker(transport {transport_id}): before auto_match")
-            find_and_notify_auto_match_for_transport(transport, db)
-            dbg_mem(f"worker(transport {transport_id}): after auto_match")
-
+        auto_match_queue.run_job(
+            db, auto_match_queue.Job(None, kind, entity_id, attempts=1))
     finally:
         db.close()
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kind", choices=["order", "transport"])
+    parser.add_argument("--id")
+    parser.add_argument("--workers", type=int, default=AUTO_MATCH_WORKERS)
+    args = parser.parse_args()
+
+    if args.kind and args.id:
+        run_once(args.kind, args.id)
+        return
+    run_pool(args.workers)
+
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,11 @@
 
-from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, date
+from typing import Dict, Iterable, Optional
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, text
 from database import SessionLocal
 from models import (
     User as UserModel, UserRole,
-    Transport as TransportModel,
     BillingUsageDaily, BillingPeriod, Subscription, SubscriptionStatus, Payment
 )
 from billing_calc import USD_SLOT_CENTS
@@ -15,46 +14,93 @@ import os
 import math
 
 
-def _account_user_ids(db: Session, account_id: int):
-    users = db.query(UserModel).filter(
-        (UserModel.id == account_id) | (UserModel.manager_id == account_id)
-    ).all()
-    return [u.id for u in users]
+# Аккаунт биллинга пользователя: EMPLOYEE с менеджером идёт в учёт менеджера
+_ACCOUNT_OF_USER = (
+    "CASE WHEN u.role = 'EMPLOYEE' AND u.manager_id IS NOT NULL "
+    "THEN u.manager_id ELSE u.id END")
+
+# Все аккаунты со снапшотом (MANAGER/TRANSPORT/EMPLOYEE)
+_ACCOUNTS_ALL = f"""
+    SELECT DISTINCT {_ACCOUNT_OF_USER} AS account_id
+      FROM users AS u
+     WHERE u.role IN ('MANAGER', 'TRANSPORT', 'EMPLOYEE')
+"""
+_ACCOUNTS_BY_ID = "SELECT DISTINCT unnest(CAST(:account_ids AS integer[])) AS account_id"
+
+
+def _usage_cte(accounts_sql: str) -> str:
+    """
+    CTE usage(account_id, active_count): активный транспорт аккаунта —
+    его собственный и его сотрудников (users.manager_id), один GROUP BY.
+    """
+    return f"""
+        accounts AS ({accounts_sql}),
+        members AS (
+            SELECT account_id, account_id AS user_id FROM accounts
+            UNION
+            SELECT a.account_id, m.id
+              FROM accounts AS a
+              JOIN users AS m ON m.manager_id = a.account_id
+        ),
+        usage AS (
+            SELECT mb.account_id, count(t.id) AS active_count
+              FROM members AS mb
+              LEFT JOIN transports AS t
+                ON t.owner_id = mb.user_id AND t.is_active = true
+             GROUP BY mb.account_id
+        )
+    """
+
+
+def active_transport_counts(db: Session, account_ids: Iterable[int]) -> Dict[int, int]:
+    """Текущее число активного транспорта по аккаунтам: {account_id: count}."""
+    ids = sorted({int(a) for a in account_ids})
+    if not ids:
+        return {}
+    rows = db.execute(
+        text(f"WITH {_usage_cte(_ACCOUNTS_BY_ID)} SELECT account_id, active_count FROM usage"),
+        {"account_ids": ids},
+    ).fetchall()
+    return {r[0]: int(r[1]) for r in rows}
+
+
+def snapshot_usage(db: Session, account_ids: Optional[Iterable[int]] = None,
+                   day: Optional[date] = None) -> int:
+    """
+    Снапшот usage за день одним INSERT ... ON CONFLICT: за день хранится
+    максимум. account_ids=None — все аккаунты. Не коммитит; возвращает число строк.
+    """
+    params = {"day": day or date.today(), "now": datetime.utcnow()}
+    if account_ids is None:
+        accounts = _ACCOUNTS_ALL
+    else:
+        params["account_ids"] = sorted({int(a) for a in account_ids})
+        if not params["account_ids"]:
+            return 0
+        accounts = _ACCOUNTS_BY_ID
+    res = db.execute(text(f"""
+        WITH {_usage_cte(accounts)}
+        INSERT INTO billing_usage_daily AS d (account_id, day, active_transport_count, created_at)
+        SELECT account_id, CAST(:day AS date), active_count, :now
+          FROM usage
+        ON CONFLICT (account_id, day) DO UPDATE
+           SET active_transport_count = GREATEST(d.active_transport_count,
+                                                 EXCLUDED.active_transport_count)
+    """), params)
+    return res.rowcount or 0
 
 
 def touch_usage_snapshot_for_user(db: Session, user_id: int):
     """
     Обновляет либо создаёт снапшот usage для аккаунта пользователя на сегодня.
     """
-    # Определяем "аккаунт" (менеджер для EMPLOYEE)
-    u = db.query(UserModel).filter(UserModel.id == user_id).first()
-    if not u:
-        return
-    account_id = u.manager_id if (
-        u.role == UserRole.EMPLOYEE and u.manager_id) else u.id
-    ids = _account_user_ids(db, account_id)
-
-    active_count = (
-        db.query(func.count(TransportModel.id))
-        .filter(TransportModel.owner_id.in_(ids))
-        .filter(TransportModel.is_active.is_(True))
-        .scalar()
-    ) or 0
-
-    today = date.today()
-    row = (
-        db.query(BillingUsageDaily)
-        .filter(BillingUsageDaily.account_id == account_id, BillingUsageDaily.day == today)
-        .first()
-    )
+    row = db.execute(
+        text(f"SELECT {_ACCOUNT_OF_USER} FROM users AS u WHERE u.id = :id"),
+        {"id": user_id},
+    ).first()
     if not row:
-        row = BillingUsageDaily(
-            account_id=account_id, day=today, active_transport_count=int(active_count))
-        db.add(row)
-    else:
-        # Сохраняем максимум за день
-        row.active_transport_count = max(
-            row.active_transport_count or 0, int(active_count))
+        return
+    snapshot_usage(db, [row[0]])
     db.commit()
 
 
@@ -62,49 +108,21 @@ def billing_snapshot_job():
     db = SessionLocal()
     try:
         # Снимок всем MANAGER/TRANSPORT/EMPLOYEE (идёт в учёт менеджера)
-        users = db.query(UserModel).filter(UserModel.role.in_(
-            [UserRole.MANAGER, UserRole.TRANSPORT, UserRole.EMPLOYEE])).all()
-        seen_accounts = set()
-        for u in users:
-            account_id = u.manager_id if (
-                u.role == UserRole.EMPLOYEE and u.manager_id) else u.id
-            if account_id in seen_accounts:
-                continue
-            seen_accounts.add(account_id)
-            ids = _account_user_ids(db, account_id)
-            active_count = (
-                db.query(func.count(TransportModel.id))
-                .filter(TransportModel.owner_id.in_(ids))
-                .filter(TransportModel.is_active.is_(True))
-                .scalar()
-            ) or 0
-            today = date.today()
-            row = (
-                db.query(BillingUsageDaily)
-                .filter(BillingUsageDaily.account_id == account_id, BillingUsageDaily.day == today)
-                .first()
-            )
-            if not row:
-                row = BillingUsageDaily(
-                    account_id=account_id, day=today, active_transport_count=int(active_count))
-                db.add(row)
-            else:
-                row.active_transport_count = max(
-                    row.active_transport_count or 0, int(active_count))
+        snapshot_usage(db)
         db.commit()
     except Exception as e:
+        db.rollback()
         print("[Billing snapshot error]", e)
     finally:
         db.close()
 
 
-def start_billing_scheduler():
-    sch = BackgroundScheduler()
+def register_billing_jobs(sch):
+    """Периодические задачи биллинга; запускает их scheduler_worker."""
     # Снимок пикового usage раз в 15 минут (надёжнее, чем 1 раз в день)
     sch.add_job(billing_snapshot_job, 'cron', minute='*/15')
     # Ежечасно проверяем закрытие периодов (в dev так удобнее; в проде можно раз в сутки)
     sch.add_job(ensure_periods_job, 'cron', minute='5')
-    sch.start()
 
 # ====== ПОДДЕРЖКА ПЕРИОДОВ И АДДОНОВ ======
 
@@ -144,13 +162,6 @@ def _open_or_create_period(db: Session, sub: Subscription) -> BillingPeriod:
     return period
 
 
-def _account_user_ids(db: Session, account_id: int):
-    users = db.query(UserModel).filter(
-        (UserModel.id == account_id) | (UserModel.manager_id == account_id)
-    ).all()
-    return [u.id for u in users]
-
-
 def _peak_active_transports(db: Session, account_id: int, start, end) -> int:
     q = (
         db.query(func.max(BillingUsageDaily.active_transport_count))
@@ -161,14 +172,7 @@ def _peak_active_transports(db: Session, account_id: int, start, end) -> int:
     mx = q.scalar() or 0
     # подстрахуемся: если снапшотов ещё нет, берём текущее фактическое число
     if mx == 0:
-        ids = _account_user_ids(db, account_id)
-        cur = (
-            db.query(func.count(TransportModel.id))
-            .filter(TransportModel.owner_id.in_(ids))
-            .filter(TransportModel.is_active.is_(True))
-            .scalar()
-        ) or 0
-        mx = int(cur)
+        mx = active_transport_counts(db, [account_id]).get(account_id, 0)
     return int(mx)
 
 
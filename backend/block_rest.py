@@ -3,6 +3,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from database import get_db
 from auth import get_current_user
+import http_cache
 from models import User as UserModel, UserBlock
 
 router = APIRouter()
@@ -52,4 +53,7 @@ def unblock_user(target_id: int, db: Session = Depends(get_db), current_user: Us
         UserBlock.blocked_id == target_id
     ).delete(synchronize_session=False)
     db.commit()
+    if deleted:
+        # Блок-лист фильтрует выдачу /orders и /transports
+        http_cache.invalidate("orders", "transports")
     return {"status": "ok", "deleted": bool(deleted)}
@@ -0,0 +1,234 @@
+"""
+Персональные сводки чатов (таблица chat_inbox) для /my-chats.
+
+Раньше /my-chats на каждый чат пользователя делал отдельные запросы за
+последним сообщением, числом непрочитанных, собеседником и владельцем
+тикета. Теперь на пару (user_id, chat_id) хранится готовая сводка:
+последнее видимое сообщение (с учётом cleared_at), превью, число
+непрочитанных и activity_at — ключ сортировки списка.
+
+Всё — в той же транзакции, что и изменение:
+- новое сообщение (самый частый случай) — append(): один UPDATE сводок
+  участников чата, unread_count += 1 у всех, кроме отправителя, без
+  пересчёта count(*) по истории;
+- прочтение, очистка истории, смена состава, правка/удаление сообщений —
+  refresh(): сводка пересчитывается целиком одним INSERT ... SELECT
+  (ON CONFLICT DO UPDATE).
+ORM-изменения ChatMessage / ChatParticipant ловит after_flush (install_hooks),
+bulk-операции (mark_read, remove_member) вызывают refresh() явно.
+Оба пути двигают счётчик непрочитанного ("chats") в unread_counters.
+"""
+from __future__ import annotations
+
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import unread_counters
+
+# Сколько символов последнего сообщения хранить для списка чатов
+LAST_PREVIEW_LEN = 500
+
+# old/upserted в одном statement видят один снимок: разница — дельта
+# непрочитанных по пользователю для unread_counters
+_REFRESH_SQL = text("""
+    WITH old AS (
+        SELECT user_id, unread_count FROM chat_inbox WHERE chat_id = ANY(:chat_ids)
+    ),
+    -- Участник вышел/удалён — его сводка больше не нужна
+    pruned AS (
+        DELETE FROM chat_inbox AS i
+         WHERE i.chat_id = ANY(:chat_ids)
+           AND NOT EXISTS (
+               SELECT 1 FROM chat_participant AS p
+                WHERE p.chat_id = i.chat_id AND p.user_id = i.user_id
+           )
+        RETURNING i.user_id
+    ),
+    upserted AS (
+        INSERT INTO chat_inbox (user_id, chat_id, last_message_id, last_message_at,
+                                last_message_type, last_preview, unread_count,
+                                activity_at, updated_at)
+        SELECT DISTINCT ON (p.user_id, p.chat_id)
+               p.user_id, p.chat_id,
+               lm.id, lm.sent_at, lm.message_type,
+               left(coalesce(lm.content, ''), :preview_len),
+               coalesce(ur.n, 0),
+               CASE WHEN lm.id IS NOT NULL THEN lm.sent_at
+                    WHEN c.is_group THEN c.created_at
+               END,
+               now() AT TIME ZONE 'utc'
+          FROM chat_participant AS p
+          JOIN chat AS c ON c.id = p.chat_id
+          LEFT JOIN LATERAL (
+               SELECT m.id, m.sent_at, m.message_type, m.content
+                 FROM chat_message AS m
+                WHERE m.chat_id = p.chat_id
+                  AND (p.cleared_at IS NULL OR m.sent_at >= p.cleared_at)
+                ORDER BY m.sent_at DESC, m.id DESC
+                LIMIT 1
+          ) AS lm ON true
+          LEFT JOIN LATERAL (
+               SELECT count(*) AS n
+                 FROM chat_message AS m
+                WHERE m.chat_id = p.chat_id
+                  AND m.sender_id <> p.user_id
+                  AND m.is_read = false
+                  AND (p.cleared_at IS NULL OR m.sent_at >= p.cleared_at)
+          ) AS ur ON true
+         WHERE p.chat_id = ANY(:chat_ids)
+         ORDER BY p.user_id, p.chat_id, p.id
+        ON CONFLICT (user_id, chat_id) DO UPDATE
+           SET last_message_id = excluded.last_message_id,
+               last_message_at = excluded.last_message_at,
+               last_message_type = excluded.last_message_type,
+               last_preview = excluded.last_preview,
+               unread_count = excluded.unread_count,
+               activity_at = excluded.activity_at,
+               updated_at = excluded.updated_at
+        RETURNING user_id, unread_count
+    )
+    SELECT user_id, sum(delta) AS delta
+      FROM (SELECT user_id, unread_count AS delta FROM upserted
+            UNION ALL
+            SELECT user_id, -unread_count FROM old) AS d
+     GROUP BY user_id
+    HAVING sum(delta) <> 0
+""")
+
+
+# «Новое сообщение lm новее текущего последнего в сводке i»
+_NEWER = ("(i.last_message_at IS NULL OR lm.sent_at > i.last_message_at"
+          " OR (lm.sent_at = i.last_message_at AND lm.id > i.last_message_id))")
+
+_APPEND_SQL = text(f"""
+    WITH msg AS (
+        SELECT *
+          FROM unnest(CAST(:ids AS integer[]), CAST(:chat_ids AS integer[]),
+                      CAST(:sender_ids AS integer[]), CAST(:sent_at AS timestamp[]),
+                      CAST(:types AS text[]), CAST(:previews AS text[]),
+                      CAST(:is_read AS boolean[]))
+               AS t(id, chat_id, sender_id, sent_at, message_type, preview, is_read)
+    ),
+    -- Видимые участнику новые сообщения (с учётом cleared_at)
+    seen AS (
+        SELECT p.user_id, p.chat_id,
+               count(*) FILTER (WHERE m.sender_id <> p.user_id AND NOT m.is_read) AS n
+          FROM chat_participant AS p
+          JOIN msg AS m ON m.chat_id = p.chat_id
+                       AND (p.cleared_at IS NULL OR m.sent_at >= p.cleared_at)
+         GROUP BY p.user_id, p.chat_id
+    ),
+    lm AS (
+        SELECT DISTINCT ON (chat_id) *
+          FROM msg
+         ORDER BY chat_id, sent_at DESC, id DESC
+    )
+    UPDATE chat_inbox AS i
+       SET unread_count = i.unread_count + s.n,
+           last_message_id = CASE WHEN {_NEWER} THEN lm.id ELSE i.last_message_id END,
+           last_message_type = CASE WHEN {_NEWER} THEN lm.message_type ELSE i.last_message_type END,
+           last_preview = CASE WHEN {_NEWER} THEN lm.preview ELSE i.last_preview END,
+           activity_at = CASE WHEN {_NEWER} THEN lm.sent_at ELSE i.activity_at END,
+           last_message_at = CASE WHEN {_NEWER} THEN lm.sent_at ELSE i.last_message_at END,
+           updated_at = now() AT TIME ZONE 'utc'
+      FROM seen AS s
+      JOIN lm ON lm.chat_id = s.chat_id
+     WHERE i.user_id = s.user_id AND i.chat_id = s.chat_id
+    RETURNING i.user_id, s.n
+""")
+
+# Участники без сводки (новый чат, сводка ещё не построена) — их чаты через refresh()
+_MISSING_SQL = text("""
+    SELECT DISTINCT p.chat_id
+      FROM chat_participant AS p
+     WHERE p.chat_id = ANY(:chat_ids)
+       AND NOT EXISTS (
+           SELECT 1 FROM chat_inbox AS i
+            WHERE i.user_id = p.user_id AND i.chat_id = p.chat_id
+       )
+""")
+
+
+def append(db: Session, messages) -> None:
+    """
+    Новые сообщения (ChatMessage после flush): инкрементально обновляет
+    сводки участников. commit — за вызывающим.
+    """
+    messages = sorted(messages, key=lambda m: m.id)
+    if not messages:
+        return
+    conn = db.connection()
+    rows = conn.execute(_APPEND_SQL, {
+        "ids": [m.id for m in messages],
+        "chat_ids": [m.chat_id for m in messages],
+        "sender_ids": [m.sender_id for m in messages],
+        "sent_at": [m.sent_at for m in messages],
+        "types": [m.message_type for m in messages],
+        "previews": [(m.content or "")[:LAST_PREVIEW_LEN] for m in messages],
+        "is_read": [bool(m.is_read) for m in messages],
+    })
+    deltas = {}
+    for r in rows:
+        if r.n:
+            key = (r.user_id, "")
+            deltas[key] = deltas.get(key, 0) + int(r.n)
+    unread_counters.add(db, unread_counters.KIND_CHATS, deltas)
+
+    missing = conn.execute(
+        _MISSING_SQL, {"chat_ids": sorted({m.chat_id for m in messages})}).scalars().all()
+    if missing:
+        refresh(db, missing)
+
+
+def refresh(db: Session, chat_ids: Iterable[Optional[int]]) -> None:
+    """
+    Пересчитывает сводки всех участников чатов chat_ids и их счётчики
+    непрочитанного. Можно вызывать из flush-событий; commit — за вызывающим.
+    """
+    ids = sorted({int(c) for c in chat_ids if c is not None})
+    if not ids:
+        return
+    # Напрямую через соединение: session.execute внутри flush-событий нельзя
+    rows = db.connection().execute(
+        _REFRESH_SQL, {"chat_ids": ids, "preview_len": LAST_PREVIEW_LEN})
+    unread_counters.add(db, unread_counters.KIND_CHATS, {
+        (r.user_id, ""): int(r.delta) for r in rows})
+
+
+def _after_flush(session, flush_context) -> None:
+    from models import ChatMessage, ChatParticipant
+
+    new_messages = []
+    chat_ids = set()
+    for obj in session.new:
+        if isinstance(obj, ChatMessage) and obj.id is not None and obj.sent_at is not None:
+            new_messages.append(obj)
+        elif isinstance(obj, (ChatMessage, ChatParticipant)):
+            chat_ids.add(obj.chat_id)
+    for bucket in (session.dirty, session.deleted):
+        for obj in bucket:
+            if isinstance(obj, (ChatMessage, ChatParticipant)):
+                chat_ids.add(obj.chat_id)
+    # Чат с другими изменениями в том же flush пересчитывается целиком — без двойного учёта
+    new_messages = [m for m in new_messages if m.chat_id not in chat_ids]
+    if new_messages:
+        append(session, new_messages)
+    if chat_ids:
+        refresh(session, chat_ids)
+
+
+_hooks_installed = False
+
+
+def install_hooks() -> None:
+    """Подписывает все ORM-сессии на пересчёт сводок после flush."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    event.listen(Session, "after_flush", _after_flush)
+    _hooks_installed = True
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, Query, HTTPException, Body, Request, Response
 from fastapi.encoders import jsonable_encoder
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
+from sqlalchemy.orm import Session, joinedload, aliased
+from sqlalchemy import func, select, true, tuple_
 from typing import List
 from collections import defaultdict
 from datetime import datetime, timedelta
@@ -9,6 +9,9 @@ import asyncio
 
 from database import get_db
 from auth import get_current_user
+import http_cache
+import chat_inbox
+import unread_counters
 from notifications import push_notification
 from support_bot import start_for_chat as supportbot_start, cancel_for_chat as supportbot_cancel
 from support_models import SupportTicket, TicketStatus
@@ -16,11 +19,10 @@ from support_models import SupportTicket, TicketStatus
 from ws_events import ws_emit_to_chat
 
 import asyncio
-from ws_events import active_connections
 
 # Модели / схемы
 from models import (
-    Chat, ChatParticipant, ChatMessage, ChatFile, User,
+    Chat, ChatParticipant, ChatMessage, ChatFile, User, ChatInbox,
     GroupMute, ChatMessageReaction,
     GROUP_ROLE_OWNER, GROUP_ROLE_ADMIN, GROUP_ROLE_MEMBER,
     UserRole,
@@ -350,23 +352,8 @@ def clear_chat_for_me(
 
 @router.get("/my-chats/unread_count")
 def unread_chats_count(db: Session = Depends(get_db), user=Depends(get_current_user)):
-    links = db.query(ChatParticipant).filter_by(user_id=user.id).all()
-    if not links:
-        return {"unread": 0}
-    unread = (
-        db.query(ChatMessage)
-        .join(ChatParticipant,
-              (ChatParticipant.chat_id == ChatMessage.chat_id) &
-              (ChatParticipant.user_id == user.id))
-        .filter(ChatMessage.sender_id != user.id)
-        .filter(ChatMessage.is_read == False)  # noqa: E712
-        .filter(
-            (ChatParticipant.cleared_at.is_(None)) |
-            (ChatMessage.sent_at >= ChatParticipant.cleared_at)
-        )
-        .count()
-    )
-    return {"unread": unread}
+    # Счётчик ведёт chat_inbox.refresh(); новое значение приходит и по WS (unread_counters)
+    return {"unread": unread_counters.get(db, user.id, unread_counters.KIND_CHATS)}
 
 
 @router.post("/chat/{chat_id}/mark_read")
@@ -376,18 +363,15 @@ def mark_chat_read(chat_id: int, db: Session = Depends(get_db), user=Depends(get
         .filter(ChatMessage.chat_id == chat_id, ChatMessage.sender_id != user.id, ChatMessage.is_read == False)
         .update({"is_read": True}, synchronize_session=False)
     )
+    # bulk-update не проходит через ORM-события — пересчитываем сводки чата сами
+    chat_inbox.refresh(db, [chat_id])
     db.commit()
+    # bulk-update не проходит через ORM-события — сбрасываем кэш списка чатов явно
+    http_cache.invalidate_user_chats(user.id)
 
     # Неблокирующая рассылка "прочитано" отправителю(ям)
     async def _broadcast_seen(_chat_id: int, _user_id: int):
-        for ws in list(active_connections.get(_chat_id, [])):
-            try:
-                await ws.send_json({"event": "messages_seen", "chat_id": _chat_id, "seen_by": _user_id})
-            except Exception:
-                try:
-                    active_connections[_chat_id].remove(ws)
-                except Exception:
-                    pass
+        await ws_emit_to_chat(_chat_id, {"event": "messages_seen", "chat_id": _chat_id, "seen_by": _user_id})
     try:
         loop = asyncio.get_running_loop()
         loop.create_task(_broadcast_seen(chat_id, user.id))
@@ -398,98 +382,108 @@ def mark_chat_read(chat_id: int, db: Session = Depends(get_db), user=Depends(get
 
 
 # --- СПИСОК МОИХ ЧАТОВ (c support метой) ---
+def _my_chats_cursor(value: str):
+    """'<activity_at iso>_<chat_id>' -> (datetime, chat_id)."""
+    try:
+        at, chat_id = value.rsplit("_", 1)
+        return datetime.fromisoformat(at), int(chat_id)
+    except (ValueError, AttributeError):
+        raise HTTPException(400, _i18n(
+            "error.chat.badCursor", "Некорректный курсор"))
+
+
 @router.get("/my-chats")
 def get_my_chats(
     limit: int = Query(30, ge=1, le=200),
     offset: int = Query(0, ge=0),
+    cursor: str = Query(None),
     response: Response = None,
     db: Session = Depends(get_db),
     user=Depends(get_current_user)
 ):
+    """
+    Один запрос по chat_inbox (сводки поддерживает chat_inbox.refresh),
+    сортировка activity_at DESC, chat_id DESC. Пагинация: limit/offset
+    (как раньше, с X-Total-Count) или keyset через cursor из X-Next-Cursor.
+    """
     try:
-        # Все чаты, где состоит пользователь
-        links = db.query(ChatParticipant).filter_by(user_id=user.id).all()
-        chat_ids = list({p.chat_id for p in links})
-        if not chat_ids:
-            return []
-
-        # Карта саппорт-тикетов по chat_id
-        tickets = db.query(SupportTicket).filter(
-            SupportTicket.chat_id.in_(chat_ids)).all()
-        support_by_chat = {
-            t.chat_id: t for t in tickets if getattr(t, "chat_id", None)}
-
-        chats = db.query(Chat).filter(Chat.id.in_(chat_ids)).all()
-        out = []
-
-        has_is_read = hasattr(ChatMessage, "is_read")
-
-        for chat in chats:
-            # персональный срез для текущего пользователя
-            cp = next((p for p in links if p.chat_id == chat.id), None)
-            last_q = db.query(ChatMessage).filter(
-                ChatMessage.chat_id == chat.id)
-            if cp and cp.cleared_at is not None:
-                last_q = last_q.filter(ChatMessage.sent_at >= cp.cleared_at)
-            last_msg = last_q.order_by(ChatMessage.sent_at.desc()).first()
-
-            # Приватные чаты без сообщений скрываем, группы показываем всегда
-            if not last_msg and not getattr(chat, "is_group", False):
-                continue
+        is_support_agent = getattr(user, "role", None) == UserRole.SUPPORT
+
+        PeerUser = aliased(User)
+        OwnerUser = aliased(User)
+        # собеседник приватного чата
+        peer = (
+            select(ChatParticipant.user_id.label("user_id"))
+            .where(ChatParticipant.chat_id == Chat.id,
+                   ChatParticipant.user_id != user.id,
+                   Chat.is_group.isnot(True))
+            .order_by(ChatParticipant.id)
+            .limit(1)
+            .lateral("peer")
+        )
+        # тикет поддержки, привязанный к чату
+        ticket = (
+            select(SupportTicket.id.label("id"))
+            .where(SupportTicket.chat_id == Chat.id)
+            .order_by(SupportTicket.id.desc())
+            .limit(1)
+            .lateral("ticket")
+        )
 
-            # непрочитанные (если в схеме есть поле is_read)
-            if has_is_read:
-                unread_count = (
-                    db.query(ChatMessage)
-                    .filter_by(chat_id=chat.id)
-                    .filter(ChatMessage.sender_id != user.id)
-                    .filter(ChatMessage.is_read == False)  # noqa: E712
-                    .count()
-                )
-            else:
-                unread_count = 0
-
-            # peer для приватного чата
-            peer = None
-            if not getattr(chat, "is_group", False):
-                peer_link = (
-                    db.query(ChatParticipant)
-                    .filter(ChatParticipant.chat_id == chat.id, ChatParticipant.user_id != user.id)
-                    .first()
-                )
-                if peer_link:
-                    peer_user = db.query(User).filter_by(
-                        id=peer_link.user_id).first()
-                    if peer_user:
-                        peer = {
-                            "id": peer_user.id,
-                            "organization": getattr(peer_user, "organization", None),
-                            "contact_person": getattr(peer_user, "contact_person", None),
-                            "full_name": getattr(peer_user, "full_name", None),
-                            "email": getattr(peer_user, "email", None),
-                            "avatar": getattr(peer_user, "avatar", None),
-                        }
+        columns = [ChatInbox, Chat, PeerUser, SupportTicket, OwnerUser]
+        if cursor is None:
+            columns.append(func.count().over().label("total"))
+        q = (
+            db.query(*columns)
+            .join(Chat, Chat.id == ChatInbox.chat_id)
+            .outerjoin(peer, true())
+            .outerjoin(PeerUser, PeerUser.id == peer.c.user_id)
+            .outerjoin(ticket, true())
+            .outerjoin(SupportTicket, SupportTicket.id == ticket.c.id)
+            .outerjoin(OwnerUser, OwnerUser.id == SupportTicket.user_id)
+            .filter(ChatInbox.user_id == user.id,
+                    ChatInbox.activity_at.isnot(None))
+        )
+        # SUPPORT: если тикет уже назначен другому агенту — не показываем его в списке
+        if is_support_agent:
+            q = q.filter(
+                (SupportTicket.agent_user_id.is_(None)) |
+                (SupportTicket.agent_user_id == user.id)
+            )
+        if cursor is not None:
+            c_at, c_id = _my_chats_cursor(cursor)
+            q = q.filter(tuple_(ChatInbox.activity_at, ChatInbox.chat_id)
+                         < tuple_(c_at, c_id))
+        q = q.order_by(ChatInbox.activity_at.desc(), ChatInbox.chat_id.desc())
+        if cursor is None:
+            q = q.offset(offset)
+        rows = q.limit(limit).all()
 
-            st = support_by_chat.get(chat.id)
-            # SUPPORT: если тикет уже назначен другому агенту — не показываем его в списке
-            if getattr(user, "role", None) == UserRole.SUPPORT:
-                if st and getattr(st, "agent_user_id", None) and st.agent_user_id != user.id:
-                    continue
+        out = []
+        for row in rows:
+            inbox, chat, peer_user, st, owner = row[:5]
+            peer_out = None
+            if peer_user:
+                peer_out = {
+                    "id": peer_user.id,
+                    "organization": getattr(peer_user, "organization", None),
+                    "contact_person": getattr(peer_user, "contact_person", None),
+                    "full_name": getattr(peer_user, "full_name", None),
+                    "email": getattr(peer_user, "email", None),
+                    "avatar": getattr(peer_user, "avatar", None),
+                }
 
             item = {
                 "chat_id": chat.id,
                 "order_id": getattr(chat, "order_id", None),
                 "transport_id": (str(getattr(chat, "transport_id", "")) or None),
-                "unread": unread_count,
+                "unread": inbox.unread_count or 0,
                 "last_message": {
-                    "content": getattr(last_msg, "content", "") if last_msg else "",
-                    "message_type": getattr(last_msg, "message_type", "") if last_msg else "",
-                    "sent_at": (
-                        getattr(last_msg, "sent_at", None).isoformat() if last_msg and getattr(last_msg, "sent_at", None)
-                        else (getattr(chat, "created_at", None).isoformat() if getattr(chat, "is_group", False) and getattr(chat, "created_at", None) else None)
-                    ),
+                    "content": (inbox.last_preview or "") if inbox.last_message_id else "",
+                    "message_type": (inbox.last_message_type or "") if inbox.last_message_id else "",
+                    "sent_at": inbox.activity_at.isoformat() if inbox.activity_at else None,
                 },
-                "peer": peer,
+                "peer": peer_out,
                 "is_group": bool(getattr(chat, "is_group", False)),
                 "group_name": getattr(chat, "group_name", None),
                 "group_avatar": getattr(chat, "group_avatar", None),
@@ -503,8 +497,6 @@ def get_my_chats(
             }
 
             if st:
-                is_support_agent = (
-                    getattr(user, "role", None) == UserRole.SUPPORT)
                 item["support_logo_url"] = getattr(
                     chat, "group_avatar", None) or "/static/support-logo.svg"
                 item["input_locked"] = (
@@ -513,8 +505,6 @@ def get_my_chats(
                 item["autoclose_eta_iso"] = None
 
                 if is_support_agent:
-                    owner = db.query(User).filter_by(id=getattr(st, "user_id", None)).first(
-                    ) if getattr(st, "user_id", None) else None
                     if owner:
                         item["display_title"] = owner.organization or getattr(
                             owner, "contact_person", None) or owner.email or f"ID: {owner.id}"
@@ -533,28 +523,24 @@ def get_my_chats(
 
             out.append(item)
 
-        # пагинация по собранному списку
-        total = len(out)
-        try:
-            out.sort(
-                key=lambda x: (x.get("last_message", {})
-                               or {}).get("sent_at") or "",
-                reverse=True
-            )
-        except Exception:
-            pass
-        page = out[offset: offset + limit]
-
         if response is not None:
             try:
-                response.headers["X-Total-Count"] = str(total)
                 response.headers["X-Limit"] = str(limit)
-                response.headers["X-Offset"] = str(offset)
+                if cursor is None:
+                    total = int(rows[0].total) if rows else 0
+                    response.headers["X-Total-Count"] = str(total)
+                    response.headers["X-Offset"] = str(offset)
+                if len(rows) == limit:
+                    last = rows[-1][0]
+                    response.headers["X-Next-Cursor"] = (
+                        f"{last.activity_at.isoformat()}_{last.chat_id}")
             except Exception:
                 pass
 
-        return page
+        return out
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         print("ERROR in /my-chats:", str(e))
@@ -1331,7 +1317,9 @@ def remove_member(chat_id: int, user_id: int = Body(...), db: Session = Depends(
     user_obj = db.query(User).filter_by(id=user_id).first()
     db.query(ChatParticipant).filter_by(
         chat_id=chat_id, user_id=user_id).delete()
+    chat_inbox.refresh(db, [chat_id])
     db.commit()
+    http_cache.invalidate_user_chats(user_id)
 
     participants = db.query(ChatParticipant).filter_by(chat_id=chat_id).all()
     for p in participants:
@@ -14,7 +14,8 @@ from models import (
     Notification,
     NotificationType,
 )
-from notifications import push_notification, _send_email_notification as send_notification_email
+from notifications import push_notification
+import email_outbox
 
 router = APIRouter(prefix="/contacts", tags=["contacts"])
 
@@ -153,17 +154,11 @@ def _notify(
         payload=extra,
     )
     db.add(n)
+    # e‑mail с тем же текстом уведомления — через outbox (тот же шаблон, что в notifications.py)
+    email_outbox.enqueue_notification(db, user_id, message, datetime.utcnow())
     db.commit()
     db.refresh(n)
 
-    # После сохранения записи шлём e‑mail с тем же текстом уведомления.
-    # Используем общий helper из notifications.py, чтобы формат писем был единым.
-    try:
-        send_notification_email(db, user_id, message, n.created_at)
-    except Exception as e:
-        # Не роняем ручку контактов, просто логируем
-        print(f"[WARN] Email notification (contacts) failed: {e}")
-
     # соберём полезный payload для фронта / WS
     # строковое представление типа (работает и с Enum, и со строкой)
     type_str = (
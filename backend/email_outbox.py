@@ -0,0 +1,308 @@
+"""
+Transactional outbox для писем (таблица email_outbox) и фоновый диспетчер.
+
+Раньше create_notification прямо в запросе/задаче планировщика определял
+язык пользователя, собирал письмо и делал синхронный SMTP-обмен — прогон
+автоподбора на 50 уведомлений открывал 50 SMTP-соединений подряд. Теперь:
+- enqueue_*() добавляет строку в текущую сессию — письмо появится только
+  если транзакция события закоммитится;
+- после commit диспетчер будится (install_hooks), а также опрашивает
+  таблицу раз в EMAIL_OUTBOX_POLL_SEC;
+- диспетчер забирает пачку (FOR UPDATE SKIP LOCKED — безопасно для
+  нескольких воркеров), собирает письма и шлёт их через одно постоянное
+  SMTP-соединение (email_utils.SMTPConnection);
+- ошибки — повтор с экспоненциальной задержкой, после EMAIL_OUTBOX_MAX_ATTEMPTS
+  строка помечается failed.
+"""
+from __future__ import annotations
+
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models import EmailOutbox
+
+EMAIL_OUTBOX_ENABLED = (os.getenv("EMAIL_OUTBOX_DISPATCHER", "1") or "1").strip().lower() in {
+    "1", "true", "yes", "on"}
+EMAIL_OUTBOX_POLL_SEC = float(os.getenv("EMAIL_OUTBOX_POLL_SEC", "5") or "5")
+EMAIL_OUTBOX_BATCH = int(os.getenv("EMAIL_OUTBOX_BATCH", "50") or "50")
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", "8") or "8")
+# Задержка повтора: BACKOFF_SEC * 2^(attempts-1), не больше BACKOFF_MAX_SEC
+EMAIL_OUTBOX_BACKOFF_SEC = int(os.getenv("EMAIL_OUTBOX_BACKOFF_SEC", "30") or "30")
+EMAIL_OUTBOX_BACKOFF_MAX_SEC = int(os.getenv("EMAIL_OUTBOX_BACKOFF_MAX_SEC", "3600") or "3600")
+# Сколько хранить отправленные строки
+EMAIL_OUTBOX_KEEP_DAYS = int(os.getenv("EMAIL_OUTBOX_KEEP_DAYS", "7") or "7")
+# Если процесс умер посреди отправки, строка снова станет доступна через это время
+_LOCK_SEC = 300
+
+KIND_RAW = "raw"
+KIND_NOTIFICATION = "notification"
+
+_SESSION_KEY = "_email_outbox_wake"
+
+_wakeup = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+_hooks_installed = False
+_stats = {"sent": 0, "failed": 0, "retried": 0, "batches": 0,
+          "last_batch_at": None, "last_lag_sec": None, "max_lag_sec": 0.0,
+          "send_ms_total": 0.0}
+
+
+# ----------------------------- постановка -----------------------------
+
+def enqueue_notification(db: Session, user_id: int, message: str,
+                         created_at: Optional[datetime] = None) -> None:
+    """Письмо об уведомлении; язык и шаблон определяются при отправке."""
+    db.add(EmailOutbox(
+        kind=KIND_NOTIFICATION,
+        user_id=user_id,
+        payload={"message": message,
+                 "created_at": created_at.isoformat() if created_at else None},
+    ))
+    db.info[_SESSION_KEY] = True
+
+
+def enqueue(db: Session, to_email: str, subject: str, html_body: str) -> None:
+    """Готовое письмо."""
+    db.add(EmailOutbox(kind=KIND_RAW, to_email=to_email,
+                       subject=subject, html_body=html_body))
+    db.info[_SESSION_KEY] = True
+
+
+def wake() -> None:
+    """Для строк, вставленных мимо enqueue_*() (SQL в listing_expiry)."""
+    _wakeup.set()
+
+
+def _after_commit(session) -> None:
+    if session.info.pop(_SESSION_KEY, False):
+        _wakeup.set()
+
+
+def _after_rollback(session) -> None:
+    session.info.pop(_SESSION_KEY, None)
+
+
+def install_hooks() -> None:
+    """Будит диспетчер после commit сессий, в которых ставились письма."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session as _Session
+
+    event.listen(_Session, "after_commit", _after_commit)
+    event.listen(_Session, "after_rollback", _after_rollback)
+    _hooks_installed = True
+
+
+# ----------------------------- отправка -----------------------------
+
+_CLAIM_SQL = text("""
+    UPDATE email_outbox AS o
+       SET status = 'sending',
+           attempts = o.attempts + 1,
+           locked_until = :locked_until
+     WHERE o.id IN (
+            SELECT id FROM email_outbox
+             WHERE status IN ('pending', 'sending')
+               AND next_attempt_at <= :now
+               AND (status = 'pending' OR locked_until < :now)
+             ORDER BY next_attempt_at, id
+             LIMIT :limit
+             FOR UPDATE SKIP LOCKED)
+    RETURNING o.id, o.kind, o.user_id, o.to_email, o.subject, o.html_body,
+              o.payload, o.attempts, o.created_at
+""")
+
+
+def _render(db: Session, rows) -> dict:
+    """{id: (to_email, subject, html_body) | None} — None: адресата нет, письмо не нужно."""
+    from notifications import _build_email, _detect_user_lang
+    from models import User
+
+    user_ids = {r.user_id for r in rows if r.kind == KIND_NOTIFICATION and r.user_id}
+    users = {u.id: u for u in db.query(User).filter(User.id.in_(user_ids))} if user_ids else {}
+    langs = {}
+    out = {}
+    for r in rows:
+        if r.kind != KIND_NOTIFICATION:
+            out[r.id] = (r.to_email, r.subject, r.html_body) if r.to_email else None
+            continue
+        user = users.get(r.user_id)
+        if not user or not user.email:
+            out[r.id] = None
+            continue
+        if user.id not in langs:
+            langs[user.id] = _detect_user_lang(db, user)
+        payload = r.payload or {}
+        created_at = payload.get("created_at")
+        subject, html_body = _build_email(
+            langs[user.id], payload.get("message") or "",
+            datetime.fromisoformat(created_at) if created_at else None)
+        out[r.id] = (user.email, subject, html_body)
+    return out
+
+
+def _backoff(attempts: int) -> timedelta:
+    sec = EMAIL_OUTBOX_BACKOFF_SEC * (2 ** max(0, attempts - 1))
+    return timedelta(seconds=min(sec, EMAIL_OUTBOX_BACKOFF_MAX_SEC))
+
+
+def dispatch_batch(db: Session, conn, limit: int = EMAIL_OUTBOX_BATCH) -> int:
+    """Забирает и отправляет одну пачку. Возвращает число обработанных строк."""
+    now = datetime.utcnow()
+    rows = db.execute(_CLAIM_SQL, {
+        "now": now, "locked_until": now + timedelta(seconds=_LOCK_SEC), "limit": limit,
+    }).fetchall()
+    db.commit()
+    if not rows:
+        return 0
+
+    try:
+        messages = _render(db, rows)
+    except Exception as e:
+        db.rollback()
+        print("[EMAIL_OUTBOX] render failed:", e)
+        messages = {}
+    sent, skipped, retry, failed = [], [], [], []
+    smtp_down = None
+    started = time.monotonic()
+    for r in rows:
+        if r.id not in messages:
+            err = "render failed"
+        elif smtp_down:
+            # Сервер недоступен — остаток пачки откладываем, не дожидаясь таймаута на каждом письме
+            err = smtp_down
+        elif messages[r.id] is None:
+            skipped.append(r.id)
+            continue
+        else:
+            try:
+                conn.send(*messages[r.id])
+                sent.append(r.id)
+                lag = (datetime.utcnow() - r.created_at).total_seconds()
+                _stats["last_lag_sec"] = round(lag, 3)
+                _stats["max_lag_sec"] = max(_stats["max_lag_sec"], round(lag, 3))
+                continue
+            except Exception as e:
+                err = f"{type(e).__name__}: {e}"
+                # Соединение в неизвестном состоянии — следующее письмо откроет новое
+                conn.close()
+                if isinstance(e, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, OSError)):
+                    smtp_down = err
+        if r.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+            failed.append((r.id, err))
+        else:
+            retry.append((r.id, err, datetime.utcnow() + _backoff(r.attempts)))
+    _stats["send_ms_total"] += (time.monotonic() - started) * 1000.0
+
+    done = datetime.utcnow()
+    if sent or skipped:
+        db.execute(
+            text("""
+                UPDATE email_outbox
+                   SET status = 'sent', sent_at = :done, locked_until = NULL, last_error = NULL
+                 WHERE id = ANY(CAST(:ids AS bigint[]))
+            """),
+            {"done": done, "ids": sent + skipped},
+        )
+    for rid, err, at in retry:
+        db.execute(
+            text("""
+                UPDATE email_outbox
+                   SET status = 'pending', next_attempt_at = :at, locked_until = NULL,
+                       last_error = :err
+                 WHERE id = :id
+            """),
+            {"id": rid, "at": at, "err": err[:2000]},
+        )
+    for rid, err in failed:
+        db.execute(
+            text("""
+                UPDATE email_outbox
+                   SET status = 'failed', locked_until = NULL, last_error = :err
+                 WHERE id = :id
+            """),
+            {"id": rid, "err": err[:2000]},
+        )
+    db.commit()
+
+    _stats["sent"] += len(sent)
+    _stats["retried"] += len(retry)
+    _stats["failed"] += len(failed)
+    _stats["batches"] += 1
+    _stats["last_batch_at"] = done.isoformat()
+    if failed:
+        print(f"[EMAIL_OUTBOX] gave up on {len(failed)} emails, last error: {failed[-1][1]}")
+    return len(rows)
+
+
+def purge_sent(db: Session, keep_days: int = EMAIL_OUTBOX_KEEP_DAYS) -> int:
+    res = db.execute(
+        text("DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < :cutoff"),
+        {"cutoff": datetime.utcnow() - timedelta(days=keep_days)},
+    )
+    db.commit()
+    return res.rowcount or 0
+
+
+def _dispatcher_loop() -> None:
+    from database import SessionLocal
+    from email_utils import SMTPConnection
+
+    conn = SMTPConnection(idle_sec=max(10.0, EMAIL_OUTBOX_POLL_SEC * 2))
+    last_purge = 0.0
+    while True:
+        _wakeup.wait(EMAIL_OUTBOX_POLL_SEC)
+        _wakeup.clear()
+        db = SessionLocal()
+        try:
+            # Пока пачки полные — выбираем дальше без ожидания
+            while dispatch_batch(db, conn) >= EMAIL_OUTBOX_BATCH:
+                pass
+            if time.monotonic() - last_purge > 3600:
+                purge_sent(db)
+                last_purge = time.monotonic()
+        except Exception as e:
+            db.rollback()
+            print("[EMAIL_OUTBOX] dispatch failed:", e)
+        finally:
+            db.close()
+
+
+def start() -> None:
+    """Запускает диспетчер в фоне (один поток на процесс)."""
+    global _started
+    if not EMAIL_OUTBOX_ENABLED:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_dispatcher_loop, name="email-outbox-dispatcher",
+                     daemon=True).start()
+
+
+def stats(db: Optional[Session] = None) -> dict:
+    out = {"enabled": EMAIL_OUTBOX_ENABLED, "batch": EMAIL_OUTBOX_BATCH, **_stats}
+    attempts = _stats["sent"] + _stats["retried"] + _stats["failed"]
+    out["avg_send_ms"] = round(_stats["send_ms_total"] / attempts, 1) if attempts else None
+    if db is not None:
+        row = db.execute(text("""
+            SELECT count(*), min(created_at)
+              FROM email_outbox
+             WHERE status IN ('pending', 'sending')
+        """)).first()
+        out["queued"] = int(row[0] or 0)
+        out["oldest_queued_sec"] = (
+            round((datetime.utcnow() - row[1]).total_seconds(), 1) if row[1] else 0)
+    return out
+
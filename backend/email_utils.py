@@ -1,6 +1,7 @@
 import os
 import smtplib
 import ssl
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import formatdate, make_msgid
@@ -111,6 +112,82 @@ def _print_to_console(to_email: str, subject: str, html_body: str) -> None:
     print("=== /EMAIL ===\n")
 
 
+def _open_smtp(cfg: dict) -> smtplib.SMTP:
+    if cfg["use_ssl"] or cfg["port"] == 465:
+        # SMTPS
+        server = smtplib.SMTP_SSL(cfg["host"], cfg["port"], context=_ssl_context(), timeout=20)
+        if cfg["debug"]:
+            server.set_debuglevel(1)
+    else:
+        # SMTP + STARTTLS
+        server = smtplib.SMTP(cfg["host"], cfg["port"], timeout=20)
+        if cfg["debug"]:
+            server.set_debuglevel(1)
+        server.ehlo()
+        if cfg["use_tls"] or cfg["port"] == 587:
+            server.starttls(context=_ssl_context())
+            server.ehlo()
+    if cfg["user"]:
+        server.login(cfg["user"], cfg["pwd"])
+    return server
+
+
+class SMTPConnection:
+    """
+    Долгоживущее SMTP-соединение для пакетной отправки (email_outbox).
+    Открывается лениво, после idle_sec простоя проверяется NOOP, при обрыве
+    переоткрывается один раз. В отличие от send_email, ошибки пробрасывает —
+    решение о повторе принимает вызывающий.
+    """
+
+    def __init__(self, idle_sec: float = 60.0):
+        self.idle_sec = idle_sec
+        self._server = None
+        self._cfg = None
+        self._used_at = 0.0
+
+    def _connect(self) -> None:
+        self.close()
+        self._cfg = _cfg()
+        if self._cfg["transport"] != "console":
+            self._server = _open_smtp(self._cfg)
+
+    def _ensure(self) -> None:
+        if self._cfg is None:
+            self._connect()
+        elif self._server is not None and time.monotonic() - self._used_at > self.idle_sec:
+            try:
+                if self._server.noop()[0] != 250:
+                    self._connect()
+            except Exception:
+                self._connect()
+
+    def send(self, to_email: str, subject: str, html_body: str) -> None:
+        self._ensure()
+        if self._cfg["transport"] == "console":
+            _print_to_console(to_email, subject, html_body)
+            return
+        msg = _build_message(self._cfg["from"], to_email, subject, html_body)
+        try:
+            self._server.sendmail(self._cfg["from"], [to_email], msg.as_string())
+        except (smtplib.SMTPServerDisconnected, ConnectionError, OSError):
+            self._connect()
+            self._server.sendmail(self._cfg["from"], [to_email], msg.as_string())
+        self._used_at = time.monotonic()
+
+    def close(self) -> None:
+        server, self._server = self._server, None
+        self._cfg = None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                try:
+                    server.close()
+                except Exception:
+                    pass
+
+
 def send_email(to_email: str, subject: str, html_body: str) -> None:
     """
     EMAIL_TRANSPORT=console -> печатаем письмо.
@@ -128,26 +205,8 @@ def send_email(to_email: str, subject: str, html_body: str) -> None:
     try:
         log.info(
             f"[EMAIL] transport={cfg['transport']} host={cfg['host']} port={cfg['port']} TLS={cfg['use_tls']} SSL={cfg['use_ssl']} user={'set' if cfg['user'] else 'none'}")
-        if cfg["use_ssl"] or cfg["port"] == 465:
-            # SMTPS
-            with smtplib.SMTP_SSL(cfg["host"], cfg["port"], context=_ssl_context(), timeout=20) as server:
-                if cfg["debug"]:
-                    server.set_debuglevel(1)
-                if cfg["user"]:
-                    server.login(cfg["user"], cfg["pwd"])
-                server.sendmail(cfg["from"], [to_email], msg.as_string())
-        else:
-            # SMTP + STARTTLS
-            with smtplib.SMTP(cfg["host"], cfg["port"], timeout=20) as server:
-                if cfg["debug"]:
-                    server.set_debuglevel(1)
-                server.ehlo()
-                if cfg["use_tls"] or cfg["port"] == 587:
-                    server.starttls(context=_ssl_context())
-                    server.ehlo()
-                if cfg["user"]:
-                    server.login(cfg["user"], cfg["pwd"])
-                server.sendmail(cfg["from"], [to_email], msg.as_string())
+        with _open_smtp(cfg) as server:
+            server.sendmail(cfg["from"], [to_email], msg.as_string())
     except Exception as e:
         # На DEV/стейдже не хотим 500 из-за SMTP — лог и тихий возврат
         print(f"[EMAIL][warning] SMTP failed: {type(e).__name__}: {e}")
@@ -0,0 +1,305 @@
+"""
+Двухуровневый кэш ответов внешних геокодеров для /geo/autocomplete.
+
+Раньше был только OrderedDict в памяти воркера, по умолчанию выключенный
+(GEO_CACHE_TTL=0): каждый, кто набирал «Tbilisi», заново шёл в Nominatim и
+остальных провайдеров, рискуя их лимитами. Теперь:
+- L1 — LRU в памяти процесса (GEO_CACHE_MAX записей);
+- L2 — общее для воркеров и рестартов хранилище: таблица geocode_cache
+  (GEO_CACHE_BACKEND=postgres, по умолчанию) или Redis (redis);
+- ключ — нормализованный запрос + язык + scope + страна + limit;
+- запись свежая GEO_CACHE_TTL секунд, затем ещё GEO_CACHE_STALE_SEC отдаётся
+  как устаревшая, а в фоне запрашивается заново (stale-while-revalidate);
+- пустой ответ (все провайдеры ответили, но ничего не нашли) кэшируется на
+  GEO_CACHE_NEGATIVE_TTL — отказы провайдеров не кэшируются вовсе.
+Ошибки L2 = промах. Счётчики — stats() и diag["cache"] автокомплита.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+# 0 = кэш выключен
+GEO_CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", "86400") or "0")
+GEO_CACHE_MAX = int(os.getenv("GEO_CACHE_MAX", "2000") or "0")
+GEO_CACHE_STALE_SEC = int(os.getenv("GEO_CACHE_STALE_SEC", str(7 * 86400)) or "0")
+GEO_CACHE_NEGATIVE_TTL = int(os.getenv("GEO_CACHE_NEGATIVE_TTL", "600") or "0")
+# postgres | redis | none (только L1)
+GEO_CACHE_BACKEND = (os.getenv("GEO_CACHE_BACKEND", "postgres") or "none").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+_REDIS_PREFIX = "geocache:"
+_MAX_KEY_LEN = 512
+
+FRESH = "fresh"
+STALE = "stale"
+MISS = "miss"
+
+_stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "stale_served": 0,
+          "negative_hits": 0, "writes": 0, "refreshes": 0, "l2_errors": 0}
+
+
+def enabled() -> bool:
+    return GEO_CACHE_TTL > 0 and GEO_CACHE_MAX > 0
+
+
+def make_key(q: str, lang: str, scope: str, country: Optional[str], limit: int) -> str:
+    qn = " ".join((q or "").casefold().split())
+    return f"{qn}|{lang}|{scope}|{(country or '').upper()}|{limit}"
+
+
+class _Entry:
+    __slots__ = ("items", "fresh_until", "stale_until")
+
+    def __init__(self, items: List[Dict[str, Any]], fresh_until: float, stale_until: float):
+        self.items = items
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+    def state(self, now: float) -> str:
+        if now < self.fresh_until:
+            return FRESH
+        return STALE if now < self.stale_until else MISS
+
+
+class MemoryStore:
+    """L1: LRU в памяти процесса."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry.state(time.time()) == MISS:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: _Entry) -> None:
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def prune(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        with self._lock:
+            expired = [k for k, e in self._data.items() if e.state(now) == MISS]
+            for k in expired:
+                del self._data[k]
+        return len(expired)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"items": len(self._data), "max_items": self.max_items}
+
+
+class PostgresStore:
+    """L2: таблица geocode_cache (общая для воркеров, переживает рестарты)."""
+
+    def get(self, key: str) -> Optional[_Entry]:
+        from database import engine
+
+        with engine.connect() as conn:
+            row = conn.execute(
+                text("""
+                    SELECT items, fresh_until, stale_until
+                      FROM geocode_cache
+                     WHERE key = :key AND stale_until > :now
+                """),
+                {"key": key, "now": datetime.utcnow()},
+            ).first()
+        if row is None:
+            return None
+        return _Entry(row[0] or [], _ts(row[1]), _ts(row[2]))
+
+    def set(self, key: str, entry: _Entry) -> None:
+        from database import engine
+
+        with engine.begin() as conn:
+            conn.execute(
+                text("""
+                    INSERT INTO geocode_cache (key, items, fetched_at, fresh_until, stale_until)
+                    VALUES (:key, CAST(:items AS jsonb), :now, :fresh_until, :stale_until)
+                    ON CONFLICT (key) DO UPDATE
+                       SET items = EXCLUDED.items,
+                           fetched_at = EXCLUDED.fetched_at,
+                           fresh_until = EXCLUDED.fresh_until,
+                           stale_until = EXCLUDED.stale_until
+                """),
+                {"key": key, "items": json.dumps(entry.items, ensure_ascii=False),
+                 "now": datetime.utcnow(),
+                 "fresh_until": datetime.utcfromtimestamp(entry.fresh_until),
+                 "stale_until": datetime.utcfromtimestamp(entry.stale_until)},
+            )
+
+
+class RedisStore:
+    """L2: Redis, запись живёт до stale_until."""
+
+    def __init__(self, url: str):
+        import redis
+        self._r = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+
+    @staticmethod
+    def _key(key: str) -> str:
+        return f"{_REDIS_PREFIX}{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def get(self, key: str) -> Optional[_Entry]:
+        raw = self._r.get(self._key(key))
+        if not raw:
+            return None
+        d = json.loads(raw)
+        return _Entry(d["i"], d["f"], d["s"])
+
+    def set(self, key: str, entry: _Entry) -> None:
+        ttl_ms = int((entry.stale_until - time.time()) * 1000)
+        if ttl_ms <= 0:
+            return
+        value = json.dumps({"i": entry.items, "f": entry.fresh_until, "s": entry.stale_until},
+                           ensure_ascii=False)
+        self._r.set(self._key(key), value, px=ttl_ms)
+
+
+def _ts(dt: datetime) -> float:
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+_l1 = MemoryStore(max(1, GEO_CACHE_MAX))
+_l2 = None
+_l2_lock = threading.Lock()
+_refreshing: set = set()
+
+
+def _store():
+    global _l2
+    if GEO_CACHE_BACKEND not in ("postgres", "redis"):
+        return None
+    if _l2 is None:
+        with _l2_lock:
+            if _l2 is None:
+                _l2 = RedisStore(REDIS_URL) if GEO_CACHE_BACKEND == "redis" else PostgresStore()
+    return _l2
+
+
+def lookup(key: str) -> Tuple[Optional[List[Dict[str, Any]]], str, Optional[str]]:
+    """(items | None, fresh|stale|miss, l1|l2|None). L2 — блокирующий вызов."""
+    if not enabled() or len(key) > _MAX_KEY_LEN:
+        return None, MISS, None
+    now = time.time()
+    tier = "l1"
+    entry = _l1.get(key)
+    if entry is None and _store() is not None:
+        try:
+            entry = _store().get(key)
+        except Exception as e:
+            _stats["l2_errors"] += 1
+            print("[GEO_CACHE] l2 get failed:", e)
+            entry = None
+        if entry is not None:
+            tier = "l2"
+            _l1.set(key, entry)
+    state = entry.state(now) if entry is not None else MISS
+    if state == MISS:
+        _stats["misses"] += 1
+        return None, MISS, None
+    _stats[f"{tier}_hits"] += 1
+    if state == STALE:
+        _stats["stale_served"] += 1
+    if not entry.items:
+        _stats["negative_hits"] += 1
+    return entry.items, state, tier
+
+
+def store(key: str, items: List[Dict[str, Any]]) -> None:
+    """Кладёт ответ в оба уровня; пустой список — негативная запись. L2 — блокирующий вызов."""
+    if not enabled() or len(key) > _MAX_KEY_LEN:
+        return
+    ttl = GEO_CACHE_TTL if items else GEO_CACHE_NEGATIVE_TTL
+    if ttl <= 0:
+        return
+    now = time.time()
+    # Негативная запись устаревшей не отдаётся
+    entry = _Entry(items, now + ttl, now + ttl + (GEO_CACHE_STALE_SEC if items else 0))
+    _l1.set(key, entry)
+    _stats["writes"] += 1
+    if _store() is not None:
+        try:
+            _store().set(key, entry)
+        except Exception as e:
+            _stats["l2_errors"] += 1
+            print("[GEO_CACHE] l2 set failed:", e)
+
+
+async def aget(key: str):
+    if _l1.get(key) is not None:
+        # Попадание в L1 — без перехода в пул потоков
+        return lookup(key)
+    return await run_in_threadpool(lookup, key)
+
+
+async def aput(key: str, items: List[Dict[str, Any]]) -> None:
+    await run_in_threadpool(store, key, items)
+
+
+def refresh_in_background(key: str,
+                          fetch: Callable[[], Awaitable[Optional[List[Dict[str, Any]]]]]) -> None:
+    """
+    Обновление устаревшей записи после ответа клиенту (одно на ключ в воркере).
+    fetch() возвращает список для кэша или None — тогда запись не трогаем.
+    """
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+
+    async def _run():
+        try:
+            items = await fetch()
+            if items is not None:
+                await aput(key, items)
+                _stats["refreshes"] += 1
+        except Exception as e:
+            print("[GEO_CACHE] refresh failed:", e)
+        finally:
+            _refreshing.discard(key)
+
+    asyncio.get_running_loop().create_task(_run())
+
+
+def prune_l1(now: Optional[float] = None) -> int:
+    return _l1.prune(now)
+
+
+def purge_expired(db) -> int:
+    """Удаляет из geocode_cache записи, которые уже не отдаются даже устаревшими."""
+    res = db.execute(text("DELETE FROM geocode_cache WHERE stale_until < :now"),
+                     {"now": datetime.utcnow()})
+    db.commit()
+    return res.rowcount or 0
+
+
+def stats() -> dict:
+    lookups = _stats["l1_hits"] + _stats["l2_hits"] + _stats["misses"]
+    return {
+        "enabled": enabled(),
+        "backend": GEO_CACHE_BACKEND,
+        "l1": _l1.stats(),
+        **_stats,
+        "hit_ratio": round((lookups - _stats["misses"]) / lookups, 3) if lookups else None,
+    }
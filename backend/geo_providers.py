@@ -0,0 +1,313 @@
+"""
+Параллельный опрос внешних геокодеров для /geo/autocomplete.
+
+Раньше geo_rest.autocomplete ходил в Nominatim → Photon → maps.co →
+Open-Meteo по очереди блокирующим requests внутри sync-обработчика, и всё
+должно было уложиться в TOTAL_TIME_BUDGET (0.9 с) — до последних
+провайдеров очередь часто не доходила. Теперь:
+- все провайдеры запрашиваются одновременно через общий httpx.AsyncClient
+  (пул keep-alive соединений на процесс);
+- fan_out() отдаёт ответы по мере прихода; когда вызывающему хватает
+  результатов или кончился бюджет, оставшиеся запросы отменяются;
+- транслитерация грузинского запроса — hedge: второй запрос к тому же
+  провайдеру уходит, только если основной за GEO_HEDGE_DELAY_MS ничего не
+  вернул (не удваиваем нагрузку на Nominatim с его лимитом 1 req/s);
+- у каждого провайдера гистограмма задержек и circuit breaker: после
+  GEO_BREAKER_FAILURES ошибок/таймаутов подряд провайдер пропускается
+  GEO_BREAKER_OPEN_SEC секунд, затем пробуется одним запросом.
+
+Разбор ответов (нормализация, scope) остаётся в geo_rest.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import httpx
+
+HTTP_TIMEOUT = float(os.getenv("GEO_HTTP_TIMEOUT", "0.7") or "0.7")
+# Проверять ли SSL у внешних геокодеров (по умолчанию да)
+VERIFY_SSL = os.getenv("GEO_VERIFY_SSL", "1").lower() not in ("0", "false", "no")
+GEO_HTTP_MAX_CONNECTIONS = int(os.getenv("GEO_HTTP_MAX_CONNECTIONS", "50") or "50")
+GEO_HEDGE_DELAY_MS = int(os.getenv("GEO_HEDGE_DELAY_MS", "250") or "250")
+GEO_BREAKER_FAILURES = int(os.getenv("GEO_BREAKER_FAILURES", "3") or "3")
+GEO_BREAKER_OPEN_SEC = float(os.getenv("GEO_BREAKER_OPEN_SEC", "30") or "30")
+
+NOMINATIM = "https://nominatim.openstreetmap.org"
+PHOTON = "https://photon.komoot.io/api/"
+MAPSCO = "https://geocode.maps.co/search"
+OPENMETEO = "https://geocoding-api.open-meteo.com/v1/search"
+USER_AGENT = "Transinfo/1.0 (support@transinfo)"
+
+# Верхние границы корзин гистограммы задержек, мс (последняя — всё, что больше)
+LATENCY_BUCKETS_MS = (50, 100, 200, 300, 500, 700, 1000)
+
+
+# ----------------------------- запросы -----------------------------
+
+def _nominatim_request(q: str, lang: str, limit: int, country: Optional[str]):
+    params = {
+        "q": q, "format": "jsonv2", "addressdetails": 1, "namedetails": 1,
+        "limit": min(limit, 20), "dedupe": 1, "extratags": 1,
+    }
+    if country:
+        params["countrycodes"] = country.lower()
+    elif lang == "ka":
+        params["countrycodes"] = "ge"
+    return f"{NOMINATIM}/search", params, {"Accept-Language": f"{lang},en;q=0.8,ru;q=0.7"}
+
+
+def _photon_request(q: str, lang: str, limit: int, country: Optional[str]):
+    return PHOTON, {"q": q, "lang": lang, "limit": min(limit, 20)}, None
+
+
+def _mapsco_request(q: str, lang: str, limit: int, country: Optional[str]):
+    params = {
+        "q": q, "format": "jsonv2", "addressdetails": 1, "namedetails": 1,
+        "limit": min(limit, 20),
+    }
+    if country:
+        params["countrycodes"] = country.lower()
+    elif lang == "ka":
+        params["countrycodes"] = "ge"
+    return MAPSCO, params, None
+
+
+def _openmeteo_request(q: str, lang: str, limit: int, country: Optional[str]):
+    params = {"name": q, "language": lang, "count": min(limit, 20)}
+    if country:
+        params["country_code"] = country.upper()
+    return OPENMETEO, params, None
+
+
+def _as_list(data) -> list:
+    return data if isinstance(data, list) else []
+
+
+# имя -> (построение запроса, извлечение списка из JSON)
+PROVIDERS: Dict[str, Tuple[Callable, Callable[[Any], list]]] = {
+    "nominatim": (_nominatim_request, _as_list),
+    "photon": (_photon_request, lambda d: (d or {}).get("features") or []),
+    "mapsco": (_mapsco_request, _as_list),
+    "openmeteo": (_openmeteo_request, lambda d: (d or {}).get("results") or []),
+}
+
+
+# ----------------------------- метрики и breaker -----------------------------
+
+class _Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.opened = 0
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def allow(self, now: float) -> bool:
+        state = self.state(now)
+        if state == "closed":
+            return True
+        if state == "open" or self.probing:
+            return False
+        # half-open: пропускаем один пробный запрос
+        self.probing = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def failure(self, now: float) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.failures >= GEO_BREAKER_FAILURES:
+            if self.state(now) != "open":
+                self.opened += 1
+            self.open_until = now + GEO_BREAKER_OPEN_SEC
+
+    def release(self) -> None:
+        # Запрос отменён (результатов уже хватило) — ни успех, ни сбой
+        self.probing = False
+
+
+def _new_metrics() -> dict:
+    return {"ok": 0, "error": 0, "timeout": 0, "cancelled": 0, "skipped": 0,
+            "latency_ms": {**{f"le_{b}": 0 for b in LATENCY_BUCKETS_MS}, "inf": 0},
+            "latency_sum_ms": 0.0, "latency_count": 0}
+
+
+_breakers: Dict[str, _Breaker] = {name: _Breaker() for name in PROVIDERS}
+_metrics: Dict[str, dict] = {name: _new_metrics() for name in PROVIDERS}
+
+
+def _observe(name: str, outcome: str, ms: Optional[float] = None) -> None:
+    m = _metrics[name]
+    m[outcome] += 1
+    if ms is None:
+        return
+    for b in LATENCY_BUCKETS_MS:
+        if ms <= b:
+            m["latency_ms"][f"le_{b}"] += 1
+            break
+    else:
+        m["latency_ms"]["inf"] += 1
+    m["latency_sum_ms"] += ms
+    m["latency_count"] += 1
+
+
+# ----------------------------- HTTP -----------------------------
+
+_client_obj: Optional[httpx.AsyncClient] = None
+_client_loop = None
+
+
+def _client() -> httpx.AsyncClient:
+    """Общий клиент на event loop воркера: соединения к провайдерам переиспользуются."""
+    global _client_obj, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client_obj is None or _client_loop is not loop:
+        _client_obj = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            verify=VERIFY_SSL,
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(max_connections=GEO_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=20),
+        )
+        _client_loop = loop
+    return _client_obj
+
+
+async def _fetch(name: str, q: str, lang: str, limit: int,
+                 country: Optional[str]) -> Tuple[list, str]:
+    build, extract = PROVIDERS[name]
+    url, params, headers = build(q, lang, limit, country)
+    r = await _client().get(url, params=params, headers=headers)
+    r.raise_for_status()
+    return extract(r.json()), str(r.url)
+
+
+async def query(name: str, q: str, lang: str, limit: int, country: Optional[str] = None,
+                alt_q: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Запрос к одному провайдеру; alt_q — hedge-вариант (см. модуль).
+    Возвращает {"raw", "url", "t_ms"} и, если hedge ушёл, {"alt_raw", "alt_url"}.
+    """
+    t0 = time.perf_counter()
+    tasks = [asyncio.ensure_future(_fetch(name, q, lang, limit, country))]
+    try:
+        if alt_q:
+            done, _ = await asyncio.wait(tasks, timeout=GEO_HEDGE_DELAY_MS / 1000.0)
+            primary = tasks[0]
+            if not done or primary.exception() is not None or not primary.result()[0]:
+                tasks.append(asyncio.ensure_future(_fetch(name, alt_q, lang, limit, country)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    except asyncio.CancelledError:
+        for t in tasks:
+            t.cancel()
+        raise
+
+    ms = (time.perf_counter() - t0) * 1000.0
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if len(errors) == len(results):
+        err = errors[0]
+        _observe(name, "timeout" if isinstance(err, httpx.TimeoutException) else "error", ms)
+        _breakers[name].failure(time.monotonic())
+        raise err
+    _observe(name, "ok", ms)
+    _breakers[name].success()
+
+    out: Dict[str, Any] = {"raw": [], "url": None, "t_ms": round(ms)}
+    if not isinstance(results[0], BaseException):
+        out["raw"], out["url"] = results[0]
+    else:
+        out["error"] = str(results[0]) or type(results[0]).__name__
+    if len(results) > 1:
+        if isinstance(results[1], BaseException):
+            out["alt_error"] = str(results[1]) or type(results[1]).__name__
+        else:
+            out["alt_raw"], out["alt_url"] = results[1]
+    return out
+
+
+async def fan_out(names: Iterable[str], q: str, lang: str, limit: int,
+                  country: Optional[str], *, alt_q: Optional[str] = None,
+                  budget_sec: float,
+                  on_result: Callable[[str, Dict[str, Any]], bool]) -> Dict[str, dict]:
+    """
+    Опрашивает провайдеров одновременно. on_result(name, result) вызывается
+    по мере прихода ответов и возвращает True, когда результатов достаточно —
+    тогда (или по истечении budget_sec) оставшиеся запросы отменяются.
+    Возвращает diag по провайдерам.
+    """
+    diag: Dict[str, dict] = {}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget_sec
+    now = time.monotonic()
+    tasks: Dict[asyncio.Future, str] = {}
+    for name in names:
+        if not _breakers[name].allow(now):
+            _observe(name, "skipped")
+            diag[name] = {"skipped": "circuit open"}
+            continue
+        tasks[asyncio.ensure_future(query(name, q, lang, limit, country, alt_q))] = name
+
+    pending = set(tasks)
+    enough = False
+    while pending and not enough:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        done, pending = await asyncio.wait(
+            pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            name = tasks[t]
+            try:
+                res = t.result()
+            except Exception as e:
+                diag[name] = {"error": str(e) or type(e).__name__}
+                continue
+            diag[name] = {"raw_len": len(res["raw"]), "url": res["url"], "t_ms": res["t_ms"]}
+            for key in ("error", "alt_url", "alt_error"):
+                if res.get(key):
+                    diag[name][key] = res[key]
+            if "alt_raw" in res:
+                diag[name]["alt_raw_len"] = len(res["alt_raw"])
+            if on_result(name, res):
+                enough = True
+
+    # Отстающие: при нехватке времени это сбой провайдера, иначе просто не нужны
+    for t in pending:
+        t.cancel()
+        name = tasks[t]
+        if enough:
+            _observe(name, "cancelled")
+            _breakers[name].release()
+            diag[name] = {"cancelled": "enough results"}
+        else:
+            _observe(name, "timeout", budget_sec * 1000.0)
+            _breakers[name].failure(time.monotonic())
+            diag[name] = {"cancelled": "time budget"}
+    return diag
+
+
+def stats() -> dict:
+    now = time.monotonic()
+    out = {}
+    for name, m in _metrics.items():
+        b = _breakers[name]
+        out[name] = {
+            **m,
+            "latency_avg_ms": (round(m["latency_sum_ms"] / m["latency_count"], 1)
+                               if m["latency_count"] else None),
+            "breaker": b.state(now),
+            "breaker_failures": b.failures,
+            "breaker_opened": b.opened,
+        }
+    return out
@@ -1,13 +1,15 @@
 # backend/geo_rest.py
 import time
-from collections import OrderedDict
 from fastapi import APIRouter, Query, Depends, Response, Request
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
 from database import get_db
 from models import Place
+import geo_cache
+import geo_providers
+import place_index
 import re
-import requests
 import logging
 import json
 import uuid
@@ -17,16 +19,16 @@ from typing import Dict, Any, List, Optional
 # Логгер для гео‑автокомлита
 log = logging.getLogger("geo_autocomplete")
 
-# Таймауты и бюджеты по времени (можно переопределить через ENV)
-HTTP_TIMEOUT = float(os.getenv("GEO_HTTP_TIMEOUT", "0.7") or "0.7")
+# Бюджет по времени на весь опрос провайдеров (таймауты HTTP — geo_providers)
 TOTAL_TIME_BUDGET = float(os.getenv("GEO_TOTAL_TIME_BUDGET", "0.9") or "0.9")
 
-# Проверять ли SSL у внешних геокодеров (по умолчанию да)
-VERIFY_SSL = os.getenv("GEO_VERIFY_SSL", "1").lower() not in ("0", "false", "no")
-
 # Сколько результатов считается «достаточно», чтобы не ждать остальных провайдеров
 FAST_ENOUGH_RESULTS = int(os.getenv("GEO_FAST_ENOUGH_RESULTS", "5") or "5")
 
+# Если локальный индекс places (place_index) нашёл столько мест, внешние
+# геокодеры не опрашиваются; 0 — всегда опрашивать
+LOCAL_FIRST_MIN = int(os.getenv("GEO_LOCAL_FIRST_MIN", str(FAST_ENOUGH_RESULTS)) or "0")
+
 # Простая эвристика для аэропортов
 _RE_AIRPORT = re.compile(r"airport|аэропорт|aerodrome|airfield", re.IGNORECASE)
 
@@ -54,35 +56,8 @@ SUPPORTED_LANGS = {"ru", "en", "ka", "tr", "az"}
 # (используется в Query(DEFAULT_LIMIT, ...))
 DEFAULT_LIMIT = 8
 
-NOMINATIM = "https://nominatim.openstreetmap.org"
-PHOTON = "https://photon.komoot.io/api/"
-MAPSCO = "https://geocode.maps.co/search"
-OPENMETEO = "https://geocoding-api.open-meteo.com/v1/search"
-
-# --- HTTP session with keep-alive / connection pool for speed ---
-try:
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
-    SESSION = requests.Session()
-    adapter = HTTPAdapter(
-        pool_connections=20, pool_maxsize=50,
-        max_retries=Retry(total=2, backoff_factor=0.1,
-                          status_forcelist=[502, 503, 504])
-    )
-    SESSION.mount("http://", adapter)
-    SESSION.mount("https://", adapter)
-except Exception:
-    SESSION = requests  # fallback
-
-# --- simple in-process TTL cache ---
-_CACHE = OrderedDict()  # key -> (ts, data)
-# 0 = полностью выключить кэш
-CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", "0") or "0")
-CACHE_MAX = int(os.getenv("GEO_CACHE_MAX", "0") or "0")
-
-
 def prune_expired_cache(current_time: Optional[float] = None) -> int:
-    """Remove expired entries from the in-memory cache.
+    """Remove expired entries from the in-process (L1) geocode cache.
 
     Parameters
     ----------
@@ -92,59 +67,7 @@ def prune_expired_cache(current_time: Optional[float] = None) -> int:
         used.  The function returns the number of entries that were evicted so
         the caller may log or otherwise react to aggressive pruning.
     """
-
-    if current_time is None:
-        current_time = time.time()
-
-    expired: List[str] = []
-    for key, (ts, _data) in list(_CACHE.items()):
-        if current_time - ts > CACHE_TTL:
-            expired.append(key)
-
-    for key in expired:
-        _CACHE.pop(key, None)
-
-    return len(expired)
-
-def _cache_get(key: str) -> Optional[List[Dict[str, Any]]]:
-    """
-    Достаём из кэша список айтемов, если он включён и не протух.
-    """
-    # Кэш гео можно полностью отключить через ENV:
-    #   GEO_CACHE_MAX=0 или GEO_CACHE_TTL=0
-    if CACHE_MAX <= 0 or CACHE_TTL <= 0:
-        return None
-
-    entry = _CACHE.get(key)
-    if not entry:
-        return None
-
-    ts, data = entry
-    if time.time() - ts > CACHE_TTL:
-        # устарело — выкидываем
-        try:
-            del _CACHE[key]
-        except KeyError:
-            pass
-        return None
-
-    return data
-
-
-def _cache_set(key: str, items: List[Dict[str, Any]]) -> None:
-    """
-    Кладём в кэш (в простом формате: (timestamp, items)).
-    """
-    if CACHE_MAX <= 0 or CACHE_TTL <= 0:
-        return
-
-    now = time.time()
-    _CACHE[key] = (now, items)
-
-    # Лишнее выкидываем с начала (самые старые)
-    while len(_CACHE) > CACHE_MAX:
-        _CACHE.popitem(last=False)
-
+    return geo_cache.prune_l1(current_time)
 
 
 def _looks_like_poi(item: Dict[str, Any]) -> bool:
@@ -212,7 +135,12 @@ def _ka_variants(q: str) -> List[str]:
     return list(dict.fromkeys(out))
 
 
-def _local_fallback_items(db: Session, q: str, eff_lang: str, limit: int) -> List[Dict[str, Any]]:
+def _local_fallback_items(db: Session, q: str, eff_lang: str, limit: int,
+                          country: Optional[str] = None) -> List[Dict[str, Any]]:
+    # In-memory индекс places; SQL — пока индекс строится (или выключен)
+    indexed = place_index.search(q, eff_lang, limit, country)
+    if indexed is not None:
+        return indexed
     like = f"{q}%"
     rows = (
         db.query(Place)
@@ -480,8 +408,57 @@ def _passes_scope(item: Dict[str, Any], scope: str, provider: str) -> bool:
     return True
 
 
+# Разбор ответов провайдеров: нормализация и правило scope (osm / грубая эвристика)
+_PROVIDER_PARSERS = {
+    "nominatim": (_normalize_nominatim, "osm"),
+    "photon": (_normalize_photon, "photon"),
+    "mapsco": (_normalize_mapsco, "osm"),
+    "openmeteo": (_normalize_openmeteo, "photon"),
+}
+
+
+async def _remote_items(q: str, eff_lang: str, scope: str, limit: int,
+                        country: Optional[str]):
+    """Опрос провайдеров: (items, diag по провайдерам, ответили ли все)."""
+    combined: List[Dict[str, Any]] = []
+    enough = min(FAST_ENOUGH_RESULTS, limit)
+
+    def _merge(provider: str, res: Dict[str, Any]) -> bool:
+        normalize, scope_rule = _PROVIDER_PARSERS[provider]
+        for it in list(res.get("raw") or []) + list(res.get("alt_raw") or []):
+            norm = normalize(it, eff_lang)
+            if not norm:
+                continue
+            if not _passes_scope(norm, scope, scope_rule):
+                continue
+            if scope == "settlement" and _looks_like_poi(norm):
+                continue
+            _enrich_with_query(norm, q, eff_lang)
+            combined.append(norm)
+        return len(_dedupe(combined, limit)) >= enough
+
+    # Грузинский запрос: транслитерация — hedge-запрос к тем же провайдерам
+    alt_q = _ka_to_lat(q) if eff_lang == "ka" else None
+    if alt_q == q:
+        alt_q = None
+
+    provider_diag = await geo_providers.fan_out(
+        _PROVIDER_PARSERS, q, eff_lang, limit, country,
+        alt_q=alt_q, budget_sec=TOTAL_TIME_BUDGET, on_result=_merge)
+    complete = not any(d.get("error") or d.get("skipped") or d.get("cancelled") == "time budget"
+                       for d in provider_diag.values())
+    return _dedupe(combined, limit), provider_diag, complete
+
+
+async def _remote_for_cache(q: str, eff_lang: str, scope: str, limit: int,
+                            country: Optional[str]):
+    """Фоновое обновление устаревшей записи кэша: None — не перезаписывать."""
+    items, _diag, complete = await _remote_items(q, eff_lang, scope, limit, country)
+    return items if (items or complete) else None
+
+
 @router.get("/autocomplete")
-def autocomplete(
+async def autocomplete(
     q: str = Query(..., min_length=2),
     lang: str = Query("ru"),
     scope: str = Query("settlement"),
@@ -512,300 +489,53 @@ def autocomplete(
 
     eff_lang = _detect_lang_from_query(q)
     diag["lang_detected"] = eff_lang
-    ka_alts: List[str] = _ka_variants(q) if eff_lang == "ka" else []
     if eff_lang not in SUPPORTED_LANGS:
         eff_lang = "en"
     inp_lang = _detect_lang_from_query(q)
     if eff_lang != inp_lang:
         eff_lang = inp_lang
 
-    cache_key = f"{q}|{eff_lang}|{scope}|{country}"
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        return {"items": cached}
-
     # Полностью оффлайн‑режим: не ходим ни в какие внешние геокодеры,
     # работаем только с локальной таблицей places.
     if os.getenv("GEOCODER_OFFLINE") == "1":
-        items = _local_fallback_items(db, q, eff_lang, limit)
-        # На всякий случай можем закэшировать, если GEO_CACHE_MAX > 0
-        _cache_set(cache_key, items)
+        items = await run_in_threadpool(_local_fallback_items, db, q, eff_lang, limit, country)
         return {"items": items}
 
-    combined: List[Dict[str, Any]] = []
-
-    t0 = time.perf_counter()
-
-    def _within_budget() -> bool:
-        return (time.perf_counter() - t0) < TOTAL_TIME_BUDGET
-
-    def _respond(items):
-        # финализация + лог
-        if not items:
-            items = _local_fallback_items(db, q, eff_lang, limit)
-        _cache_set(cache_key, items)
-        payload = {"items": items}
-        if debug:
-            payload["diag"] = diag
-        try:
-            log.info("AC %s %s", rid, json.dumps({
-                "rid": rid, "q": q, "lang": eff_lang, "scope": scope,
-                "counts": {k: v.get("raw_len") for k, v in diag.items() if isinstance(v, dict)},
-                "errors": {k: v.get("error") for k, v in diag.items() if isinstance(v, dict) and v.get("error")}
-            }, ensure_ascii=False))
-        except Exception:
-            pass
-        return payload
-
-    # ---------- Nominatim ----------
-    try:
-        t1 = time.perf_counter()
-        params = {
-            "q": q, "format": "jsonv2", "addressdetails": 1, "namedetails": 1,
-            "limit": min(limit, 20), "dedupe": 1, "extratags": 1,
-        }
-        if country:
-            params["countrycodes"] = country.lower()
-        if not country and eff_lang == "ka":
-            params["countrycodes"] = "ge"
-        headers = {
-            "Accept-Language": f"{eff_lang},en;q=0.8,ru;q=0.7",
-            "User-Agent": "Transinfo/1.0 (support@transinfo)"
-        }
-        r = SESSION.get(f"{NOMINATIM}/search", params=params,
-                        headers=headers, timeout=HTTP_TIMEOUT)
-        diag["nominatim"]["status"] = r.status_code
-        diag["nominatim"]["url"] = getattr(r, "url", None)
-        r.raise_for_status()
-        raw = r.json()
-        diag["nominatim"]["raw_len"] = len(raw) if isinstance(raw, list) else 0
-        diag["nominatim"]["t_ms"] = round((time.perf_counter() - t1) * 1000)
-
-        for it in raw or []:
-            norm = _normalize_nominatim(it, eff_lang)
-            if not norm:
-                continue
-            if not _passes_scope(norm, scope, "osm"):
-                continue
-            if scope == "settlement" and _looks_like_poi(norm):
-                continue
-            _enrich_with_query(norm, q, eff_lang)
-            combined.append(norm)
-
-        if len(combined) == 0 and eff_lang == "ka":
-            alt_q = _ka_to_lat(q)
-            if alt_q and alt_q != q:
-                params_alt = dict(params)
-                params_alt["q"] = alt_q
-                t2 = time.perf_counter()
-                r2 = SESSION.get(
-                    f"{NOMINATIM}/search", params=params_alt, headers=headers, timeout=HTTP_TIMEOUT)
-                try:
-                    raw2 = r2.json()
-                except Exception:
-                    raw2 = []
-                diag["nominatim"]["alt_url"] = getattr(r2, "url", None)
-                diag["nominatim"]["alt_t_ms"] = round(
-                    (time.perf_counter() - t2) * 1000)
-                for it in raw2 or []:
-                    norm = _normalize_nominatim(it, eff_lang)
-                    if not norm:
-                        continue
-                    if not _passes_scope(norm, scope, "osm"):
-                        continue
-                    if scope == "settlement" and _looks_like_poi(norm):
-                        continue
-                    _enrich_with_query(norm, q, eff_lang)
-                    combined.append(norm)
-
-        if combined:
-            items_fast = _dedupe(combined, limit)
-            if items_fast:
-                return _respond(items_fast)
-    except Exception as e:
-        diag["nominatim"]["error"] = str(e)
-        log.error("AUTO nominatim failed q=%r lang=%r err=%s", q, lang, e)
-
-    if not _within_budget():
-        return _respond(_dedupe(combined, limit))
-
-    # ---------- Photon ----------
-    try:
-        t1 = time.perf_counter()
-        pr = SESSION.get(PHOTON, params={"q": q, "lang": eff_lang, "limit": min(
-            limit, 20)}, timeout=HTTP_TIMEOUT, verify=VERIFY_SSL)
-        pr.raise_for_status()
-        pdata = pr.json()
-        feats = pdata.get("features") or []
-        diag["photon"]["raw_len"] = len(feats)
-        diag["photon"]["url"] = getattr(pr, "url", None)
-        diag["photon"]["t_ms"] = round((time.perf_counter() - t1) * 1000)
-        for feat in feats:
-            norm = _normalize_photon(feat, eff_lang)
-            if not norm:
-                continue
-            if not _passes_scope(norm, scope, "photon"):
-                continue
-            if scope == "settlement" and _looks_like_poi(norm):
-                continue
-            _enrich_with_query(norm, q, eff_lang)
-            combined.append(norm)
-
-        if len(combined) == 0 and eff_lang == "ka":
-            alt_q = _ka_to_lat(q)
-            if alt_q and alt_q != q:
-                t2 = time.perf_counter()
-                pr2 = SESSION.get(PHOTON, params={"q": alt_q, "lang": eff_lang, "limit": min(
-                    limit, 20)}, timeout=HTTP_TIMEOUT, verify=VERIFY_SSL)
-                try:
-                    feats2 = pr2.json().get("features") or []
-                except Exception:
-                    feats2 = []
-                diag["photon"]["alt_url"] = getattr(pr2, "url", None)
-                diag["photon"]["alt_t_ms"] = round(
-                    (time.perf_counter() - t2) * 1000)
-                for feat in feats2:
-                    norm = _normalize_photon(feat, eff_lang)
-                    if norm and _passes_scope(norm, scope, "photon") and not (scope == "settlement" and _looks_like_poi(norm)):
-                        _enrich_with_query(norm, q, eff_lang)
-                        combined.append(norm)
-
-        if combined and len(combined) >= FAST_ENOUGH_RESULTS:
-            items_fast = _dedupe(combined, limit)
-            return _respond(items_fast)
-    except Exception as e:
-        diag["photon"]["error"] = str(e)
-        log.error("AUTO photon failed q=%r lang=%r err=%s", q, lang, e)
-
-    if not _within_budget():
-        return _respond(_dedupe(combined, limit))
-
-    # ---------- Maps.co ----------
-    if len(combined) < limit:
-        try:
-            mparams = {
-                "q": q, "format": "jsonv2", "addressdetails": 1, "namedetails": 1,
-                "limit": min(limit, 20),
-            }
-            if country:
-                mparams["countrycodes"] = country.lower()
-            elif eff_lang == "ka":
-                mparams["countrycodes"] = "ge"
-            t1 = time.perf_counter()
-            mr = SESSION.get(MAPSCO, params=mparams,
-                             timeout=HTTP_TIMEOUT, verify=VERIFY_SSL)
-            mr.raise_for_status()
-            mraw = mr.json()
-            diag["mapsco"] = {"raw_len": len(
-                mraw) if isinstance(mraw, list) else 0}
-            diag["mapsco"]["url"] = getattr(mr, "url", None)
-            diag["mapsco"]["t_ms"] = round((time.perf_counter() - t1) * 1000)
-            for it in (mraw or []):
-                norm = _normalize_mapsco(it, eff_lang)
-                if not norm:
-                    continue
-                if not _passes_scope(norm, scope, "osm"):
-                    continue
-                if scope == "settlement" and _looks_like_poi(norm):
-                    continue
-                _enrich_with_query(norm, q, eff_lang)
-                combined.append(norm)
-
-            if combined and len(combined) >= FAST_ENOUGH_RESULTS:
-                items_fast = _dedupe(combined, limit)
-                return _respond(items_fast)
-        except Exception as e:
-            diag["mapsco"] = {"error": str(e)}
-            log.error("AUTO mapsco failed q=%r lang=%r err=%s", q, lang, e)
-
-    # ---------- Open-Meteo ----------
-    if len(combined) < limit:
-        try:
-            om_params = {"name": q, "language": eff_lang,
-                         "count": min(limit, 20)}
-            if country:
-                om_params["country_code"] = country.upper()
-            t1 = time.perf_counter()
-            om = SESSION.get(OPENMETEO, params=om_params,
-                             timeout=HTTP_TIMEOUT, verify=VERIFY_SSL)
-            om.raise_for_status()
-            oj = om.json() or {}
-            results = oj.get("results") or []
-            diag["openmeteo"] = {"raw_len": len(results)}
-            diag["openmeteo"]["url"] = getattr(om, "url", None)
-            diag["openmeteo"]["t_ms"] = round(
-                (time.perf_counter() - t1) * 1000)
-            for it in results:
-                norm = _normalize_openmeteo(it, eff_lang)
-                if norm and _passes_scope(norm, scope, "photon"):
-                    if scope == "settlement" and _looks_like_poi(norm):
-                        continue
-                    _enrich_with_query(norm, q, eff_lang)
-                    combined.append(norm)
-
-            if len(combined) == 0 and eff_lang == "ka":
-                alt_q = _ka_to_lat(q)
-                if alt_q and alt_q != q:
-                    om_params_alt = dict(om_params)
-                    om_params_alt["name"] = alt_q
-                    t2 = time.perf_counter()
-                    orq2 = SESSION.get(
-                        OPENMETEO, params=om_params_alt, timeout=HTTP_TIMEOUT, verify=VERIFY_SSL)
-                    try:
-                        results2 = orq2.json().get("results") or []
-                    except Exception:
-                        results2 = []
-                    diag["openmeteo"]["alt_url"] = getattr(orq2, "url", None)
-                    diag["openmeteo"]["alt_t_ms"] = round(
-                        (time.perf_counter() - t2) * 1000)
-                    for it in results2:
-                        norm = _normalize_openmeteo(it, eff_lang)
-                        if norm and _passes_scope(norm, scope, "photon"):
-                            if scope == "settlement" and _looks_like_poi(norm):
-                                continue
-                            _enrich_with_query(norm, q, eff_lang)
-                            combined.append(norm)
-
-            if combined and len(combined) >= FAST_ENOUGH_RESULTS:
-                items_fast = _dedupe(combined, limit)
-                return _respond(items_fast)
-        except Exception as e:
-            diag["openmeteo"] = {"error": str(e)}
-            log.error("AUTO openmeteo failed q=%r lang=%r err=%s", q, lang, e)
+    # Большинство нажатий клавиш закрывает локальный индекс — без внешних запросов
+    if LOCAL_FIRST_MIN > 0 and scope != "address":
+        local = place_index.search(q, eff_lang, limit, country)
+        if local is not None and len(local) >= min(LOCAL_FIRST_MIN, limit):
+            payload = {"items": local}
+            if debug:
+                diag["local_first"] = len(local)
+                payload["diag"] = diag
+            return payload
+
+    # Кэш ответов провайдеров: L1 воркера → общий L2 (geo_cache)
+    cache_key = geo_cache.make_key(q, eff_lang, scope, country, limit)
+    cached, cache_state, cache_tier = await geo_cache.aget(cache_key)
+    diag["cache"] = {"state": cache_state, "tier": cache_tier,
+                     "negative": cached == [], "counters": geo_cache.stats()}
+    if cached is not None:
+        if cache_state == geo_cache.STALE:
+            geo_cache.refresh_in_background(
+                cache_key, lambda: _remote_for_cache(q, eff_lang, scope, limit, country))
+        items = cached
+    else:
+        t0 = time.perf_counter()
+        items, provider_diag, complete = await _remote_items(q, eff_lang, scope, limit, country)
+        diag.update(provider_diag)
+        diag["t_ms"] = round((time.perf_counter() - t0) * 1000)
+        for name, d in provider_diag.items():
+            if d.get("error"):
+                log.error("AUTO %s failed q=%r lang=%r err=%s", name, q, lang, d["error"])
+        # Пустой ответ кэшируем (негативно), только если его подтвердили все провайдеры
+        if items or complete:
+            await geo_cache.aput(cache_key, items)
 
     # Локальная БД — последняя страховка
-    if not combined:
-        like = f"{q}%"
-        rows = (
-            db.query(Place)
-            .filter(
-                text(
-                    "EXISTS (SELECT 1 FROM jsonb_each_text(translations) AS t(key, value) WHERE t.value ILIKE :like)"
-                )
-            )
-            .params(like=like)
-            .limit(limit * 2)
-            .all()
-        )
-        for r in rows:
-            tr = r.translations or {}
-            name = tr.get(eff_lang) or tr.get(
-                "en") or next(iter(tr.values()), "")
-            combined.append({
-                "source": "local",
-                "osm_id": r.external_id,
-                "osm_type": r.osm_type,
-                "class": "place",
-                "type": "city",
-                "lat": float(r.lat), "lon": float(r.lon),
-                "country_iso2": (r.country_iso2 or "").upper(),
-                "name": name,
-                "translations": tr,
-                "container_city": None,
-                "address": {},
-            })
-
-    items = _dedupe(combined, limit)
+    if not items:
+        items = await run_in_threadpool(_local_fallback_items, db, q, eff_lang, limit, country)
 
     if not items:
         ql = (q or "").strip().lower()
@@ -819,4 +549,18 @@ def autocomplete(
                 "container_city": None, "address": {}
             }]
 
-    return _respond(items)
+    payload = {"items": items}
+    if debug:
+        payload["diag"] = diag
+    try:
+        log.info("AC %s %s", rid, json.dumps({
+            "rid": rid, "q": q, "lang": eff_lang, "scope": scope, "t_ms": diag.get("t_ms"),
+            "cache": cache_state,
+            "counts": {k: v.get("raw_len") for k, v in diag.items() if isinstance(v, dict)},
+            "errors": {k: v.get("error") or v.get("cancelled") or v.get("skipped")
+                       for k, v in diag.items()
+                       if isinstance(v, dict) and (v.get("error") or v.get("cancelled") or v.get("skipped"))}
+        }, ensure_ascii=False))
+    except Exception:
+        pass
+    return payload
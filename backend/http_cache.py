@@ -0,0 +1,430 @@
+"""
+Кэш GET-ответов для частых опросов (/my-chats, списки /orders и /transports).
+
+- ключ: user_id из JWT (а не сырой Authorization) + путь + query;
+- хранилище: in-process LRU с бюджетом по байтам (HTTP_CACHE_BACKEND=memory)
+  или Redis (HTTP_CACHE_BACKEND=redis) — тогда кэш общий для всех воркеров;
+- инвалидация через «поколения» областей (scope): запись валидна, пока
+  поколения её областей не изменились. Поколения поднимаются после commit
+  сессий, в которых менялись заявки/транспорт/чаты (см. install_invalidation_hooks),
+  и явно через invalidate() / invalidate_user_chats() для bulk-операций.
+
+Области:
+  "orders", "transports"   — все списки заявок/транспорта;
+  "chats"                  — все списки чатов;
+  "chats:u:<user_id>"      — чаты конкретного пользователя.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from jose import jwt
+from starlette.responses import Response
+
+from auth import ALGORITHM, SECRET_KEY, get_token_from_header_or_cookie
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    return raw.strip().lower() in {"1", "true", "yes", "on"}
+
+
+DISABLE_HTTP_CACHE = _env_bool("DISABLE_HTTP_CACHE", False)
+# memory | redis
+HTTP_CACHE_BACKEND = (os.getenv("HTTP_CACHE_BACKEND", "memory") or "memory").strip().lower()
+# Максимум записей (0 = кэш выключен — так он выключен в systemd по умолчанию)
+HTTP_CACHE_MAX_ITEMS = int(os.getenv("HTTP_CACHE_MAX_ITEMS", "0") or "0")
+# Бюджет памяти in-process хранилища, байт (тело + заголовки)
+HTTP_CACHE_MAX_BYTES = int(
+    os.getenv("HTTP_CACHE_MAX_BYTES", str(32 * 1024 * 1024)) or "0")
+# Крупные ответы не кэшируем вовсе
+HTTP_CACHE_MAX_ENTRY_BYTES = int(
+    os.getenv("HTTP_CACHE_MAX_ENTRY_BYTES", str(512 * 1024)) or "0")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+_REDIS_PREFIX = "httpcache:"
+
+
+def enabled() -> bool:
+    return not DISABLE_HTTP_CACHE and HTTP_CACHE_MAX_ITEMS > 0 and HTTP_CACHE_MAX_BYTES > 0
+
+
+# Заголовки — список пар (имя в нижнем регистре, значение): имена могут
+# повторяться (несколько Set-Cookie), dict оставил бы одно значение
+Headers = List[Tuple[str, str]]
+
+
+class CachedResponse:
+    __slots__ = ("status_code", "headers", "body", "etag")
+
+    def __init__(self, status_code: int, headers: Headers, body: bytes, etag: str):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers) + 64
+
+    def dumps(self) -> bytes:
+        meta = json.dumps({"s": self.status_code, "h": self.headers, "e": self.etag},
+                          ensure_ascii=False).encode("utf-8")
+        return meta + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, raw: bytes) -> "CachedResponse":
+        meta, _, body = raw.partition(b"\n")
+        m = json.loads(meta.decode("utf-8"))
+        headers = m["h"]
+        # записи, сохранённые словарём до перехода на пары
+        pairs = headers.items() if isinstance(headers, dict) else headers
+        return cls(m["s"], [(k, v) for k, v in pairs], body, m["e"])
+
+
+class MemoryStore:
+    """LRU в памяти процесса с лимитом по числу записей и по байтам."""
+
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (expires_at, gens, CachedResponse)
+        self._data: "OrderedDict[str, Tuple[float, Tuple[int, ...], CachedResponse]]" = OrderedDict()
+        self._bytes = 0
+        self._gens: Dict[str, int] = {}
+
+    def generations(self, scopes: Sequence[str]) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._gens.get(s, 0) for s in scopes)
+
+    def get(self, key: str, scopes: Sequence[str]):
+        """(запись или None, текущие поколения scopes)."""
+        now = time.time()
+        with self._lock:
+            gens = tuple(self._gens.get(s, 0) for s in scopes)
+            item = self._data.get(key)
+            if item is None:
+                return None, gens
+            expires_at, item_gens, resp = item
+            if expires_at <= now or item_gens != gens:
+                self._pop(key)
+                return None, gens
+            self._data.move_to_end(key)
+            return resp, gens
+
+    def set(self, key: str, resp: CachedResponse, ttl: float, gens: Tuple[int, ...], scopes: Sequence[str]) -> None:
+        size = resp.size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Пока считали ответ, область могла инвалидироваться — тогда не кладём
+            if tuple(self._gens.get(s, 0) for s in scopes) != gens:
+                return
+            self._pop(key)
+            self._data[key] = (time.time() + ttl, gens, resp)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_items or self._bytes > self.max_bytes):
+                old_key = next(iter(self._data))
+                self._pop(old_key)
+
+    def _pop(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2].size
+
+    def bump(self, scopes: Iterable[str]) -> None:
+        with self._lock:
+            for s in scopes:
+                self._gens[s] = self._gens.get(s, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "items": len(self._data), "bytes": self._bytes,
+                    "max_items": self.max_items, "max_bytes": self.max_bytes}
+
+
+class RedisStore:
+    """
+    Общий для воркеров кэш в Redis. Поколения — счётчики httpcache:gen:<scope>,
+    запись и поколения читаются одним MGET. Ошибки Redis = промах кэша.
+    """
+
+    def __init__(self, url: str):
+        import redis
+        self._r = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+
+    @staticmethod
+    def _gen_key(scope: str) -> str:
+        return f"{_REDIS_PREFIX}gen:{scope}"
+
+    @staticmethod
+    def _entry_key(key: str) -> str:
+        return f"{_REDIS_PREFIX}e:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def generations(self, scopes: Sequence[str]) -> Tuple[int, ...]:
+        vals = self._r.mget([self._gen_key(s) for s in scopes]) if scopes else []
+        return tuple(int(v or 0) for v in vals)
+
+    def get(self, key: str, scopes: Sequence[str]):
+        try:
+            vals = self._r.mget([self._gen_key(s) for s in scopes] + [self._entry_key(key)])
+        except Exception as e:
+            print("[HTTP_CACHE] redis get failed:", e)
+            return None, None
+        gens = tuple(int(v or 0) for v in vals[:-1])
+        raw = vals[-1]
+        if not raw:
+            return None, gens
+        stored_gens, _, payload = raw.partition(b"|")
+        if stored_gens.decode("ascii") != ",".join(map(str, gens)):
+            return None, gens
+        try:
+            return CachedResponse.loads(payload), gens
+        except Exception:
+            return None, gens
+
+    def set(self, key: str, resp: CachedResponse, ttl: float, gens, scopes: Sequence[str]) -> None:
+        if gens is None:
+            return
+        try:
+            value = ",".join(map(str, gens)).encode("ascii") + b"|" + resp.dumps()
+            self._r.set(self._entry_key(key), value, px=max(1, int(ttl * 1000)))
+        except Exception as e:
+            print("[HTTP_CACHE] redis set failed:", e)
+
+    def bump(self, scopes: Iterable[str]) -> None:
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            for s in scopes:
+                pipe.incr(self._gen_key(s))
+            pipe.execute()
+        except Exception as e:
+            print("[HTTP_CACHE] redis invalidate failed:", e)
+
+    def stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if HTTP_CACHE_BACKEND == "redis":
+                    _store = RedisStore(REDIS_URL)
+                else:
+                    _store = MemoryStore(HTTP_CACHE_MAX_ITEMS, HTTP_CACHE_MAX_BYTES)
+    return _store
+
+
+# ---------------------------- инвалидация ----------------------------
+
+def invalidate(*scopes: str) -> None:
+    scopes = tuple(s for s in scopes if s)
+    if scopes and enabled():
+        store().bump(scopes)
+
+
+def invalidate_user_chats(*user_ids) -> None:
+    invalidate(*(f"chats:u:{uid}" for uid in user_ids if uid is not None))
+
+
+_SESSION_KEY = "_http_cache_scopes"
+_IGNORED_ATTRS = {"views"}  # счётчик просмотров не влияет на списки
+
+
+def _changed(obj) -> bool:
+    from sqlalchemy import inspect as sa_inspect
+    state = sa_inspect(obj)
+    for attr in state.attrs:
+        if attr.key in _IGNORED_ATTRS:
+            continue
+        if attr.history.has_changes():
+            return True
+    return False
+
+
+def _collect(session, flush_context) -> None:
+    from models import (
+        Chat, ChatMessage, ChatParticipant, Order, Transport, UserBlock,
+    )
+    from sqlalchemy import select
+
+    scopes = session.info.setdefault(_SESSION_KEY, set())
+    chat_ids = set()
+    tracked = (Order, Transport, UserBlock, Chat, ChatMessage, ChatParticipant)
+    for bucket, is_dirty in ((session.new, False), (session.dirty, True), (session.deleted, False)):
+        for obj in bucket:
+            if not isinstance(obj, tracked):
+                continue
+            if is_dirty and isinstance(obj, (Order, Transport)) and not _changed(obj):
+                continue
+            if isinstance(obj, Order):
+                scopes.add("orders")
+            elif isinstance(obj, Transport):
+                scopes.add("transports")
+            elif isinstance(obj, UserBlock):
+                scopes.update(("orders", "transports"))
+            elif isinstance(obj, Chat):
+                chat_ids.add(obj.id)
+            elif isinstance(obj, (ChatMessage, ChatParticipant)):
+                chat_ids.add(obj.chat_id)
+                if isinstance(obj, ChatParticipant):
+                    scopes.add(f"chats:u:{obj.user_id}")
+    chat_ids.discard(None)
+    if chat_ids:
+        rows = session.connection().execute(
+            select(ChatParticipant.user_id).where(
+                ChatParticipant.chat_id.in_(chat_ids))
+        )
+        scopes.update(f"chats:u:{uid}" for (uid,) in rows)
+
+
+def _after_flush(session, flush_context) -> None:
+    if not enabled():
+        return
+    try:
+        _collect(session, flush_context)
+    except Exception as e:
+        # Кэш живёт секунды — лучше сбросить всё, чем уронить транзакцию
+        print("[HTTP_CACHE] collect scopes failed:", e)
+        session.info.setdefault(_SESSION_KEY, set()).update(
+            ("orders", "transports", "chats"))
+
+
+def _after_commit(session) -> None:
+    scopes = session.info.pop(_SESSION_KEY, None)
+    if scopes:
+        invalidate(*scopes)
+
+
+def _after_rollback(session) -> None:
+    session.info.pop(_SESSION_KEY, None)
+
+
+_hooks_installed = False
+
+
+def install_invalidation_hooks() -> None:
+    """Подписывает все ORM-сессии: после commit поднимаем поколения затронутых областей."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    event.listen(Session, "after_flush", _after_flush)
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
+    _hooks_installed = True
+
+
+# ---------------------------- middleware-хелпер ----------------------------
+
+def user_scope(request) -> Optional[str]:
+    """'u<user_id>' по JWT, 'anon' без токена, None — токен невалиден (не кэшируем)."""
+    token = get_token_from_header_or_cookie(request)
+    if not token:
+        return "anon"
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except Exception:
+        return None
+    uid = payload.get("user_id")
+    return f"u{int(uid)}" if uid else None
+
+
+def _header(headers: Headers, name: str) -> Optional[str]:
+    for k, v in headers:
+        if k == name:
+            return v
+    return None
+
+
+def _set_default(headers: Headers, name: str, value: str) -> None:
+    if _header(headers, name.lower()) is None:
+        headers.append((name.lower(), value))
+
+
+def _response(body: bytes, status_code: int, headers: Headers) -> Response:
+    # raw_headers напрямую: Response(headers=dict) схлопнул бы повторы;
+    # content-length считает сам Response
+    resp = Response(content=body, status_code=status_code)
+    resp.raw_headers = resp.raw_headers + [
+        (k.encode("latin-1"), v.encode("latin-1"))
+        for k, v in headers if k != "content-length"
+    ]
+    return resp
+
+
+async def serve(request, call_next, *, ttl: float, scopes: Sequence[str],
+                cache_control: str, extra_headers: Optional[dict] = None,
+                user: Optional[str] = None):
+    """
+    Отдаёт ответ из кэша (или 304 по If-None-Match), иначе вызывает handler и
+    кладёт успешный JSON в кэш с поколениями, прочитанными ДО handler'а.
+    """
+    key = f"{user}:{request.url.path}?{request.url.query}"
+    st = store()
+    cached, gens = None, None
+    if request.query_params.get("nocache") not in ("1", "true"):
+        cached, gens = st.get(key, scopes)
+    else:
+        try:
+            gens = st.generations(scopes)
+        except Exception:
+            gens = None
+
+    if cached is not None:
+        inm = request.headers.get("if-none-match")
+        if inm and cached.etag and inm == cached.etag:
+            return Response(status_code=304)
+        out_headers = [(k, v) for k, v in cached.headers if k != "etag"]
+        if cached.etag:
+            out_headers.append(("etag", cached.etag))
+        _set_default(out_headers, "Cache-Control", cache_control)
+        for k, v in (extra_headers or {}).items():
+            _set_default(out_headers, k, v)
+        return _response(cached.body, cached.status_code, out_headers)
+
+    response = await call_next(request)
+
+    body = b""
+    async for chunk in response.body_iterator:
+        body += chunk
+
+    headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in response.headers.raw]
+    _set_default(headers, "Vary", "Authorization, Cookie")
+    ctype = _header(headers, "content-type") or ""
+    if response.status_code == 200 and "application/json" in ctype:
+        etag = 'W/"%s"' % hashlib.md5(body).hexdigest()
+        headers = [(k, v) for k, v in headers if k != "etag"]
+        headers.append(("etag", etag))
+        _set_default(headers, "Cache-Control", cache_control)
+        for k, v in (extra_headers or {}).items():
+            _set_default(headers, k, v)
+        if gens is not None and (HTTP_CACHE_MAX_ENTRY_BYTES <= 0 or len(body) <= HTTP_CACHE_MAX_ENTRY_BYTES):
+            # content-length пересчитает Response
+            stored_headers = [(k, v) for k, v in headers if k != "content-length"]
+            st.set(key, CachedResponse(response.status_code, stored_headers, body, etag),
+                   ttl, gens, scopes)
+
+    return _response(body, response.status_code, headers)
+
+
+def stats() -> dict:
+    if not enabled():
+        return {"enabled": False}
+    return {"enabled": True, **store().stats()}
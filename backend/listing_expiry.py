@@ -0,0 +1,175 @@
+"""
+Просрочка заявок и транспорта одним набором SQL-операторов.
+
+Раньше это делали четыре цикла (два потока в main.py и две задачи в
+order_reminders.py): все активные строки через .all(), разбор строковых дат
+в Python и create_notification по одной — со своей проверкой дублей и commit.
+Теперь run() за один проход:
+- уведомления за 1/4/7 дней — INSERT ... SELECT по индексированным
+  типизированным датам (orders.load_date_d, transports.ready_date_*_d);
+- через EXPIRE_AFTER_DAYS — UPDATE ... SET is_active = false RETURNING
+  и уведомления *_AUTO_DISABLED по возвращённым строкам.
+Дубли отсекает уникальный индекс uq_notifications_listing_expiry_day
+(ON CONFLICT DO NOTHING): повторный запуск в тот же день (рестарт, второй
+воркер) ничего не дублирует. Письма ставятся в email_outbox тем же оператором,
+WS-события уходят после commit.
+
+Дата транспорта — ready_date_to, а если её нет — ready_date_from.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# Через сколько дней после даты загрузки/готовности объявление скрывается
+EXPIRE_AFTER_DAYS = int(os.getenv("LISTING_EXPIRE_AFTER_DAYS", "8") or "8")
+REMIND_DAYS = (1, 4, 7)
+
+ORDER_MESSAGES = {
+    1: "notif.order.overdue1|{}|Срок даты загрузки заявки истёк.",
+    4: "notif.order.overdue4|{}|Прошло 4 дня с даты загрузки. Заявка будет скрыта, если вы не обновите дату загрузки.",
+    7: "notif.order.overdue7|{}|Прошло 7 дней с даты загрузки. Обновите дату, иначе завтра заявка будет автоматически скрыта.",
+    0: "notif.order.autoDisabled|{}|Ваша заявка скрыта из-за истечения срока.",
+}
+TRANSPORT_MESSAGES = {
+    1: "notif.transport.overdue1|{}|По объявлению транспорта просрочка 1 день.",
+    4: "notif.transport.overdue4|{}|По объявлению транспорта просрочка 4 дня.",
+    7: "notif.transport.overdue7|{}|По объявлению транспорта просрочка 7 дней.",
+    0: "notif.transport.autoDisabled|{}|Ваше транспортное объявление скрыто из-за истечения срока.",
+}
+
+# table, колонка даты, префикс типа уведомления, тексты
+_KINDS = {
+    "orders": ("o.load_date_d", "ORDER", ORDER_MESSAGES),
+    "transports": ("COALESCE(o.ready_date_to_d, o.ready_date_from_d)", "TRANSPORT", TRANSPORT_MESSAGES),
+}
+
+# Вставка уведомлений + писем по выборке due(id, owner_id, type, message);
+# ins — реально вставленные (не задублированные) уведомления.
+_NOTIFY_CTE = """
+    ins AS (
+        INSERT INTO notifications (user_id, type, message, related_id, created_at, read)
+        SELECT owner_id, CAST(type AS notificationtype), message, CAST(id AS varchar), :now, false
+          FROM due
+         WHERE owner_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+        RETURNING id, user_id, type, message, related_id, created_at
+    ), mail AS (
+        INSERT INTO email_outbox (kind, user_id, payload, status, attempts, next_attempt_at, created_at)
+        SELECT 'notification', user_id,
+               jsonb_build_object('message', message, 'created_at', CAST(:now_iso AS text)),
+               'pending', 0, :now, :now
+          FROM ins
+    )
+"""
+_INS_COLUMNS = "ins.id, ins.user_id, CAST(ins.type AS text), ins.message, ins.related_id, ins.created_at"
+
+
+def _remind(db: Session, table: str, today: date, now: datetime) -> list:
+    """Уведомления за 1/4/7 дней. Возвращает вставленные уведомления."""
+    date_expr, prefix, messages = _KINDS[table]
+    cases_type = " ".join(f"WHEN {d} THEN '{prefix}_OVERDUE_{d}'" for d in REMIND_DAYS)
+    cases_msg = " ".join(f"WHEN {d} THEN CAST(:msg{d} AS varchar)" for d in REMIND_DAYS)
+    return db.execute(text(f"""
+        WITH src AS (
+            SELECT o.id, o.owner_id, CAST(:today AS date) - {date_expr} AS days
+              FROM {table} AS o
+             WHERE o.is_active = true
+               AND {date_expr} IN ({", ".join(f":day{d}" for d in REMIND_DAYS)})
+        ), due AS (
+            SELECT id, owner_id,
+                   CASE days {cases_type} END AS type,
+                   CASE days {cases_msg} END AS message
+              FROM src
+        ), {_NOTIFY_CTE}
+        SELECT {_INS_COLUMNS} FROM ins
+    """), {
+        "today": today, "now": now, "now_iso": now.isoformat(),
+        **{f"day{d}": today - timedelta(days=d) for d in REMIND_DAYS},
+        **{f"msg{d}": messages[d] for d in REMIND_DAYS},
+    }).fetchall()
+
+
+def _expire(db: Session, table: str, today: date, now: datetime) -> tuple:
+    """Скрывает просроченные. Возвращает (id скрытых, вставленные уведомления)."""
+    date_expr, prefix, messages = _KINDS[table]
+    rows = db.execute(text(f"""
+        WITH off AS (
+            UPDATE {table} AS o
+               SET is_active = false
+             WHERE o.is_active = true
+               AND {date_expr} <= :cutoff
+         RETURNING o.id, o.owner_id
+        ), due AS (
+            SELECT id, owner_id, CAST(:type AS varchar) AS type,
+                   CAST(:message AS varchar) AS message
+              FROM off
+        ), {_NOTIFY_CTE}
+        SELECT off.id, {_INS_COLUMNS}
+          FROM off
+          LEFT JOIN ins ON ins.related_id = CAST(off.id AS varchar)
+    """), {
+        "cutoff": today - timedelta(days=EXPIRE_AFTER_DAYS),
+        "type": f"{prefix}_AUTO_DISABLED",
+        "message": messages[0],
+        "now": now, "now_iso": now.isoformat(),
+    }).fetchall()
+    return [r[0] for r in rows], [tuple(r[1:]) for r in rows if r[1] is not None]
+
+
+def _event(row) -> dict:
+    nid, _user_id, ntype, message, related_id, created_at = row
+    return {
+        "event": "new_notification",
+        "id": nid,
+        "type": ntype,
+        "message": message,
+        "related_id": related_id,
+        "payload": None,
+        "created_at": created_at.isoformat() if created_at else None,
+        "read": False,
+    }
+
+
+async def _push_all(rows) -> None:
+    from notifications import push_notification
+    await asyncio.gather(
+        *(push_notification(r[1], _event(r)) for r in rows), return_exceptions=True)
+
+
+def run(db: Session, today: Optional[date] = None) -> Dict[str, int]:
+    """Один проход по заявкам и транспорту (коммитит сам). Возвращает счётчики."""
+    import http_cache
+
+    now = datetime.utcnow()
+    today = today or now.date()
+    notified = []
+    disabled = {}
+    counts = {}
+    for table in ("orders", "transports"):
+        reminded = _remind(db, table, today, now)
+        ids, expired_notified = _expire(db, table, today, now)
+        notified.extend(reminded)
+        notified.extend(expired_notified)
+        disabled[table] = ids
+        counts[f"{table}_reminded"] = len(reminded)
+        counts[f"{table}_disabled"] = len(ids)
+    db.commit()
+
+    # bulk UPDATE мимо ORM: HTTP-кэш списков — вручную (ключи автоподбора
+    # от is_active не зависят, его фильтрует сам запрос подбора)
+    http_cache.invalidate(*(t for t in ("orders", "transports") if disabled[t]))
+
+    if notified:
+        try:
+            asyncio.run(_push_all(notified))
+        except Exception as e:
+            print("[LISTING_EXPIRY] push failed:", e)
+        import email_outbox
+        email_outbox.wake()
+    return counts
@@ -0,0 +1,161 @@
+"""
+Точки погрузки/выгрузки заявок и транспорта в отдельной таблице listing_points.
+
+Координаты у записей лежат в JSONB (orders.from_locations_coords,
+transports.to_locations и т.п.), и радиусный поиск по ним шёл через
+jsonb_array_elements + ::double precision — без индекса, seq scan.
+Здесь они раскладываются в строки (order_id|transport_id, kind, lat, lng),
+а фильтр/сортировка по расстоянию идут через earthdistance:
+earth_box(...) @> ll_to_earth(lat, lng) берёт GiST-индекс, earth_distance
+отсекает углы бокса (точное расстояние по дуге большого круга).
+
+sync_* вызываются ДО commit, в той же транзакции, что и изменение записи.
+"""
+from __future__ import annotations
+
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from models import ListingPoint
+
+POINT_FROM = "from"
+POINT_TO = "to"
+
+# listing -> (таблица, колонка-ссылка в listing_points)
+_LISTINGS = {
+    "order": ("orders", "order_id"),
+    "transport": ("transports", "transport_id"),
+}
+
+
+def _coord(lat, lng) -> Optional[Tuple[float, float]]:
+    try:
+        lat = float(lat)
+        lng = float(lng)
+    except (TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return None
+    if lat == 0.0 and lng == 0.0:
+        return None
+    return lat, lng
+
+
+def _from_items(items) -> List[Tuple[int, float, float]]:
+    """(позиция в исходном массиве, lat, lng) для валидных точек."""
+    if isinstance(items, dict):
+        items = [items]
+    out = []
+    for i, item in enumerate(items or []):
+        if not isinstance(item, dict):
+            continue
+        c = _coord(item.get("lat"), item.get("lng"))
+        if c:
+            out.append((i, c[0], c[1]))
+    return out
+
+
+def transport_points(transport) -> List[Tuple[str, int, float, float]]:
+    points = []
+    c = _coord(getattr(transport, "from_location_lat", None),
+               getattr(transport, "from_location_lng", None))
+    src = [(0, c[0], c[1])] if c else _from_items(
+        getattr(transport, "from_location_coords", None))
+    for i, lat, lng in src[:1]:
+        points.append((POINT_FROM, i, lat, lng))
+    for i, lat, lng in _from_items(getattr(transport, "to_locations", None)):
+        points.append((POINT_TO, i, lat, lng))
+    return points
+
+
+def order_points(order) -> List[Tuple[str, int, float, float]]:
+    points = []
+    for i, lat, lng in _from_items(getattr(order, "from_locations_coords", None)):
+        points.append((POINT_FROM, i, lat, lng))
+    for i, lat, lng in _from_items(getattr(order, "to_locations_coords", None)):
+        points.append((POINT_TO, i, lat, lng))
+    return points
+
+
+def _replace(db: Session, column, owner_id, points: Iterable[Tuple[str, int, float, float]]) -> None:
+    db.query(ListingPoint).filter(column == owner_id).delete(
+        synchronize_session=False)
+    key = column.key
+    db.add_all([
+        ListingPoint(**{key: owner_id}, kind=kind, idx=idx, lat=lat, lng=lng)
+        for kind, idx, lat, lng in points
+    ])
+
+
+def sync_transport(db: Session, transport) -> None:
+    if transport is None or transport.id is None:
+        return
+    _replace(db, ListingPoint.transport_id, transport.id,
+             transport_points(transport))
+
+
+def sync_order(db: Session, order) -> None:
+    """Заявке нужен id — вызывать после flush()."""
+    if order is None or order.id is None:
+        return
+    _replace(db, ListingPoint.order_id, order.id, order_points(order))
+
+
+def _radius_km(radius_km) -> Optional[float]:
+    try:
+        r = float(radius_km or 0)
+    except (TypeError, ValueError):
+        return None
+    return r if r > 0 else None
+
+
+def radius_filter(listing: str, kind: str, lat, lng, radius_km, *, prefix: str):
+    """
+    SQL-условие «у записи есть точка kind в радиусе radius_km от (lat, lng)»
+    или None, если фильтр не задан. prefix — уникальный префикс параметров.
+    """
+    r = _radius_km(radius_km)
+    center = _coord(lat, lng)
+    if r is None or center is None:
+        return None
+    table, ref = _LISTINGS[listing]
+    return text(f"""
+        EXISTS (
+            SELECT 1
+            FROM listing_points AS lp
+            WHERE lp.{ref} = {table}.id
+              AND lp.kind = :{prefix}_kind
+              AND earth_box(ll_to_earth(:{prefix}_lat, :{prefix}_lng), :{prefix}_m)
+                  @> ll_to_earth(lp.lat, lp.lng)
+              AND earth_distance(ll_to_earth(:{prefix}_lat, :{prefix}_lng),
+                                 ll_to_earth(lp.lat, lp.lng)) <= :{prefix}_m
+        )
+    """).bindparams(**{
+        f"{prefix}_kind": kind,
+        f"{prefix}_lat": center[0],
+        f"{prefix}_lng": center[1],
+        f"{prefix}_m": r * 1000.0,
+    })
+
+
+def distance_order(listing: str, kind: str, lat, lng, *, prefix: str):
+    """
+    Выражение для ORDER BY: расстояние (м) до ближайшей точки kind.
+    Записи без координат — в конце.
+    """
+    center = _coord(lat, lng)
+    if center is None:
+        return None
+    table, ref = _LISTINGS[listing]
+    return text(f"""
+        (SELECT min(earth_distance(ll_to_earth(:{prefix}_lat, :{prefix}_lng),
+                                   ll_to_earth(lp.lat, lp.lng)))
+           FROM listing_points AS lp
+          WHERE lp.{ref} = {table}.id AND lp.kind = :{prefix}_kind) ASC NULLS LAST
+    """).bindparams(**{
+        f"{prefix}_kind": kind,
+        f"{prefix}_lat": center[0],
+        f"{prefix}_lng": center[1],
+    })
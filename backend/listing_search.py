@@ -0,0 +1,92 @@
+"""
+Текстовые фильтры списков заявок и транспорта (pg_trgm).
+
+Раньше q в /transports и /orders был ILIKE '%q%' по нескольким колонкам,
+«откуда/куда» — ILIKE по элементам JSONB через jsonb_array_elements, а
+/public/orders — lower(...).contains: ни один фильтр не мог взять индекс,
+каждый запрос читал всю таблицу. Теперь у orders/transports есть теневые
+колонки (собираются при записи, см. models.join_search_values):
+  search_text — свободный текст (фильтр q),
+  search_from — названия точек «откуда»,
+  search_to   — названия точек «куда»,
+с GIN-индексами gin_trgm_ops: ILIKE '%...%' по ним идёт через индекс, а
+word_similarity даёт релевантность для sort=relevance.
+"""
+from __future__ import annotations
+
+from typing import Optional
+
+from sqlalchemy import func, or_
+
+from models import Order, Transport
+
+FIELD_TEXT = "text"
+FIELD_FROM = "from"
+FIELD_TO = "to"
+
+_MODELS = {"order": Order, "transport": Transport}
+_COLUMNS = {FIELD_TEXT: "search_text", FIELD_FROM: "search_from", FIELD_TO: "search_to"}
+
+
+def _term(value) -> Optional[str]:
+    if value is None:
+        return None
+    term = " ".join(str(value).split())
+    return term or None
+
+
+def _like(term: str) -> str:
+    # Пользовательские % и _ ищутся буквально
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def column(listing: str, field: str):
+    return getattr(_MODELS[listing], _COLUMNS[field])
+
+
+def text_filter(listing: str, field: str, value):
+    """Условие «подстрока value в поле field» или None, если фильтр не задан."""
+    term = _term(value)
+    if term is None:
+        return None
+    return column(listing, field).ilike(_like(term), escape="\\")
+
+
+def any_filter(listing: str, value, *extra_columns):
+    """
+    Подстрока в любом из полей поиска (админка: один общий q). extra_columns —
+    дополнительные колонки того же listing (без индекса, только для админки).
+    """
+    conds = [text_filter(listing, field, value) for field in _COLUMNS]
+    if conds[0] is None:
+        return None
+    like = _like(_term(value))
+    conds.extend(col.ilike(like, escape="\\") for col in extra_columns)
+    return or_(*conds)
+
+
+def apply_filters(query, listing: str, *, q=None, from_location=None, to_location=None):
+    for field, value in ((FIELD_TEXT, q), (FIELD_FROM, from_location), (FIELD_TO, to_location)):
+        cond = text_filter(listing, field, value)
+        if cond is not None:
+            query = query.filter(cond)
+    return query
+
+
+def relevance_order(listing: str, *, q=None, from_location=None, to_location=None):
+    """
+    Выражение для ORDER BY (sort=relevance): сумма word_similarity заданных
+    фильтров по своим полям, лучшие — первыми. None, если фильтров нет.
+    """
+    scores = []
+    for field, value in ((FIELD_TEXT, q), (FIELD_FROM, from_location), (FIELD_TO, to_location)):
+        term = _term(value)
+        if term is not None:
+            scores.append(func.coalesce(func.word_similarity(term, column(listing, field)), 0))
+    if not scores:
+        return None
+    total = scores[0]
+    for s in scores[1:]:
+        total = total + s
+    return total.desc()
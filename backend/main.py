@@ -1,12 +1,12 @@
 from database import get_db
 from models import Match, Order, Transport, TrackingSession, TrackingShare, TrackingPoint, User as UserModel, Order as OrderModel, Transport as TransportModel  # get_db убран отсюда
-from models import Notification, NotificationType
+from models import NotificationType
 from notifications import router as notifications_router
 import models
 from notifications import find_matching_orders_for_transport
 from math import radians, cos, sin, asin, sqrt
 import asyncio
-from notifications import create_notification, find_and_notify_auto_match_for_order, find_and_notify_auto_match_for_transport, find_matching_orders
+from notifications import find_and_notify_auto_match_for_order, find_and_notify_auto_match_for_transport, find_matching_orders
 from notification_rest import router as notification_router
 from order_comments import router as order_comments_router
 from chat_rest import router as chat_rest_router
@@ -28,11 +28,8 @@ from models import (
 )
 from database import engine, Base
 from auth import router as auth_router, authenticate_user, create_access_token, get_current_user, SECRET_KEY, ALGORITHM
-import sys
-import threading
 import schemas
 from uuid import uuid4
-import subprocess
 import requests
 import redis
 import contextlib
@@ -40,12 +37,11 @@ import logging
 import uuid
 from collections import defaultdict
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional
 from password_reset_rest import router as password_reset_router
 from ws_chat import ws_router as ws_chat_router
 from starlette.websockets import WebSocketDisconnect, WebSocketState
 from jose import jwt, JWTError
-from models import UserBlock as UB
 from sqlalchemy.types import String
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSONB
@@ -62,10 +58,9 @@ from starlette.websockets import WebSocketState
 from starlette.responses import Response
 from fastapi import FastAPI, WebSocket, Query, Path as ApiPath, Response, Depends, HTTPException, status, Body, UploadFile, File, APIRouter, Request, Header, Response, Request
 from notifications import user_notification_connections, push_notification, find_matching_orders
-from order_reminders import start_scheduler
+from notifications import BlockedPairs
 from fastapi import Query, Depends, Response
 from typing import Optional, List
-from billing_tasks import start_billing_scheduler
 # TEMP: billing выключен, чтобы поднять API; вернём после фикса импорта в billing_rest
 # from billing_rest import router as billing_router
 from fastapi import Query, Depends
@@ -111,7 +106,6 @@ from starlette.responses import Response as StarletteResponse
 import hashlib
 import json
 import time
-from typing import Dict, Tuple
 from typing import Any, Optional
 from models import UserRole
 from schemas import Transport as TransportSchema
@@ -119,6 +113,21 @@ from schemas import Order as OrderSchema
 from schemas import OrderOut
 # (или где у тебя эта функция)
 from notifications import find_matching_transports
+import listing_points
+import listing_search
+import http_cache
+import chat_inbox
+import unread_counters
+import ws_broker
+import ws_outbox
+import tracking_ingest
+import tracking_history
+import track_positions
+import track_fanout
+import email_outbox
+import scheduler_worker
+import place_index
+import auto_match_queue
 from schemas import Order      # Импортируй Pydantic-модель!
 from typing import List
 from auth import get_current_user, get_token_from_header_or_cookie
@@ -127,7 +136,7 @@ from models import UserRole as DbUserRole
 from typing import Optional
 import secrets
 from schemas import BidOut, Order
-from datetime import datetime, timedelta, date
+from datetime import datetime, date
 import os
 DEBUG_SQL = os.getenv('DEBUG_SQL', '0') == '1'
 
@@ -217,34 +226,26 @@ def dbg_mem(tag: str) -> None:
 # Временный флажок: можно полностью отключить тяжёлые пересчёты счётчиков совпадений.
 DISABLE_MATCH_COUNTERS = os.getenv("DISABLE_MATCH_COUNTERS", "0") == "1"
 
-# Путь до скрипта воркера авто‑матча
-AUTO_MATCH_WORKER_PATH = Path(__file__).with_name("auto_match_worker.py")
-
-
 def enqueue_auto_match(kind: str, object_id):
     """
-    Стартует отдельный процесс auto_match_worker.py, чтобы подобрать совпадения.
+    Ставит задачу авто-подбора в очередь auto_match_jobs.
+    Выполняет её пул auto_match_worker.py (отдельный сервис), а не процесс на каждую запись.
     kind: "order" или "transport"
     object_id: id заявки или транспорта
     """
+    db = SessionLocal()
     try:
-        cmd = [
-            sys.executable,                      # тот же python, что и у uvicorn
-            str(AUTO_MATCH_WORKER_PATH),
-            "--kind", kind,
-            "--id", str(object_id),
-        ]
-        # Запускаем процесс в фоне, не блокируя запрос
-        subprocess.Popen(
-            cmd,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            close_fds=True,
+        created = auto_match_queue.enqueue(db, kind, object_id)
+        print(
+            f"[AUTO_MATCH] enqueued {kind}:{object_id}"
+            + ("" if created else " (coalesced with pending job)")
         )
-        print(f"[AUTO_MATCH] spawned worker: {' '.join(cmd)}")
     except Exception as e:
         # В случае ошибки просто логируем, но не валим API
-        print("[AUTO_MATCH] failed to spawn worker:", e)
+        db.rollback()
+        print("[AUTO_MATCH] failed to enqueue job:", e)
+    finally:
+        db.close()
 
 
 def get_optional_current_user(
@@ -507,8 +508,6 @@ ALLOW_WS_TOKEN_QUERY = os.getenv("ALLOW_WS_TOKEN_QUERY", "1") == "1"
 # Разрешать ли токен в query (?token=...) — только для DEV. В проде держим "0".
 ALLOW_WS_TOKEN_QUERY = os.getenv("ALLOW_WS_TOKEN_QUERY", "1") == "1"
 
-active_websockets = defaultdict(set)
-
 transport_live_watchers = defaultdict(set)
 
 # session_id -> set[WebSocket] (публичные зрители по share-ссылке)
@@ -530,22 +529,8 @@ def haversine(lat1, lon1, lat2, lon2):
 
 
 async def notify_user(user_id, message):
-    key = str(user_id)
-    ws_set = active_websockets.get(key)
-    if not ws_set:
-        return
-
-    for ws in ws_set.copy():
-        try:
-            await ws.send_json(message)
-        except Exception:
-            try:
-                ws_set.discard(ws)
-            except Exception:
-                pass
-
-    if not ws_set:
-        active_websockets.pop(key, None)
+    # Единый канал уведомлений: локальные сокеты + другие воркеры через ws_broker
+    await push_notification(user_id, message)
 
 # Логирование
 logging.basicConfig(
@@ -566,144 +551,48 @@ global_ws_connections = {}
 
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "https://transinfo.ge")
 
-# ключ: "<auth-идентификатор>:<path>?<query>" -> (ts, body, headers, status, etag)
-_HTTP_CACHE: Dict[str, Tuple[float, bytes, dict, int, str]] = {}
+# HTTP-кэш ответов (см. http_cache.py): бюджет по байтам, ключ по user_id из JWT,
+# опционально общий Redis, инвалидация после commit изменений заявок/транспорта/чатов.
+http_cache.install_invalidation_hooks()
+# Сводки /my-chats (chat_inbox) пересчитываются в той же транзакции, что и сообщения
+chat_inbox.install_hooks()
+# Счётчики непрочитанного: меняются в транзакции, после commit пушатся в WS уведомлений
+unread_counters.install_hooks()
+# Письма уведомлений: outbox в транзакции события, отправка — фоновый диспетчер
+email_outbox.install_hooks()
 
 
-def _get_env_bool(name: str, default: bool = False) -> bool:
-    raw = os.getenv(name)
-    if raw is None:
-        return default
-    return raw.strip().lower() in {"1", "true", "yes", "on"}
+@app.on_event("startup")
+async def _start_ws_broker():
+    # WS_BROKER=redis: подписка воркера на события чатов/уведомлений других воркеров
+    ws_broker.start(asyncio.get_running_loop())
+    print(f"[WS_BROKER] backend = {ws_broker.WS_BROKER}, worker = {ws_broker.WORKER_ID}")
 
 
-# Возможность мгновенно отключить HTTP-кэш без деплоя.
-DISABLE_HTTP_CACHE = _get_env_bool("DISABLE_HTTP_CACHE", False)
+@app.on_event("startup")
+async def _start_email_outbox():
+    email_outbox.start()
 
-# Максимальное число записей в памяти.
-# 0 или отрицательное значение полностью выключает кэширование.
-HTTP_CACHE_MAX_ITEMS = int(os.getenv("HTTP_CACHE_MAX_ITEMS", "0") or "0")
 
-# TTL записей (в секундах). После его истечения элементы удаляются.
-HTTP_CACHE_TTL = float(os.getenv("HTTP_CACHE_TTL", "5") or "5")
+@app.on_event("startup")
+async def _start_place_index():
+    # Префиксный индекс places для локального автокомплита (строится в фоне)
+    place_index.start()
 
-# За один проход чистки удаляем не более указанного количества записей.
-HTTP_CACHE_CLEANUP_BUDGET = int(
-    os.getenv("HTTP_CACHE_CLEANUP_BUDGET", "100") or "100")
 
+@app.on_event("startup")
+async def _start_scheduler():
+    # Периодические задачи — только у лидера (scheduler_worker); в проде SCHEDULER_MODE=off
+    scheduler_worker.start_in_api()
 
-# Порог, при котором мы считаем, что кэш раздулся и надо перезапустить сервис.
-# 0 или отрицательное значение = автоперезапуск выключен.
-HTTP_CACHE_RESTART_AT = int(os.getenv("HTTP_CACHE_RESTART_AT", "0") or "0")
-
-# Минимальный интервал (в секундах) между перезапусками по кэшу.
-HTTP_CACHE_RESTART_COOLDOWN = int(
-    os.getenv("HTTP_CACHE_RESTART_COOLDOWN", "300") or "300")
-
-if DISABLE_HTTP_CACHE:
-    HTTP_CACHE_MAX_ITEMS = 0
-
-
-_last_cache_restart_ts: float = 0.0
-
-print(f"[HTTP_CACHE] max items = {HTTP_CACHE_MAX_ITEMS}")
-print(
-    f"[HTTP_CACHE] ttl = {HTTP_CACHE_TTL}s, cleanup_budget = {HTTP_CACHE_CLEANUP_BUDGET}")
-print(
-    f"[HTTP_CACHE] restart_at = {HTTP_CACHE_RESTART_AT}, cooldown = {HTTP_CACHE_RESTART_COOLDOWN}s")
-
-
-def _http_cache_enabled() -> bool:
-    return HTTP_CACHE_MAX_ITEMS > 0 and HTTP_CACHE_TTL > 0 and not DISABLE_HTTP_CACHE
-
-
-def _http_cache_cleanup(now: Optional[float] = None) -> None:
-    """Удаляет протухшие записи из кэша, чтобы не накапливать память."""
-
-    if not _HTTP_CACHE:
-        return
-
-    now = now or time.time()
-    removed = 0
-    for key, value in list(_HTTP_CACHE.items()):
-        ts = value[0]
-        if now - ts >= HTTP_CACHE_TTL:
-            _HTTP_CACHE.pop(key, None)
-            removed += 1
-            if removed >= HTTP_CACHE_CLEANUP_BUDGET:
-                break
-
-
-def _restart_backend_service(reason: str) -> None:
-    """
-    Автоперезапуск сервиса, когда кэш разрастается.
-
-    Управляется переменными окружения:
-      - HTTP_CACHE_RESTART_AT — порог по числу записей (0 = выкл)
-      - HTTP_CACHE_RESTART_COOLDOWN — минимальный интервал между рестартами.
-    """
-    global _last_cache_restart_ts
-
-    if HTTP_CACHE_RESTART_AT <= 0:
-        # Автоперезапуск отключен
-        return
-
-    now = time.time()
-    # Защита от частых рестартов
-    if _last_cache_restart_ts and now - _last_cache_restart_ts < HTTP_CACHE_RESTART_COOLDOWN:
-        return
-
-    _last_cache_restart_ts = now
-    try:
-        size = len(_HTTP_CACHE)
-        print(
-            f"[HTTP_CACHE] size={size}, reason={reason} → restarting transinfo-backend.service")
-
-        # Перезапуск сервиса
-        subprocess.run(
-            ["sudo", "systemctl", "restart", "transinfo-backend.service"],
-            check=False,
-        )
-        # Логируем статус (вывод попадёт в journalctl)
-        subprocess.run(
-            ["sudo", "systemctl", "status", "transinfo-backend.service"],
-            check=False,
-        )
-    except Exception as e:
-        print(f"[HTTP_CACHE] restart failed: {e}")
-
-
-def _http_cache_put(key: str, entry: Tuple[float, bytes, dict, int, str]):
-    """
-    Кладём запись в _HTTP_CACHE с ограничением по количеству.
-    entry: (ts, body, headers, status_code, etag)
-    """
-    if not _http_cache_enabled():
-        # Кэш полностью выключен
-        return
-
-    try:
-        # Перед добавлением вычищаем протухшие записи.
-        _http_cache_cleanup(now=entry[0])
-
-        current_size = len(_HTTP_CACHE)
-
-        # Если кэш разросся — пробуем аккуратно перезапустить backend
-        if HTTP_CACHE_RESTART_AT > 0 and current_size >= HTTP_CACHE_RESTART_AT:
-            _restart_backend_service("HTTP cache size limit reached")
-
-        if current_size >= HTTP_CACHE_MAX_ITEMS:
-            # выкидываем ~10% самых старых ключей (по ts)
-            to_drop = sorted(
-                _HTTP_CACHE.items(), key=lambda kv: kv[1][0]
-            )[: max(1, HTTP_CACHE_MAX_ITEMS // 10)]
-            for k, _ in to_drop:
-                _HTTP_CACHE.pop(k, None)
+# Списки, которые фронт опрашивает по таймеру: путь -> область инвалидации
+_CACHEABLE_LIST_PATHS = {
+    "/orders": "orders",
+    "/transports": "transports",
+}
 
-        _HTTP_CACHE[key] = entry
-    except Exception:
-        # На всякий случай, чтобы из-за возможной ошибки не рухнул весь запрос
-        _HTTP_CACHE.clear()
+print(f"[HTTP_CACHE] enabled = {http_cache.enabled()}, backend = {http_cache.HTTP_CACHE_BACKEND}, "
+      f"max_items = {http_cache.HTTP_CACHE_MAX_ITEMS}, max_bytes = {http_cache.HTTP_CACHE_MAX_BYTES}")
 
 
 class ChatCacheMiddleware(BaseHTTPMiddleware):
@@ -715,7 +604,7 @@ class ChatCacheMiddleware(BaseHTTPMiddleware):
     TTL ~1.5с на пользователя и конкретный путь+query.
     Отдаём 304, если If-None-Match совпал с ETag.
 
-    При выключенном _http_cache_enabled() кэширование полностью отключено.
+    При выключенном http_cache.enabled() кэширование полностью отключено.
     """
 
     def __init__(self, app, ttl: float = 1.5):
@@ -724,85 +613,23 @@ class ChatCacheMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request, call_next):
         # если кэш глобально выключен — просто пропускаем дальше
-        if request.method != "GET" or not _http_cache_enabled():
+        if request.method != "GET" or not http_cache.enabled():
             return await call_next(request)
 
         path = request.url.path
         if path not in ("/my-chats", "/my-chats/unread_count"):
             return await call_next(request)
 
-        # Простая идентификация пользователя для ключа кэша:
-        auth_id = (
-            request.headers.get("authorization")
-            or request.cookies.get("access_token")
-            or request.cookies.get("token")
-            or ""
-        )
-        cache_key = f"{auth_id}:{path}?{request.url.query}"
-        now = time.time()
-
-        cached = None
-        if request.query_params.get("nocache") not in ("1", "true"):
-            cached = _HTTP_CACHE.get(cache_key)
-
-        if cached and (now - cached[0]) >= self.ttl:
-            _HTTP_CACHE.pop(cache_key, None)
-            cached = None
-
-        if cached:
-            _, body, headers, status_code, etag = cached
-            inm = request.headers.get("if-none-match")
-            if inm and etag and inm == etag:
-                # Клиент уже получил такую же версию
-                return Response(status_code=304)
-            # Отдаём кэш как есть
-            out_headers = dict(headers)
-            if etag:
-                out_headers["ETag"] = etag
-            out_headers.setdefault(
-                "Cache-Control", "private, max-age=1, stale-while-revalidate=5"
-            )
-            return Response(
-                content=body,
-                status_code=status_code,
-                headers=out_headers,
-                media_type=headers.get("content-type"),
-            )
-
-        # Нет кэша или протух — выполняем реальный handler
-        response = await call_next(request)
-
-        # Считываем тело ответа (превращаем в обычный Response)
-        body = b""
-        async for chunk in response.body_iterator:
-            body += chunk
-
-        headers = dict(response.headers)
-        headers.setdefault("Vary", "Authorization, Cookie")
-
-        # Кэшируем только успешный JSON
-        ctype = headers.get("content-type", "")
-        etag = None
-        if response.status_code == 200 and ("application/json" in ctype):
-            try:
-                etag = 'W/"%s"' % hashlib.md5(body).hexdigest()
-            except Exception:
-                etag = ""
-            if etag:
-                headers["ETag"] = etag
-            headers.setdefault(
-                "Cache-Control", "private, max-age=1, stale-while-revalidate=5"
-            )
-            _http_cache_put(
-                cache_key, (now, body, headers, response.status_code, etag)
-            )
-
-        # Возвращаем «пересобранный» ответ
-        return Response(
-            content=body,
-            status_code=response.status_code,
-            headers=headers,
-            media_type=response.media_type,
+        user = http_cache.user_scope(request)
+        if user is None or user == "anon":
+            return await call_next(request)
+        uid = user[1:]
+        return await http_cache.serve(
+            request, call_next,
+            ttl=self.ttl,
+            scopes=("chats", f"chats:u:{uid}"),
+            cache_control="private, max-age=1, stale-while-revalidate=5",
+            user=user,
         )
 
 
@@ -813,76 +640,23 @@ class ListCacheMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request, call_next):
         # глобальный выключатель кэша
-        if request.method != "GET" or not _http_cache_enabled():
+        if request.method != "GET" or not http_cache.enabled():
             return await call_next(request)
 
-        path = request.url.path
-        if path not in _CACHEABLE_LIST_PATHS:
+        scope = _CACHEABLE_LIST_PATHS.get(request.url.path)
+        if scope is None:
             return await call_next(request)
 
-        auth_id = (
-            request.headers.get("authorization")
-            or request.cookies.get("access_token")
-            or request.cookies.get("token")
-            or ""
-        )
-        cache_key = f"{auth_id}:{path}?{request.url.query}"
-        now = time.time()
-
-        cached = _HTTP_CACHE.get(cache_key)
-        if cached and (now - cached[0]) >= self.ttl:
-            _HTTP_CACHE.pop(cache_key, None)
-            cached = None
-
-        if cached:
-            _, body, headers, status_code, etag = cached
-            inm = request.headers.get("if-none-match")
-            if inm and etag and inm == etag:
-                return Response(status_code=304)
-            out_headers = dict(headers)
-            if etag:
-                out_headers["ETag"] = etag
-            out_headers.setdefault(
-                "Cache-Control", "private, max-age=2, stale-while-revalidate=5"
-            )
-            out_headers.setdefault("X-Poll-Interval", "2000")
-            return Response(
-                content=body,
-                status_code=status_code,
-                headers=out_headers,
-                media_type=headers.get("content-type"),
-            )
-
-        response = await call_next(request)
-
-        body = b""
-        async for chunk in response.body_iterator:
-            body += chunk
-
-        headers = dict(response.headers)
-        headers.setdefault("Vary", "Authorization, Cookie")
-
-        ctype = headers.get("content-type", "")
-        if response.status_code == 200 and ("application/json" in ctype):
-            try:
-                etag = 'W/"%s"' % hashlib.md5(body).hexdigest()
-            except Exception:
-                etag = ""
-            if etag:
-                headers["ETag"] = etag
-            headers.setdefault(
-                "Cache-Control", "private, max-age=1, stale-while-revalidate=5"
-            )
-            headers.setdefault("X-Poll-Interval", "1500")
-            _http_cache_put(
-                cache_key, (now, body, headers, response.status_code, etag)
-            )
-
-        return Response(
-            content=body,
-            status_code=response.status_code,
-            headers=headers,
-            media_type=response.media_type,
+        user = http_cache.user_scope(request)
+        if user is None:
+            return await call_next(request)
+        return await http_cache.serve(
+            request, call_next,
+            ttl=self.ttl,
+            scopes=(scope,),
+            cache_control="private, max-age=1, stale-while-revalidate=5",
+            extra_headers={"X-Poll-Interval": "1500"},
+            user=user,
         )
 
 
@@ -938,14 +712,9 @@ def whoami(current_user: UserModel = Depends(get_current_user)):
 app.include_router(notifications_router)
 
 
-start_scheduler()
-
-
 # --- BILLING ---
 # app.include_router(billing_router)
 
-start_billing_scheduler()
-
 # Sanity log — видно, подхватились ли ключи TBC
 print("[TBC env] APIKEY:", bool(os.getenv("TBC_API_KEY")),
       "CLIENT_ID:", bool(os.getenv("TBC_CLIENT_ID")),
@@ -1021,6 +790,10 @@ def ranged_file_response(request: Request, path: Path, content_type: str):
     return StreamingResponse(file_iterator(), status_code=206, headers=headers, media_type=content_type)
 
 
+if http_cache.enabled():
+    app.add_middleware(ChatCacheMiddleware)
+    app.add_middleware(ListCacheMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=CORS_ORIGINS,
@@ -1346,6 +1119,7 @@ def end_tracking_session(
         sh.active = False
         sh.stopped_at = datetime.utcnow()
     db.commit()
+    track_positions.forget(sess.id)
     # уведомим подписчиков сессии и карточки транспорта + персональные unshare
     try:
         import asyncio
@@ -1450,17 +1224,85 @@ def get_points(
     if not _can_view_tracking(db, user, sess):
         raise HTTPException(status_code=403, detail={
                             "code": "error.forbidden", "message": "Доступ запрещён"})
+    limit = min(limit, 5000)
+    if since:
+        since = tracking_ingest.naive_utc(since)
+    # Опрос «что нового с since» обычно целиком покрывается буфером последних точек
+    if since:
+        cached = track_positions.recent(sess.id, sess.last_point_at, since)
+        if cached is not None:
+            return cached[:limit]
     q = db.query(TrackingPoint).filter(TrackingPoint.session_id == session_id)
     if since:
         q = q.filter(TrackingPoint.ts >= since)
-    pts = q.order_by(TrackingPoint.ts.asc()).limit(min(limit, 5000)).all()
-    return [
+    pts = q.order_by(TrackingPoint.ts.asc()).limit(limit).all()
+    out = [
         {
             "lat": p.lat, "lng": p.lng, "ts": p.ts,
             "speed": p.speed, "heading": p.heading, "accuracy": p.accuracy, "battery": p.battery
         }
         for p in pts
     ]
+    # + точки, которые ещё ждут пакетной записи
+    if len(out) < limit:
+        out.extend(
+            {k: p[k] for k in ("lat", "lng", "ts", "speed", "heading", "accuracy", "battery")}
+            for p in tracking_ingest.pending_points(session_id, since)
+        )
+        out.sort(key=lambda x: x["ts"])
+        out = out[:limit]
+    return out
+
+
+@tracking_router.get("/track/sessions/{session_id}/history")
+def get_history(
+    session_id: str,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    tolerance_m: float = Query(10.0, ge=0, le=10000),
+    max_points: int = Query(2000, ge=2, le=20000),
+    db: Session = Depends(get_db),
+    user=Depends(get_current_user)
+):
+    """
+    Трек за окно [since, until], упрощённый на сервере (Дуглас–Пекер, допуск в метрах).
+    Если после упрощения точек больше max_points — допуск увеличивается.
+    """
+    sess = db.query(TrackingSession).filter(
+        TrackingSession.id == session_id).first()
+    if not sess:
+        raise HTTPException(status_code=404, detail={
+                            "code": "error.track.sessionNotFound", "message": "Сессия не найдена"})
+    if not _can_view_tracking(db, user, sess):
+        raise HTTPException(status_code=403, detail={
+                            "code": "error.forbidden", "message": "Доступ запрещён"})
+    if since and until and until < since:
+        raise HTTPException(status_code=422, detail={
+                            "code": "error.validation", "message": "until раньше since"})
+    raw = tracking_history.load_points(db, sess.id, since, until)
+    points, tolerance = tracking_history.simplify_to(raw, tolerance_m, max_points)
+    return {
+        "session_id": str(sess.id),
+        "since": since,
+        "until": until,
+        "tolerance_m": tolerance,
+        "raw_count": len(raw),
+        "truncated": len(raw) >= tracking_history.HISTORY_RAW_MAX,
+        "points": points,
+    }
+
+
+def _recent_track_points(db: Session, session_id, limit: int) -> List[dict]:
+    """Последние limit точек сессии по возрастанию ts: БД + ещё не записанный буфер."""
+    fields = ("lat", "lng", "ts", "speed", "heading", "accuracy", "battery")
+    pts = db.query(TrackingPoint).filter(TrackingPoint.session_id == session_id)\
+        .order_by(TrackingPoint.ts.desc()).limit(limit).all()
+    out = [{k: getattr(p, k) for k in fields} for p in reversed(pts)]
+    # ещё не записанные в БД точки из tracking_ingest — самые свежие
+    out.extend({k: p[k] for k in fields}
+               for p in tracking_ingest.pending_points(session_id))
+    out.sort(key=lambda x: x["ts"])
+    return out[-limit:] if limit > 0 else []
 
 
 @ws_router.websocket("/ws/track/transport_live")
@@ -1480,7 +1322,8 @@ async def ws_transport_live(
             await websocket.close(code=4401)
             return
 
-        # подписываем
+        # подписываем: очередь отправки создаём сразу, закрываем в finally
+        ws_outbox.attach(websocket, ws_outbox.WS_CHAT_OVERFLOW)
         transport_live_watchers[str(transport_id)].add(websocket)
 
         # моментальный снапшот: есть ли активная сессия для транспорта
@@ -1497,17 +1340,13 @@ async def ws_transport_live(
                 TrackingShare.active == True
             ).count()
             link_cnt = len(link_watchers.get(str(sess.id), set()))
-        # Первая отправка снапшота: тихо выходим, если клиент уже закрылся
-        try:
-            await websocket.send_json({
-                "type": "snapshot",
-                "live": bool(sess and (shares_cnt > 0 or link_cnt > 0)),
-                "session_id": str(sess.id) if sess else None
-            })
-        except WebSocketDisconnect:
-            return
-        except Exception as e:
-            logger.warning("ws_transport_live snapshot send failed: %r", e)
+        # Снапшот — через ту же очередь, что и события live_start/live_end,
+        # чтобы не писать в сокет параллельно с broadcast
+        if not ws_outbox.send(websocket, {
+            "type": "snapshot",
+            "live": bool(sess and (shares_cnt > 0 or link_cnt > 0)),
+            "session_id": str(sess.id) if sess else None
+        }):
             return
 
         # держим соединение (входящие не ждём)
@@ -1524,6 +1363,7 @@ async def ws_transport_live(
                 bucket.discard(websocket)
                 if not bucket:
                     transport_live_watchers.pop(key, None)
+            ws_outbox.detach(websocket)
         except Exception:
             pass
         db.close()
@@ -1534,12 +1374,9 @@ async def _emit_transport_live_event(transport_id: str, kind: str, session_id: s
     payload = {"type": kind, "transport_id": str(
         transport_id), "session_id": str(session_id)}
     key = str(transport_id)
-    dead = []
-    for ws in list(transport_live_watchers.get(key, set())):
-        try:
-            await ws.send_json(payload)
-        except Exception:
-            dead.append(ws)
+    dead = ws_outbox.broadcast(
+        list(transport_live_watchers.get(key, set())), payload,
+        policy=ws_outbox.WS_CHAT_OVERFLOW)
     if dead:
         bucket = transport_live_watchers.get(key)
         if bucket is not None:
@@ -1767,7 +1604,29 @@ async def track_watch(
                 await websocket.close(code=4403)
                 return
 
+        # Снапшот — последние 1000 точек (а не первые: зрителю нужен хвост трека)
+        cached = track_positions.recent(sess.id, sess.last_point_at)
+        if cached is None:
+            cached = _recent_track_points(db, sess.id, 1000)
+        points = [
+            {k: p[k] for k in ("lat", "lng", "ts", "speed", "heading", "accuracy")}
+            for p in cached[-1000:]
+        ]
+        for pt in points:
+            pt["ts"] = pt["ts"].isoformat()
+
+        # Снапшот идёт через ту же очередь, что и живые точки (один writer на
+        # сокет), и встаёт в неё первым: между чтением снапшота, регистрацией
+        # зрителя и постановкой batch нет await — точка не потеряется и не
+        # обгонит снапшот
+        ws_outbox.attach(websocket, ws_outbox.WS_TRACK_OVERFLOW)
         track_watchers[str(session_id)].add(websocket)
+        if not ws_outbox.send(websocket, {
+            "type": "batch",
+            "session_id": str(session_id),
+            "points": points
+        }, ws_outbox.WS_TRACK_OVERFLOW):
+            return
 
         # Если подключились по публичной ссылке — учитываем как live-зрителя
         if share:
@@ -1775,24 +1634,6 @@ async def track_watch(
             # Кто-то открыл ссылку — пересчитываем и, если надо, шлём live_start
             await _recalc_and_emit_live(db, sess)
 
-        pts = db.query(TrackingPoint).filter(TrackingPoint.session_id == session_id)\
-            .order_by(TrackingPoint.ts.asc()).limit(1000).all()
-        try:
-            await websocket.send_json({
-                "type": "batch",
-                "session_id": str(session_id),
-                "points": [
-                    {"lat": p.lat, "lng": p.lng, "ts": p.ts.isoformat(),
-                     "speed": p.speed, "heading": p.heading, "accuracy": p.accuracy}
-                    for p in pts
-                ]
-            })
-        except WebSocketDisconnect:
-            return
-        except Exception as e:
-            logger.warning("track_watch batch send failed: %r", e)
-            return
-
         while True:
             try:
                 _ = await websocket.receive_text()  # игнорим входящие от watcher
@@ -1801,6 +1642,7 @@ async def track_watch(
     finally:
         try:
             track_watchers[str(session_id)].discard(websocket)
+            ws_outbox.detach(websocket)
         except:
             pass
         try:
@@ -1832,60 +1674,41 @@ async def track_publish(
         if user.id not in [sess.driver_id, sess.created_by] and user.role.name not in ("MANAGER", "ADMIN"):
             await websocket.close(code=4403)
             return
+        # Буфер последних точек сессии: зрители и опросы дальше читают его, а не tracking_points
+        track_positions.seed(sess.id, _recent_track_points(
+            db, sess.id, track_positions.TRACK_RECENT_POINTS))
 
         while True:
             msg = await websocket.receive_json()
             if msg.get("type") in ("ping", "init"):
                 continue
             if msg.get("type") == "point":
-                p = TrackingPoint(
-                    session_id=session_id,
-                    ts=datetime.fromisoformat(msg.get("ts").replace(
-                        "Z", "")) if msg.get("ts") else datetime.utcnow(),
-                    lat=float(msg["lat"]),
-                    lng=float(msg["lng"]),
-                    speed=float(msg.get("speed")) if msg.get(
-                        "speed") is not None else None,
-                    heading=float(msg.get("heading")) if msg.get(
-                        "heading") is not None else None,
-                    accuracy=float(msg.get("accuracy")) if msg.get(
-                        "accuracy") is not None else None,
-                    source="device",
-                )
-                db.add(p)
-                sess.last_point_at = p.ts
-                db.commit()
-
-                dead = []
-                key = str(session_id)
-                dead = []
-                for ws in list(track_watchers.get(key, set())):
-                    try:
-                        await ws.send_json({
-                            "type": "point",
-                            "session_id": key,
-                            "point": {
-                                "lat": p.lat,
-                                "lng": p.lng,
-                                "ts": p.ts.isoformat(),
-                                "speed": p.speed,
-                                "heading": p.heading,
-                                "accuracy": p.accuracy,
-                            },
-                        })
-                    except Exception:
-                        dead.append(ws)
-                if dead:
-                    bucket = track_watchers.get(key)
-                    if bucket is not None:
-                        for ws in dead:
-                            bucket.discard(ws)
-                        if not bucket:
-                            track_watchers.pop(key, None)
+                # В БД точка уйдёт пакетом (tracking_ingest), зрителям — сразу
+                p = tracking_ingest.make_point(session_id, msg)
+                tracking_ingest.submit(p)
+                track_positions.record(session_id, p)
+                # Зрителям — не чаще TRACK_WATCH_MAX_HZ кадров в секунду на сессию
+                if track_watchers.get(str(session_id)):
+                    track_fanout.publish(session_id, p, _deliver_track_frame)
     finally:
         db.close()
 
 
+def _deliver_track_frame(key: str, payload: dict) -> None:
+    # Очереди зрителей: при переполнении теряются старые кадры, а не свежие
+    dead = ws_outbox.broadcast(
+        list(track_watchers.get(key, set())), payload,
+        policy=ws_outbox.WS_TRACK_OVERFLOW,
+    )
+    if dead:
+        bucket = track_watchers.get(key)
+        if bucket is not None:
+            for ws in dead:
+                bucket.discard(ws)
+            if not bucket:
+                track_watchers.pop(key, None)
+
+
 @tracking_router.post("/track/sessions/{session_id}/share", response_model=List[schemas.TrackingShareOut])
 async def share_tracking_session(
     session_id: str,
@@ -2067,7 +1890,8 @@ def transport_live_state(
         TrackingShare.session_id == sess.id,
         TrackingShare.active == True
     ).count()
-    return {"live": cnt > 0, "session_id": str(sess.id)}
+    last = track_positions.last(sess.id, sess.last_point_at)
+    return {"live": cnt > 0, "session_id": str(sess.id), "last_position": last}
 
 
 @tracking_router.get("/track/incoming", response_model=List[schemas.IncomingShareItem])
@@ -2497,107 +2321,6 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     return JSONResponse(status_code=422, content={"detail": exc.errors()})
 
 
-def deactivate_overdue_transports():
-    def parse_date_safe(val: Optional[str]) -> Optional[datetime]:
-        if not val:
-            return None
-        for fmt in ("%d/%m/%Y", "%d.%m.%Y", "%Y-%m-%d"):
-            try:
-                return datetime.strptime(val, fmt)
-            except ValueError:
-                pass
-        return None  # не распарсили — лучше пропустить, чем падать
-
-    def get_ready_end_dt(tr) -> Optional[datetime]:
-        # Вариант с типизированными полями (Date + Integer)
-        base = getattr(tr, "ready_date", None)
-        if base:
-            days = getattr(tr, "ready_days", None) or 1
-            if isinstance(base, datetime):
-                base_dt = base
-            else:
-                base_dt = datetime.combine(base, datetime.min.time())
-            return base_dt + timedelta(days=days - 1)
-
-        # Обратная совместимость со строковыми полями
-        date_str = getattr(tr, "ready_date_to", None) or getattr(
-            tr, "ready_date_from", None)
-        return parse_date_safe(date_str)
-
-    while True:
-        db = SessionLocal()
-        try:
-            now = datetime.utcnow()
-            threshold = now - timedelta(days=8)
-            transports = db.query(TransportModel).filter(
-                TransportModel.is_active == True).all()
-            for transport in transports:
-                try:
-                    ready_end = get_ready_end_dt(transport)
-                    if not ready_end:
-                        continue  # нет даты — ничего не делаем
-                    if ready_end < threshold:
-                        transport.is_active = False
-                        create_notification(
-                            db,
-                            transport.owner_id,
-                            NotificationType.TRANSPORT_AUTO_DISABLED,
-                            "notif.transport.autoDisabled",
-                            related_id=str(transport.id),
-                        )
-                except Exception as e:
-                    print("Ошибка обработки даты транспорта:", e)
-            db.commit()
-        finally:
-            db.close()
-        time.sleep(3600 * 24)  # раз в сутки
-
-
-# И запусти поток:
-threading.Thread(target=deactivate_overdue_transports, daemon=True).start()
-
-
-def deactivate_overdue_orders():
-    while True:
-        db = SessionLocal()
-        try:
-            now = datetime.utcnow()
-            threshold = now - timedelta(days=8)
-            orders = db.query(OrderModel).filter(
-                OrderModel.is_active == True).all()
-            for order in orders:
-                try:
-                    # Принимаем DD/MM/YYYY, DD.MM.YYYY и YYYY-MM-DD
-                    load_date = None
-                    for fmt in ("%d/%m/%Y", "%d.%m.%Y", "%Y-%m-%d"):
-                        try:
-                            load_date = datetime.strptime(
-                                (order.load_date or "").strip(), fmt)
-                            break
-                        except Exception:
-                            pass
-                    if not load_date:
-                        raise ValueError(f"Unparsed date: {order.load_date!r}")
-                    if load_date < threshold:
-                        order.is_active = False
-                        create_notification(
-                            db,
-                            order.owner_id,
-                            NotificationType.ORDER_AUTO_DISABLED,
-                            "notif.order.autoDisabled",
-                            related_id=str(order.id)
-                        )
-                except Exception as e:
-                    print("Ошибка обработки даты:", e)
-            db.commit()
-        finally:
-            db.close()
-        time.sleep(3600 * 24)  # раз в сутки
-
-
-threading.Thread(target=deactivate_overdue_orders, daemon=True).start()
-
-
 def run_async_task(coro):
     try:
         loop = asyncio.get_running_loop()
@@ -2689,30 +2412,11 @@ def get_matching_orders(
     except Exception:
         pass
 
-    from sqlalchemy import func, text
     from datetime import datetime, timedelta
 
-    if from_loc:
-        q = q.filter(
-            text("""
-                EXISTS (
-                    SELECT 1
-                    FROM jsonb_array_elements_text(orders.from_locations) AS t(val)
-                    WHERE lower(t.val) ILIKE lower(:from_loc)
-                )
-            """)
-        ).params(from_loc=f"%{from_loc}%")
-
-    if to_loc:
-        q = q.filter(
-            text("""
-                EXISTS (
-                    SELECT 1
-                    FROM jsonb_array_elements_text(orders.to_locations) AS t(val)
-                    WHERE lower(t.val) ILIKE lower(:to_loc)
-                )
-            """)
-        ).params(to_loc=f"%{to_loc}%")
+    # Подстрока в названиях точек (search_from/search_to, GIN pg_trgm)
+    q = listing_search.apply_filters(
+        q, "order", from_location=from_loc, to_location=to_loc)
 
     # Тип машины, если задан
     if getattr(order_data, "truck_type", None):
@@ -2731,21 +2435,9 @@ def get_matching_orders(
                 continue
 
         if parsed:
-            date_min = (parsed - timedelta(days=3)).strftime("%Y-%m-%d")
-            date_max = (parsed + timedelta(days=3)).strftime("%Y-%m-%d")
-
-            load_date_col = func.to_date(
-                func.nullif(
-                    func.replace(func.coalesce(
-                        OrderModel.load_date, ""), ".", "/"),
-                    ""
-                ),
-                "DD/MM/YYYY",
-            )
-
             q = q.filter(
-                load_date_col >= func.to_date(date_min, "YYYY-MM-DD"),
-                load_date_col <= func.to_date(date_max, "YYYY-MM-DD"),
+                OrderModel.load_date_d >= (parsed - timedelta(days=3)).date(),
+                OrderModel.load_date_d <= (parsed + timedelta(days=3)).date(),
             )
 
     # Легко: только свежие, ограничение по количеству
@@ -2819,6 +2511,7 @@ async def notifications_ws(
         print(f"[WS DEBUG] СОЕДИНЕНИЕ ПРИНЯТО user_id={user_id}")
         if str(user_id) not in user_notification_connections:
             user_notification_connections[str(user_id)] = set()
+        ws_outbox.attach(websocket, ws_outbox.WS_CHAT_OVERFLOW)
         user_notification_connections[str(user_id)].add(websocket)
         print(
             f"WebSocket подключен: user_id={user_id}, всего: {len(user_notification_connections[str(user_id)])}")
@@ -2858,6 +2551,7 @@ async def notifications_ws(
                     bucket.discard(websocket)
                     if not bucket:
                         user_notification_connections.pop(key, None)
+                ws_outbox.detach(websocket)
                 left = len(user_notification_connections.get(key, []))
                 print(
                     f"WebSocket отключён: user_id={user_id}, осталось: {left}")
@@ -3030,6 +2724,7 @@ def update_transport(
     # Обновить только пришедшие поля
     for attr, value in data.items():
         setattr(transport, attr, value)
+    listing_points.sync_transport(db, transport)
 
     db.commit()
     db.refresh(transport)
@@ -3256,6 +2951,7 @@ def update_order(order_id: int, order_update: dict, db: Session = Depends(get_db
             order_update.get("attachments") or [])
     for attr, value in order_update.items():
         setattr(order, attr, value)
+    listing_points.sync_order(db, order)
     db.commit()
     db.refresh(order)
     return order
@@ -3825,6 +3521,9 @@ def get_transports(
     response: Response = None,
     from_radius: float = Query(None, alias="from_radius"),
     to_radius: float = Query(None, alias="to_radius"),
+    # "distance" — ближние к точке from_location_lat/lng первыми,
+    # "relevance" — лучшие совпадения текстовых фильтров (q, from/to_location)
+    sort: Optional[str] = Query(None, alias="sort"),
     db: Session = Depends(get_db),
     current_user: Optional[UserModel] = Depends(get_optional_current_user),
 ):
@@ -3853,17 +3552,15 @@ def get_transports(
     # списка и становятся «невидимыми» на сайте.
     query = db.query(TransportModel)
     # Применяем фильтр блокировок только для авторизованного пользователя.
+    # Блок-лист грузим один раз и фильтруем по owner_id, без коррелированного подзапроса.
+    blocks = BlockedPairs(db)
     if current_user is not None:
-        query = query.filter(
-            ~db.query(UB.id).filter(
-                or_(
-                    and_(UB.blocker_id == current_user.id,
-                         UB.blocked_id == TransportModel.owner_id),
-                    and_(UB.blocker_id == TransportModel.owner_id,
-                         UB.blocked_id == current_user.id),
-                )
-            ).exists()
-        )
+        blocked_ids = blocks.blocked_ids(current_user.id)
+        if blocked_ids:
+            query = query.filter(or_(
+                TransportModel.owner_id.is_(None),
+                ~TransportModel.owner_id.in_(blocked_ids),
+            ))
 
     # --- ВИДЫ ЗАГРУЗКИ (логика "ИЛИ", пересечение хотя бы одного) ---
     if load_types:
@@ -3878,15 +3575,9 @@ def get_transports(
             """)
         ).params(arr=load_types)
 
-    if from_location not in [None, ""]:
-        query = query.filter(
-            TransportModel.from_location.ilike(f"%{from_location}%"))
-    if to_location not in [None, ""]:
-        query = query.filter(
-            text(
-                "EXISTS (SELECT 1 FROM jsonb_array_elements(transports.to_locations) AS elem WHERE lower(elem->>'location') ILIKE lower(:to_loc))"
-            )
-        ).params(to_loc=f"%{to_location}%")
+    # Текстовые фильтры (q, откуда, куда) — теневые колонки с GIN pg_trgm
+    query = listing_search.apply_filters(
+        query, "transport", q=q, from_location=from_location, to_location=to_location)
     from sqlalchemy import cast, Date, Integer, func
 
     def ready_end_date_expr():
@@ -3906,22 +3597,9 @@ def get_transports(
     # (если вверху файла уже импортирован — пропусти)
     from sqlalchemy import func
 
-    rd_from_col = func.to_date(
-        func.nullif(
-            func.replace(func.coalesce(
-                TransportModel.ready_date_from, ""), ".", "/"),
-            ""
-        ),
-        "DD/MM/YYYY"
-    )
-    rd_to_col = func.to_date(
-        func.nullif(
-            func.replace(func.coalesce(
-                TransportModel.ready_date_to, ""), ".", "/"),
-            ""
-        ),
-        "DD/MM/YYYY"
-    )
+    # Типизированные DATE-колонки (заполняются при записи, с B-tree индексами)
+    rd_from_col = TransportModel.ready_date_from_d
+    rd_to_col = TransportModel.ready_date_to_d
 
     def _to_date_iso(s):
         return func.to_date(s, "YYYY-MM-DD")
@@ -3969,15 +3647,6 @@ def get_transports(
             query = query.filter(TransportModel.volume >= float(volume))
         except (ValueError, TypeError):
             pass
-    if q not in [None, ""]:
-        ilike_q = f"%{q}%"
-        query = query.filter(
-            (TransportModel.truck_type.ilike(ilike_q)) |
-            (TransportModel.transport_kind.ilike(ilike_q)) |
-            (TransportModel.contact_name.ilike(ilike_q)) |
-            (TransportModel.comment.ilike(ilike_q)) |
-            (TransportModel.email.ilike(ilike_q))
-        )
 
     # --- ФИЛЬТР «только Соответствия» (лёгкая версия) ---
     if matches_only and current_user is not None:
@@ -4007,7 +3676,7 @@ def get_transports(
                     OrderModel.is_active == True
                 ).all()
                 for order in my_orders:
-                    for tr in find_matching_transports(order, db, exclude_user_id=current_user.id):
+                    for tr in find_matching_transports(order, db, exclude_user_id=current_user.id, blocks=blocks):
                         if tr and tr.id:
                             matched_transport_ids.append(tr.id)
             except Exception:
@@ -4028,64 +3697,31 @@ def get_transports(
         )))
         print('---')
 
-    # --- Радиусные фильтры "откуда / куда" на уровне SQL (bbox) ---
-    def _bbox(center_lat, center_lng, radius_km):
-        try:
-            r = float(radius_km or 0)
-        except (TypeError, ValueError):
-            return None
-        if center_lat is None or center_lng is None or r <= 0:
-            return None
-
-        # 1 градус широты ≈ 111 км
-        lat_delta = r / 111.0
-        lat_min = center_lat - lat_delta
-        lat_max = center_lat + lat_delta
-
-        # Долгота зависит от широты
-        lng_delta = r / (111.0 * max(cos(radians(center_lat)), 0.1))
-        lng_min = center_lng - lng_delta
-        lng_max = center_lng + lng_delta
-
-        return lat_min, lat_max, lng_min, lng_max
-
-    # 1) FROM‑радиус — по обычным числовым колонкам
-    bbox_from = _bbox(from_location_lat, from_location_lng, from_radius)
-    if bbox_from:
-        lat_min, lat_max, lng_min, lng_max = bbox_from
-        query = query.filter(
-            TransportModel.from_location_lat >= lat_min,
-            TransportModel.from_location_lat <= lat_max,
-            TransportModel.from_location_lng >= lng_min,
-            TransportModel.from_location_lng <= lng_max,
-        )
-
-    # 2) TO‑радиус — по JSON‑массиву to_locations (lat/lng внутри JSON)
-    bbox_to = _bbox(to_location_lat, to_location_lng, to_radius)
-    if bbox_to:
-        t_lat_min, t_lat_max, t_lng_min, t_lng_max = bbox_to
-        query = query.filter(
-            text("""
-                EXISTS (
-                    SELECT 1
-                    FROM jsonb_array_elements(
-                        COALESCE(transports.to_locations, '[]'::jsonb)
-                    ) AS dest
-                    WHERE dest ? 'lat'
-                      AND dest ? 'lng'
-                      AND dest->>'lat' <> '' AND dest->>'lng' <> ''
-                      AND (dest->>'lat')::double precision BETWEEN :to_lat_min AND :to_lat_max
-                      AND (dest->>'lng')::double precision BETWEEN :to_lng_min AND :to_lng_max
-                )
-            """)
-        ).params(
-            to_lat_min=t_lat_min,
-            to_lat_max=t_lat_max,
-            to_lng_min=t_lng_min,
-            to_lng_max=t_lng_max,
-        )
-
-    base_q = query.order_by(TransportModel.created_at.desc())
+    # --- Радиусные фильтры "откуда / куда": точки в listing_points (GiST/earthdistance) ---
+    from_cond = listing_points.radius_filter(
+        "transport", listing_points.POINT_FROM,
+        from_location_lat, from_location_lng, from_radius, prefix="from")
+    if from_cond is not None:
+        query = query.filter(from_cond)
+    to_cond = listing_points.radius_filter(
+        "transport", listing_points.POINT_TO,
+        to_location_lat, to_location_lng, to_radius, prefix="to")
+    if to_cond is not None:
+        query = query.filter(to_cond)
+
+    order_by = [TransportModel.created_at.desc()]
+    if sort == "distance":
+        dist = listing_points.distance_order(
+            "transport", listing_points.POINT_FROM,
+            from_location_lat, from_location_lng, prefix="dist")
+        if dist is not None:
+            order_by.insert(0, dist)
+    elif sort == "relevance":
+        rank = listing_search.relevance_order(
+            "transport", q=q, from_location=from_location, to_location=to_location)
+        if rank is not None:
+            order_by.insert(0, rank)
+    base_q = query.order_by(*order_by)
 
     # --- БЕЗ РАДИУСА: чистая SQL-пагинация ---
     if page and page_size:
@@ -4192,6 +3828,8 @@ def create_transport(
 
     db_transport = TransportModel(**data, id=uuid.uuid4())
     db.add(db_transport)
+    db.flush()
+    listing_points.sync_transport(db, db_transport)
     db.commit()
     db.refresh(db_transport)
     try:
@@ -4240,6 +3878,9 @@ def get_orders(
     to_location_lat: float = Query(None, alias="to_location_lat"),
     to_location_lng: float = Query(None, alias="to_location_lng"),
     to_radius: float = Query(None, alias="to_radius"),
+    # "distance" — ближние к точке from_location_lat/lng первыми,
+    # "relevance" — лучшие совпадения текстовых фильтров (q, from/to_location)
+    sort: Optional[str] = Query(None, alias="sort"),
     matches_only: Optional[bool] = Query(None, alias="matches_only"),
     loading_types: Optional[List[str]] = Query(None, alias="loading_types"),
     db: Session = Depends(get_db),
@@ -4263,17 +3904,14 @@ def get_orders(
         print('---')
 
     query = db.query(OrderModel).filter(OrderModel.is_active == True)
+    blocks = BlockedPairs(db)
     if current_user is not None:
-        query = query.filter(
-            ~db.query(UB.id).filter(
-                or_(
-                    and_(UB.blocker_id == current_user.id,
-                         UB.blocked_id == OrderModel.owner_id),
-                    and_(UB.blocker_id == OrderModel.owner_id,
-                         UB.blocked_id == current_user.id),
-                )
-            ).exists()
-        )
+        blocked_ids = blocks.blocked_ids(current_user.id)
+        if blocked_ids:
+            query = query.filter(or_(
+                OrderModel.owner_id.is_(None),
+                ~OrderModel.owner_id.in_(blocked_ids),
+            ))
 
     # --- ВИДЫ ЗАГРУЗКИ ---
     if loading_types:
@@ -4289,29 +3927,16 @@ def get_orders(
             """)
         ).params(arr=loading_types)
 
-    if from_location not in [None, ""]:
-        query = query.filter(
-            text(
-                f"EXISTS (SELECT 1 FROM jsonb_array_elements_text(orders.from_locations) AS t(val) WHERE lower(t.val) ILIKE lower('%{from_location}%'))")
-        )
-    if to_location not in [None, ""]:
-        query = query.filter(
-            text(
-                f"EXISTS (SELECT 1 FROM jsonb_array_elements_text(orders.to_locations) AS t(val) WHERE lower(t.val) ILIKE lower('%{to_location}%'))")
-        )
+    # Текстовые фильтры (q, откуда, куда) — теневые колонки с GIN pg_trgm
+    query = listing_search.apply_filters(
+        query, "order", q=q, from_location=from_location, to_location=to_location)
     if truck_type not in [None, "", "все"]:
         query = query.filter(OrderModel.truck_type == truck_type)
     # (если уже есть импорт — ничего добавлять не нужно)
     from sqlalchemy import func
 
-    # Приводим STRING → DATE: поддерживаем 'дд.мм.гггг' и 'дд/мм/гггг'
-    load_date_col = func.to_date(
-        func.nullif(
-            func.replace(func.coalesce(OrderModel.load_date, ""), ".", "/"),
-            ""
-        ),
-        "DD/MM/YYYY"
-    )
+    # Типизированная DATE-колонка (заполняется при записи, с B-tree индексом)
+    load_date_col = OrderModel.load_date_d
 
     def _to_date_iso(s):
         return func.to_date(s, "YYYY-MM-DD")
@@ -4332,13 +3957,6 @@ def get_orders(
     if with_attachments:
         query = query.filter(OrderModel.attachments != None).filter(
             OrderModel.attachments != [])
-    if q not in [None, ""]:
-        ilike_q = f"%{q}%"
-        query = query.filter(
-            (OrderModel.description.ilike(ilike_q)) |
-            (OrderModel.truck_type.ilike(ilike_q)) |
-            (OrderModel.comment.ilike(ilike_q))
-        )
 
     # --- ФИЛЬТР «только Соответствия» (лёгкая версия + безопасный фолбэк) ---
     if matches_only and current_user is not None:
@@ -4365,7 +3983,7 @@ def get_orders(
                     TransportModel.is_active == True
                 ).all()
                 for tr in my_transports:
-                    for order in find_matching_orders_for_transport(tr, db, exclude_user_id=current_user.id):
+                    for order in find_matching_orders_for_transport(tr, db, exclude_user_id=current_user.id, blocks=blocks):
                         if order and order.id:
                             matched_order_ids.append(order.id)
             except Exception:
@@ -4384,78 +4002,31 @@ def get_orders(
         )))
         print('---')
 
-    # --- Радиусные фильтры по координатам на уровне SQL (bbox по JSON coords) ---
-    def _bbox(center_lat, center_lng, radius_km):
-        try:
-            r = float(radius_km or 0)
-        except (TypeError, ValueError):
-            return None
-        if center_lat is None or center_lng is None or r <= 0:
-            return None
-
-        # 1 градус широты ≈ 111 км
-        lat_delta = r / 111.0
-        lat_min = center_lat - lat_delta
-        lat_max = center_lat + lat_delta
-
-        # Долгота зависит от широты
-        lng_delta = r / (111.0 * max(cos(radians(center_lat)), 0.1))
-        lng_min = center_lng - lng_delta
-        lng_max = center_lng + lng_delta
-
-        return lat_min, lat_max, lng_min, lng_max
-
-    # FROM‑радиус: orders.from_locations_coords (jsonb массив координат)
-    bbox_from = _bbox(from_location_lat, from_location_lng, from_radius)
-    if bbox_from:
-        lat_min, lat_max, lng_min, lng_max = bbox_from
-        query = query.filter(
-            text("""
-                EXISTS (
-                    SELECT 1
-                    FROM jsonb_array_elements(
-                        COALESCE(orders.from_locations_coords, '[]'::jsonb)
-                    ) AS coord
-                    WHERE coord ? 'lat'
-                      AND coord ? 'lng'
-                      AND coord->>'lat' <> '' AND coord->>'lng' <> ''
-                      AND (coord->>'lat')::double precision BETWEEN :from_lat_min AND :from_lat_max
-                      AND (coord->>'lng')::double precision BETWEEN :from_lng_min AND :from_lng_max
-                )
-            """)
-        ).params(
-            from_lat_min=lat_min,
-            from_lat_max=lat_max,
-            from_lng_min=lng_min,
-            from_lng_max=lng_max,
-        )
-
-    # TO‑радиус: orders.to_locations_coords
-    bbox_to = _bbox(to_location_lat, to_location_lng, to_radius)
-    if bbox_to:
-        t_lat_min, t_lat_max, t_lng_min, t_lng_max = bbox_to
-        query = query.filter(
-            text("""
-                EXISTS (
-                    SELECT 1
-                    FROM jsonb_array_elements(
-                        COALESCE(orders.to_locations_coords, '[]'::jsonb)
-                    ) AS coord
-                    WHERE coord ? 'lat'
-                      AND coord ? 'lng'
-                      AND coord->>'lat' <> '' AND coord->>'lng' <> ''
-                      AND (coord->>'lat')::double precision BETWEEN :to_lat_min AND :to_lat_max
-                      AND (coord->>'lng')::double precision BETWEEN :to_lng_min AND :to_lng_max
-                )
-            """)
-        ).params(
-            to_lat_min=t_lat_min,
-            to_lat_max=t_lat_max,
-            to_lng_min=t_lng_min,
-            to_lng_max=t_lng_max,
-        )
-
-    base_q = query.order_by(OrderModel.created_at.desc())
+    # --- Радиусные фильтры по координатам: точки в listing_points (GiST/earthdistance) ---
+    from_cond = listing_points.radius_filter(
+        "order", listing_points.POINT_FROM,
+        from_location_lat, from_location_lng, from_radius, prefix="from")
+    if from_cond is not None:
+        query = query.filter(from_cond)
+    to_cond = listing_points.radius_filter(
+        "order", listing_points.POINT_TO,
+        to_location_lat, to_location_lng, to_radius, prefix="to")
+    if to_cond is not None:
+        query = query.filter(to_cond)
+
+    order_by = [OrderModel.created_at.desc()]
+    if sort == "distance":
+        dist = listing_points.distance_order(
+            "order", listing_points.POINT_FROM,
+            from_location_lat, from_location_lng, prefix="dist")
+        if dist is not None:
+            order_by.insert(0, dist)
+    elif sort == "relevance":
+        rank = listing_search.relevance_order(
+            "order", q=q, from_location=from_location, to_location=to_location)
+        if rank is not None:
+            order_by.insert(0, rank)
+    base_q = query.order_by(*order_by)
     # Режим выдачи: авторизованным — полный, гостям — публичный
     view_full = current_user is not None
     if response is not None:
@@ -4604,6 +4175,8 @@ def create_order(
 
     db_order = OrderModel(**order_data)
     db.add(db_order)
+    db.flush()
+    listing_points.sync_order(db, db_order)
     db.commit()
     db.refresh(db_order)
 
@@ -4746,17 +4319,15 @@ def public_orders(
     loading_types: Optional[List[str]] = Query(None, alias="loading_types"),
     page: Optional[int] = Query(1, ge=1),
     page_size: Optional[int] = Query(30, ge=1, le=120),
+    # "relevance" — лучшие совпадения from/to_location первыми
+    sort: Optional[str] = Query(None, alias="sort"),
     db: Session = Depends(get_db),
 ):
     q = db.query(OrderModel).filter(OrderModel.is_active == True)
 
     # те же фильтры, что и в /orders (при необходимости добавьте сюда ваши доп. фильтры)
-    if from_location:
-        q = q.filter(func.lower(OrderModel.from_location).contains(
-            from_location.lower()))
-    if to_location:
-        q = q.filter(func.lower(OrderModel.to_location).contains(
-            to_location.lower()))
+    q = listing_search.apply_filters(
+        q, "order", from_location=from_location, to_location=to_location)
     if truck_type:
         q = q.filter(OrderModel.truck_type == truck_type)
     if load_date_from:
@@ -4766,7 +4337,13 @@ def public_orders(
     if loading_types:
         q = q.filter(OrderModel.loading_types.overlap(loading_types))
 
-    q = q.order_by(OrderModel.created_at.desc())
+    order_by = [OrderModel.created_at.desc()]
+    if sort == "relevance":
+        rank = listing_search.relevance_order(
+            "order", from_location=from_location, to_location=to_location)
+        if rank is not None:
+            order_by.insert(0, rank)
+    q = q.order_by(*order_by)
     total = q.count()
     items = q.offset((page - 1) * page_size).limit(page_size).all()
 
@@ -5437,16 +5014,8 @@ def get_unread_matches(
     if not transport_id and not order_id:
         raise HTTPException(
             status_code=400, detail="transport_id or order_id required")
-    query = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.type == NotificationType.AUTO_MATCH,
-        Notification.read == False
-    )
-    if transport_id:
-        query = query.filter(Notification.related_id == str(transport_id))
-    if order_id:
-        query = query.filter(Notification.related_id == str(order_id))
-    return {"unread": query.count()}
+    return {"unread": unread_counters.get_match(
+        db, current_user.id, transport_id=transport_id, order_id=order_id)}
 
 # Получить количество новых Соответствий по заявке
 
@@ -5460,8 +5029,8 @@ def get_order_new_matches_count(
     """
     Лёгкий подсчёт количества новых совпадений по заявке.
 
-    Вместо тяжёлого find_matching_transports считаем только
-    непрочитанные уведомления типа AUTO_MATCH с related_id = order_id.
+    Вместо тяжёлого find_matching_transports отдаём поддерживаемый счётчик
+    непрочитанных уведомлений AUTO_MATCH с related_id = order_id (unread_counters).
     """
     order = db.query(OrderModel).filter(OrderModel.id == order_id).first()
     if not order:
@@ -5471,16 +5040,8 @@ def get_order_new_matches_count(
                     "message": "Заявка не найдена"},
         )
 
-    new_count = (
-        db.query(Notification)
-        .filter(
-            Notification.user_id == current_user.id,
-            Notification.type == NotificationType.AUTO_MATCH,
-            Notification.read == False,
-            Notification.related_id == str(order_id),
-        )
-        .count()
-    )
+    new_count = unread_counters.get(
+        db, current_user.id, unread_counters.KIND_MATCH, str(order_id))
     return {"new_matches": new_count}
 # Отметить Соответствия по заявке просмотренными
 
@@ -5515,7 +5076,8 @@ def get_transport_new_matches_count(
     """
     Лёгкий подсчёт новых совпадений по транспорту.
 
-    Считаем только непрочитанные AUTO_MATCH-уведомления с related_id = transport_id.
+    Счётчик непрочитанных AUTO_MATCH-уведомлений с related_id = transport_id
+    (unread_counters).
     """
     tr = db.query(TransportModel).filter(
         TransportModel.id == transport_id).first()
@@ -5526,16 +5088,8 @@ def get_transport_new_matches_count(
                     "message": "Транспорт не найден"},
         )
 
-    new_count = (
-        db.query(Notification)
-        .filter(
-            Notification.user_id == current_user.id,
-            Notification.type == NotificationType.AUTO_MATCH,
-            Notification.read == False,
-            Notification.related_id == str(transport_id),
-        )
-        .count()
-    )
+    new_count = unread_counters.get(
+        db, current_user.id, unread_counters.KIND_MATCH, str(transport_id))
     return {"new_matches": new_count}
 
 
@@ -0,0 +1,326 @@
+"""
+Ключи авто-подбора в колонках orders/transports (Postgres).
+
+Раньше индекс кандидатов жил в памяти каждого процесса: инкрементально его
+обновляли только ORM-хэндлеры того же процесса, а целиком он
+перестраивался раз в MATCH_INDEX_REFRESH_SEC (и первый раз — прямо в
+запросе). Записи, созданные/изменённые/скрытые другим воркером uvicorn,
+пулом auto_match_worker или set-based просрочкой listing_expiry, до 10 минут
+оставались невидимыми или устаревшими. Теперь ключи лежат в самих строках:
+  match_code            — канонический тип кузова (canon_truck_type),
+  match_permanent       — транспорт «постоянно» (даты не важны),
+  match_date_from/_to   — даты, которые сравнивает подбор (listing_date),
+  match_cells           — ячейки geohash точек погрузки,
+  match_cover           — ячейки, покрывающие круг радиуса записи
+                          ({'*'} — радиус больше MATCH_INDEX_MAX_RADIUS_KM),
+  match_cities          — нормализованные города погрузки;
+они пересчитываются при каждой записи через ORM (models, как *_d даты), а
+candidate_filter() строит по ним SQL-условие с btree/GIN-индексами.
+is_active и всё, что меняется bulk-UPDATE, проверяется по живой строке.
+
+Ключи только сужают выборку: окончательная проверка (блокировки,
+совместимость, даты, радиусы) выполняется по строкам в notifications.
+Строки, для которых ключи ещё не посчитаны (match_keys_at IS NULL, до
+бэкфилла), всегда остаются кандидатами; их дозаполняет backfill() из
+планировщика.
+"""
+from __future__ import annotations
+
+import os
+from datetime import datetime
+from math import cos, radians
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import and_, false, or_, update
+from sqlalchemy.orm import Session
+
+from models import Order, Transport
+from notifications import (
+    ORDER_DEFAULT_RADIUS_KM,
+    _order_pickup_coords,
+    _parse_km,
+    _transport_pickup_point,
+    canon_truck_type,
+    is_permanent_mode,
+    listing_date,
+    normalize_city,
+    normalize_str,
+)
+
+MATCH_INDEX_ENABLED = os.getenv("MATCH_INDEX_ENABLED", "1") == "1"
+
+# Точность geohash: 3 символа ≈ 156×156 км, 4 символа ≈ 39×20 км.
+MATCH_INDEX_GEOHASH_PRECISION = int(
+    os.getenv("MATCH_INDEX_GEOHASH_PRECISION", "3") or "3")
+
+# Радиус больше порога по ячейкам не раскладываем: match_cover = {'*'}
+# (запись — кандидат для любой точки).
+MATCH_INDEX_MAX_RADIUS_KM = float(
+    os.getenv("MATCH_INDEX_MAX_RADIUS_KM", "1000") or "1000")
+
+# Сколько строк без ключей дозаполнять за пачку
+MATCH_KEYS_BACKFILL_BATCH = int(os.getenv("MATCH_KEYS_BACKFILL_BATCH", "500") or "500")
+
+ANY_CELL = "*"
+
+# --- geohash ------------------------------------------------------------------
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lng: float, precision: int) -> str:
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    out = []
+    bit = 0
+    ch = 0
+    even = True
+    while len(out) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                ch = (ch << 1) | 1
+                lng_lo = mid
+            else:
+                ch <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                lat_lo = mid
+            else:
+                ch <<= 1
+                lat_hi = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            out.append(_GEOHASH_BASE32[ch])
+            bit = 0
+            ch = 0
+    return "".join(out)
+
+
+def _geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """(dlat, dlng) ячейки geohash заданной точности в градусах."""
+    bits = 5 * precision
+    lng_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def _wrap_lng(lng: float) -> float:
+    return ((lng + 180.0) % 360.0) - 180.0
+
+
+def geohash_cells_around(lat: float, lng: float, radius_km: float, precision: int) -> Set[str]:
+    """Все ячейки geohash, пересекающие bbox круга радиуса radius_km."""
+    dlat, dlng = _geohash_cell_size(precision)
+    lat_delta = radius_km / 111.0
+    lat_min = max(-89.999999, lat - lat_delta)
+    lat_max = min(89.999999, lat + lat_delta)
+    widest = max(abs(lat_min), abs(lat_max))
+    lng_delta = min(180.0, radius_km / (111.0 * max(cos(radians(widest)), 0.05)))
+    lng_min = lng - lng_delta
+    lng_max = lng + lng_delta
+
+    cells: Set[str] = set()
+    la = lat_min
+    while True:
+        lo = lng_min
+        while True:
+            cells.add(geohash_encode(la, _wrap_lng(lo), precision))
+            if lo >= lng_max:
+                break
+            lo = min(lo + dlng, lng_max)
+        if la >= lat_max:
+            break
+        la = min(la + dlat, lat_max)
+    return cells
+
+
+# --- ключи записей -------------------------------------------------------------
+
+
+def compatible_truck_codes(code: str) -> Tuple[str, ...]:
+    """Коды, совместимые с данным (см. are_truck_types_compatible)."""
+    if not code:
+        return ()
+    if code == "refr_tent":
+        return ("refr_tent", "refr", "tent")
+    if code in ("refr", "tent"):
+        return (code, "refr_tent")
+    return (code,)
+
+
+def _order_radius(order) -> float:
+    # Та же логика, что в notifications._check_location_match
+    raw = getattr(order, "from_radius", None)
+    if raw in (None, "", 0, "0"):
+        return _parse_km(raw, default=ORDER_DEFAULT_RADIUS_KM)
+    return _parse_km(raw, default=0.0)
+
+
+def _cells(points) -> List[str]:
+    return sorted({geohash_encode(la, lo, MATCH_INDEX_GEOHASH_PRECISION) for la, lo in points})
+
+
+def _cover(points, radius_km: float) -> List[str]:
+    if not points or radius_km <= 0:
+        return []
+    if radius_km > MATCH_INDEX_MAX_RADIUS_KM:
+        return [ANY_CELL]
+    cells: Set[str] = set()
+    for la, lo in points:
+        cells |= geohash_cells_around(la, lo, radius_km, MATCH_INDEX_GEOHASH_PRECISION)
+    return sorted(cells)
+
+
+def _day(value):
+    return value.date() if value is not None else None
+
+
+def transport_keys(tr) -> Dict:
+    """Значения match_* для транспорта (строка, объект или Row с нужными колонками)."""
+    d_from = listing_date(tr, "ready_date_from")
+    d_to = listing_date(tr, "ready_date_to") or d_from
+    point = _transport_pickup_point(tr)
+    points = [point] if point else []
+    city = normalize_city(getattr(tr, "from_location", "") or "")
+    return {
+        "match_code": canon_truck_type(getattr(tr, "truck_type", "") or "") or None,
+        "match_permanent": is_permanent_mode(normalize_str(getattr(tr, "mode", ""))),
+        "match_date_from": _day(d_from),
+        "match_date_to": _day(d_to),
+        "match_cells": _cells(points),
+        "match_cover": _cover(points, _parse_km(getattr(tr, "from_radius", 0), default=0.0)),
+        "match_cities": [city] if city else [],
+        "match_keys_at": datetime.utcnow(),
+    }
+
+
+def order_keys(order) -> Dict:
+    """Значения match_* для заявки."""
+    d = _day(listing_date(order, "load_date"))
+    points = list(_order_pickup_coords(order))
+    cities = sorted({
+        c for c in (normalize_city(x) for x in (getattr(order, "from_locations", None) or [])) if c
+    })
+    return {
+        "match_code": canon_truck_type(getattr(order, "truck_type", "") or "") or None,
+        "match_permanent": False,
+        "match_date_from": d,
+        "match_date_to": d,
+        "match_cells": _cells(points),
+        "match_cover": _cover(points, _order_radius(order)),
+        "match_cities": cities,
+        "match_keys_at": datetime.utcnow(),
+    }
+
+
+def apply_transport_keys(tr) -> None:
+    """Вызывается из ORM before_insert/before_update (models)."""
+    for k, v in transport_keys(tr).items():
+        setattr(tr, k, v)
+
+
+def apply_order_keys(order) -> None:
+    for k, v in order_keys(order).items():
+        setattr(order, k, v)
+
+
+# --- выборка кандидатов -------------------------------------------------------
+
+
+def _geo_filter(model, keys: Dict):
+    """Пересечение по ячейкам/городам (None — гео не сужает выборку)."""
+    cells, cover, cities = keys["match_cells"], keys["match_cover"], keys["match_cities"]
+    if cover == [ANY_CELL]:
+        return None
+    branches = []
+    if cells:
+        # Радиус кандидата покрывает точку subject (или радиус кандидата «любой»)
+        branches.append(model.match_cover.overlap(cells + [ANY_CELL]))
+    if cover:
+        # Радиус subject покрывает точку кандидата
+        branches.append(model.match_cells.overlap(cover))
+    if cities:
+        branches.append(model.match_cities.overlap(cities))
+    if not branches:
+        return false()
+    return or_(*branches)
+
+
+def candidate_filter(subject):
+    """
+    SQL-условие на кандидатов для subject (Order -> транспорты,
+    Transport -> заявки). None — ключи выключены (MATCH_INDEX_ENABLED=0),
+    вызывающий идёт полным стримом.
+    """
+    if not MATCH_INDEX_ENABLED:
+        return None
+    if isinstance(subject, Order):
+        model, keys = Transport, order_keys(subject)
+    else:
+        model, keys = Order, transport_keys(subject)
+    if not keys["match_code"]:
+        return false()
+
+    conds = [model.match_code.in_(compatible_truck_codes(keys["match_code"]))]
+    if model is Transport:
+        d = keys["match_date_from"]
+        if d is None:
+            return false()
+        conds.append(or_(
+            Transport.match_permanent == True,
+            and_(Transport.match_date_from <= d, Transport.match_date_to >= d),
+        ))
+    elif not keys["match_permanent"]:
+        if keys["match_date_from"] is None:
+            return false()
+        conds.append(Order.match_date_from.between(
+            keys["match_date_from"], keys["match_date_to"]))
+    geo = _geo_filter(model, keys)
+    if geo is not None:
+        conds.append(geo)
+    return or_(and_(*conds), model.match_keys_at.is_(None))
+
+
+# --- бэкфилл ------------------------------------------------------------------
+
+_BACKFILL = (
+    (Order, order_keys, (
+        Order.id, Order.truck_type, Order.load_date, Order.load_date_d,
+        Order.from_locations, Order.from_locations_coords,
+    )),
+    (Transport, transport_keys, (
+        Transport.id, Transport.truck_type, Transport.mode,
+        Transport.ready_date_from, Transport.ready_date_to,
+        Transport.ready_date_from_d, Transport.ready_date_to_d,
+        Transport.from_location, Transport.from_location_lat,
+        Transport.from_location_lng, Transport.from_radius,
+    )),
+)
+
+
+def backfill(db: Session, batch: int = MATCH_KEYS_BACKFILL_BATCH) -> int:
+    """
+    Дозаполняет ключи у строк, записанных до миграции (или мимо ORM).
+    Одна пачка на таблицу, коммитит сам. Возвращает число обновлённых строк.
+    """
+    total = 0
+    for model, keys_of, columns in _BACKFILL:
+        rows = (
+            db.query(*columns)
+            .filter(model.match_keys_at.is_(None))
+            .limit(batch)
+            .all()
+        )
+        if not rows:
+            continue
+        # UPDATE по первичному ключу пачкой, без ORM-событий
+        db.execute(update(model), [{"id": r.id, **keys_of(r)} for r in rows])
+        db.commit()
+        total += len(rows)
+    return total
+
@@ -12,6 +12,7 @@ import uuid
 import uuid
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy as sa
+from sqlalchemy import event
 import json
 import enum
 from sqlalchemy import create_engine
@@ -259,6 +260,8 @@ class Order(Base):
     transport_type = Column(String)
     truck_quantity = Column(Integer, default=1)
     load_date = Column(String)
+    # Типизированная копия load_date (для индексов/фильтров), см. parse_listing_date
+    load_date_d = Column(Date, nullable=True, index=True)
     unload_date = Column(String)
     has_customs = Column(sa.Boolean, default=False)
     customs_info = Column(String)
@@ -287,6 +290,19 @@ class Order(Base):
     owner_id = Column(Integer)
     # Счётчик просмотров детальной страницы
     views = Column(Integer, default=0)
+    # Теневые колонки текстового поиска (GIN pg_trgm), см. _order_sync_search
+    search_text = Column(Text, nullable=True)
+    search_from = Column(Text, nullable=True)
+    search_to = Column(Text, nullable=True)
+    # Ключи авто-подбора (match_index), пересчитываются в _order_sync_match_keys
+    match_code = Column(String(32), nullable=True)
+    match_permanent = Column(sa.Boolean, nullable=False, default=False, server_default=sa.false())
+    match_date_from = Column(Date, nullable=True)
+    match_date_to = Column(Date, nullable=True)
+    match_cells = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_cover = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_cities = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_keys_at = Column(DateTime, nullable=True)
 
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -324,6 +340,9 @@ class Transport(Base):
     from_location_coords = Column(JSONB, nullable=True)
     ready_date_from = Column(String)
     ready_date_to = Column(String)
+    # Типизированные копии ready_date_* (для индексов/фильтров)
+    ready_date_from_d = Column(Date, nullable=True, index=True)
+    ready_date_to_d = Column(Date, nullable=True, index=True)
     mode = Column(String)
     regularity = Column(String)
     rate_type = Column(String)
@@ -341,6 +360,19 @@ class Transport(Base):
     owner_id = Column(Integer)
     # Счётчик просмотров детальной страницы
     views = Column(Integer, default=0)
+    # Теневые колонки текстового поиска (GIN pg_trgm), см. _transport_sync_search
+    search_text = Column(Text, nullable=True)
+    search_from = Column(Text, nullable=True)
+    search_to = Column(Text, nullable=True)
+    # Ключи авто-подбора (match_index), пересчитываются в _transport_sync_match_keys
+    match_code = Column(String(32), nullable=True)
+    match_permanent = Column(sa.Boolean, nullable=False, default=False, server_default=sa.false())
+    match_date_from = Column(Date, nullable=True)
+    match_date_to = Column(Date, nullable=True)
+    match_cells = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_cover = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_cities = Column(ARRAY(String), nullable=False, default=list, server_default='{}')
+    match_keys_at = Column(DateTime, nullable=True)
 
 # --- Daily unique views (one per user per day) -------------------------------
 
@@ -405,6 +437,95 @@ class ChatParticipant(Base):
     chat = relationship("Chat", back_populates="participants")
 
 
+class ChatInbox(Base):
+    """
+    Сводка чата для конкретного участника: последнее видимое сообщение
+    (с учётом cleared_at) и число непрочитанных. Пересчитывается
+    chat_inbox.refresh() при отправке/прочтении/очистке; по ней /my-chats
+    отдаётся одним запросом с keyset-пагинацией.
+    """
+    __tablename__ = "chat_inbox"
+    user_id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey(
+        "chat.id", ondelete="CASCADE"), primary_key=True, index=True)
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(TIMESTAMP, nullable=True)
+    last_message_type = Column(String(16), nullable=True)
+    last_preview = Column(Text, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0)
+    # Ключ сортировки списка: время последнего сообщения, для групп без
+    # сообщений — время создания; NULL — чат в списке не показывается
+    activity_at = Column(TIMESTAMP, nullable=True)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+
+class UnreadCounter(Base):
+    """
+    Поддерживаемые счётчики непрочитанного (см. unread_counters.py):
+    ("chats", "") — сообщения во всех чатах, ("match", related_id) —
+    непрочитанные AUTO_MATCH-уведомления по заявке/транспорту.
+    """
+    __tablename__ = "unread_counters"
+    user_id = Column(Integer, primary_key=True)
+    kind = Column(String(16), primary_key=True)
+    key = Column(String(64), primary_key=True, default="")
+    count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+
+class EmailOutbox(Base):
+    """
+    Исходящие письма (см. email_outbox.py). Строка пишется в той же транзакции,
+    что и событие; отправляет фоновый диспетчер. kind="notification" —
+    письмо собирается при отправке из payload {message, created_at} и языка
+    пользователя; kind="raw" — готовые to_email/subject/html_body.
+    """
+    __tablename__ = "email_outbox"
+    id = Column(sa.BigInteger, primary_key=True)
+    kind = Column(String(32), nullable=False, default="raw")
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)
+    to_email = Column(String, nullable=True)
+    subject = Column(String, nullable=True)
+    html_body = Column(Text, nullable=True)
+    payload = Column(JSONB, nullable=True)
+    # pending | sending | sent | failed
+    status = Column(String(16), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+
+class SchedulerJobStat(Base):
+    """Статистика периодических задач (scheduler_worker.py): длительность, сбои, наложения."""
+    __tablename__ = "scheduler_job_stats"
+    job_id = Column(String(128), primary_key=True)
+    runs = Column(Integer, nullable=False, default=0)
+    failures = Column(Integer, nullable=False, default=0)
+    # Запуск пропущен: предыдущий ещё выполнялся
+    overlaps = Column(Integer, nullable=False, default=0)
+    last_started_at = Column(DateTime, nullable=True)
+    last_finished_at = Column(DateTime, nullable=True)
+    last_duration_ms = Column(Integer, nullable=True)
+    max_duration_ms = Column(Integer, nullable=True)
+    total_duration_ms = Column(sa.BigInteger, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    instance = Column(String(128), nullable=True)
+
+
+class GeocodeCache(Base):
+    """L2 кэша ответов внешних геокодеров (geo_cache.py)."""
+    __tablename__ = "geocode_cache"
+    # нормализованный запрос|язык|scope|страна|limit
+    key = Column(String(512), primary_key=True)
+    items = Column(JSONB, nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+    fresh_until = Column(DateTime, nullable=False)
+    stale_until = Column(DateTime, nullable=False, index=True)
+
+
 class Place(Base):
     __tablename__ = "places"
     id = sa.Column(sa.BigInteger, primary_key=True)
@@ -416,6 +537,11 @@ class Place(Base):
     lon = sa.Column(sa.Float, nullable=False)
     country_iso2 = sa.Column(sa.String(2), nullable=False)
     translations = sa.Column(JSONB, nullable=False, default=dict)
+    # Для ранжирования локального автокомплита (place_index)
+    population = sa.Column(sa.BigInteger, nullable=True)
+    place_type = sa.Column(sa.String(32), nullable=True)  # city|town|village|...
+    updated_at = sa.Column(sa.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     __table_args__ = (sa.UniqueConstraint(
         'source', 'external_id', name='uq_place_source_ext'),)
 
@@ -588,6 +714,55 @@ class TransportMatchView(Base):
                          name='transport_match_views_user_transport_uc'),
     )
 
+# === Очередь авто-подбора (см. auto_match_queue.py) ===
+
+
+class ListingPoint(Base):
+    """
+    Нормализованные точки погрузки/выгрузки заявок и транспорта для радиусного поиска.
+    Заполняется listing_points.sync_* при сохранении записи; GiST-индекс
+    по ll_to_earth(lat, lng) (earthdistance) создаётся миграцией.
+    """
+    __tablename__ = "listing_points"
+    id = Column(sa.BigInteger, primary_key=True, autoincrement=True)
+    order_id = Column(Integer, ForeignKey(
+        "orders.id", ondelete="CASCADE"), nullable=True, index=True)
+    transport_id = Column(UUID(as_uuid=True), ForeignKey(
+        "transports.id", ondelete="CASCADE"), nullable=True, index=True)
+    kind = Column(String(8), nullable=False)   # "from" | "to"
+    idx = Column(Integer, nullable=False, default=0)
+    lat = Column(Float, nullable=False)
+    lng = Column(Float, nullable=False)
+
+    __table_args__ = (
+        sa.CheckConstraint(
+            "(order_id IS NULL) <> (transport_id IS NULL)",
+            name="ck_listing_points_owner"),
+    )
+
+
+class AutoMatchJob(Base):
+    __tablename__ = "auto_match_jobs"
+    id = Column(sa.BigInteger, primary_key=True, autoincrement=True)
+    kind = Column(String(16), nullable=False)        # "order" | "transport"
+    entity_id = Column(String(64), nullable=False)
+    # pending | running | done | failed | coalesced
+    status = Column(String(16), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    run_after = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    locked_by = Column(String(128), nullable=True)
+    last_error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        # Коалесинг: не больше одной ожидающей задачи на сущность
+        sa.Index("uq_auto_match_jobs_pending", "kind", "entity_id", unique=True,
+                 postgresql_where=sa.text("status = 'pending'")),
+        sa.Index("ix_auto_match_jobs_status_run_after", "status", "run_after"),
+    )
+
     # === GPS Tracking ===
 
 
@@ -611,11 +786,20 @@ class TrackingSession(Base):
 
 
 class TrackingPoint(Base):
+    """
+    В БД — секционирована по месяцам (RANGE по ts, см. миграцию
+    20251125_partition_tracking_points и tracking_partitions.py), поэтому ts
+    входит в первичный ключ.
+    """
     __tablename__ = "tracking_points"
-    id = Column(Integer, primary_key=True)
+    __table_args__ = (
+        sa.Index("ix_tracking_points_session_ts", "session_id", "ts"),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(UUID(as_uuid=True), ForeignKey(
-        "tracking_sessions.id", ondelete="CASCADE"), index=True, nullable=False)
-    ts = Column(DateTime, default=datetime.utcnow, index=True)
+        "tracking_sessions.id", ondelete="CASCADE"), nullable=False)
+    ts = Column(DateTime, default=datetime.utcnow,
+                primary_key=True, nullable=False)
     lat = Column(Float, nullable=False)
     lng = Column(Float, nullable=False)
     speed = Column(Float)
@@ -806,3 +990,116 @@ class PhoneVerification(Base):
     sent_at = Column(DateTime, nullable=False)
     attempts = Column(Integer, nullable=False, server_default="0")
     verified_at = Column(DateTime, nullable=True)
+
+
+# === Типизированные даты заявок/транспорта ===
+# Строковые load_date / ready_date_* остаются как есть (их шлёт и читает фронт),
+# а *_d колонки пересчитываются при каждой записи через ORM.
+
+LISTING_DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d.%m.%Y")
+
+
+def parse_listing_date(value):
+    """Строка даты в форматах проекта -> date (или None)."""
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in LISTING_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+@event.listens_for(Order, "before_insert")
+@event.listens_for(Order, "before_update")
+def _order_sync_typed_dates(mapper, connection, target):
+    target.load_date_d = parse_listing_date(target.load_date)
+
+
+@event.listens_for(Transport, "before_insert")
+@event.listens_for(Transport, "before_update")
+def _transport_sync_typed_dates(mapper, connection, target):
+    target.ready_date_from_d = parse_listing_date(target.ready_date_from)
+    target.ready_date_to_d = parse_listing_date(target.ready_date_to)
+
+
+# === Текстовый поиск заявок/транспорта (listing_search) ===
+# search_text — свободный текст (фильтр q), search_from/search_to — названия
+# точек «откуда»/«куда» из JSONB; строки через \n. Пересчитываются при каждой
+# записи через ORM; тот же расчёт в SQL — миграция 20251202_listing_search_trgm.
+
+ORDER_SEARCH_FIELDS = ("description", "truck_type", "comment")
+TRANSPORT_SEARCH_FIELDS = ("truck_type", "transport_kind", "contact_name", "comment", "email")
+
+
+def listing_location_names(items):
+    """Названия точек из JSONB-массива: строки или объекты {location|name|address}."""
+    names = []
+    if not isinstance(items, list):
+        return names
+    for item in items:
+        if isinstance(item, dict):
+            item = item.get("location") or item.get("name") or item.get("address")
+        if isinstance(item, str):
+            names.append(item)
+    return names
+
+
+def join_search_values(values):
+    parts = [v.strip() for v in values if isinstance(v, str) and v.strip()]
+    return "\n".join(parts) or None
+
+
+@event.listens_for(Order, "before_insert")
+@event.listens_for(Order, "before_update")
+def _order_sync_search(mapper, connection, target):
+    target.search_text = join_search_values(getattr(target, f) for f in ORDER_SEARCH_FIELDS)
+    target.search_from = join_search_values(listing_location_names(target.from_locations))
+    target.search_to = join_search_values(listing_location_names(target.to_locations))
+
+
+@event.listens_for(Transport, "before_insert")
+@event.listens_for(Transport, "before_update")
+def _transport_sync_search(mapper, connection, target):
+    target.search_text = join_search_values(getattr(target, f) for f in TRANSPORT_SEARCH_FIELDS)
+    target.search_from = join_search_values([target.from_location])
+    target.search_to = join_search_values(listing_location_names(target.to_locations))
+
+
+# === Ключи авто-подбора (match_index) ===
+# Пересчитываются при записи через ORM после *_d дат, если изменилось
+# что-то, от чего они зависят (счётчик просмотров ключи не трогает).
+# Строки, записанные мимо ORM, дозаполняет match_index.backfill.
+
+ORDER_MATCH_FIELDS = (
+    "truck_type", "load_date", "from_locations", "from_locations_coords",
+)
+TRANSPORT_MATCH_FIELDS = (
+    "truck_type", "mode", "ready_date_from", "ready_date_to", "from_location",
+    "from_location_lat", "from_location_lng", "from_radius",
+)
+
+
+def _match_keys_stale(target, fields) -> bool:
+    if target.match_keys_at is None:
+        return True
+    attrs = sa.inspect(target).attrs
+    return any(attrs[f].history.has_changes() for f in fields)
+
+
+@event.listens_for(Order, "before_insert")
+@event.listens_for(Order, "before_update")
+def _order_sync_match_keys(mapper, connection, target):
+    if _match_keys_stale(target, ORDER_MATCH_FIELDS):
+        import match_index  # импортирует models
+        match_index.apply_order_keys(target)
+
+
+@event.listens_for(Transport, "before_insert")
+@event.listens_for(Transport, "before_update")
+def _transport_sync_match_keys(mapper, connection, target):
+    if _match_keys_stale(target, TRANSPORT_MATCH_FIELDS):
+        import match_index
+        match_index.apply_transport_keys(target)
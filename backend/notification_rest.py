@@ -5,6 +5,7 @@ from models import Notification
 from schemas import NotificationOut
 from auth import get_current_user
 from database import get_db
+import unread_counters
 
 router = APIRouter()
 
@@ -16,7 +17,13 @@ def get_notifications(db: Session = Depends(get_db), user=Depends(get_current_us
 
 @router.post("/notifications/read")
 def mark_read(ids: List[int] = Body(...), db: Session = Depends(get_db), user=Depends(get_current_user)):
-    db.query(Notification).filter(Notification.user_id == user.id, Notification.id.in_(
-        ids)).update({"read": True}, synchronize_session=False)
+    t = Notification.__table__
+    rows = db.execute(
+        t.update()
+        .where(t.c.user_id == user.id, t.c.id.in_(ids), t.c.read.isnot(True))
+        .values(read=True)
+        .returning(t.c.user_id, t.c.type, t.c.related_id)
+    ).all()
+    unread_counters.notifications_read(db, rows)
     db.commit()
     return {"status": "ok"}
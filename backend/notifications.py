@@ -2,20 +2,26 @@ from math import radians, cos, sin, asin, sqrt
 from datetime import datetime, timedelta
 import asyncio
 from collections import defaultdict
-import heapq
 import html
 from typing import Iterator, TypeVar
 from jose import jwt, JWTError
 from auth import get_token_from_header_or_cookie, SECRET_KEY, ALGORITHM
 from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query
 from sqlalchemy.orm import Session, noload
-from sqlalchemy import and_, or_
+from sqlalchemy import or_
 import os
 import json
+try:
+    import numpy as np  # опционально: векторные расстояния для подбора/ближайших
+except ImportError:
+    np = None
 
 from database import get_db
+import unread_counters
+import email_outbox
+import ws_broker
+import ws_outbox
 from auth import get_current_user
-from email_utils import send_email
 from i18n_email import SUPPORTED as EMAIL_LANGS, DEFAULT as DEFAULT_EMAIL_LANG
 from models import (
     Transport,
@@ -78,6 +84,7 @@ async def _notifications_ws_impl(websocket: WebSocket):
             return
 
         key = str(current_user.id)
+        ws_outbox.attach(websocket, ws_outbox.WS_CHAT_OVERFLOW)
         user_notification_connections[key].add(websocket)
         try:
             while True:
@@ -96,6 +103,7 @@ async def _notifications_ws_impl(websocket: WebSocket):
             pass
         finally:
             user_notification_connections[key].discard(websocket)
+            ws_outbox.detach(websocket)
     finally:
         try:
             db.close()
@@ -121,6 +129,37 @@ def _stream_query(query, *, chunk_size: int = 256) -> Iterator[T]:
         session.expunge(row)
 
 
+def _load_by_ids(query, model, ids, *, chunk_size: int = 256) -> Iterator[T]:
+    """Подгружает строки по списку id пачками, сохраняя порядок ids."""
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        rows = query.filter(model.id.in_(chunk)).options(noload("*")).all()
+        by_id = {row.id: row for row in rows}
+        for _id in chunk:
+            row = by_id.get(_id)
+            if row is not None:
+                yield row
+
+
+def _match_candidates(db: Session, query, subject, *, tag: str) -> Iterator[T]:
+    """
+    Кандидаты для подбора к subject (Order -> транспорты, Transport -> заявки).
+    query сужаем по ключам match_* (тип кузова, даты, ячейки geohash; см.
+    match_index) — Postgres берёт их по индексам, одинаково для всех
+    процессов. Если ключи выключены — старый стрим по всем активным записям.
+    """
+    import match_index
+
+    cond = match_index.candidate_filter(subject)
+    if cond is None:
+        total = query.order_by(None).count()
+        print(f"{tag} full scan, active candidates={total}")
+        return _stream_query(query)
+
+    print(f"{tag} candidates by match keys")
+    return _stream_query(query.filter(cond))
+
+
 # --------------------------- WEBSOCKET /notifications ---------------------------
 # Фронт соединяется как ws://<host>/notifications?user_id=...&token=...
 # Здесь мы регистрируем соединение и держим его открытым (для push по create_notification).
@@ -151,6 +190,34 @@ def haversine(lat1, lon1, lat2, lon2):
     return R * c
 
 
+def haversine_many(lat, lng, lats, lngs):
+    """
+    Расстояния (км) от точки (lat, lng) до массивов lats/lngs одним вызовом.
+    С numpy — ndarray, без него — список (та же формула, что в haversine).
+    """
+    if np is None:
+        return [haversine(lat, lng, la, lo) for la, lo in zip(lats, lngs)]
+    lat1 = np.radians(float(lat))
+    lng1 = np.radians(float(lng))
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lng2 = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * \
+        np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _top_k(values, k: int):
+    """Индексы k наименьших значений по возрастанию (argpartition вместо кучи)."""
+    n = len(values)
+    if n == 0 or k <= 0:
+        return []
+    if np is None:
+        return sorted(range(n), key=values.__getitem__)[:k]
+    arr = np.asarray(values, dtype=np.float64)
+    idx = np.argpartition(arr, k - 1)[:k] if k < n else np.arange(n)
+    return idx[np.argsort(arr[idx], kind="stable")].tolist()
+
+
 ORDER_DEFAULT_RADIUS_KM = float(os.getenv("ORDER_DEFAULT_RADIUS_KM", "80"))
 
 # Максимальное количество автосовпадений для одного заказа/транспорта
@@ -337,18 +404,6 @@ def _build_email(lang: str, message: str, created_at: datetime | None) -> tuple[
     return subject, html_body
 
 
-def _send_email_notification(db: Session, user_id: int, message: str, created_at: datetime | None) -> None:
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user or not user.email:
-            return
-        lang = _detect_user_lang(db, user)
-        subject, html_body = _build_email(lang, message, created_at)
-        send_email(user.email, subject, html_body)
-    except Exception as e:
-        print(f"[WARN] Email notification failed: {e}")
-
-
 def _parse_km(val, default=0.0):
     try:
         v = float(val) if val is not None else default
@@ -397,11 +452,10 @@ def _transport_pickup_point(transport):
 
 
 def _nearest_distance_km(point, coords):
-    best = None
-    for (la, lo) in coords:
-        d = haversine(la, lo, point[0], point[1])
-        best = d if best is None else min(best, d)
-    return best if best is not None else float("inf")
+    # У кандидата 1–3 точки: скалярная формула быстрее, чем собирать массивы numpy
+    if not coords:
+        return float("inf")
+    return min(haversine(point[0], point[1], c[0], c[1]) for c in coords)
 
 
 def _check_location_match(transport, order):
@@ -421,17 +475,19 @@ def _check_location_match(transport, order):
         default=ORDER_DEFAULT_RADIUS_KM
     ) if ord_radius_raw in (None, "", 0, "0") else _parse_km(ord_radius_raw, default=0.0)
 
+    # Расстояния до всех точек заказа считаем один раз: «хоть одна точка
+    # в радиусе» ⇔ ближайшая точка в радиусе
+    nearest = float("inf")
+    if tr_point and order_coords:
+        nearest = _nearest_distance_km(tr_point, order_coords)
+
     # 1) Радиус транспорта → точки заказа
-    if tr_point and tr_radius > 0 and order_coords:
-        for (la, lo) in order_coords:
-            if haversine(la, lo, tr_point[0], tr_point[1]) <= tr_radius:
-                return True, "by_transport_radius", 0.0
+    if tr_radius > 0 and nearest <= tr_radius:
+        return True, "by_transport_radius", 0.0
 
     # 2) Радиус заказа → точка транспорта
-    if tr_point and ord_radius > 0 and order_coords:
-        d = _nearest_distance_km(tr_point, order_coords)
-        if d <= ord_radius:
-            return True, "by_order_radius", d
+    if ord_radius > 0 and nearest <= ord_radius:
+        return True, "by_order_radius", nearest
 
     # 3) Фоллбек по городу
     tr_city = normalize_city(getattr(transport, "from_location", "") or "")
@@ -441,11 +497,7 @@ def _check_location_match(transport, order):
         return True, "by_city", float("inf")
 
     # 4) Нет Соответствия — вернём ближайшую дистанцию (для UI-подсказок)
-    if tr_point and order_coords:
-        d = _nearest_distance_km(tr_point, order_coords)
-        return False, None, d
-
-    return False, None, float("inf")
+    return False, None, nearest
 
 
 def normalize_str(val):
@@ -539,28 +591,83 @@ def parse_date(date_str):
     return None
 
 
-def _is_blocked_pair(db: Session, a_id: int, b_id: int) -> bool:
-    """True, если хотя бы один из пользователей заблокировал другого (симметрия по эффекту)."""
-    return db.query(UB.id).filter(
-        or_(
-            and_(UB.blocker_id == a_id, UB.blocked_id == b_id),
-            and_(UB.blocker_id == b_id, UB.blocked_id == a_id),
-        )
-    ).first() is not None
+def listing_date(obj, field: str):
+    """
+    Дата записи (load_date / ready_date_from / ready_date_to) как datetime.
+    Берём типизированную колонку <field>_d, строку парсим только если её нет
+    (старые строки до бэкфилла, несохранённые объекты).
+    """
+    typed = getattr(obj, f"{field}_d", None)
+    if typed is not None:
+        return datetime.combine(typed, datetime.min.time())
+    return parse_date(getattr(obj, field, "") or "")
+
+
+class BlockedPairs:
+    """
+    Блокировки (A↔B) на время одного прогона подбора или одного запроса.
+
+    Для каждого пользователя множество id, с которыми у него блокировка
+    в любую сторону, грузится из user_blocks один раз; дальше все проверки
+    по кандидатам идут по памяти, без SELECT на каждого кандидата.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._sets: dict[int, set[int]] = {}
+
+    def prefetch(self, user_ids) -> None:
+        """Загружает блок-листы сразу для нескольких пользователей одним запросом."""
+        ids = {int(u) for u in user_ids if u is not None} - self._sets.keys()
+        if not ids:
+            return
+        for uid in ids:
+            self._sets[uid] = set()
+        rows = self.db.query(UB.blocker_id, UB.blocked_id).filter(
+            or_(UB.blocker_id.in_(ids), UB.blocked_id.in_(ids))
+        ).all()
+        for blocker_id, blocked_id in rows:
+            if blocker_id in ids:
+                self._sets[blocker_id].add(blocked_id)
+            if blocked_id in ids:
+                self._sets[blocked_id].add(blocker_id)
+
+    def blocked_ids(self, user_id) -> set[int]:
+        """Все id, заблокировавшие user_id или заблокированные им."""
+        if user_id is None:
+            return set()
+        user_id = int(user_id)
+        if user_id not in self._sets:
+            self.prefetch([user_id])
+        return self._sets[user_id]
+
+    def is_blocked(self, a_id, b_id) -> bool:
+        """Блокировка между a_id и b_id в любую сторону; блок-лист грузится для a_id (владелец прогона)."""
+        if a_id is None or b_id is None:
+            return False
+        return int(b_id) in self.blocked_ids(a_id)
 
 # --------------------------- PUSH УВЕДОМЛЕНИЙ ---------------------------
 
 
 async def push_notification(user_id, data):
+    """Событие в WS уведомлений пользователя: локально и в другие воркеры (ws_broker)."""
     print(f"[WS][PUSH_NOTIFY] push_notification user_id={user_id} data={data}")
+    await deliver_to_user(user_id, data)
+    ws_broker.publish(ws_broker.TARGET_USER, user_id, data)
+
+
+async def deliver_to_user(user_id, data):
+    """
+    Доставка только сокетам этого процесса (вызывается и брокером) через
+    очереди соединений (ws_outbox).
+    """
     ws_set = user_notification_connections.get(str(user_id))
     if ws_set:
-        for ws in ws_set.copy():
-            try:
-                await ws.send_json(data)
-            except Exception as e:
-                user_notification_connections[str(user_id)].discard(ws)
-                print(f"[ERROR] push_notification WS send_json: {e}")
+        dead = ws_outbox.broadcast(
+            ws_set.copy(), data, policy=ws_outbox.WS_CHAT_OVERFLOW)
+        for ws in dead:
+            ws_set.discard(ws)
 
 
 def create_notification(
@@ -629,6 +736,9 @@ def create_notification(
         read=False,
     )
     db.add(notif)
+    # Письмо — строкой outbox в той же транзакции; язык, шаблон и SMTP —
+    # в фоновом диспетчере (email_outbox.py)
+    email_outbox.enqueue_notification(db, user_id, notif.message, notif.created_at)
     if auto_commit:
         db.commit()
         db.refresh(notif)
@@ -637,11 +747,6 @@ def create_notification(
         # transaction – the caller is responsible for committing later.
         db.flush()
 
-    try:
-        _send_email_notification(db, user_id, notif.message, notif.created_at)
-    except Exception as e:
-        print("[WARN] Email notification dispatch failed:", e)
-
     event = {
         "event": "new_notification",
         "id": notif.id,
@@ -677,16 +782,8 @@ def get_unread_matches(
         raise HTTPException(
             status_code=400, detail="transport_id or order_id required")
 
-    query = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.type == NotificationType.AUTO_MATCH,
-        Notification.read == False,
-    )
-    if transport_id:
-        query = query.filter(Notification.related_id == str(transport_id))
-    if order_id:
-        query = query.filter(Notification.related_id == str(order_id))
-    return {"unread": query.count()}
+    return {"unread": unread_counters.get_match(
+        db, current_user.id, transport_id=transport_id, order_id=order_id)}
 
 
 @router.patch("/matches/mark_read")
@@ -700,19 +797,23 @@ def mark_matches_as_read(
         raise HTTPException(
             status_code=400, detail="transport_id or order_id required")
 
-    query = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.type == NotificationType.AUTO_MATCH,
-        Notification.read == False,
+    t = Notification.__table__
+    stmt = t.update().where(
+        t.c.user_id == current_user.id,
+        t.c.type == NotificationType.AUTO_MATCH,
+        t.c.read == False,
     )
     if transport_id:
-        query = query.filter(Notification.related_id == str(transport_id))
+        stmt = stmt.where(t.c.related_id == str(transport_id))
     if order_id:
-        query = query.filter(Notification.related_id == str(order_id))
+        stmt = stmt.where(t.c.related_id == str(order_id))
 
-    updated = query.update({"read": True}, synchronize_session="fetch")
+    # RETURNING — чтобы уменьшить счётчики ровно на помеченные строки
+    rows = db.execute(stmt.values(read=True).returning(
+        t.c.user_id, t.c.type, t.c.related_id)).all()
+    unread_counters.notifications_read(db, rows)
     db.commit()
-    return {"marked_read": updated}
+    return {"marked_read": len(rows)}
 
 # --------------------------- АВТОПОДБОРЫ + НОТИФИКАЦИИ ---------------------------
 
@@ -735,11 +836,13 @@ def _format_transport_period(tr: Transport) -> str:
         return ""
 
 
-def find_and_notify_auto_match_for_order(order: Order, db: Session):
+def find_and_notify_auto_match_for_order(order: Order, db: Session, raise_errors: bool = False):
     """
     ORDER -> TRANSPORT: находит подходящие транспорты и уведомляет владельцев транспорта.
     Учитывает блокировки (A↔B).
     Использует _stream_query, чтобы не грузить все транспорты в память.
+    raise_errors=True (auto_match_queue.run_job) — ошибка уходит вызывающему,
+    чтобы задача ушла на повтор с backoff.
     """
     print(
         f"\n[AUTO_MATCH][ORDER->TRANSPORT] START "
@@ -754,7 +857,7 @@ def find_and_notify_auto_match_for_order(order: Order, db: Session):
 
     order_cities = [normalize_city(c) for c in (order.from_locations or [])]
     order_truck_type = canon_truck_type(getattr(order, "truck_type", ""))
-    order_date = parse_date(getattr(order, "load_date", ""))
+    order_date = listing_date(order, "load_date")
 
     if not order_date:
         print("[AUTO_MATCH][ORDER->TRANSPORT] cannot parse order.load_date")
@@ -778,23 +881,19 @@ def find_and_notify_auto_match_for_order(order: Order, db: Session):
         transport_query = transport_query.filter(
             Transport.created_at >= cutoff)
 
-    total_candidates = transport_query.order_by(None).count()
-    print(
-        f"[AUTO_MATCH][ORDER->TRANSPORT] "
-        f"Total active transports (with created_at filter={cutoff is not None}): "
-        f"{total_candidates}"
-    )
-
     matched = 0
+    blocks = BlockedPairs(db)
 
     try:
-        for tr in _stream_query(transport_query):
+        candidates = _match_candidates(
+            db, transport_query, order, tag="[AUTO_MATCH][ORDER->TRANSPORT]")
+        for tr in candidates:
             # Не уведомляем самого себя
             if tr.owner_id == order.owner_id:
                 continue
 
             # Блокировки в обе стороны
-            if _is_blocked_pair(db, order.owner_id, tr.owner_id):
+            if blocks.is_blocked(order.owner_id, tr.owner_id):
                 continue
 
             tr_truck_type = canon_truck_type(getattr(tr, "truck_type", ""))
@@ -804,8 +903,8 @@ def find_and_notify_auto_match_for_order(order: Order, db: Session):
             tr_mode_raw = getattr(tr, "mode", "")
             tr_mode = normalize_str(tr_mode_raw)
             is_permanent = is_permanent_mode(tr_mode)
-            tr_from = parse_date(getattr(tr, "ready_date_from", ""))
-            tr_to = parse_date(getattr(tr, "ready_date_to", "")) or tr_from
+            tr_from = listing_date(tr, "ready_date_from")
+            tr_to = listing_date(tr, "ready_date_to") or tr_from
 
             # Дата
             if not is_permanent:
@@ -879,13 +978,16 @@ def find_and_notify_auto_match_for_order(order: Order, db: Session):
         print(
             f"[AUTO_MATCH][ORDER->TRANSPORT] ERROR order_id={getattr(order, 'id', None)}: {e}"
         )
+        if raise_errors:
+            raise
 
 
-def find_and_notify_auto_match_for_transport(transport: Transport, db: Session):
+def find_and_notify_auto_match_for_transport(transport: Transport, db: Session, raise_errors: bool = False):
     """
     TRANSPORT -> ORDER: находит подходящие заказы и уведомляет владельцев заказов.
     Учитывает блокировки _в обе стороны_ (A↔B).
     Использует _stream_query + лимиты, чтобы не грузить память.
+    raise_errors — как у find_and_notify_auto_match_for_order.
     """
     print(
         f"\n[AUTO_MATCH][TRANSPORT->ORDER] START "
@@ -902,8 +1004,8 @@ def find_and_notify_auto_match_for_transport(transport: Transport, db: Session):
     tr_mode_raw = getattr(transport, "mode", "")
     tr_mode = normalize_str(tr_mode_raw)
     is_permanent = is_permanent_mode(tr_mode)
-    tr_from = parse_date(getattr(transport, "ready_date_from", ""))
-    tr_to = parse_date(getattr(transport, "ready_date_to", "")) or tr_from
+    tr_from = listing_date(transport, "ready_date_from")
+    tr_to = listing_date(transport, "ready_date_to") or tr_from
 
     _iso_from = tr_from
     _iso_to = tr_to
@@ -932,31 +1034,28 @@ def find_and_notify_auto_match_for_transport(transport: Transport, db: Session):
     if cutoff is not None:
         order_query = order_query.filter(Order.created_at >= cutoff)
 
-    total_orders = order_query.order_by(None).count()
-    print(
-        f"[AUTO_MATCH][TRANSPORT->ORDER] Total active orders "
-        f"(with created_at filter={cutoff is not None}): {total_orders}"
-    )
-
     matched = 0
+    blocks = BlockedPairs(db)
 
     try:
         import json
 
-        for order in _stream_query(order_query):
+        candidates = _match_candidates(
+            db, order_query, transport, tag="[AUTO_MATCH][TRANSPORT->ORDER]")
+        for order in candidates:
             # Не матчим самих себя
             if order.owner_id == transport.owner_id:
                 continue
 
             # Блокировки (оба направления)
-            if _is_blocked_pair(db, order.owner_id, transport.owner_id):
+            if blocks.is_blocked(transport.owner_id, order.owner_id):
                 continue
 
             order_type = canon_truck_type(getattr(order, "truck_type", ""))
             if not are_truck_types_compatible(order_type, tr_type):
                 continue
 
-            order_date = parse_date(getattr(order, "load_date", ""))
+            order_date = listing_date(order, "load_date")
             if not order_date:
                 continue
 
@@ -1027,6 +1126,8 @@ def find_and_notify_auto_match_for_transport(transport: Transport, db: Session):
         print(
             f"[AUTO_MATCH][TRANSPORT->ORDER] ERROR transport_id={getattr(transport, 'id', None)}: {e}"
         )
+        if raise_errors:
+            raise
 # --------------------------- ПОИСК Соответствий (без уведомлений) ---------------------------
 
 
@@ -1034,6 +1135,7 @@ def find_matching_orders_for_transport(
     transport: Transport,
     db: Session,
     exclude_user_id=None,
+    blocks: "BlockedPairs | None" = None,
 ):
     """
     Находит заказы, совпадающие с транспортом (для UI/фильтра matches_only).
@@ -1044,32 +1146,31 @@ def find_matching_orders_for_transport(
     if exclude_user_id:
         order_query = order_query.filter(Order.owner_id != exclude_user_id)
 
-    total_orders = order_query.order_by(None).count()
-    print(
-        f"[MATCH LIST T->O] total active orders={total_orders} for transport_id={getattr(transport, 'id', None)}"
-    )
-
     results = []
     seen = set()
+    blocks = blocks or BlockedPairs(db)
 
     tr_type = canon_truck_type(getattr(transport, "truck_type", ""))
     tr_mode_raw = getattr(transport, "mode", "")
     tr_mode = normalize_str(tr_mode_raw)
     is_permanent = is_permanent_mode(tr_mode)
-    tr_from = parse_date(getattr(transport, "ready_date_from", ""))
-    tr_to = parse_date(getattr(transport, "ready_date_to", "")) or tr_from
+    tr_from = listing_date(transport, "ready_date_from")
+    tr_to = listing_date(transport, "ready_date_to") or tr_from
 
-    for order in _stream_query(order_query):
+    candidates = _match_candidates(
+        db, order_query, transport,
+        tag=f"[MATCH LIST T->O] transport_id={getattr(transport, 'id', None)}")
+    for order in candidates:
         if exclude_user_id and order.owner_id == exclude_user_id:
             continue
-        if _is_blocked_pair(db, order.owner_id, transport.owner_id):
+        if blocks.is_blocked(transport.owner_id, order.owner_id):
             continue
 
         order_type = canon_truck_type(getattr(order, "truck_type", ""))
         if order_type != tr_type:
             continue
 
-        order_date = parse_date(getattr(order, "load_date", ""))
+        order_date = listing_date(order, "load_date")
         if not order_date:
             continue
 
@@ -1108,13 +1209,13 @@ def find_matching_orders(order_data: Order, db: Session, exclude_user_id=None):
     return query.all()
 
 
-def find_matching_transports(order: Order, db: Session, exclude_user_id=None):
+def find_matching_transports(order: Order, db: Session, exclude_user_id=None, blocks: "BlockedPairs | None" = None):
     """
     Находит совпадающие транспорты к заказу. Без отправки уведомлений.
     Учитывает блокировки.
     Используется фильтр matches_only и карточки Соответствий.
     """
-    _order_iso = parse_date(getattr(order, "load_date", ""))
+    _order_iso = listing_date(order, "load_date")
     print(
         f"[MATCH DEBUG] order.id={getattr(order, 'id', None)} "
         f"truck_type={order.truck_type} (code={canon_truck_type(getattr(order, 'truck_type', ''))}) "
@@ -1128,21 +1229,20 @@ def find_matching_transports(order: Order, db: Session, exclude_user_id=None):
             Transport.owner_id != exclude_user_id
         )
 
-    total_candidates = transport_query.order_by(None).count()
-    print(
-        f"[MATCH DEBUG] found {total_candidates} transport candidates (all active)"
-    )
-
     results = []
     seen = set()  # dedupe by id
+    blocks = blocks or BlockedPairs(db)
 
     order_truck_type = canon_truck_type(getattr(order, "truck_type", ""))
-    order_date = parse_date(getattr(order, "load_date", ""))
+    order_date = listing_date(order, "load_date")
 
-    for tr in _stream_query(transport_query):
+    candidates = _match_candidates(
+        db, transport_query, order,
+        tag=f"[MATCH DEBUG] order_id={getattr(order, 'id', None)}")
+    for tr in candidates:
         if exclude_user_id and tr.owner_id == exclude_user_id:
             continue
-        if _is_blocked_pair(db, order.owner_id, tr.owner_id):
+        if blocks.is_blocked(order.owner_id, tr.owner_id):
             continue
 
         tr_truck_type = canon_truck_type(getattr(tr, "truck_type", ""))
@@ -1151,8 +1251,8 @@ def find_matching_transports(order: Order, db: Session, exclude_user_id=None):
 
         tr_mode = normalize_str(getattr(tr, "mode", ""))
         is_permanent = is_permanent_mode(tr_mode)
-        tr_from = parse_date(getattr(tr, "ready_date_from", ""))
-        tr_to = parse_date(getattr(tr, "ready_date_to", "")) or tr_from
+        tr_from = listing_date(tr, "ready_date_from")
+        tr_to = listing_date(tr, "ready_date_to") or tr_from
 
         if not order_date:
             continue
@@ -1181,43 +1281,76 @@ def nearest_orders_for_transport(transport: Transport, db: Session, limit: int =
     tr_point = _transport_pickup_point(transport)
     if not tr_point:
         return []
-    order_query = db.query(Order).filter(Order.is_active == True)
-    scored_heap = []
-    for order in _stream_query(order_query):
-        coords = _order_pickup_coords(order)
+    # Только id и координаты: ORM-объекты грузим лишь для top-k
+    rows = (
+        db.query(Order.id, Order.from_locations_coords)
+        .filter(Order.is_active == True)
+        .yield_per(1000)
+    )
+    ids, starts, lats, lngs = [], [], [], []
+    for row in rows:
+        coords = _order_pickup_coords(row)
         if not coords:
             continue
-        d = _nearest_distance_km(tr_point, coords)
-        if d == float("inf"):
-            continue
-        if len(scored_heap) < limit:
-            heapq.heappush(scored_heap, (-d, order))
-        else:
-            worst = -scored_heap[0][0]
-            if d < worst:
-                heapq.heapreplace(scored_heap, (-d, order))
-    scored = sorted(scored_heap, key=lambda item: -item[0])
-    return [(order, -distance) for distance, order in scored]
+        ids.append(row.id)
+        starts.append(len(lats))
+        for la, lo in coords:
+            lats.append(la)
+            lngs.append(lo)
+    if not ids:
+        return []
+
+    dists = haversine_many(tr_point[0], tr_point[1], lats, lngs)
+    # Расстояние до заказа — до ближайшей из его точек погрузки
+    if np is None:
+        bounds = starts[1:] + [len(lats)]
+        per_order = [min(dists[a:b]) for a, b in zip(starts, bounds)]
+    else:
+        per_order = np.minimum.reduceat(dists, np.asarray(starts))
+
+    top = _top_k(per_order, limit)
+    dist_by_id = {ids[i]: float(per_order[i]) for i in top}
+    orders = _load_by_ids(db.query(Order), Order, [ids[i] for i in top])
+    return [(order, dist_by_id[order.id]) for order in orders]
 
 
 def nearest_transports_for_order(order: Order, db: Session, limit: int = 10):
     coords = _order_pickup_coords(order)
     if not coords:
         return []
-    transport_query = db.query(Transport).filter(Transport.is_active == True)
-    scored_heap = []
-    for tr in _stream_query(transport_query):
-        tr_point = _transport_pickup_point(tr)
-        if not tr_point:
-            continue
-        d = _nearest_distance_km(tr_point, coords)
-        if d == float("inf"):
+    rows = (
+        db.query(Transport.id, Transport.from_location_lat, Transport.from_location_lng)
+        .filter(
+            Transport.is_active == True,
+            Transport.from_location_lat.isnot(None),
+            Transport.from_location_lng.isnot(None),
+        )
+        .yield_per(1000)
+    )
+    ids, lats, lngs = [], [], []
+    for row in rows:
+        point = _transport_pickup_point(row)
+        if not point:
             continue
-        if len(scored_heap) < limit:
-            heapq.heappush(scored_heap, (-d, tr))
+        ids.append(row.id)
+        lats.append(point[0])
+        lngs.append(point[1])
+    if not ids:
+        return []
+
+    # Для каждой точки погрузки заказа — один векторный проход по всем транспортам
+    best = None
+    for la, lo in coords:
+        d = haversine_many(la, lo, lats, lngs)
+        if best is None:
+            best = d
+        elif np is None:
+            best = [min(x, y) for x, y in zip(best, d)]
         else:
-            worst = -scored_heap[0][0]
-            if d < worst:
-                heapq.heapreplace(scored_heap, (-d, tr))
-    scored = sorted(scored_heap, key=lambda item: -item[0])
-    return [(tr, -distance) for distance, tr in scored]
+            best = np.minimum(best, d)
+
+    top = _top_k(best, limit)
+    dist_by_id = {ids[i]: float(best[i]) for i in top}
+    transports = _load_by_ids(
+        db.query(Transport), Transport, [ids[i] for i in top])
+    return [(tr, dist_by_id[tr.id]) for tr in transports]
@@ -1,11 +1,20 @@
-from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
-from models import Order, Transport, ChatMessage, ChatParticipant, NotificationType
+from models import ChatMessage, ChatParticipant
 from database import SessionLocal
-from notifications import create_notification
 from support_models import SupportTicket, TicketStatus
 from ws_events import ws_emit_to_chat
 import asyncio
+import os
+
+import chat_inbox
+import unread_counters
+import tracking_partitions
+import listing_expiry
+import geo_cache
+import match_index
+
+UNREAD_COUNTERS_RECONCILE_MIN = int(
+    os.getenv("UNREAD_COUNTERS_RECONCILE_MIN", "10") or "10")
 
 # --- SUPPORT: авто-закрытие чатов по бездействию ---
 
@@ -74,6 +83,7 @@ def check_support_inactivity():
                     ChatParticipant.chat_id == t.chat_id,
                     ChatParticipant.user_id == t.user_id
                 ).delete()
+                chat_inbox.refresh(db, [t.chat_id])
                 # Помечаем тикет
                 t.status = TicketStatus.CLOSED
                 t.closed_at = now
@@ -89,144 +99,88 @@ def check_support_inactivity():
         db.close()
 
 
-def check_order_deadlines():
+def check_listing_expiry():
+    """Уведомления о просрочке 1/4/7 дней и авто-скрытие заявок/транспорта (listing_expiry)."""
     db = SessionLocal()
-    now = datetime.utcnow()
-    orders = db.query(Order).filter(Order.is_active ==
-                                    True, Order.load_date != None).all()
-    for order in orders:
-        if not order.load_date:
-            continue
-        try:
-            # --- Определяем дату ---
-            load_date = order.load_date
-            if isinstance(load_date, str):
-                ds = load_date.strip()
-                if "/" in ds:
-                    load_date = datetime.strptime(ds, "%d/%m/%Y")
-                elif "-" in ds:
-                    load_date = datetime.strptime(ds, "%Y-%m-%d")
-                else:
-                    continue
-
-            days_passed = (now.date() - load_date.date()).days
-            if days_passed == 1:
-                create_notification(
-                    db,
-                    user_id=order.owner_id,
-                    notif_type="ORDER_OVERDUE_1",
-                    message="notif.order.overdue1|{}|Срок даты загрузки заявки истёк.",
-                    related_id=order.id
-                )
-            elif days_passed == 4:
-                create_notification(
-                    db,
-                    user_id=order.owner_id,
-                    notif_type="ORDER_OVERDUE_4",
-                    message="notif.order.overdue4|{}|Прошло 4 дня с даты загрузки. Заявка будет скрыта, если вы не обновите дату загрузки.",
-                    related_id=order.id
-                )
-            elif days_passed == 7:
-                create_notification(
-                    db,
-                    user_id=order.owner_id,
-                    notif_type="ORDER_OVERDUE_7",
-                    message="notif.order.overdue7|{}|Прошло 7 дней с даты загрузки. Обновите дату, иначе завтра заявка будет автоматически скрыта.",
-                    related_id=order.id
-                )
-            elif days_passed >= 8:
-                if order.is_active:  # --- только если ещё не отключена!
-                    order.is_active = False
-                    db.commit()
-                    create_notification(
-                        db,
-                        user_id=order.owner_id,
-                        notif_type="ORDER_AUTO_DISABLED",
-                        message="notif.order.autoDisabled|{}|Ваша заявка скрыта из-за истечения срока.",
-                        related_id=order.id
-                    )
-        except Exception as e:
-            print("[Order Overdue Check Error]", e)
-    db.close()
-
-
-def _parse_date_any(ds: str):
-    """Поддерживаем dd.mm.yyyy, dd/mm/yyyy, yyyy-mm-dd."""
-    ds = (ds or "").strip()
-    for fmt in ("%d.%m.%Y", "%d/%m/%Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(ds, fmt)
-        except Exception:
-            pass
-    return None
-
-
-def check_transport_deadlines():
-    """Ежедневная проверка просрочки по ТРАНСПОРТАМ от даты 'ready_date_to' (дата 'до')."""
+    try:
+        counts = listing_expiry.run(db)
+        if any(counts.values()):
+            print("[LISTING_EXPIRY]", counts)
+    except Exception as e:
+        print("[LISTING_EXPIRY] run failed:", e)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def reconcile_unread_counters():
     db = SessionLocal()
-    now = datetime.utcnow()
     try:
-        # Берём только активные транспорты
-        transports = db.query(Transport).filter(
-            Transport.is_active.is_(True)).all()
-        for tr in transports:
-            to_raw = getattr(tr, "ready_date_to", None)
-            if not to_raw:
-                continue
-            to_dt = _parse_date_any(to_raw) if isinstance(
-                to_raw, str) else to_raw
-            if not to_dt:
-                continue
+        fixed = unread_counters.reconcile(db)
+        if fixed:
+            print(f"[UNREAD] reconcile fixed {fixed} counters")
+    except Exception as e:
+        print("[UNREAD] reconcile failed:", e)
+        db.rollback()
+    finally:
+        db.close()
 
-            # Сколько дней прошло после "даты до"
-            days_passed = (now.date() - to_dt.date()).days
-            if days_passed < 1:
-                continue
 
-            # 1 / 4 / 7 дней — уведомления
-            if days_passed in (1, 4, 7):
-                try:
-                    create_notification(
-                        db=db,
-                        user_id=tr.owner_id,
-                        notif_type=NotificationType[f"TRANSPORT_OVERDUE_{days_passed}"],
-                        # ключи notif.transport.overdue1 / 4 / 7 в новом формате
-                        message={
-                            1: "notif.transport.overdue1|{}|По объявлению транспорта просрочка 1 день.",
-                            4: "notif.transport.overdue4|{}|По объявлению транспорта просрочка 4 дня.",
-                            7: "notif.transport.overdue7|{}|По объявлению транспорта просрочка 7 дней."
-                        }.get(days_passed, "notif.transport.overdue1|{}|По объявлению транспорта просрочка 1 день."),
-                        related_id=str(tr.id),
-                    )
-                except Exception as e:
-                    print("[Transport Overdue Notif Error]", e)
-
-            # >= 8 дней — авто-деактивация + уведомление
-            if days_passed >= 8 and getattr(tr, "is_active", False):
-                try:
-                    tr.is_active = False
-                    db.commit()
-                    create_notification(
-                        db=db,
-                        user_id=tr.owner_id,
-                        notif_type=NotificationType.TRANSPORT_AUTO_DISABLED,
-                        message="notif.transport.autoDisabled|{}|Ваше транспортное объявление скрыто из-за истечения срока.",
-                        related_id=str(tr.id),
-                    )
-                except Exception as e:
-                    print("[Transport Auto-Disable Error]", e)
+def maintain_tracking_partitions():
+    db = SessionLocal()
+    try:
+        res = tracking_partitions.maintain(db)
+        if res["created"] or res["dropped"]:
+            print("[TRACK_PARTITIONS]", res)
+    except Exception as e:
+        print("[TRACK_PARTITIONS] maintenance failed:", e)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def purge_geocode_cache():
+    db = SessionLocal()
+    try:
+        removed = geo_cache.purge_expired(db)
+        if removed:
+            print(f"[GEO_CACHE] purged {removed} expired rows")
+    except Exception as e:
+        print("[GEO_CACHE] purge failed:", e)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def backfill_match_keys():
+    db = SessionLocal()
+    try:
+        updated = match_index.backfill(db)
+        if updated:
+            print(f"[MATCH_KEYS] backfilled {updated} rows")
     except Exception as e:
-        print("[Transport Overdue Check Error]", e)
+        print("[MATCH_KEYS] backfill failed:", e)
+        db.rollback()
     finally:
         db.close()
 
 
-def start_scheduler():
-    scheduler = BackgroundScheduler()
-    # Заказы — раз в день
-    scheduler.add_job(check_order_deadlines, 'cron', hour=6, minute=0)
-    # Транспорты — раз в день (чуть позже, чтобы не одновременно)
-    scheduler.add_job(check_transport_deadlines, 'cron', hour=6, minute=2)
+def register_jobs(scheduler):
+    """Периодические задачи модуля; запускает их scheduler_worker (один экземпляр на кластер)."""
+    # Просрочка заявок и транспорта — раз в день и сразу при старте
+    # (повторный запуск в тот же день ничего не дублирует)
+    scheduler.add_job(check_listing_expiry, 'cron', hour=6, minute=0,
+                      next_run_time=datetime.now())
     # Саппорт — каждые 10 секунд
     scheduler.add_job(check_support_inactivity, 'interval', seconds=10)
-    scheduler.start()
+    # Сверка счётчиков непрочитанного с первоисточниками
+    scheduler.add_job(reconcile_unread_counters, 'interval',
+                      minutes=UNREAD_COUNTERS_RECONCILE_MIN)
+    # Секции tracking_points на месяцы вперёд + удаление по сроку хранения
+    scheduler.add_job(maintain_tracking_partitions, 'cron', hour=3, minute=30,
+                      next_run_time=datetime.now())
+    # Кэш геокодера: строки, которые уже не отдаются даже устаревшими
+    scheduler.add_job(purge_geocode_cache, 'cron', hour=4, minute=15)
+    # Ключи авто-подбора у строк, записанных до миграции или мимо ORM
+    scheduler.add_job(backfill_match_keys, 'interval', minutes=1,
+                      next_run_time=datetime.now())
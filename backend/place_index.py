@@ -0,0 +1,430 @@
+"""
+In-memory префиксный индекс названий из таблицы places (локальный геокодер).
+
+Раньше локальный поиск (geo_rest._local_fallback_items при
+GEOCODER_OFFLINE=1 или отказе всех провайдеров, /places/suggest) на каждое
+нажатие клавиши делал ILIKE по jsonb_each_text(translations) — полный скан
+places. Теперь воркер держит индекс в памяти:
+- ключи — нормализованные названия на всех языках (casefold, без диакритики,
+  пробелы схлопнуты) плюс латинская транслитерация грузинских названий
+  (geo_rest._ka_variants): «tbil» находит и «თბილისი»;
+- ключи лежат в отсортированных массивах (bisect по префиксу); для
+  префиксов длиной до PLACE_INDEX_TOP_PREFIX заранее посчитаны топ-K мест,
+  чтобы короткие запросы не перебирали тысячи совпадений;
+- ранжирование: тип места (geo_rest.TYPE_WEIGHT) и население, плюс бонус
+  за точное совпадение и за перевод на языке запроса.
+
+Индекс строится в фоне при старте (до готовности ready() = False и
+работает прежний SQL), /places/upsert обновляет его сразу, а изменения из
+других воркеров подтягиваются по places.updated_at раз в
+PLACE_INDEX_REFRESH_SEC.
+
+Индекс есть в каждом воркере, а places после массового импорта
+(places_import) — миллионы строк, поэтому в память берётся не всё:
+PLACE_INDEX_COUNTRIES (ISO2 через запятую, пусто — все страны),
+PLACE_INDEX_MIN_POPULATION и не больше PLACE_INDEX_MAX_PLACES самых
+населённых мест. Если индекс неполный и на запрос нашлось меньше limit
+мест (или страна запроса не загружена), search() возвращает None и
+вызывающий идёт в прежний SQL.
+"""
+from __future__ import annotations
+
+import bisect
+import heapq
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+
+PLACE_INDEX_ENABLED = (os.getenv("PLACE_INDEX", "1") or "1").strip().lower() in {
+    "1", "true", "yes", "on"}
+PLACE_INDEX_REFRESH_SEC = float(os.getenv("PLACE_INDEX_REFRESH_SEC", "60") or "60")
+# Для префиксов не длиннее этого держим готовый топ
+PLACE_INDEX_TOP_PREFIX = int(os.getenv("PLACE_INDEX_TOP_PREFIX", "3") or "3")
+PLACE_INDEX_TOP_K = int(os.getenv("PLACE_INDEX_TOP_K", "64") or "64")
+# Сколько ключей максимум просматриваем для длинного префикса
+PLACE_INDEX_SCAN_MAX = int(os.getenv("PLACE_INDEX_SCAN_MAX", "5000") or "5000")
+# Если с прошлой загрузки изменилось больше мест (массовый импорт) — перестраиваем
+# индекс целиком: поштучная вставка в отсортированные списки квадратична
+PLACE_INDEX_REBUILD_OVER = int(os.getenv("PLACE_INDEX_REBUILD_OVER", "5000") or "5000")
+PLACE_INDEX_COUNTRIES = frozenset(
+    c.strip().upper() for c in (os.getenv("PLACE_INDEX_COUNTRIES", "") or "").split(",")
+    if c.strip())
+PLACE_INDEX_MIN_POPULATION = int(os.getenv("PLACE_INDEX_MIN_POPULATION", "0") or "0")
+# 0 — без ограничения
+PLACE_INDEX_MAX_PLACES = int(os.getenv("PLACE_INDEX_MAX_PLACES", "300000") or "0")
+_MIN_PREFIX = 2
+
+_RE_SEP = re.compile(r"[\s\-.,'’`\"()]+")
+
+_SELECT = """
+    SELECT id, source, external_id, osm_type, lat, lon, country_iso2,
+           translations, population, place_type, updated_at
+      FROM places
+"""
+
+
+def _where() -> Tuple[str, dict]:
+    conds, params = [], {}
+    if PLACE_INDEX_COUNTRIES:
+        conds.append("upper(country_iso2) = ANY(:countries)")
+        params["countries"] = sorted(PLACE_INDEX_COUNTRIES)
+    if PLACE_INDEX_MIN_POPULATION > 0:
+        conds.append("population >= :min_population")
+        params["min_population"] = PLACE_INDEX_MIN_POPULATION
+    return " AND ".join(conds), params
+
+
+def _wanted(e: "_Entry") -> bool:
+    if PLACE_INDEX_COUNTRIES and e.country not in PLACE_INDEX_COUNTRIES:
+        return False
+    return (e.population or 0) >= PLACE_INDEX_MIN_POPULATION
+
+
+class _Entry:
+    __slots__ = ("id", "external_id", "osm_type", "lat", "lon", "country",
+                 "translations", "population", "place_type", "rank", "keys")
+
+
+def normalize(s: str) -> str:
+    """Ключ поиска: casefold, без диакритики, разделители → один пробел."""
+    s = unicodedata.normalize("NFKD", (s or "").casefold())
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return _RE_SEP.sub(" ", s).strip()
+
+
+def _variants(s: str) -> List[str]:
+    from geo_rest import _ka_variants
+    return _ka_variants(s)
+
+
+def _keys_for(translations: Dict[str, str]) -> Tuple[str, ...]:
+    keys = set()
+    for v in (translations or {}).values():
+        if not isinstance(v, str):
+            continue
+        for k in [normalize(v)] + [normalize(x) for x in _variants(v)]:
+            if len(k) >= _MIN_PREFIX:
+                keys.add(k)
+    return tuple(sorted(keys))
+
+
+def _rank(place_type: Optional[str], population: Optional[int]) -> float:
+    from geo_rest import TYPE_WEIGHT
+    w = TYPE_WEIGHT.get((place_type or "city").lower(), 0)
+    return w + 10.0 * math.log10((population or 0) + 1)
+
+
+def _entry(row) -> _Entry:
+    e = _Entry()
+    e.id = int(row.id)
+    e.external_id = row.external_id
+    e.osm_type = row.osm_type
+    e.lat = float(row.lat)
+    e.lon = float(row.lon)
+    e.country = (row.country_iso2 or "").upper()
+    e.translations = row.translations or {}
+    e.population = row.population
+    e.place_type = row.place_type
+    e.rank = _rank(row.place_type, row.population)
+    e.keys = _keys_for(e.translations)
+    return e
+
+
+def _prefixes(keys: Iterable[str]) -> set:
+    return {k[:n] for k in keys
+            for n in range(_MIN_PREFIX, PLACE_INDEX_TOP_PREFIX + 1) if len(k) >= n}
+
+
+class _Index:
+    def __init__(self):
+        self.places: Dict[int, _Entry] = {}
+        self.keys: List[str] = []
+        self.ids: List[int] = []
+        # префикс -> [(rank, id)] по убыванию rank, не больше TOP_K
+        self.top: Dict[str, List[Tuple[float, int]]] = {}
+
+    @classmethod
+    def build(cls, entries: Iterable[_Entry]) -> "_Index":
+        idx = cls()
+        pairs = []
+        heaps: Dict[str, list] = {}
+        for e in entries:
+            idx.places[e.id] = e
+            pairs.extend((k, e.id) for k in e.keys)
+            for p in _prefixes(e.keys):
+                h = heaps.setdefault(p, [])
+                if len(h) < PLACE_INDEX_TOP_K:
+                    heapq.heappush(h, (e.rank, e.id))
+                elif (e.rank, e.id) > h[0]:
+                    heapq.heapreplace(h, (e.rank, e.id))
+        pairs.sort()
+        idx.keys = [k for k, _ in pairs]
+        idx.ids = [i for _, i in pairs]
+        idx.top = {p: sorted(h, reverse=True) for p, h in heaps.items()}
+        return idx
+
+    def scan(self, prefix: str, cap: int = PLACE_INDEX_SCAN_MAX) -> List[int]:
+        out = []
+        i = bisect.bisect_left(self.keys, prefix)
+        n = len(self.keys)
+        while i < n and len(out) < cap and self.keys[i].startswith(prefix):
+            out.append(self.ids[i])
+            i += 1
+        return out
+
+    def _rebuild_top(self, prefix: str) -> None:
+        best = heapq.nlargest(
+            PLACE_INDEX_TOP_K,
+            {(self.places[i].rank, i) for i in self.scan(prefix, cap=len(self.keys))})
+        if best:
+            self.top[prefix] = best
+        else:
+            self.top.pop(prefix, None)
+
+    def remove(self, pid: int) -> None:
+        e = self.places.pop(pid, None)
+        if e is None:
+            return
+        for k in e.keys:
+            lo = bisect.bisect_left(self.keys, k)
+            hi = bisect.bisect_right(self.keys, k, lo)
+            for i in range(lo, hi):
+                if self.ids[i] == pid:
+                    del self.keys[i]
+                    del self.ids[i]
+                    break
+        for p in _prefixes(e.keys):
+            bucket = self.top.get(p)
+            if not bucket or (e.rank, pid) not in bucket:
+                continue
+            if len(bucket) >= PLACE_INDEX_TOP_K:
+                # Из полного топа выбыл элемент — на его место мог претендовать кто-то вне топа
+                self._rebuild_top(p)
+            else:
+                bucket.remove((e.rank, pid))
+                if not bucket:
+                    del self.top[p]
+
+    def add(self, e: _Entry) -> None:
+        self.remove(e.id)
+        self.places[e.id] = e
+        for k in e.keys:
+            lo = bisect.bisect_left(self.keys, k)
+            hi = bisect.bisect_right(self.keys, k, lo)
+            i = lo + bisect.bisect_left(self.ids[lo:hi], e.id)
+            self.keys.insert(i, k)
+            self.ids.insert(i, e.id)
+        item = (e.rank, e.id)
+        for p in _prefixes(e.keys):
+            bucket = self.top.setdefault(p, [])
+            if len(bucket) < PLACE_INDEX_TOP_K or item > bucket[-1]:
+                bisect.insort(bucket, item, key=lambda x: (-x[0], -x[1]))
+                del bucket[PLACE_INDEX_TOP_K:]
+
+
+_index: Optional[_Index] = None
+_lock = threading.RLock()
+_started = False
+_start_lock = threading.Lock()
+_since: Optional[datetime] = None
+# False — в памяти не все места (фильтры/лимит): при нехватке результатов нужен SQL
+_complete = True
+_stats = {"loaded_at": None, "build_ms": None, "refreshes": 0, "updates": 0,
+          "searches": 0, "search_us_total": 0.0, "sql_fallbacks": 0}
+
+
+def ready() -> bool:
+    return _index is not None
+
+
+def load(db) -> int:
+    """Полная перестройка индекса из places. Возвращает число мест."""
+    global _index, _since, _complete
+    t0 = time.perf_counter()
+    where, params = _where()
+    sql = _SELECT + (f" WHERE {where}" if where else "")
+    if PLACE_INDEX_MAX_PLACES > 0:
+        # Лишняя строка — признак, что в лимит влезли не все
+        sql += " ORDER BY population DESC NULLS LAST, id LIMIT :max_places"
+        params["max_places"] = PLACE_INDEX_MAX_PLACES + 1
+    since = None
+    entries = []
+    truncated = False
+    rows = db.execute(text(sql), params, execution_options={"stream_results": True})
+    for row in rows.yield_per(5000):
+        if len(entries) >= PLACE_INDEX_MAX_PLACES > 0:
+            truncated = True
+            break
+        entries.append(_entry(row))
+        if row.updated_at and (since is None or row.updated_at > since):
+            since = row.updated_at
+    rows.close()
+    if truncated:
+        # Метка по последней изменённой строке таблицы, а не только по загруженным
+        since = db.execute(text("SELECT max(updated_at) FROM places")).scalar() or since
+    idx = _Index.build(entries)
+    with _lock:
+        _index = idx
+        _since = since
+        _complete = not (truncated or where)
+    _stats["loaded_at"] = datetime.utcnow().isoformat()
+    _stats["build_ms"] = round((time.perf_counter() - t0) * 1000)
+    print(f"[PLACE_INDEX] {len(idx.places)} places, {len(idx.keys)} keys, "
+          f"{_stats['build_ms']} ms")
+    return len(idx.places)
+
+
+def refresh(db) -> int:
+    """Подтягивает места, изменённые после прошлой загрузки (другими воркерами)."""
+    global _since
+    if _index is None:
+        return 0
+    params = {"since": _since or datetime(1970, 1, 1)}
+    changed = db.execute(
+        text("SELECT count(*) FROM places WHERE updated_at >= :since"), params).scalar() or 0
+    if changed > PLACE_INDEX_REBUILD_OVER:
+        _stats["refreshes"] += 1
+        return load(db)
+    rows = db.execute(
+        # >=: строки с той же меткой, записанные после прошлого чтения; повтор безвреден
+        text(_SELECT + " WHERE updated_at >= :since ORDER BY updated_at"), params,
+    ).fetchall()
+    for row in rows:
+        e = _entry(row)
+        with _lock:
+            if _wanted(e):
+                _index.add(e)
+            else:
+                _index.remove(e.id)
+            _since = max(_since or row.updated_at, row.updated_at)
+    _stats["refreshes"] += 1
+    return len(rows)
+
+
+def upsert(row) -> None:
+    """Место только что записано в этом воркере (/places/upsert) — сразу в индекс."""
+    if _index is None:
+        return
+    e = _entry(row)
+    with _lock:
+        if _wanted(e):
+            _index.add(e)
+        else:
+            _index.remove(e.id)
+    _stats["updates"] += 1
+
+
+def _item(e: _Entry, lang: str) -> dict:
+    tr = e.translations
+    name = tr.get(lang) or tr.get("en") or tr.get("ru") or next(iter(tr.values()), "")
+    return {
+        "source": "local",
+        "osm_id": e.external_id,
+        "osm_type": e.osm_type,
+        "class": "place",
+        "type": e.place_type or "city",
+        "population": e.population,
+        "lat": e.lat,
+        "lon": e.lon,
+        "country_iso2": e.country,
+        "name": name,
+        "translations": tr,
+        "container_city": None,
+        "address": {},
+    }
+
+
+def search(q: str, lang: str, limit: int, country: Optional[str] = None) -> Optional[List[dict]]:
+    """
+    Автокомплит по префиксу; None — индекс ещё не готов или не покрывает
+    запрос (см. модуль), нужен SQL.
+    """
+    idx = _index
+    if idx is None:
+        return None
+    country = (country or "").upper() or None
+    if country and PLACE_INDEX_COUNTRIES and country not in PLACE_INDEX_COUNTRIES:
+        return None
+    t0 = time.perf_counter()
+    qn = normalize(q)
+    prefixes = [p for p in dict.fromkeys([qn] + [normalize(v) for v in _variants(q)])
+                if len(p) >= _MIN_PREFIX]
+    cand = set()
+    with _lock:
+        for p in prefixes:
+            if len(p) <= PLACE_INDEX_TOP_PREFIX:
+                ids = [i for _, i in idx.top.get(p, ())]
+                if country and sum(idx.places[i].country == country for i in ids) < limit:
+                    ids = idx.scan(p)
+            else:
+                ids = idx.scan(p)
+            cand.update(ids)
+        entries = [idx.places[i] for i in cand if i in idx.places]
+    if country:
+        entries = [e for e in entries if e.country == country]
+
+    def score(e: _Entry) -> float:
+        s = e.rank
+        if any(p in e.keys for p in prefixes):
+            s += 40.0
+        if e.translations.get(lang):
+            s += 15.0
+        return s
+
+    best = heapq.nlargest(limit, entries, key=score)
+    _stats["searches"] += 1
+    _stats["search_us_total"] += (time.perf_counter() - t0) * 1e6
+    if len(best) < limit and not _complete:
+        # Недостающее может лежать в places вне индекса
+        _stats["sql_fallbacks"] += 1
+        return None
+    return [_item(e, lang) for e in best]
+
+
+def _loop() -> None:
+    from database import SessionLocal
+
+    while True:
+        db = SessionLocal()
+        try:
+            if _index is None:
+                load(db)
+            else:
+                refresh(db)
+        except Exception as e:
+            db.rollback()
+            print("[PLACE_INDEX] refresh failed:", e)
+        finally:
+            db.close()
+        time.sleep(PLACE_INDEX_REFRESH_SEC)
+
+
+def start() -> None:
+    """Фоновая загрузка и периодическое обновление (один поток на процесс)."""
+    global _started
+    if not PLACE_INDEX_ENABLED:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_loop, name="place-index", daemon=True).start()
+
+
+def stats() -> dict:
+    idx = _index
+    out = {"enabled": PLACE_INDEX_ENABLED, "ready": idx is not None, "complete": _complete,
+           "countries": sorted(PLACE_INDEX_COUNTRIES), "min_population": PLACE_INDEX_MIN_POPULATION,
+           "max_places": PLACE_INDEX_MAX_PLACES, **_stats}
+    out["places"] = len(idx.places) if idx else 0
+    out["keys"] = len(idx.keys) if idx else 0
+    out["avg_search_us"] = (round(_stats["search_us_total"] / _stats["searches"], 1)
+                            if _stats["searches"] else None)
+    return out
@@ -0,0 +1,341 @@
+"""
+Массовый импорт газеттира в places (GeoNames, OSM-выгрузки).
+
+/places/upsert добавляет по одному месту за HTTP-запрос и сливает переводы в
+Python — для миллионов мест региона это часы. Здесь:
+- читатели потоково разбирают дамп и отдают записи в формате places
+  (переводы — JSONB {ru, en, ka, tr, az}, население, тип места);
+- записи идут одним COPY во временную таблицу places_stage (без WAL, без
+  индексов), затем один INSERT ... SELECT ... ON CONFLICT (source,
+  external_id) DO UPDATE сливает их в places: переводы объединяются
+  (значения из дампа важнее), неизменённые строки не переписываются;
+- изменённые строки получают новый updated_at — in-memory индекс
+  автокомплита (place_index) подтянет их сам.
+
+Форматы:
+  geonames — cities500.txt / GE.txt / allCountries.txt (.txt, .zip, .gz) и
+             опционально alternateNamesV2.txt для переводов;
+  osm      — .osm.pbf (нужен pyosmium ≥ 3.7: pip install osmium); берутся
+             узлы place=city|town|village|hamlet|suburb|locality.
+
+CLI:
+    python places_import.py geonames GE.zip --alternate-names GE_alt.zip --countries GE
+    python places_import.py osm georgia-latest.osm.pbf --country GE
+Эндпоинт: POST /admin/places/import (admin_rest) — для небольших файлов.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+import zipfile
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional, Set
+
+# Языки переводов, как geo_rest.SUPPORTED_LANGS
+LANGS = ("ru", "en", "ka", "tr", "az")
+
+# Коды объектов GeoNames (класс P) -> place_type (ключи geo_rest.TYPE_WEIGHT)
+_GEONAMES_TYPES = {
+    "PPLC": "city", "PPLA": "city", "PPLA2": "city", "PPLG": "city",
+    "PPLA3": "town", "PPLA4": "town", "PPLA5": "town",
+    "PPL": None,  # по населению, см. _geonames_type
+    "PPLX": "suburb", "PPLL": "locality", "PPLF": "hamlet", "PPLS": "village",
+    "PPLR": "village",
+}
+# Исторические/исчезнувшие/разрушенные пункты не импортируем
+_GEONAMES_SKIP = {"PPLH", "PPLQ", "PPLW", "PPLCH"}
+
+_OSM_PLACES = {"city", "town", "village", "hamlet", "suburb", "locality"}
+
+_STAGE_COLUMNS = ("source", "external_id", "osm_type", "lat", "lon",
+                  "country_iso2", "translations", "population", "place_type")
+
+# Сколько байт CSV copy_expert забирает из _CopySource за один read()
+COPY_CHUNK_BYTES = 1 << 20
+
+
+# ----------------------------- чтение файлов -----------------------------
+
+def _open_text(path: str):
+    """Текстовый поток из .txt, .gz или .zip (берётся одноимённый или первый .txt)."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    if path.endswith(".zip"):
+        zf = zipfile.ZipFile(path)
+        names = [n for n in zf.namelist() if n.endswith(".txt") and not n.startswith("readme")]
+        base = os.path.splitext(os.path.basename(path))[0] + ".txt"
+        member = base if base in names else names[0]
+        return io.TextIOWrapper(zf.open(member), encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def _tsv(path: str) -> Iterator[list]:
+    with _open_text(path) as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            yield line.rstrip("\n").split("\t")
+
+
+def _geonames_type(code: str, population: int) -> Optional[str]:
+    t = _GEONAMES_TYPES.get(code)
+    if t is None and code == "PPL":
+        return "town" if population >= 10000 else "village"
+    return t
+
+
+def _geonames_alternate_names(path: str, ids: Set[int]) -> Dict[int, Dict[str, str]]:
+    """
+    {geonameid: {lang: name}} из alternateNamesV2.txt. Предпочтительные
+    названия (isPreferredName) важнее, исторические и разговорные пропускаются.
+    """
+    out: Dict[int, Dict[str, str]] = {}
+    preferred: Set[tuple] = set()
+    for row in _tsv(path):
+        if len(row) < 4 or row[2] not in LANGS:
+            continue
+        try:
+            gid = int(row[1])
+        except ValueError:
+            continue
+        if gid not in ids:
+            continue
+        is_pref = len(row) > 4 and row[4] == "1"
+        colloquial = len(row) > 6 and row[6] == "1"
+        historic = len(row) > 7 and row[7] == "1"
+        if colloquial or historic:
+            continue
+        names = out.setdefault(gid, {})
+        key = (gid, row[2])
+        if row[2] not in names or (is_pref and key not in preferred):
+            names[row[2]] = row[3]
+            if is_pref:
+                preferred.add(key)
+    return out
+
+
+def read_geonames(path: str, alternate_names: Optional[str] = None,
+                  countries: Optional[Iterable[str]] = None,
+                  min_population: int = 0) -> Iterator[dict]:
+    """Населённые пункты (класс P) из дампа GeoNames."""
+    countries = {c.upper() for c in countries} if countries else None
+
+    def _rows():
+        for row in _tsv(path):
+            if len(row) < 15 or row[6] != "P" or row[7] in _GEONAMES_SKIP:
+                continue
+            if countries and row[8].upper() not in countries:
+                continue
+            try:
+                population = int(row[14] or 0)
+            except ValueError:
+                population = 0
+            if population < min_population:
+                continue
+            yield row, population
+
+    translations: Dict[int, Dict[str, str]] = {}
+    if alternate_names:
+        # Первый проход — только id, чтобы не держать в памяти чужие страны
+        ids = {int(row[0]) for row, _ in _rows()}
+        translations = _geonames_alternate_names(alternate_names, ids)
+
+    for row, population in _rows():
+        gid = int(row[0])
+        tr = dict(translations.get(gid) or {})
+        tr.setdefault("en", row[1])
+        yield {
+            "source": "geonames",
+            "external_id": gid,
+            "osm_type": None,
+            "lat": float(row[4]),
+            "lon": float(row[5]),
+            "country_iso2": row[8].upper(),
+            "translations": tr,
+            "population": population or None,
+            "place_type": _geonames_type(row[7], population),
+        }
+
+
+def read_osm(path: str, country: Optional[str] = None) -> Iterator[dict]:
+    """Узлы place=* из .osm.pbf (pyosmium)."""
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError("OSM import needs pyosmium: pip install osmium")
+
+    fp = osmium.FileProcessor(path, osmium.osm.NODE).with_filter(osmium.filter.KeyFilter("place"))
+    for node in fp:
+        tags = node.tags
+        place = tags.get("place")
+        name = tags.get("name")
+        if place not in _OSM_PLACES or not name or not node.location.valid():
+            continue
+        iso2 = (tags.get("is_in:country_code") or tags.get("addr:country") or country or "").upper()
+        if len(iso2) != 2:
+            continue
+        tr = {lng: tags.get(f"name:{lng}") for lng in LANGS if tags.get(f"name:{lng}")}
+        tr.setdefault("en", name)
+        try:
+            population = int(str(tags.get("population", "")).replace(" ", "").replace(",", "")) or None
+        except ValueError:
+            population = None
+        yield {
+            "source": "osm",
+            "external_id": node.id,
+            "osm_type": "N",
+            "lat": node.location.lat,
+            "lon": node.location.lon,
+            "country_iso2": iso2,
+            "translations": tr,
+            "population": population,
+            "place_type": place,
+        }
+
+
+# ----------------------------- загрузка -----------------------------
+
+class _CopySource(io.RawIOBase):
+    """Файлоподобный поток CSV для COPY FROM STDIN поверх генератора записей."""
+
+    def __init__(self, records: Iterable[dict]):
+        self._records = iter(records)
+        self._buf = b""
+        self.count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _line(self, r: dict) -> bytes:
+        out = io.StringIO()
+        csv.writer(out).writerow([
+            r["source"], r["external_id"], r.get("osm_type") or "", r["lat"], r["lon"],
+            r["country_iso2"], json.dumps(r["translations"], ensure_ascii=False),
+            "" if r.get("population") is None else r["population"], r.get("place_type") or "",
+        ])
+        return out.getvalue().encode("utf-8")
+
+    def readinto(self, b) -> int:
+        # RawIOBase.read/readall и BufferedReader читают через readinto
+        size = len(b)
+        while len(self._buf) < size:
+            try:
+                r = next(self._records)
+            except StopIteration:
+                break
+            self._buf += self._line(r)
+            self.count += 1
+        n = min(size, len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+_MERGE_SQL = """
+    WITH merged AS (
+        INSERT INTO places AS p (source, external_id, osm_type, lat, lon, country_iso2,
+                                 translations, population, place_type, updated_at)
+        SELECT DISTINCT ON (source, external_id)
+               source, external_id, osm_type, lat, lon, country_iso2,
+               translations, population, place_type, %(now)s
+          FROM places_stage
+         ORDER BY source, external_id
+        ON CONFLICT (source, external_id) DO UPDATE
+           SET osm_type = COALESCE(EXCLUDED.osm_type, p.osm_type),
+               lat = EXCLUDED.lat,
+               lon = EXCLUDED.lon,
+               country_iso2 = EXCLUDED.country_iso2,
+               translations = p.translations || EXCLUDED.translations,
+               population = COALESCE(EXCLUDED.population, p.population),
+               place_type = COALESCE(EXCLUDED.place_type, p.place_type),
+               updated_at = EXCLUDED.updated_at
+         WHERE NOT (p.translations @> EXCLUDED.translations)
+            OR (p.lat, p.lon, p.country_iso2) IS DISTINCT FROM
+               (EXCLUDED.lat, EXCLUDED.lon, EXCLUDED.country_iso2)
+            OR (EXCLUDED.population IS NOT NULL AND p.population IS DISTINCT FROM EXCLUDED.population)
+            OR (EXCLUDED.place_type IS NOT NULL AND p.place_type IS DISTINCT FROM EXCLUDED.place_type)
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+      FROM merged
+"""
+
+
+def import_records(records: Iterable[dict], engine=None) -> Dict[str, int]:
+    """COPY в places_stage и одно слияние в places (одна транзакция)."""
+    if engine is None:
+        from database import engine
+    t0 = time.perf_counter()
+    source = _CopySource(records)
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE places_stage (
+                source       text,
+                external_id  bigint,
+                osm_type     text,
+                lat          double precision,
+                lon          double precision,
+                country_iso2 varchar(2),
+                translations jsonb,
+                population   bigint,
+                place_type   varchar(32)
+            ) ON COMMIT DROP
+        """)
+        cur.copy_expert(
+            f"COPY places_stage ({', '.join(_STAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+            source,
+            size=COPY_CHUNK_BYTES,
+        )
+        copied_ms = round((time.perf_counter() - t0) * 1000)
+        cur.execute("ANALYZE places_stage")
+        cur.execute(_MERGE_SQL, {"now": datetime.utcnow()})
+        inserted, updated = cur.fetchone()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+    return {
+        "read": source.count,
+        "inserted": int(inserted or 0),
+        "updated": int(updated or 0),
+        "unchanged": source.count - int(inserted or 0) - int(updated or 0),
+        "copy_ms": copied_ms,
+        "total_ms": round((time.perf_counter() - t0) * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import of places (GeoNames / OSM)")
+    parser.add_argument("format", choices=["geonames", "osm"])
+    parser.add_argument("path")
+    parser.add_argument("--alternate-names", help="GeoNames alternateNamesV2.txt (.zip/.gz)")
+    parser.add_argument("--countries", help="GeoNames: ISO2 через запятую, например GE,AM,AZ,TR")
+    parser.add_argument("--min-population", type=int, default=0)
+    parser.add_argument("--country", help="OSM: ISO2 для узлов без is_in:country_code")
+    args = parser.parse_args()
+
+    if args.format == "geonames":
+        countries = [c.strip() for c in (args.countries or "").split(",") if c.strip()]
+        records = read_geonames(args.path, args.alternate_names, countries, args.min_population)
+    else:
+        records = read_osm(args.path, args.country)
+    try:
+        res = import_records(records)
+    except RuntimeError as e:
+        print(f"[PLACES_IMPORT] {e}")
+        sys.exit(1)
+    print("[PLACES_IMPORT]", res)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ from models import Place
 from sqlalchemy import text
 import logging
 import os
+import place_index
 
 log = logging.getLogger("places_upsert")
 DEBUG_UPSERT = os.getenv("PLACES_UPSERT_DEBUG", "0").lower() in ("1", "true", "yes")
@@ -13,6 +14,19 @@ DEBUG_UPSERT = os.getenv("PLACES_UPSERT_DEBUG", "0").lower() in ("1", "true", "y
 router = APIRouter(prefix="/places", tags=["places"])
 
 
+def _optional_rank_fields(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # population / type — необязательные поля для ранжирования в place_index
+    out: Dict[str, Any] = {}
+    if payload.get("population") is not None:
+        try:
+            out["population"] = int(payload["population"])
+        except Exception:
+            pass
+    if payload.get("type"):
+        out["place_type"] = str(payload["type"])[:32]
+    return out
+
+
 def _merge_translations(old: Dict[str, str], new: Dict[str, str]) -> Dict[str, str]:
     out = dict(old or {})
     for k, v in (new or {}).items():
@@ -37,6 +51,7 @@ def upsert_place(payload: Dict[str, Any] = Body(...), db: Session = Depends(get_
         raise HTTPException(status_code=400, detail="error.externalId.notInt")
 
     translations = payload.get("translations") or {}
+    rank_fields = _optional_rank_fields(payload)
 
     existing = (
         db.query(Place)
@@ -54,8 +69,11 @@ def upsert_place(payload: Dict[str, Any] = Body(...), db: Session = Depends(get_
         existing.country_iso2 = (payload.get("country_iso2") or "").upper()
         existing.osm_type = payload.get("osm_type")
         existing.translations = merged
+        for k, v in rank_fields.items():
+            setattr(existing, k, v)
         db.flush()
         place_id = existing.id
+        place = existing
         if DEBUG_UPSERT:
             log.info(
                 "[places_upsert] update id=%s langs_before=%d langs_after=%d",
@@ -70,10 +88,12 @@ def upsert_place(payload: Dict[str, Any] = Body(...), db: Session = Depends(get_
             lon=float(payload["lon"]),
             country_iso2=(payload.get("country_iso2") or "").upper(),
             translations=translations,
+            **rank_fields,
         )
         db.add(new_place)
         db.flush()
         place_id = new_place.id
+        place = new_place
         if DEBUG_UPSERT:
             log.info(
                 "[places_upsert] insert id=%s langs_after=%d",
@@ -81,6 +101,8 @@ def upsert_place(payload: Dict[str, Any] = Body(...), db: Session = Depends(get_
             )
 
     db.commit()
+    # Индекс автокомплита этого воркера — сразу; остальные подтянут по updated_at
+    place_index.upsert(place)
     return {"id": place_id}
 
 
@@ -93,6 +115,15 @@ def suggest_places(q: str, lang: str = "ru", limit: int = 8, debug: int = 0, db:
     q = (q or "").strip()
     if len(q) < 2:
         return {"items": []}
+
+    indexed = place_index.search(q, lang, limit)
+    if indexed is not None:
+        payload = {"items": indexed}
+        if debug:
+            payload["diag"] = {"q": q, "lang": lang, "index": True,
+                               "returned": len(indexed)}
+        return payload
+
     like = f"{q}%"
 
     rows = (
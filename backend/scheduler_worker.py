@@ -0,0 +1,266 @@
+# scheduler_worker.py
+"""
+Единственный экземпляр периодических задач (APScheduler).
+
+Раньше main.py при импорте запускал два потока просрочки и два
+BackgroundScheduler (order_reminders, billing_tasks) — при N воркерах uvicorn
+каждая задача шла N раз параллельно, включая check_support_inactivity раз в
+10 секунд. Теперь все задачи регистрируются здесь и выполняются только
+лидером: процессом, который держит advisory lock Postgres
+(SCHEDULER_LOCK_KEY) на отдельном соединении. Остальные ждут и
+перехватывают лидерство, если соединение лидера пропало.
+
+Запуск (отдельный systemd-сервис, см. server-config/systemd/transinfo-scheduler.service):
+    python scheduler_worker.py
+В API-процессе режим задаёт SCHEDULER_MODE:
+    leader — воркер тоже участвует в выборах (по умолчанию: dev с одним uvicorn);
+    off    — API задачами не занимается (прод: работает отдельный сервис).
+
+По каждой задаче в scheduler_job_stats пишутся число запусков, длительность
+(последняя/максимальная/суммарная), сбои и наложения — запуски, пропущенные
+потому, что предыдущий ещё не закончился (max_instances=1).
+
+События WS (закрытие тикетов, уведомления) из отдельного процесса доходят до
+клиентов только через WS_BROKER=redis.
+"""
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from database import SessionLocal, engine
+
+SCHEDULER_MODE = (os.getenv("SCHEDULER_MODE", "leader") or "leader").strip().lower()
+# Ключ pg_advisory_lock (любое bigint, одинаковое у всех процессов кластера)
+SCHEDULER_LOCK_KEY = int(os.getenv("SCHEDULER_LOCK_KEY", "7262010") or "7262010")
+# Как часто не-лидер пытается взять лидерство и лидер проверяет своё соединение
+SCHEDULER_LEADER_CHECK_SEC = float(os.getenv("SCHEDULER_LEADER_CHECK_SEC", "15") or "15")
+
+INSTANCE = f"{socket.gethostname()}:{os.getpid()}"
+
+_state = {"leader": False, "since": None}
+
+
+def _record(job_id: str, started: datetime, duration_ms: int, error) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            text("""
+                INSERT INTO scheduler_job_stats AS s
+                       (job_id, runs, failures, last_started_at, last_finished_at,
+                        last_duration_ms, max_duration_ms, total_duration_ms, last_error, instance)
+                VALUES (:job_id, 1, :failed, :started, :finished,
+                        :ms, :ms, :ms, :error, :instance)
+                ON CONFLICT (job_id) DO UPDATE
+                   SET runs = s.runs + 1,
+                       failures = s.failures + EXCLUDED.failures,
+                       last_started_at = EXCLUDED.last_started_at,
+                       last_finished_at = EXCLUDED.last_finished_at,
+                       last_duration_ms = EXCLUDED.last_duration_ms,
+                       max_duration_ms = GREATEST(COALESCE(s.max_duration_ms, 0), EXCLUDED.max_duration_ms),
+                       total_duration_ms = s.total_duration_ms + EXCLUDED.total_duration_ms,
+                       last_error = COALESCE(EXCLUDED.last_error, s.last_error),
+                       instance = EXCLUDED.instance
+            """),
+            {"job_id": job_id, "failed": 1 if error else 0, "started": started,
+             "finished": datetime.utcnow(), "ms": duration_ms,
+             "error": error, "instance": INSTANCE},
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("[SCHEDULER] stats write failed:", e)
+    finally:
+        db.close()
+
+
+def _record_overlap(job_id: str) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            text("""
+                INSERT INTO scheduler_job_stats AS s (job_id, overlaps, instance)
+                VALUES (:job_id, 1, :instance)
+                ON CONFLICT (job_id) DO UPDATE SET overlaps = s.overlaps + 1
+            """),
+            {"job_id": job_id, "instance": INSTANCE},
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("[SCHEDULER] stats write failed:", e)
+    finally:
+        db.close()
+
+
+def _instrumented(job_id: str, func):
+    def run():
+        started = datetime.utcnow()
+        t0 = time.monotonic()
+        error = None
+        try:
+            func()
+        except Exception as e:
+            # Задачи сами ловят свои ошибки; это — на случай, если какая-то не поймала
+            error = f"{type(e).__name__}: {e}"
+            print(f"[SCHEDULER] job {job_id} failed: {error}")
+        _record(job_id, started, int((time.monotonic() - t0) * 1000), error)
+    run.__name__ = job_id
+    return run
+
+
+class _InstrumentedScheduler:
+    """Обёртка над add_job: id задачи = имя функции, max_instances=1, coalesce."""
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+
+    def add_job(self, func, trigger=None, **kwargs):
+        job_id = kwargs.pop("id", None) or func.__name__
+        kwargs.setdefault("max_instances", 1)
+        kwargs.setdefault("coalesce", True)
+        return self._scheduler.add_job(
+            _instrumented(job_id, func), trigger, id=job_id, **kwargs)
+
+
+def build_scheduler():
+    from apscheduler.events import EVENT_JOB_MAX_INSTANCES
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    import billing_tasks
+    import order_reminders
+
+    scheduler = BackgroundScheduler()
+    target = _InstrumentedScheduler(scheduler)
+    order_reminders.register_jobs(target)
+    billing_tasks.register_billing_jobs(target)
+    scheduler.add_listener(lambda ev: _record_overlap(ev.job_id), EVENT_JOB_MAX_INSTANCES)
+    return scheduler
+
+
+def _install_session_hooks() -> None:
+    # Те же хуки сессий, что ставит main.py: задачи пишут сообщения/уведомления
+    import chat_inbox
+    import email_outbox
+    import http_cache
+    import unread_counters
+
+    http_cache.install_invalidation_hooks()
+    chat_inbox.install_hooks()
+    unread_counters.install_hooks()
+    email_outbox.install_hooks()
+
+
+def run_leader(stop: threading.Event) -> None:
+    """Цикл выборов: держит advisory lock и, пока держит, выполняет задачи."""
+    while not stop.is_set():
+        conn = None
+        scheduler = None
+        try:
+            conn = engine.connect()
+            got = conn.execute(text("SELECT pg_try_advisory_lock(:key)"),
+                               {"key": SCHEDULER_LOCK_KEY}).scalar()
+            conn.commit()
+            if not got:
+                conn.close()
+                conn = None
+                stop.wait(SCHEDULER_LEADER_CHECK_SEC)
+                continue
+
+            scheduler = build_scheduler()
+            scheduler.start()
+            _state.update(leader=True, since=datetime.utcnow().isoformat())
+            print(f"[SCHEDULER] {INSTANCE} is the leader, jobs: "
+                  f"{', '.join(j.id for j in scheduler.get_jobs())}")
+            # Блокировка живёт, пока живо соединение — его и проверяем
+            while not stop.wait(SCHEDULER_LEADER_CHECK_SEC):
+                conn.execute(text("SELECT 1"))
+                conn.commit()
+        except Exception as e:
+            print(f"[SCHEDULER] {INSTANCE} leadership lost or unavailable: {e}")
+            stop.wait(SCHEDULER_LEADER_CHECK_SEC)
+        finally:
+            if scheduler is not None:
+                try:
+                    scheduler.shutdown(wait=stop.is_set())
+                except Exception:
+                    pass
+                _state.update(leader=False, since=None)
+            if conn is not None:
+                try:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"),
+                                 {"key": SCHEDULER_LOCK_KEY})
+                    conn.commit()
+                except Exception:
+                    pass
+                conn.close()
+
+
+def start_in_api() -> None:
+    """Вызывается из main.py: в режиме leader воркер API участвует в выборах."""
+    if SCHEDULER_MODE != "leader":
+        print(f"[SCHEDULER] mode={SCHEDULER_MODE}: periodic jobs are not run by this process")
+        return
+    threading.Thread(target=run_leader, args=(threading.Event(),),
+                     name="scheduler-leader", daemon=True).start()
+
+
+def stats(db) -> dict:
+    rows = db.execute(text("""
+        SELECT job_id, runs, failures, overlaps, last_started_at, last_duration_ms,
+               max_duration_ms, total_duration_ms, last_error, instance
+          FROM scheduler_job_stats
+         ORDER BY job_id
+    """)).mappings().all()
+    jobs = []
+    for r in rows:
+        item = dict(r)
+        item["avg_duration_ms"] = (
+            round(r["total_duration_ms"] / r["runs"], 1) if r["runs"] else None)
+        jobs.append(item)
+    return {"mode": SCHEDULER_MODE, "instance": INSTANCE, **_state, "jobs": jobs}
+
+
+def _load_env() -> None:
+    # Ключи TBC/SMTP лежат в .env, как у main.py (тот же порядок поиска, без перезаписи)
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    base = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(base)
+    for path in (os.path.join(base, ".env.local"), os.path.join(base, ".env"),
+                 os.path.join(root, ".env.local"), os.path.join(root, ".env")):
+        if os.path.exists(path) and load_dotenv(path, override=False):
+            break
+
+
+def main():
+    _load_env()
+    import email_outbox
+
+    _install_session_hooks()
+    stop = threading.Event()
+
+    def _stop(signum, frame):
+        print(f"[SCHEDULER] signal {signum}, stopping")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    # Письма из outbox рассылает тот же фоновый процесс
+    email_outbox.start()
+    leader = threading.Thread(target=run_leader, args=(stop,), daemon=True)
+    leader.start()
+    while not stop.is_set():
+        stop.wait(1.0)
+    leader.join(timeout=60)
+
+
+if __name__ == "__main__":
+    main()
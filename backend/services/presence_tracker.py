@@ -1,15 +1,24 @@
 from __future__ import annotations
 
+import atexit
+import os
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 
 from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
 from models import SiteVisit, User, UserSession
 
 VISIT_INTERVAL = timedelta(minutes=30)
 
+# How often buffered presence is written to user_sessions / site_visits / users.
+PRESENCE_FLUSH_SEC = float(os.getenv("PRESENCE_FLUSH_SEC", "5") or "5")
+
 
 def _client_ip(request: Optional[Request]) -> Optional[str]:
     if not request:
@@ -24,48 +33,199 @@ def _client_ip(request: Optional[Request]) -> Optional[str]:
     return None
 
 
+class _Presence:
+    """Coalesced activity of one user since the last flush."""
+
+    __slots__ = (
+        "first_seen_at", "first_path", "first_ip",
+        "last_seen_at", "last_path", "ip_address", "user_agent",
+    )
+
+    def __init__(self, now, path, ip, user_agent):
+        self.first_seen_at = now
+        self.first_path = path
+        self.first_ip = ip
+        self.last_seen_at = now
+        self.last_path = path
+        self.ip_address = ip
+        self.user_agent = user_agent
+
+
+_lock = threading.Lock()
+_pending: Dict[int, _Presence] = {}
+_flush_lock = threading.Lock()
+_flusher_started = False
+
+
 def record_user_activity(db: Session, user: User, request: Optional[Request] = None) -> None:
-    """Upsert user session info and record periodic site visits."""
+    """
+    Buffer user presence in memory; no DB work on the request path.
+
+    Updates are coalesced per user and written in bulk by a background
+    flusher every PRESENCE_FLUSH_SEC (see flush()). `db` is kept for
+    signature compatibility.
+    """
     if not user or not getattr(user, "id", None):
         return
 
     now = datetime.utcnow()
     ip_address = _client_ip(request)
-    user_agent = request.headers.get("user-agent")[:512] if request else None
-    last_path = request.url.path if request else None
-
-    session = db.query(UserSession).filter(
-        UserSession.user_id == user.id).first()
-    if not session:
-        session = UserSession(user_id=user.id)
-        db.add(session)
-
-    session.last_seen_at = now
-    session.ip_address = ip_address
-    session.user_agent = user_agent
-    session.last_path = last_path
-    if not session.created_at:
-        session.created_at = now
-    user.last_active_at = now
-
-    should_add_visit = False
-    if not session.last_visit_at:
-        should_add_visit = True
-    else:
-        if now - session.last_visit_at >= VISIT_INTERVAL:
-            should_add_visit = True
-
-    if should_add_visit:
-        session.last_visit_at = now
-        visit = SiteVisit(
-            user_id=user.id,
-            visited_at=now,
-            path=last_path,
-            ip_address=ip_address,
-        )
-        db.add(visit)
+    user_agent = (request.headers.get("user-agent") or "")[:512] if request else None
+    last_path = request.url.path[:512] if request else None
+
+    with _lock:
+        entry = _pending.get(user.id)
+        if entry is None:
+            _pending[user.id] = _Presence(now, last_path, ip_address, user_agent)
+        else:
+            entry.last_seen_at = now
+            entry.last_path = last_path
+            entry.ip_address = ip_address
+            entry.user_agent = user_agent
+    _ensure_flusher()
+
+
+def pending_snapshot() -> Dict[int, dict]:
+    """Buffered (not yet flushed) presence: user_id -> {last_seen_at, last_path}."""
+    with _lock:
+        return {
+            uid: {"last_seen_at": e.last_seen_at, "last_path": e.last_path}
+            for uid, e in _pending.items()
+        }
+
+
+def flush(db: Optional[Session] = None) -> int:
+    """
+    Write buffered presence to the DB. Returns the number of users flushed.
+
+    Per batch: two SELECTs (live users, their last visits), one upsert into
+    user_sessions, one multi-row insert into site_visits and one UPDATE of
+    users.last_active_at.
+    """
+    with _flush_lock:
+        with _lock:
+            if not _pending:
+                return 0
+            batch = dict(_pending)
+            _pending.clear()
+
+        own_session = db is None
+        if own_session:
+            from database import SessionLocal
+            db = SessionLocal()
+        try:
+            _write_batch(db, batch)
+            db.commit()
+            return len(batch)
+        except Exception:
+            db.rollback()
+            # Put the batch back (newer activity wins) so it is retried next time
+            with _lock:
+                for uid, entry in batch.items():
+                    newer = _pending.get(uid)
+                    if newer is None:
+                        _pending[uid] = entry
+                    else:
+                        newer.first_seen_at = entry.first_seen_at
+                        newer.first_path = entry.first_path
+                        newer.first_ip = entry.first_ip
+            raise
+        finally:
+            if own_session:
+                db.close()
+
+
+def _write_batch(db: Session, batch: Dict[int, _Presence]) -> None:
+    user_ids = list(batch)
+    # Users may be deleted between the request and the flush
+    existing = {
+        row[0] for row in db.query(User.id).filter(User.id.in_(user_ids)).all()
+    }
+    if not existing:
+        return
+    last_visits = dict(
+        db.query(UserSession.user_id, UserSession.last_visit_at)
+        .filter(UserSession.user_id.in_(existing))
+        .all()
+    )
+
+    session_rows = []
+    visit_rows = []
+    for uid in existing:
+        entry = batch[uid]
+        last_visit_at = last_visits.get(uid)
+        # Same rule as before buffering: a new visit when the first request
+        # of this window is VISIT_INTERVAL after the previous visit.
+        if last_visit_at is None or entry.first_seen_at - last_visit_at >= VISIT_INTERVAL:
+            last_visit_at = entry.first_seen_at
+            visit_rows.append({
+                "user_id": uid,
+                "visited_at": entry.first_seen_at,
+                "path": entry.first_path,
+                "ip_address": entry.first_ip,
+            })
+        session_rows.append({
+            "user_id": uid,
+            "last_seen_at": entry.last_seen_at,
+            "created_at": entry.first_seen_at,
+            "last_visit_at": last_visit_at,
+            "ip_address": entry.ip_address,
+            "user_agent": entry.user_agent,
+            "last_path": entry.last_path,
+        })
+
+    stmt = pg_insert(UserSession.__table__).values(session_rows)
+    excluded = stmt.excluded
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[UserSession.__table__.c.user_id],
+        set_={
+            "last_seen_at": excluded.last_seen_at,
+            "last_visit_at": excluded.last_visit_at,
+            "ip_address": excluded.ip_address,
+            "user_agent": excluded.user_agent,
+            "last_path": excluded.last_path,
+        },
+    ))
+    if visit_rows:
+        db.execute(SiteVisit.__table__.insert(), visit_rows)
+    db.execute(
+        text("""
+            UPDATE users AS u
+               SET last_active_at = v.ts
+              FROM unnest(CAST(:ids AS integer[]), CAST(:tss AS timestamp[])) AS v(id, ts)
+             WHERE u.id = v.id
+        """),
+        {
+            "ids": [r["user_id"] for r in session_rows],
+            "tss": [r["last_seen_at"] for r in session_rows],
+        },
+    )
+
+
+def _flusher_loop() -> None:
+    while True:
+        time.sleep(PRESENCE_FLUSH_SEC)
+        try:
+            flush()
+        except Exception as e:
+            print("[presence] flush failed:", e)
+
+
+def _ensure_flusher() -> None:
+    global _flusher_started
+    if _flusher_started:
+        return
+    with _lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+    threading.Thread(target=_flusher_loop, name="presence-flusher",
+                     daemon=True).start()
+
 
+@atexit.register
+def _flush_at_exit() -> None:
     try:
-        db.commit()
-    except Exception:
-        db.rollback()
+        flush()
+    except Exception as e:
+        print("[presence] final flush failed:", e)
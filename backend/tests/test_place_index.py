@@ -0,0 +1,166 @@
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import place_index  # noqa: E402
+from place_index import _Entry, _Index  # noqa: E402
+
+NAMES = ["Tbilisi", "Tbilisskaya", "Batumi", "Batalpashinsk", "Bakuriani", "Baku",
+         "Kutaisi", "Kobuleti", "Kazbegi", "Tbeti", "Telavi", "Tetritskaro"]
+
+
+@pytest.fixture(autouse=True)
+def small_top(monkeypatch):
+    # Маленький топ, чтобы удаления из полного топа пересчитывали его
+    monkeypatch.setattr(place_index, "PLACE_INDEX_TOP_K", 3)
+    monkeypatch.setattr(place_index, "PLACE_INDEX_TOP_PREFIX", 3)
+    monkeypatch.setattr(place_index, "_variants", lambda s: [])
+    monkeypatch.setattr(place_index, "_rank", lambda place_type, population: float(population or 0))
+
+
+def _entry(pid, name, population, country="GE"):
+    e = _Entry()
+    e.id = pid
+    e.external_id = pid
+    e.osm_type = None
+    e.lat, e.lon = 41.0, 44.0
+    e.country = country
+    e.translations = {"en": name, "ru": name.upper()}
+    e.population = population
+    e.place_type = "city"
+    e.rank = float(population)
+    e.keys = place_index._keys_for(e.translations)
+    return e
+
+
+def _state(idx: _Index):
+    return (sorted(idx.places), idx.keys, idx.ids,
+            {p: list(v) for p, v in idx.top.items() if v})
+
+
+def _entries(rng, n):
+    return [_entry(i, rng.choice(NAMES) + str(i % 3), rng.randrange(0, 10**6)) for i in range(n)]
+
+
+def test_normalize():
+    assert place_index.normalize("  Tbílisi-Mtskheta,  Road ") == "tbilisi mtskheta road"
+
+
+def test_add_matches_full_build():
+    rng = random.Random(1)
+    entries = _entries(rng, 60)
+    idx = _Index.build([])
+    for e in rng.sample(entries, len(entries)):
+        idx.add(e)
+    assert _state(idx) == _state(_Index.build(entries))
+
+
+def test_updates_and_removals_match_full_build():
+    rng = random.Random(2)
+    current = {e.id: e for e in _entries(rng, 80)}
+    idx = _Index.build(current.values())
+    for step in range(200):
+        pid = rng.randrange(100)
+        if rng.random() < 0.3:
+            idx.remove(pid)
+            current.pop(pid, None)
+        else:
+            e = _entry(pid, rng.choice(NAMES), rng.randrange(0, 10**6))
+            idx.add(e)
+            current[pid] = e
+    assert _state(idx) == _state(_Index.build(current.values()))
+
+
+def test_top_is_ranked_and_bounded():
+    entries = [_entry(i, "Batumi", pop) for i, pop in enumerate([5, 50, 500, 5000, 50])]
+    idx = _Index.build(entries)
+    assert idx.top["ba"] == [(5000.0, 3), (500.0, 2), (50.0, 4)]
+    idx.remove(3)
+    assert idx.top["ba"] == [(500.0, 2), (50.0, 4), (50.0, 1)]
+
+
+def test_scan_by_prefix():
+    idx = _Index.build([_entry(1, "Batumi", 1), _entry(2, "Baku", 2), _entry(3, "Kutaisi", 3)])
+    assert sorted(set(idx.scan("ba"))) == [1, 2]
+    assert idx.scan("kut") == [3]
+    assert idx.scan("zz") == []
+
+
+T0 = datetime(2025, 1, 1)
+
+
+def _row(pid, name, population, minutes=0):
+    return SimpleNamespace(
+        id=pid, source="geonames", external_id=pid, osm_type=None, lat=41.0, lon=44.0,
+        country_iso2="GE", translations={"en": name}, population=population,
+        place_type="city", updated_at=T0 + timedelta(minutes=minutes))
+
+
+class _Result(list):
+    def scalar(self):
+        return self[0]
+
+    def fetchall(self):
+        return list(self)
+
+    def yield_per(self, n):
+        return self
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    """places в памяти; понимает ровно те запросы, что шлёт place_index."""
+
+    def __init__(self, rows):
+        self.rows = {r.id: r for r in rows}
+        self.full_loads = 0
+
+    def execute(self, sql, params=None, execution_options=None):
+        sql = str(sql)
+        since = (params or {}).get("since")
+        rows = [r for r in self.rows.values() if since is None or r.updated_at >= since]
+        if "count(*)" in sql:
+            return _Result([len(rows)])
+        if "max(updated_at)" in sql:
+            return _Result([max(r.updated_at for r in self.rows.values())])
+        if since is None:
+            self.full_loads += 1
+        return _Result(sorted(rows, key=lambda r: r.updated_at))
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    monkeypatch.setattr(place_index, "PLACE_INDEX_MAX_PLACES", 0)
+    monkeypatch.setattr(place_index, "PLACE_INDEX_REBUILD_OVER", 5)
+    monkeypatch.setattr(place_index, "_index", None)
+    monkeypatch.setattr(place_index, "_since", None)
+    db = FakeDB([_row(i, NAMES[i], 1000 * i, minutes=-i - 1) for i in range(len(NAMES))])
+    place_index.load(db)
+    return db
+
+
+def test_refresh_applies_small_changes_incrementally(loaded):
+    db = loaded
+    db.rows[1] = _row(1, "Zestafoni", 10**6, minutes=5)
+    db.rows[100] = _row(100, "Zugdidi", 10, minutes=6)
+    place_index.refresh(db)
+    assert db.full_loads == 1
+    assert _state(place_index._index) == _state(
+        _Index.build(place_index._entry(r) for r in db.rows.values()))
+    names = [i["name"] for i in place_index.search("zu", "en", 5)]
+    assert names == ["Zugdidi"]
+
+
+def test_refresh_rebuilds_after_bulk_import(loaded):
+    db = loaded
+    for i in range(200, 210):
+        db.rows[i] = _row(i, "Gori", i, minutes=10)
+    place_index.refresh(db)
+    assert db.full_loads == 2
+    assert len(place_index._index.places) == len(db.rows)
@@ -0,0 +1,67 @@
+import csv
+import io
+import json
+
+from places_import import _CopySource
+
+
+def _record(i, **kw):
+    r = {
+        "source": "geonames",
+        "external_id": i,
+        "lat": 41.7,
+        "lon": 44.8,
+        "country_iso2": "GE",
+        "translations": {"ru": "Тбилиси", "en": "Tbilisi"},
+        "population": 1000 + i,
+        "place_type": "city",
+    }
+    r.update(kw)
+    return r
+
+
+def _rows(data: bytes):
+    return list(csv.reader(io.StringIO(data.decode("utf-8"))))
+
+
+def test_small_reads_stream_all_records():
+    records = [_record(i) for i in range(5)]
+    source = _CopySource(records)
+    chunks = []
+    while True:
+        chunk = source.read(7)
+        if not chunk:
+            break
+        assert len(chunk) <= 7
+        chunks.append(chunk)
+    rows = _rows(b"".join(chunks))
+    assert [int(r[1]) for r in rows] == list(range(5))
+    assert source.count == 5
+
+
+def test_buffered_reader_and_read_all():
+    records = [_record(i) for i in range(3)]
+    wrapped = io.BufferedReader(_CopySource(records), buffer_size=16)
+    assert _rows(wrapped.read()) == _rows(_CopySource(records).read())
+
+
+def test_csv_columns_and_empty_optionals():
+    source = _CopySource([_record(1, osm_type=None, population=None, place_type=None)])
+    (row,) = _rows(source.read())
+    assert row[:6] == ["geonames", "1", "", "41.7", "44.8", "GE"]
+    assert json.loads(row[6]) == {"ru": "Тбилиси", "en": "Tbilisi"}
+    assert row[7:] == ["", ""]
+
+
+def test_records_are_pulled_lazily():
+    pulled = []
+
+    def gen():
+        for i in range(100):
+            pulled.append(i)
+            yield _record(i)
+
+    source = _CopySource(gen())
+    source.read(10)
+    assert len(pulled) == 1
+    assert source.read(0) == b""
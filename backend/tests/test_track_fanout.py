@@ -0,0 +1,100 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import track_fanout
+
+T0 = datetime(2025, 1, 2, 3, 4, 5)
+
+
+def _point(i, **kw):
+    p = {"lat": 41.7 + i * 0.001, "lng": 44.8 - i * 0.001, "ts": T0 + timedelta(seconds=i),
+         "speed": 12.34, "heading": None, "accuracy": 5.0}
+    p.update(kw)
+    return p
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(track_fanout, "_sessions", {})
+    monkeypatch.setattr(track_fanout, "TRACK_WATCH_MAX_HZ", 20.0)
+    monkeypatch.setattr(track_fanout, "TRACK_WATCH_BATCH_MAX", 500)
+
+
+def _run(scenario):
+    frames = []
+
+    async def main():
+        await scenario(lambda key, payload: frames.append((key, payload)))
+
+    asyncio.run(main())
+    return frames
+
+
+def test_first_point_goes_out_immediately():
+    async def scenario(deliver):
+        track_fanout.publish("s1", _point(0), deliver)
+
+    frames = _run(scenario)
+    assert len(frames) == 1
+    key, frame = frames[0]
+    assert key == "s1"
+    assert frame["type"] == "point"
+    assert frame["point"]["ts"] == T0.isoformat()
+
+
+def test_burst_is_coalesced_into_one_frame():
+    async def scenario(deliver):
+        for i in range(5):
+            track_fanout.publish("s1", _point(i), deliver)
+        await asyncio.sleep(0.1)
+
+    frames = _run(scenario)
+    assert [f["type"] for _, f in frames] == ["point", "points"]
+    batch = frames[1][1]
+    assert batch["count"] == 4
+    assert batch["ts0"] == (T0 + timedelta(seconds=1)).isoformat()
+    assert batch["dt_ms"] == [0, 1000, 2000, 3000]
+    assert batch["speed"] == [12.3] * 4
+
+
+def test_sessions_are_rate_limited_independently():
+    async def scenario(deliver):
+        track_fanout.publish("a", _point(0), deliver)
+        track_fanout.publish("b", _point(0), deliver)
+
+    frames = _run(scenario)
+    assert sorted(k for k, _ in frames) == ["a", "b"]
+
+
+def test_batch_keeps_only_latest_points(monkeypatch):
+    monkeypatch.setattr(track_fanout, "TRACK_WATCH_BATCH_MAX", 3)
+
+    async def scenario(deliver):
+        track_fanout.publish("s1", _point(0), deliver)
+        for i in range(1, 11):
+            track_fanout.publish("s1", _point(i), deliver)
+        await asyncio.sleep(0.1)
+
+    frames = _run(scenario)
+    batch = frames[-1][1]
+    assert batch["count"] == 3
+    assert batch["ts0"] == (T0 + timedelta(seconds=8)).isoformat()
+
+
+def test_zero_hz_disables_coalescing(monkeypatch):
+    monkeypatch.setattr(track_fanout, "TRACK_WATCH_MAX_HZ", 0.0)
+
+    async def scenario(deliver):
+        for i in range(3):
+            track_fanout.publish("s1", _point(i), deliver)
+
+    frames = _run(scenario)
+    assert [f["type"] for _, f in frames] == ["point"] * 3
+
+
+def test_polyline6_known_value():
+    # Пример из описания формата Google (точность 1e5), пересчитанный в 1e6
+    encoded = track_fanout._polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453])
+    assert encoded == "_izlhA~rlgdF_{geC~ywl@_kwzCn`{nI"
@@ -0,0 +1,67 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import tracking_ingest  # noqa: E402
+from tracking_ingest import make_point, naive_utc, pending_points  # noqa: E402
+
+SID = uuid.UUID("5f0c2a7e-4a51-4d61-9d0f-3f1c8f0e2b11")
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    pending = []
+    monkeypatch.setattr(tracking_ingest, "_pending", pending)
+    return pending
+
+
+def test_make_point_fields():
+    p = make_point(str(SID), {"type": "point", "lat": "41.7", "lng": 44.8,
+                              "ts": "2025-01-02T03:04:05", "speed": "12.5"})
+    assert p["session_id"] == SID
+    assert (p["lat"], p["lng"], p["speed"]) == (41.7, 44.8, 12.5)
+    assert p["heading"] is None and p["accuracy"] is None
+    assert p["ts"] == datetime(2025, 1, 2, 3, 4, 5)
+    assert p["source"] == "device"
+
+
+def test_make_point_without_ts_uses_now():
+    before = datetime.utcnow()
+    p = make_point(SID, {"lat": 1, "lng": 2})
+    assert before <= p["ts"] <= datetime.utcnow()
+
+
+@pytest.mark.parametrize("ts", ["2025-01-02T07:04:05+04:00", "2025-01-02T03:04:05Z"])
+def test_make_point_converts_offsets_to_naive_utc(ts):
+    p = make_point(SID, {"lat": 1, "lng": 2, "ts": ts})
+    assert p["ts"] == datetime(2025, 1, 2, 3, 4, 5)
+    assert p["ts"].tzinfo is None
+
+
+def test_make_point_clamps_future_ts():
+    future = (datetime.utcnow() + timedelta(days=3)).isoformat()
+    p = make_point(SID, {"lat": 1, "lng": 2, "ts": future})
+    assert p["ts"] <= datetime.utcnow()
+
+
+def test_naive_utc():
+    aware = datetime(2025, 1, 2, 7, 0, tzinfo=timezone(timedelta(hours=4)))
+    assert naive_utc(aware) == datetime(2025, 1, 2, 3, 0)
+    naive = datetime(2025, 1, 2, 3, 0)
+    assert naive_utc(naive) is naive
+
+
+def test_pending_points_filters_session_and_aware_since(buffer):
+    other = uuid.uuid4()
+    buffer.extend([
+        make_point(SID, {"lat": 1, "lng": 2, "ts": "2025-01-02T03:00:00"}),
+        make_point(SID, {"lat": 1, "lng": 2, "ts": "2025-01-02T05:00:00"}),
+        make_point(other, {"lat": 1, "lng": 2, "ts": "2025-01-02T05:00:00"}),
+    ])
+    assert len(pending_points(SID)) == 2
+    since = datetime(2025, 1, 2, 8, 0, tzinfo=timezone(timedelta(hours=4)))
+    got = pending_points(str(SID), since)
+    assert [p["ts"] for p in got] == [datetime(2025, 1, 2, 5, 0)]
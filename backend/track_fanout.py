@@ -0,0 +1,160 @@
+"""
+Рассылка точек трекинга зрителям (/ws/track/watch) с ограничением частоты.
+
+track_publish раньше пересылал каждую точку каждому зрителю с той частотой,
+с какой её шлёт телефон, — включая пачки при переподключении, когда
+устройство выгружает накопленный хвост. Зрителей по публичной ссылке на одну
+сессию бывают десятки, и каждый такой всплеск умножался на их число.
+
+Теперь точки сессии копятся и уходят не чаще TRACK_WATCH_MAX_HZ раз в
+секунду, одним кадром на всех зрителей:
+  одна точка  — {"type": "point", "point": {...}} (как раньше);
+  несколько   — {"type": "points", ...} в сжатом виде (см. encode_points).
+В кадре не больше TRACK_WATCH_BATCH_MAX последних точек: при перегрузке
+важна свежая позиция, полный трек доступен через /track/sessions/{id}/history.
+Всё работает в event loop процесса (вызывать из async-обработчиков).
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Callable, Dict, List, Optional
+
+TRACK_WATCH_MAX_HZ = float(os.getenv("TRACK_WATCH_MAX_HZ", "2") or "2")
+TRACK_WATCH_BATCH_MAX = int(os.getenv("TRACK_WATCH_BATCH_MAX", "500") or "500")
+
+# Сессии без точек дольше этого забываются (чтобы состояние не копилось)
+_IDLE_FORGET_SEC = 300.0
+_POLYLINE_PRECISION = 1e6
+
+_counters = {"points": 0, "frames": 0, "coalesced": 0, "trimmed": 0}
+
+
+class _SessionState:
+    __slots__ = ("points", "handle", "last_sent")
+
+    def __init__(self):
+        self.points: List[dict] = []
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.last_sent = float("-inf")
+
+
+_sessions: Dict[str, _SessionState] = {}
+
+
+def _polyline(lats, lngs) -> str:
+    """Encoded Polyline (алгоритм Google) с точностью 1e-6 градуса (polyline6)."""
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in zip(lats, lngs):
+        ilat = int(round(lat * _POLYLINE_PRECISION))
+        ilng = int(round(lng * _POLYLINE_PRECISION))
+        for delta in (ilat - prev_lat, ilng - prev_lng):
+            v = ~(delta << 1) if delta < 0 else delta << 1
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1f)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(out)
+
+
+def _round(v, nd=1):
+    return round(v, nd) if v is not None else None
+
+
+def encode_points(points: List[dict]) -> dict:
+    """
+    Сжатый список точек: координаты — polyline6, время — смещения в мс от
+    первой точки, speed/heading/accuracy — столбцы с округлением до 0.1.
+    """
+    t0 = points[0]["ts"]
+    return {
+        "count": len(points),
+        "ts0": t0.isoformat(),
+        "polyline6": _polyline([p["lat"] for p in points], [p["lng"] for p in points]),
+        "dt_ms": [int((p["ts"] - t0).total_seconds() * 1000) for p in points],
+        "speed": [_round(p.get("speed")) for p in points],
+        "heading": [_round(p.get("heading")) for p in points],
+        "accuracy": [_round(p.get("accuracy")) for p in points],
+    }
+
+
+def _frame(session_id: str, points: List[dict]) -> dict:
+    if len(points) == 1:
+        p = points[0]
+        return {
+            "type": "point",
+            "session_id": session_id,
+            "point": {
+                "lat": p["lat"],
+                "lng": p["lng"],
+                "ts": p["ts"].isoformat(),
+                "speed": p.get("speed"),
+                "heading": p.get("heading"),
+                "accuracy": p.get("accuracy"),
+            },
+        }
+    return {"type": "points", "session_id": session_id, **encode_points(points)}
+
+
+def publish(session_id, point: dict, deliver: Callable[[str, dict], None]) -> None:
+    """
+    Ставит точку в очередь сессии. deliver(session_id, payload) вызывается
+    не чаще TRACK_WATCH_MAX_HZ раз в секунду на сессию.
+    """
+    key = str(session_id)
+    _counters["points"] += 1
+    if TRACK_WATCH_MAX_HZ <= 0:
+        _counters["frames"] += 1
+        deliver(key, _frame(key, [point]))
+        return
+
+    st = _sessions.get(key)
+    if st is None:
+        st = _sessions[key] = _SessionState()
+    st.points.append(point)
+    overflow = len(st.points) - TRACK_WATCH_BATCH_MAX
+    if overflow > 0:
+        del st.points[:overflow]
+        _counters["trimmed"] += overflow
+    if st.handle is not None:
+        return
+
+    loop = asyncio.get_running_loop()
+    wait = st.last_sent + 1.0 / TRACK_WATCH_MAX_HZ - loop.time()
+    if wait <= 0:
+        _flush(key, deliver)
+    else:
+        st.handle = loop.call_later(wait, _flush, key, deliver)
+
+
+def _flush(key: str, deliver: Callable[[str, dict], None]) -> None:
+    st = _sessions.get(key)
+    if st is None:
+        return
+    st.handle = None
+    points, st.points = st.points, []
+    if not points:
+        return
+    loop = asyncio.get_running_loop()
+    st.last_sent = loop.time()
+    _counters["frames"] += 1
+    _counters["coalesced"] += len(points) - 1
+    try:
+        deliver(key, _frame(key, points))
+    except Exception as e:
+        print("[TRACK_FANOUT] deliver failed:", e)
+    _forget_idle(st.last_sent)
+
+
+def _forget_idle(now: float) -> None:
+    if len(_sessions) < 256:
+        return
+    for key in [k for k, s in _sessions.items()
+                if s.handle is None and not s.points and now - s.last_sent > _IDLE_FORGET_SEC]:
+        _sessions.pop(key, None)
+
+
+def stats() -> dict:
+    return {"max_hz": TRACK_WATCH_MAX_HZ, "sessions": len(_sessions), **_counters}
@@ -0,0 +1,243 @@
+"""
+Последние позиции активных сессий трекинга (без обращения к tracking_points).
+
+track_publish кладёт сюда каждую точку: последний фикс сессии и кольцевой
+буфер последних TRACK_RECENT_POINTS точек. Снапшот track_watch, опрос
+/track/sessions/{id}/points?since=... и transport_live_state читают отсюда
+и идут в БД, только если кэш не может ответить сам.
+
+Хранилище: in-process (TRACK_POSITIONS_BACKEND=memory) или Redis
+(TRACK_POSITIONS_BACKEND=redis) — тогда его видят все воркеры, а не только
+тот, куда подключён водитель. Ошибки Redis = промах кэша.
+
+Буфер сессии создаётся только seed() из БД при подключении водителя, а
+record() лишь дописывает в существующий — поэтому в кэше всегда непрерывный
+хвост трека. Кэш воркера может отстать (водитель переподключился к другому
+воркеру), поэтому читатели передают fresh_after=TrackingSession.last_point_at:
+если последняя точка в кэше старше записанной в БД, кэш не используется.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import List, Optional
+
+TRACK_POSITIONS_BACKEND = (
+    os.getenv("TRACK_POSITIONS_BACKEND", "memory") or "memory").strip().lower()
+TRACK_RECENT_POINTS = int(os.getenv("TRACK_RECENT_POINTS", "1000") or "1000")
+# Сколько сессий помнит in-process хранилище (LRU)
+TRACK_POSITIONS_MAX_SESSIONS = int(
+    os.getenv("TRACK_POSITIONS_MAX_SESSIONS", "5000") or "5000")
+# Время жизни ключей в Redis после последней точки
+TRACK_POSITIONS_TTL_SEC = int(os.getenv("TRACK_POSITIONS_TTL_SEC", "86400") or "86400")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+_REDIS_PREFIX = "trackpos:"
+
+FIELDS = ("lat", "lng", "ts", "speed", "heading", "accuracy", "battery")
+
+_counters = {"hits": 0, "misses": 0, "stale": 0}
+
+
+def _slim(point: dict) -> dict:
+    return {k: point.get(k) for k in FIELDS}
+
+
+class MemoryStore:
+    def __init__(self, max_sessions: int, max_points: int):
+        self.max_sessions = max(1, max_sessions)
+        self.max_points = max(1, max_points)
+        self._lock = threading.Lock()
+        # session_id -> deque точек (по возрастанию ts)
+        self._recent: "OrderedDict[str, deque]" = OrderedDict()
+
+    def record(self, session_id: str, point: dict) -> None:
+        with self._lock:
+            buf = self._recent.get(session_id)
+            if buf is None:
+                return
+            self._recent.move_to_end(session_id)
+            buf.append(point)
+
+    def seed(self, session_id: str, points: List[dict]) -> None:
+        with self._lock:
+            self._recent[session_id] = deque(points, maxlen=self.max_points)
+            self._recent.move_to_end(session_id)
+            while len(self._recent) > self.max_sessions:
+                self._recent.popitem(last=False)
+
+    def last(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            buf = self._recent.get(session_id)
+            return dict(buf[-1]) if buf else None
+
+    def recent(self, session_id: str) -> List[dict]:
+        with self._lock:
+            buf = self._recent.get(session_id)
+            return [dict(p) for p in buf] if buf else []
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            self._recent.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "sessions": len(self._recent),
+                    "max_sessions": self.max_sessions}
+
+
+class RedisStore:
+    """
+    trackpos:r:<session_id> — список JSON-точек (новые слева, LTRIM до max_points);
+    trackpos:s:<session_id> — метка «буфер засеян»: без неё список не читается
+    (после истечения TTL record() мог начать его заново с середины трека).
+    """
+
+    def __init__(self, url: str, max_points: int, ttl: int):
+        import redis
+        self._r = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.max_points = max(1, max_points)
+        self.ttl = max(1, ttl)
+
+    @staticmethod
+    def _recent_key(session_id: str) -> str:
+        return f"{_REDIS_PREFIX}r:{session_id}"
+
+    @staticmethod
+    def _seeded_key(session_id: str) -> str:
+        return f"{_REDIS_PREFIX}s:{session_id}"
+
+    @staticmethod
+    def _dump(point: dict) -> str:
+        return json.dumps(point, default=lambda v: v.isoformat(), separators=(",", ":"))
+
+    @staticmethod
+    def _load(raw) -> dict:
+        p = json.loads(raw)
+        if p.get("ts"):
+            p["ts"] = datetime.fromisoformat(p["ts"])
+        return p
+
+    def seed(self, session_id: str, points: List[dict]) -> None:
+        key = self._recent_key(session_id)
+        try:
+            pipe = self._r.pipeline(transaction=True)
+            pipe.delete(key)
+            if points:
+                pipe.rpush(key, *[self._dump(p) for p in reversed(points[-self.max_points:])])
+                pipe.expire(key, self.ttl)
+            pipe.set(self._seeded_key(session_id), 1, ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            print("[TRACK_POSITIONS] redis seed failed:", e)
+
+    def record(self, session_id: str, point: dict) -> None:
+        key = self._recent_key(session_id)
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            pipe.lpush(key, self._dump(point))
+            pipe.ltrim(key, 0, self.max_points - 1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(self._seeded_key(session_id), self.ttl)
+            pipe.execute()
+        except Exception as e:
+            print("[TRACK_POSITIONS] redis record failed:", e)
+
+    def _read(self, session_id: str, start: int, stop: int) -> list:
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            pipe.exists(self._seeded_key(session_id))
+            pipe.lrange(self._recent_key(session_id), start, stop)
+            seeded, raws = pipe.execute()
+        except Exception as e:
+            print("[TRACK_POSITIONS] redis read failed:", e)
+            return []
+        return raws if seeded else []
+
+    def last(self, session_id: str) -> Optional[dict]:
+        raws = self._read(session_id, 0, 0)
+        return self._load(raws[0]) if raws else None
+
+    def recent(self, session_id: str) -> List[dict]:
+        return [self._load(r) for r in reversed(self._read(session_id, 0, -1))]
+
+    def forget(self, session_id: str) -> None:
+        try:
+            self._r.delete(self._recent_key(session_id), self._seeded_key(session_id))
+        except Exception as e:
+            print("[TRACK_POSITIONS] redis delete failed:", e)
+
+    def stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if TRACK_POSITIONS_BACKEND == "redis":
+                    _store = RedisStore(REDIS_URL, TRACK_RECENT_POINTS, TRACK_POSITIONS_TTL_SEC)
+                else:
+                    _store = MemoryStore(TRACK_POSITIONS_MAX_SESSIONS, TRACK_RECENT_POINTS)
+    return _store
+
+
+def record(session_id, point: dict) -> None:
+    """Новая точка сессии (см. tracking_ingest.make_point)."""
+    store().record(str(session_id), _slim(point))
+
+
+def seed(session_id, points: List[dict]) -> None:
+    """Заменяет буфер сессии хвостом трека из БД (по возрастанию ts)."""
+    store().seed(str(session_id), [_slim(p) for p in points])
+
+
+def forget(session_id) -> None:
+    store().forget(str(session_id))
+
+
+def _is_fresh(last: Optional[dict], fresh_after: Optional[datetime]) -> bool:
+    if not last:
+        return False
+    return fresh_after is None or (last.get("ts") is not None and last["ts"] >= fresh_after)
+
+
+def last(session_id, fresh_after: Optional[datetime] = None) -> Optional[dict]:
+    """Последний фикс сессии или None (нет в кэше / кэш отстал от БД)."""
+    p = store().last(str(session_id))
+    if not _is_fresh(p, fresh_after):
+        _counters["stale" if p else "misses"] += 1
+        return None
+    _counters["hits"] += 1
+    return p
+
+
+def recent(session_id, fresh_after: Optional[datetime] = None,
+           since: Optional[datetime] = None) -> Optional[List[dict]]:
+    """
+    Хвост трека по возрастанию ts. С since — только точки не раньше since,
+    и None, если буфер не покрывает since (тогда читать из БД).
+    """
+    pts = store().recent(str(session_id))
+    if not pts or not _is_fresh(pts[-1], fresh_after):
+        _counters["stale" if pts else "misses"] += 1
+        return None
+    if since is not None:
+        # Буфер обрезан: точки раньше самой старой в нём могут быть только в БД
+        if pts[0]["ts"] > since and len(pts) >= TRACK_RECENT_POINTS:
+            _counters["misses"] += 1
+            return None
+        pts = [p for p in pts if p["ts"] >= since]
+    _counters["hits"] += 1
+    return pts
+
+
+def stats() -> dict:
+    return {**store().stats(), "recent_points": TRACK_RECENT_POINTS, **_counters}
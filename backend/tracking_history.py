@@ -0,0 +1,129 @@
+"""
+История трека за произвольное окно с упрощением ломаной на сервере.
+
+Клиенту карты не нужны десятки тысяч точек за неделю поездки: линия
+упрощается алгоритмом Дугласа–Пекера с допуском tolerance_m (метры).
+Координаты проецируются равнопромежуточно относительно средней широты
+окна — на масштабах трека ошибка проекции меньше GPS-шума.
+Запрос по (session_id, ts) с границами окна задевает только нужные
+месячные секции tracking_points.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from math import cos, radians
+from typing import List, Optional
+
+from sqlalchemy.orm import Session
+
+import tracking_ingest
+from models import TrackingPoint
+
+try:
+    import numpy as np  # опционально: векторное расстояние до отрезка
+except ImportError:
+    np = None
+
+HISTORY_FIELDS = ("lat", "lng", "ts", "speed", "heading", "accuracy", "battery")
+# Сколько сырых точек максимум читаем на один запрос истории
+HISTORY_RAW_MAX = 200000
+
+_M_PER_DEG = 111320.0
+
+
+def load_points(db: Session, session_id, since: Optional[datetime] = None,
+                until: Optional[datetime] = None, limit: int = HISTORY_RAW_MAX) -> List[dict]:
+    """Сырые точки окна [since, until] по возрастанию ts, включая буфер tracking_ingest."""
+    # ts хранится naive UTC; since/until из запроса могут прийти со смещением
+    since = tracking_ingest.naive_utc(since) if since else since
+    until = tracking_ingest.naive_utc(until) if until else until
+    q = db.query(
+        TrackingPoint.lat, TrackingPoint.lng, TrackingPoint.ts, TrackingPoint.speed,
+        TrackingPoint.heading, TrackingPoint.accuracy, TrackingPoint.battery,
+    ).filter(TrackingPoint.session_id == session_id)
+    if since:
+        q = q.filter(TrackingPoint.ts >= since)
+    if until:
+        q = q.filter(TrackingPoint.ts <= until)
+    out = [dict(zip(HISTORY_FIELDS, r)) for r in q.order_by(TrackingPoint.ts.asc()).limit(limit)]
+    if len(out) < limit:
+        out.extend(
+            {k: p[k] for k in HISTORY_FIELDS}
+            for p in tracking_ingest.pending_points(session_id, since)
+            if until is None or p["ts"] <= until
+        )
+        out.sort(key=lambda x: x["ts"])
+        out = out[:limit]
+    return out
+
+
+def _project(points: List[dict]):
+    lat0 = radians(sum(p["lat"] for p in points) / len(points))
+    kx = _M_PER_DEG * cos(lat0)
+    xs = [p["lng"] * kx for p in points]
+    ys = [p["lat"] * _M_PER_DEG for p in points]
+    return xs, ys
+
+
+def _farthest(xs, ys, i: int, j: int):
+    """(индекс, расстояние в м) самой удалённой от отрезка i–j точки между ними."""
+    ax, ay, bx, by = xs[i], ys[i], xs[j], ys[j]
+    dx, dy = bx - ax, by - ay
+    seg2 = dx * dx + dy * dy
+    if np is not None and j - i > 64:
+        px = np.asarray(xs[i + 1:j]) - ax
+        py = np.asarray(ys[i + 1:j]) - ay
+        if seg2 == 0.0:
+            d2 = px * px + py * py
+        else:
+            t = np.clip((px * dx + py * dy) / seg2, 0.0, 1.0)
+            ex, ey = px - t * dx, py - t * dy
+            d2 = ex * ex + ey * ey
+        k = int(np.argmax(d2))
+        return i + 1 + k, float(d2[k]) ** 0.5
+    best, best_d2 = i, -1.0
+    for k in range(i + 1, j):
+        px, py = xs[k] - ax, ys[k] - ay
+        if seg2 == 0.0:
+            d2 = px * px + py * py
+        else:
+            t = min(1.0, max(0.0, (px * dx + py * dy) / seg2))
+            ex, ey = px - t * dx, py - t * dy
+            d2 = ex * ex + ey * ey
+        if d2 > best_d2:
+            best, best_d2 = k, d2
+    return best, best_d2 ** 0.5
+
+
+def simplify(points: List[dict], tolerance_m: float) -> List[dict]:
+    """Дуглас–Пекер (итеративно, без рекурсии); первая и последняя точки сохраняются."""
+    n = len(points)
+    if n <= 2 or tolerance_m <= 0:
+        return list(points)
+    xs, ys = _project(points)
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        k, dist = _farthest(xs, ys, i, j)
+        if dist > tolerance_m:
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return [p for p, kept in zip(points, keep) if kept]
+
+
+def simplify_to(points: List[dict], tolerance_m: float, max_points: int) -> tuple:
+    """
+    Упрощает с допуском tolerance_m; если точек всё ещё больше max_points —
+    удваивает допуск. Возвращает (точки, фактический допуск).
+    """
+    tol = tolerance_m
+    out = simplify(points, tol)
+    while max_points and len(out) > max_points:
+        tol = tol * 2 if tol > 0 else 1.0
+        out = simplify(points, tol)
+    return out, tol
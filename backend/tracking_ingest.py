@@ -0,0 +1,195 @@
+"""
+Буфер GPS-точек трекинга (/ws/track/publish) с пакетной записью в БД.
+
+Раньше track_publish на каждую точку создавал TrackingPoint и делал
+db.commit() синхронной сессией прямо в async-обработчике — event loop
+блокировался на каждую точку каждого водителя. Теперь:
+- submit() только кладёт точку в память (зрителям она уходит сразу из
+  обработчика через ws_outbox);
+- фоновый поток раз в TRACK_FLUSH_MS мс (или как только набралось
+  TRACK_FLUSH_POINTS точек) пишет всё одним multi-row INSERT и одним
+  UPDATE tracking_sessions.last_point_at на сессию;
+- читатели истории домешивают ещё не записанные точки (pending_points).
+При ошибке записи пакет возвращается в буфер (не больше TRACK_BUFFER_MAX точек).
+"""
+from __future__ import annotations
+
+import atexit
+import os
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+
+from models import TrackingPoint
+
+TRACK_FLUSH_MS = int(os.getenv("TRACK_FLUSH_MS", "5000") or "5000")
+TRACK_FLUSH_POINTS = int(os.getenv("TRACK_FLUSH_POINTS", "500") or "500")
+# Потолок буфера, если БД недоступна: дальше теряем самые старые точки
+TRACK_BUFFER_MAX = int(os.getenv("TRACK_BUFFER_MAX", "100000") or "100000")
+
+_lock = threading.Lock()
+_pending: List[dict] = []
+_wakeup = threading.Event()
+_flush_lock = threading.Lock()
+_flusher_started = False
+_stats = {"submitted": 0, "flushed": 0, "flushes": 0, "dropped": 0, "failures": 0}
+
+
+def naive_utc(dt: datetime) -> datetime:
+    # ts в БД и в буфере — naive UTC; клиент может прислать смещение (+04:00)
+    if dt.tzinfo is not None:
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def make_point(session_id, msg: dict) -> dict:
+    """Точка из сообщения водителя {"type": "point", lat, lng, ts?, speed?, ...}."""
+    def _opt(name):
+        v = msg.get(name)
+        return float(v) if v is not None else None
+
+    ts = msg.get("ts")
+    now = datetime.utcnow()
+    ts = naive_utc(datetime.fromisoformat(ts.replace("Z", "+00:00"))) if ts else now
+    return {
+        "session_id": uuid.UUID(str(session_id)),
+        # Часы устройства «в будущем» не должны уводить точку в чужую секцию
+        "ts": min(ts, now),
+        "lat": float(msg["lat"]),
+        "lng": float(msg["lng"]),
+        "speed": _opt("speed"),
+        "heading": _opt("heading"),
+        "accuracy": _opt("accuracy"),
+        "battery": None,
+        "source": "device",
+        "meta": {},
+    }
+
+
+def submit(point: dict) -> None:
+    """Ставит точку (см. make_point) в очередь записи; БД не трогает."""
+    with _lock:
+        _pending.append(point)
+        _stats["submitted"] += 1
+        overflow = len(_pending) - TRACK_BUFFER_MAX
+        if overflow > 0:
+            del _pending[:overflow]
+            _stats["dropped"] += overflow
+        full = len(_pending) >= TRACK_FLUSH_POINTS
+    _ensure_flusher()
+    if full:
+        _wakeup.set()
+
+
+def pending_points(session_id, since: Optional[datetime] = None) -> List[dict]:
+    """Ещё не записанные точки сессии (для REST-истории и снапшота зрителя)."""
+    key = str(session_id)
+    if since is not None:
+        since = naive_utc(since)
+    with _lock:
+        return [
+            p for p in _pending
+            if str(p["session_id"]) == key and (since is None or p["ts"] >= since)
+        ]
+
+
+def flush() -> int:
+    """Пишет буфер в БД. Возвращает число записанных точек."""
+    with _flush_lock:
+        with _lock:
+            if not _pending:
+                return 0
+            batch = list(_pending)
+            _pending.clear()
+
+        from database import SessionLocal
+        db = SessionLocal()
+        try:
+            _write_batch(db, batch)
+            db.commit()
+            _stats["flushed"] += len(batch)
+            _stats["flushes"] += 1
+            return len(batch)
+        except Exception:
+            db.rollback()
+            _stats["failures"] += 1
+            # Вернуть пакет в начало буфера (порядок точек сохраняется)
+            with _lock:
+                _pending[:0] = batch
+                overflow = len(_pending) - TRACK_BUFFER_MAX
+                if overflow > 0:
+                    del _pending[:overflow]
+                    _stats["dropped"] += overflow
+            raise
+        finally:
+            db.close()
+
+
+def _write_batch(db, batch: List[dict]) -> None:
+    # Сессия могла быть удалена, пока точки ждали в буфере
+    session_ids = list({p["session_id"] for p in batch})
+    alive = {
+        str(r[0]) for r in db.execute(
+            text("SELECT id FROM tracking_sessions WHERE id = ANY(CAST(:ids AS uuid[]))"),
+            {"ids": [str(s) for s in session_ids]},
+        )
+    }
+    rows = [p for p in batch if str(p["session_id"]) in alive]
+    if not rows:
+        return
+    db.execute(TrackingPoint.__table__.insert(), rows)
+
+    last_ts: Dict[str, datetime] = defaultdict(lambda: datetime.min)
+    for p in rows:
+        key = str(p["session_id"])
+        if p["ts"] > last_ts[key]:
+            last_ts[key] = p["ts"]
+    db.execute(
+        text("""
+            UPDATE tracking_sessions AS s
+               SET last_point_at = GREATEST(COALESCE(s.last_point_at, v.ts), v.ts)
+              FROM unnest(CAST(:ids AS uuid[]), CAST(:tss AS timestamp[])) AS v(id, ts)
+             WHERE s.id = v.id
+        """),
+        {"ids": list(last_ts), "tss": list(last_ts.values())},
+    )
+
+
+def stats() -> dict:
+    with _lock:
+        pending = len(_pending)
+    return {"pending": pending, "flush_ms": TRACK_FLUSH_MS, **_stats}
+
+
+def _flusher_loop() -> None:
+    while True:
+        _wakeup.wait(TRACK_FLUSH_MS / 1000.0)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception as e:
+            print("[TRACK_INGEST] flush failed:", e)
+
+
+def _ensure_flusher() -> None:
+    global _flusher_started
+    if _flusher_started:
+        return
+    with _lock:
+        if _flusher_started:
+            return
+        _flusher_started = True
+    threading.Thread(target=_flusher_loop, name="track-ingest-flusher",
+                     daemon=True).start()
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    try:
+        flush()
+    except Exception as e:
+        print("[TRACK_INGEST] final flush failed:", e)
@@ -0,0 +1,156 @@
+"""
+Обслуживание секций tracking_points (RANGE по ts, одна секция на месяц).
+
+- ensure_partitions() заранее создаёт секции на TRACK_PARTITIONS_AHEAD
+  месяцев вперёд (точки не должны попадать в tracking_points_default);
+- drop_expired() удаляет целиком секции старше TRACK_RETENTION_DAYS
+  и чистит старые строки из default-секции. По умолчанию 0 — хранить всё:
+  удаление истории включается только явно.
+Запускается раз в сутки из планировщика (order_reminders.register_jobs).
+"""
+from __future__ import annotations
+
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+TRACK_PARTITIONS_AHEAD = int(os.getenv("TRACK_PARTITIONS_AHEAD", "2") or "2")
+TRACK_RETENTION_DAYS = int(os.getenv("TRACK_RETENTION_DAYS", "0") or "0")
+
+PARENT = "tracking_points"
+DEFAULT_PARTITION = "tracking_points_default"
+_NAME_RE = re.compile(r"^tracking_points_p(\d{4})_(\d{2})$")
+
+
+def month_start(d) -> date:
+    return date(d.year, d.month, 1)
+
+
+def next_month(d: date) -> date:
+    return date(d.year + (d.month // 12), d.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"tracking_points_p{month.year:04d}_{month.month:02d}"
+
+
+def _existing(db: Session) -> List[str]:
+    return [
+        r[0] for r in db.execute(
+            text("""
+                SELECT c.relname
+                  FROM pg_inherits AS i
+                  JOIN pg_class AS c ON c.oid = i.inhrelid
+                 WHERE i.inhparent = CAST(:parent AS regclass)
+            """),
+            {"parent": PARENT},
+        )
+    ]
+
+
+def _columns(db: Session) -> str:
+    rows = db.execute(
+        text("""
+            SELECT quote_ident(a.attname)
+              FROM pg_attribute AS a
+             WHERE a.attrelid = CAST(:parent AS regclass)
+               AND a.attnum > 0 AND NOT a.attisdropped
+             ORDER BY a.attnum
+        """),
+        {"parent": PARENT},
+    )
+    return ", ".join(r[0] for r in rows)
+
+
+def _create_partition(db: Session, name: str, month: date) -> int:
+    """
+    Создаёт секцию месяца. Если в default-секции уже лежат точки этого
+    диапазона (задача пропустила месяц или шла до миграции), Postgres не даст
+    создать секцию — тогда default отсоединяется, секция создаётся, точки
+    переносятся в неё и default подключается обратно. Возвращает число
+    перенесённых строк. Перенос держит ACCESS EXCLUSIVE на tracking_points.
+    """
+    lo, hi = month.isoformat(), next_month(month).isoformat()
+    bounds = {"lo": lo, "hi": hi}
+    create = text(f"""
+        CREATE TABLE IF NOT EXISTS {name}
+            PARTITION OF {PARENT}
+            FOR VALUES FROM ('{lo}') TO ('{hi}')
+    """)
+    stray = db.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi)"),
+        bounds,
+    ).scalar()
+    if not stray:
+        db.execute(create)
+        return 0
+
+    cols = _columns(db)
+    db.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {DEFAULT_PARTITION}"))
+    db.execute(create)
+    moved = db.execute(
+        text(f"""
+            INSERT INTO {name} ({cols})
+            SELECT {cols} FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi
+        """),
+        bounds,
+    ).rowcount or 0
+    db.execute(
+        text(f"DELETE FROM {DEFAULT_PARTITION} WHERE ts >= :lo AND ts < :hi"), bounds)
+    db.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    return moved
+
+
+def ensure_partitions(db: Session, months_ahead: int = TRACK_PARTITIONS_AHEAD) -> List[str]:
+    """
+    Создаёт недостающие месячные секции с текущего месяца. Возвращает созданные.
+    Каждая секция — своя транзакция: сбой одной не мешает остальным и
+    следующим запускам.
+    """
+    existing = set(_existing(db))
+    created = []
+    month = month_start(datetime.utcnow())
+    for _ in range(max(0, months_ahead) + 1):
+        name = partition_name(month)
+        if name not in existing:
+            try:
+                moved = _create_partition(db, name, month)
+                db.commit()
+                created.append(name)
+                if moved:
+                    print(f"[TRACK_PARTITIONS] {name}: moved {moved} rows from {DEFAULT_PARTITION}")
+            except Exception as e:
+                db.rollback()
+                print(f"[TRACK_PARTITIONS] {name} not created: {e}")
+        month = next_month(month)
+    return created
+
+
+def drop_expired(db: Session, retention_days: int = TRACK_RETENTION_DAYS) -> List[str]:
+    """Удаляет секции, целиком вышедшие за срок хранения. Возвращает удалённые."""
+    if retention_days <= 0:
+        return []
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    dropped = []
+    for name in _existing(db):
+        m = _NAME_RE.match(name)
+        if not m:
+            continue
+        upper = next_month(date(int(m.group(1)), int(m.group(2)), 1))
+        if datetime(upper.year, upper.month, upper.day) <= cutoff:
+            db.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            dropped.append(name)
+    db.execute(
+        text(f"DELETE FROM {DEFAULT_PARTITION} WHERE ts < :cutoff"),
+        {"cutoff": cutoff},
+    )
+    db.commit()
+    return dropped
+
+
+def maintain(db: Session) -> dict:
+    return {"created": ensure_partitions(db), "dropped": drop_expired(db)}
@@ -0,0 +1,256 @@
+"""
+Счётчики непрочитанного (таблица unread_counters) для эндпоинтов, которые
+фронт опрашивает постоянно: /my-chats/unread_count, /matches/unread_count,
+/orders/{id}/new_matches_count, /transport/{id}/new_matches_count.
+Чтение — один lookup по первичному ключу вместо COUNT(*).
+
+(kind, key):
+  ("chats", "")           — непрочитанные сообщения во всех чатах пользователя;
+                            дельты считает chat_inbox.refresh();
+  ("match", related_id)   — непрочитанные AUTO_MATCH-уведомления по заявке/транспорту.
+
+Счётчики меняются в той же транзакции, что и исходные данные:
+- ORM-изменения Notification ловит after_flush (install_hooks);
+- bulk mark-read передаёт строки из UPDATE ... RETURNING в notifications_read().
+После commit новые значения уходят в WS уведомлений:
+    {"event": "unread_counters", "chats": 3, "matches": {"<related_id>": 1}}
+reconcile() периодически пересчитывает всё из первоисточников (order_reminders).
+"""
+from __future__ import annotations
+
+import asyncio
+import enum
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+KIND_CHATS = "chats"
+KIND_MATCH = "match"
+
+_SESSION_KEY = "_unread_counters_push"
+
+
+def get(db: Session, user_id: int, kind: str, key: str = "") -> int:
+    value = db.execute(
+        text("""
+            SELECT count FROM unread_counters
+             WHERE user_id = :user_id AND kind = :kind AND key = :key
+        """),
+        {"user_id": user_id, "kind": kind, "key": key},
+    ).scalar()
+    return max(0, int(value or 0))
+
+
+def get_match(db: Session, user_id: int, transport_id=None, order_id=None) -> int:
+    """Непрочитанные AUTO_MATCH по related_id (как фильтры старых COUNT-запросов)."""
+    keys = {str(v) for v in (transport_id, order_id) if v}
+    if len(keys) != 1:
+        # Оба параметра и разные: related_id не может совпасть с обоими
+        return 0
+    return get(db, user_id, KIND_MATCH, keys.pop())
+
+
+def add(db: Session, kind: str, deltas: Dict[Tuple[int, str], int]) -> None:
+    """
+    Применяет дельты {(user_id, key): delta} (не уходя ниже нуля) и
+    запоминает новые значения для пуша после commit.
+    """
+    deltas = {k: d for k, d in deltas.items() if d}
+    if not deltas:
+        return
+    conn = db.connection()
+    params = {
+        "kind": kind,
+        "user_ids": [uid for uid, _ in deltas],
+        "keys": [str(key) for _, key in deltas],
+        "deltas": list(deltas.values()),
+        "now": datetime.utcnow(),
+    }
+    rows = list(conn.execute(
+        text("""
+            UPDATE unread_counters AS c
+               SET count = GREATEST(0, c.count + v.delta), updated_at = :now
+              FROM unnest(CAST(:user_ids AS integer[]), CAST(:keys AS text[]),
+                          CAST(:deltas AS integer[])) AS v(user_id, key, delta)
+             WHERE c.user_id = v.user_id AND c.kind = :kind AND c.key = v.key
+            RETURNING c.user_id, c.key, c.count
+        """),
+        params,
+    ))
+    seen = {(r.user_id, r.key) for r in rows}
+    missing = [(uid, str(key), d) for (uid, key), d in deltas.items()
+               if (uid, str(key)) not in seen]
+    if missing:
+        rows += list(conn.execute(
+            text("""
+                INSERT INTO unread_counters (user_id, kind, key, count, updated_at)
+                SELECT v.user_id, :kind, v.key, GREATEST(0, v.delta), :now
+                  FROM unnest(CAST(:user_ids AS integer[]), CAST(:keys AS text[]),
+                              CAST(:deltas AS integer[])) AS v(user_id, key, delta)
+                ON CONFLICT (user_id, kind, key) DO UPDATE
+                   SET count = GREATEST(0, unread_counters.count + excluded.count),
+                       updated_at = excluded.updated_at
+                RETURNING user_id, key, count
+            """),
+            {**params,
+             "user_ids": [m[0] for m in missing],
+             "keys": [m[1] for m in missing],
+             "deltas": [m[2] for m in missing]},
+        ))
+    pending = db.info.setdefault(_SESSION_KEY, {})
+    for r in rows:
+        pending[(r.user_id, kind, r.key)] = int(r.count)
+
+
+def _is_auto_match(notif_type) -> bool:
+    name = notif_type.name if isinstance(
+        notif_type, enum.Enum) else str(notif_type or "")
+    return name == "AUTO_MATCH"
+
+
+def notifications_read(db: Session, rows: Iterable) -> None:
+    """
+    Строки (user_id, type, related_id), только что помеченные прочитанными
+    bulk-UPDATE'ом (см. RETURNING в эндпоинтах mark-read).
+    """
+    deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+    for user_id, notif_type, related_id in rows:
+        if related_id and _is_auto_match(notif_type):
+            deltas[(user_id, related_id)] -= 1
+    add(db, KIND_MATCH, deltas)
+
+
+def _after_flush(session, flush_context) -> None:
+    from sqlalchemy import inspect as sa_inspect
+    from models import Notification
+
+    deltas: Dict[Tuple[int, str], int] = defaultdict(int)
+
+    def _track(obj, delta):
+        if obj.related_id and _is_auto_match(obj.type):
+            deltas[(obj.user_id, str(obj.related_id))] += delta
+
+    for obj in session.new:
+        if isinstance(obj, Notification) and not obj.read:
+            _track(obj, +1)
+    for obj in session.dirty:
+        if not isinstance(obj, Notification):
+            continue
+        hist = sa_inspect(obj).attrs.read.history
+        if not hist.has_changes():
+            continue
+        was_unread = not (hist.deleted[0] if hist.deleted else False)
+        if was_unread and obj.read:
+            _track(obj, -1)
+        elif not was_unread and not obj.read:
+            _track(obj, +1)
+    for obj in session.deleted:
+        if isinstance(obj, Notification) and not obj.read:
+            _track(obj, -1)
+    add(session, KIND_MATCH, deltas)
+
+
+def _push(user_id: int, event: dict) -> None:
+    from notifications import push_notification
+    try:
+        loop = asyncio.get_running_loop()
+        loop.create_task(push_notification(user_id, event))
+    except RuntimeError:
+        try:
+            asyncio.run(push_notification(user_id, event))
+        except Exception as e:
+            print("[UNREAD] push failed (asyncio.run):", e)
+    except Exception as e:
+        print("[UNREAD] push failed:", e)
+
+
+def _after_commit(session) -> None:
+    pending = session.info.pop(_SESSION_KEY, None)
+    if not pending:
+        return
+    events: Dict[int, dict] = {}
+    for (user_id, kind, key), count in pending.items():
+        event = events.setdefault(user_id, {"event": "unread_counters"})
+        if kind == KIND_CHATS:
+            event["chats"] = count
+        else:
+            event.setdefault("matches", {})[key] = count
+    for user_id, event in events.items():
+        _push(user_id, event)
+
+
+def _after_rollback(session) -> None:
+    session.info.pop(_SESSION_KEY, None)
+
+
+_hooks_installed = False
+
+
+def install_hooks() -> None:
+    """Подписывает все ORM-сессии: счётчики уведомлений и пуш после commit."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session as _Session
+
+    event.listen(_Session, "after_flush", _after_flush)
+    event.listen(_Session, "after_commit", _after_commit)
+    event.listen(_Session, "after_rollback", _after_rollback)
+    _hooks_installed = True
+
+
+def reconcile(db: Session, user_id: Optional[int] = None) -> int:
+    """
+    Пересчитывает счётчики из chat_inbox и notifications и исправляет
+    разошедшиеся (гонки параллельных транзакций). Возвращает число исправленных.
+    """
+    now = datetime.utcnow()
+    scope = "AND user_id = :user_id" if user_id is not None else ""
+    params = {"now": now, "user_id": user_id,
+              "chats": KIND_CHATS, "match": KIND_MATCH}
+    fixed = 0
+    res = db.execute(
+        text(f"""
+            INSERT INTO unread_counters (user_id, kind, key, count, updated_at)
+            SELECT user_id, :chats, '', sum(unread_count), :now
+              FROM chat_inbox
+             WHERE true {scope}
+             GROUP BY user_id
+            UNION ALL
+            SELECT user_id, :match, related_id, count(*), :now
+              FROM notifications
+             WHERE type = 'AUTO_MATCH' AND read = false
+               AND related_id IS NOT NULL {scope}
+             GROUP BY user_id, related_id
+            ON CONFLICT (user_id, kind, key) DO UPDATE
+               SET count = excluded.count, updated_at = excluded.updated_at
+             WHERE unread_counters.count IS DISTINCT FROM excluded.count
+        """),
+        params,
+    )
+    fixed += res.rowcount or 0
+    # Источника больше нет (всё прочитано/удалено) — обнуляем
+    res = db.execute(
+        text(f"""
+            UPDATE unread_counters AS c
+               SET count = 0, updated_at = :now
+             WHERE c.count <> 0 {scope.replace("user_id", "c.user_id")}
+               AND NOT (
+                   (c.kind = :chats AND EXISTS (
+                        SELECT 1 FROM chat_inbox AS i
+                         WHERE i.user_id = c.user_id AND i.unread_count > 0))
+                OR (c.kind = :match AND EXISTS (
+                        SELECT 1 FROM notifications AS n
+                         WHERE n.user_id = c.user_id AND n.related_id = c.key
+                           AND n.type = 'AUTO_MATCH' AND n.read = false))
+               )
+        """),
+        params,
+    )
+    fixed += res.rowcount or 0
+    db.commit()
+    return fixed
@@ -0,0 +1,156 @@
+"""
+Брокер WS-событий между воркерами uvicorn.
+
+Сокеты живут в памяти процесса (ws_events.active_connections,
+notifications.user_notification_connections), поэтому событие из воркера A
+не доходило до сокета, который держит воркер B. Теперь ws_emit_to_chat и
+push_notification:
+  1) сразу доставляют событие своим локальным сокетам;
+  2) при WS_BROKER=redis публикуют его в канал WS_BROKER_CHANNEL.
+Каждый воркер один раз подписывается на канал (поток-подписчик) и
+доставляет чужие события только своим локальным сокетам; свои (origin ==
+WORKER_ID) пропускает — они уже доставлены на шаге 1.
+Публикация тоже идёт из своего потока: publish() вызывается из event loop
+(ws_emit_to_chat, push_notification) и только кладёт сообщение в очередь,
+поэтому медленный или недоступный Redis не останавливает сокеты.
+
+WS_BROKER=local (по умолчанию) — прежнее поведение одного процесса.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import uuid
+from typing import Optional
+
+WS_BROKER = (os.getenv("WS_BROKER", "local") or "local").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+WS_BROKER_CHANNEL = os.getenv("WS_BROKER_CHANNEL", "transinfo:ws") or "transinfo:ws"
+# Сколько событий ждут публикации; при переполнении новые отбрасываются
+WS_BROKER_QUEUE_MAX = int(os.getenv("WS_BROKER_QUEUE_MAX", "10000") or "10000")
+
+# Уникален для процесса: отличаем свои публикации от чужих
+WORKER_ID = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+TARGET_CHAT = "chat"
+TARGET_USER = "user"
+
+_redis = None
+_redis_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_subscriber_started = False
+_outgoing: "queue.Queue[str]" = queue.Queue(maxsize=WS_BROKER_QUEUE_MAX)
+_publisher_started = False
+_publisher_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return WS_BROKER == "redis"
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                import redis
+                _redis = redis.Redis.from_url(
+                    REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+    return _redis
+
+
+def publish(target: str, target_id, payload: dict) -> None:
+    """
+    Отдаёт событие остальным воркерам (локальная доставка — на вызывающем).
+    Не блокирует: сообщение уходит в Redis из потока-публикатора.
+    """
+    if not enabled():
+        return
+    try:
+        message = json.dumps(
+            {"o": WORKER_ID, "t": target, "id": str(target_id), "p": payload},
+            default=str, ensure_ascii=False,
+        )
+    except Exception as e:
+        print("[WS_BROKER] publish failed:", e)
+        return
+    _ensure_publisher()
+    try:
+        _outgoing.put_nowait(message)
+    except queue.Full:
+        print("[WS_BROKER] publish queue full, event dropped")
+
+
+def _publisher_loop() -> None:
+    while True:
+        message = _outgoing.get()
+        try:
+            _client().publish(WS_BROKER_CHANNEL, message)
+        except Exception as e:
+            print("[WS_BROKER] publish failed:", e)
+
+
+def _ensure_publisher() -> None:
+    global _publisher_started
+    if _publisher_started:
+        return
+    with _publisher_lock:
+        if _publisher_started:
+            return
+        _publisher_started = True
+        threading.Thread(target=_publisher_loop, name="ws-broker-publisher",
+                         daemon=True).start()
+
+
+async def _deliver(target: str, target_id: str, payload: dict) -> None:
+    if target == TARGET_CHAT:
+        from ws_events import deliver_to_chat
+        await deliver_to_chat(int(target_id), payload)
+    elif target == TARGET_USER:
+        from notifications import deliver_to_user
+        await deliver_to_user(target_id, payload)
+
+
+def _dispatch(raw) -> None:
+    try:
+        msg = json.loads(raw)
+    except Exception:
+        return
+    if not isinstance(msg, dict) or msg.get("o") == WORKER_ID:
+        return
+    loop = _loop
+    if loop is None or loop.is_closed():
+        return
+    asyncio.run_coroutine_threadsafe(
+        _deliver(msg.get("t"), msg.get("id"), msg.get("p") or {}), loop)
+
+
+def _subscriber_loop() -> None:
+    import time
+    while True:
+        try:
+            pubsub = _client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(WS_BROKER_CHANNEL)
+            print(f"[WS_BROKER] {WORKER_ID} subscribed to {WS_BROKER_CHANNEL}")
+            while True:
+                # таймаут — чтобы не зависнуть на мёртвом соединении навсегда
+                msg = pubsub.get_message(timeout=30.0)
+                if msg and msg.get("type") == "message":
+                    _dispatch(msg.get("data"))
+        except Exception as e:
+            print("[WS_BROKER] subscriber error, reconnecting:", e)
+            time.sleep(1.0)
+
+
+def start(loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+    """Вызывать на старте воркера из его event loop."""
+    global _loop, _subscriber_started
+    _loop = loop or asyncio.get_event_loop()
+    if not enabled() or _subscriber_started:
+        return
+    _subscriber_started = True
+    threading.Thread(target=_subscriber_loop, name="ws-broker-subscriber",
+                     daemon=True).start()
@@ -11,7 +11,7 @@ from starlette.websockets import WebSocketState
 from database import SessionLocal
 from models import User as UserModel, ChatParticipant, ChatMessage
 import models  # для ChatMessageReaction
-from notifications import push_notification, user_notification_connections
+from notifications import push_notification
 from auth import get_token_from_header_or_cookie
 from ws_events import register_ws, unregister_ws, ws_emit_to_chat, active_connections
 
@@ -259,30 +259,22 @@ async def chat_websocket(websocket: WebSocket, chat_id: int):
                         try:
                             participants = db.query(ChatParticipant).filter_by(
                                 chat_id=chat_id).all()
-                            delivered = 0
+                            notified = 0
                             for p in participants:
                                 u_id = p.user_id
                                 if u_id == user.id:
                                     continue
-                                sockets = user_notification_connections.get(
-                                    str(u_id)) or set()
-                                for gws in list(sockets):
-                                    try:
-                                        await gws.send_json({
-                                            "event": "incoming_call",
-                                            "chat_id": chat_id,
-                                            "from_user_id": user.id,
-                                            "media": media,
-                                            "sdp": data.get("sdp")
-                                        })
-                                        delivered += 1
-                                    except Exception:
-                                        try:
-                                            sockets.discard(gws)
-                                        except Exception:
-                                            pass
+                                # через push_notification — дойдёт и до сокетов других воркеров
+                                await push_notification(u_id, {
+                                    "event": "incoming_call",
+                                    "chat_id": chat_id,
+                                    "from_user_id": user.id,
+                                    "media": media,
+                                    "sdp": data.get("sdp")
+                                })
+                                notified += 1
                             print(
-                                f"[CALL] incoming_call chat={chat_id} delivered={delivered}")
+                                f"[CALL] incoming_call chat={chat_id} notified={notified}")
                         except Exception as e:
                             print(
                                 f"[WS][CALL] incoming_call notify error: {e}")
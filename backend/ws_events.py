@@ -1,13 +1,16 @@
 from __future__ import annotations
 
 from typing import Dict, List, Optional, Set
-import json
 from fastapi import WebSocket
 
+import ws_broker
+import ws_outbox
+
 # Активные WS-соединения по chat_id
 active_connections: Dict[int, List[WebSocket]] = {}
 
 def register_ws(chat_id: int, ws: WebSocket) -> None:
+    ws_outbox.attach(ws, ws_outbox.WS_CHAT_OVERFLOW)
     active_connections.setdefault(chat_id, [])
     if ws not in active_connections[chat_id]:
         active_connections[chat_id].append(ws)
@@ -19,6 +22,7 @@ def unregister_ws(chat_id: int, ws: WebSocket) -> None:
             return
         if ws in conns:
             conns.remove(ws)
+            ws_outbox.detach(ws)
         if not conns:
             active_connections.pop(chat_id, None)
     except Exception:
@@ -26,7 +30,8 @@ def unregister_ws(chat_id: int, ws: WebSocket) -> None:
 
 async def ws_emit_to_chat(chat_id: int, arg1, arg2=None, skip: Optional[WebSocket] = None):
     """
-    Рассылает JSON всем активным WS-подключениям данного чата.
+    Рассылает JSON всем активным WS-подключениям данного чата — локальным
+    сразу, в остальных воркерах через ws_broker.
     Бэк-совместимо поддерживает оба варианта вызова:
       1) ws_emit_to_chat(chat_id, {"event": "name", ...}, skip=?)
       2) ws_emit_to_chat(chat_id, "name", {"...": "..."}, skip=?)
@@ -39,23 +44,20 @@ async def ws_emit_to_chat(chat_id: int, arg1, arg2=None, skip: Optional[WebSocke
     else:
         payload = arg1 if isinstance(arg1, dict) else {}
 
+    await deliver_to_chat(chat_id, payload, skip=skip)
+    ws_broker.publish(ws_broker.TARGET_CHAT, chat_id, payload)
+
+
+async def deliver_to_chat(chat_id: int, payload: dict, skip: Optional[WebSocket] = None):
+    """
+    Доставка только сокетам этого процесса (вызывается и брокером): кадр
+    ставится в очереди соединений (ws_outbox), медленный клиент не тормозит остальных.
+    """
     conns = list(active_connections.get(chat_id, []))
     if not conns:
         return
-    drop: List[WebSocket] = []
-    for ws in conns:
-        if skip is not None and ws is skip:
-            continue
-        try:
-            await ws.send_json(payload)
-        except TypeError:
-            # как запасной вариант приводим к json-строке (например, при datetime)
-            try:
-                await ws.send_json(json.loads(json.dumps(payload, default=str)))
-            except Exception:
-                drop.append(ws)
-        except Exception:
-            drop.append(ws)
+    drop = ws_outbox.broadcast(
+        conns, payload, policy=ws_outbox.WS_CHAT_OVERFLOW, skip=skip)
     if drop:
         for ws in drop:
             unregister_ws(chat_id, ws)
@@ -0,0 +1,184 @@
+"""
+Исходящие очереди WebSocket-соединений.
+
+Раньше рассылки (ws_emit_to_chat, push_notification, точки трекинга) по
+очереди делали `await ws.send_json(...)` на каждом сокете — один медленный
+мобильный клиент задерживал доставку всем остальным. Теперь у каждого
+соединения своя ограниченная очередь (Outbox) и writer-задача, которая
+живёт, пока очередь не опустеет. Рассылка сериализует payload один раз и
+кладёт одну и ту же строку во все очереди, не дожидаясь отправки.
+
+Переполнение очереди (WS_SEND_QUEUE_MAX кадров):
+  drop_oldest — выбросить самый старый кадр (точки трекинга: важна свежая);
+  disconnect  — закрыть соединение 1013, клиент переподключится и
+                перечитает состояние по REST (чаты, уведомления).
+Очередь привязана к event loop соединения: кадры из других потоков
+(APScheduler, asyncio.run) передаются через call_soon_threadsafe.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import weakref
+from collections import deque
+from typing import Iterable, List, Optional
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "256") or "256")
+# Дольше этого один send — клиент считается мёртвым
+WS_SEND_TIMEOUT_SEC = float(os.getenv("WS_SEND_TIMEOUT_SEC", "10") or "10")
+WS_CHAT_OVERFLOW = os.getenv(
+    "WS_CHAT_OVERFLOW", OVERFLOW_DISCONNECT) or OVERFLOW_DISCONNECT
+WS_TRACK_OVERFLOW = os.getenv(
+    "WS_TRACK_OVERFLOW", OVERFLOW_DROP_OLDEST) or OVERFLOW_DROP_OLDEST
+
+# 1013 Try Again Later
+_CLOSE_OVERLOADED = 1013
+
+_counters = {
+    "enqueued": 0,
+    "sent": 0,
+    "dropped": 0,
+    "overflow_disconnects": 0,
+    "send_errors": 0,
+}
+_outboxes: "weakref.WeakSet[Outbox]" = weakref.WeakSet()
+
+
+def encode(payload) -> str:
+    """Один раз на рассылку; формат как у WebSocket.send_json."""
+    if isinstance(payload, str):
+        return payload
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+class Outbox:
+    """Очередь кадров одного соединения и её writer."""
+
+    def __init__(self, ws, policy: str, loop: asyncio.AbstractEventLoop,
+                 maxsize: int = WS_SEND_QUEUE_MAX):
+        self.ws = ws
+        self.policy = policy
+        self.loop = loop
+        self.maxsize = max(1, maxsize)
+        self.queue = deque()
+        self.closed = False
+        self._writer = None
+
+    def offer(self, data: str) -> bool:
+        """Ставит кадр в очередь. False — соединение мёртвое/закрыто."""
+        if self.closed:
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not self.loop:
+            if self.loop.is_closed():
+                self.closed = True
+                return False
+            self.loop.call_soon_threadsafe(self._offer_local, data)
+            return True
+        return self._offer_local(data)
+
+    def _offer_local(self, data: str) -> bool:
+        if self.closed:
+            return False
+        if len(self.queue) >= self.maxsize:
+            if self.policy == OVERFLOW_DROP_OLDEST:
+                self.queue.popleft()
+                _counters["dropped"] += 1
+            else:
+                _counters["overflow_disconnects"] += 1
+                _counters["dropped"] += len(self.queue) + 1
+                self.close(code=_CLOSE_OVERLOADED)
+                return False
+        self.queue.append(data)
+        _counters["enqueued"] += 1
+        if self._writer is None:
+            self._writer = self.loop.create_task(self._drain())
+        return True
+
+    async def _drain(self) -> None:
+        try:
+            while self.queue and not self.closed:
+                data = self.queue.popleft()
+                try:
+                    await asyncio.wait_for(self.ws.send_text(data), WS_SEND_TIMEOUT_SEC)
+                    _counters["sent"] += 1
+                except Exception:
+                    _counters["send_errors"] += 1
+                    self.close()
+                    return
+        finally:
+            self._writer = None
+
+    def close(self, code: Optional[int] = None) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if code is not None:
+            self.loop.create_task(self._close_ws(code))
+
+    async def _close_ws(self, code: int) -> None:
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+
+def attach(ws, policy: str = WS_CHAT_OVERFLOW) -> Outbox:
+    """Создаёт очередь соединения; вызывать из эндпоинта (в его event loop)."""
+    box = getattr(ws, "_ws_outbox", None)
+    if box is None or box.closed:
+        box = Outbox(ws, policy, asyncio.get_running_loop())
+        ws._ws_outbox = box
+        _outboxes.add(box)
+    return box
+
+
+def detach(ws) -> None:
+    box = getattr(ws, "_ws_outbox", None)
+    if box is not None:
+        box.close()
+
+
+def send(ws, payload, policy: str = WS_CHAT_OVERFLOW) -> bool:
+    box = getattr(ws, "_ws_outbox", None)
+    if box is None:
+        box = attach(ws, policy)
+    return box.offer(encode(payload))
+
+
+def broadcast(sockets: Iterable, payload, *, policy: str = WS_CHAT_OVERFLOW,
+              skip=None) -> List:
+    """
+    Ставит payload (сериализованный один раз) в очереди всех sockets.
+    Возвращает соединения, которые надо убрать из реестров.
+    """
+    data = encode(payload)
+    dead = []
+    for ws in sockets:
+        if skip is not None and ws is skip:
+            continue
+        box = getattr(ws, "_ws_outbox", None)
+        if box is None:
+            box = attach(ws, policy)
+        if not box.offer(data):
+            dead.append(ws)
+    return dead
+
+
+def stats() -> dict:
+    depths = [len(b.queue) for b in list(_outboxes) if not b.closed]
+    return {
+        "connections": len(depths),
+        "queue_depth_total": sum(depths),
+        "queue_depth_max": max(depths) if depths else 0,
+        "queue_max": WS_SEND_QUEUE_MAX,
+        **_counters,
+    }
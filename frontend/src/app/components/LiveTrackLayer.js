@@ -42,6 +42,36 @@ const makeLivePin = (heading = 0) =>
         iconAnchor: [13, 13]
     });
 
+// Кадр {type:"points"} от сервера: координаты в polyline6, время — смещения от ts0
+const decodePointsFrame = (msg) => {
+    const str = msg.polyline6 || "";
+    const out = [];
+    const t0 = Date.parse(msg.ts0 + (/[zZ]|[+-]\d\d:\d\d$/.test(msg.ts0) ? "" : "Z"));
+    let idx = 0, lat = 0, lng = 0;
+    const next = () => {
+        let shift = 0, result = 0, b;
+        do {
+            b = str.charCodeAt(idx++) - 63;
+            result |= (b & 0x1f) << shift;
+            shift += 5;
+        } while (b >= 0x20);
+        return (result & 1) ? ~(result >> 1) : (result >> 1);
+    };
+    for (let i = 0; idx < str.length; i++) {
+        lat += next();
+        lng += next();
+        out.push({
+            lat: lat / 1e6,
+            lng: lng / 1e6,
+            ts: new Date(t0 + (msg.dt_ms?.[i] || 0)).toISOString(),
+            speed: msg.speed?.[i] ?? null,
+            heading: msg.heading?.[i] ?? null,
+            accuracy: msg.accuracy?.[i] ?? null,
+        });
+    }
+    return out;
+};
+
 export default function LiveTrackLayer({ sessionId, token, shareToken }) {
     const map = useMap();
     const [points, setPoints] = useState([]);
@@ -84,6 +114,10 @@ export default function LiveTrackLayer({ sessionId, token, shareToken }) {
                     setPoints(Array.isArray(msg.points) ? msg.points : []);
                 } else if (msg.type === "point") {
                     setPoints(prev => [...prev, msg.point].slice(-1000));
+                } else if (msg.type === "points") {
+                    // несколько точек одним кадром (сервер ограничивает частоту)
+                    const batch = decodePointsFrame(msg);
+                    setPoints(prev => [...prev, ...batch].slice(-1000));
                 }
             } catch (err) {
                 console.error("[LiveTrackLayer] parse error", err);